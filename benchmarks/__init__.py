@@ -0,0 +1 @@
+"""Benchmarks for the performance sensitive parts of slashbot."""
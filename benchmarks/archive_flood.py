@@ -0,0 +1,83 @@
+"""Benchmark the message archive under a synthetic flood of messages.
+
+Messages are recorded as fast as possible whilst a background task flushes
+them to a temporary database, as the chatbot cog does. The time to record a
+message, which is on the hot path, and the write throughput are reported.
+
+Usage:
+    python benchmarks/archive_flood.py [--messages N] [--channels N] [--batch-size N]
+"""
+
+import argparse
+import asyncio
+import datetime
+import random
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from slashbot.cogs.chatbot.archive import MessageArchiver
+from slashbot.database import DatabaseSQL, DeclarativeBase
+
+WORDS = "the wifi is down again who wants lunch at noon did anyone see the match last night what a game".split()
+
+
+def fake_message(i: int, num_channels: int) -> SimpleNamespace:
+    """Create a fake Discord message."""
+    return SimpleNamespace(
+        id=i,
+        channel=SimpleNamespace(id=i % num_channels),
+        created_at=datetime.datetime.now(tz=datetime.UTC),
+    )
+
+
+async def flood(num_messages: int, num_channels: int, batch_size: int, flush_interval: float) -> None:
+    """Record messages whilst flushing them in the background, and report the throughput."""
+    with tempfile.TemporaryDirectory() as directory:
+        db = DatabaseSQL(Path(directory) / "archive.db", DeclarativeBase)
+        await db.init()
+        archiver = MessageArchiver(max_buffered=num_messages)
+        done = asyncio.Event()
+
+        async def flush_loop() -> None:
+            while not done.is_set():
+                await archiver.flush(db, batch_size=batch_size)
+                await asyncio.sleep(flush_interval)
+            await archiver.flush(db, batch_size=batch_size)
+
+        flusher = asyncio.create_task(flush_loop())
+        start = time.perf_counter()
+        record_time = 0.0
+        for i in range(num_messages):
+            content = " ".join(random.choices(WORDS, k=12))
+            message = fake_message(i, num_channels)
+            record_start = time.perf_counter()
+            archiver.record(message, author=f"user{i % 50}", content=content)
+            record_time += time.perf_counter() - record_start
+            if i % 1000 == 0:
+                await asyncio.sleep(0)
+        done.set()
+        await flusher
+        elapsed = time.perf_counter() - start
+
+        search_start = time.perf_counter()
+        results = await db.search_archive(0, "wifi lunch", limit=10)
+        search_time = time.perf_counter() - search_start
+        await db.engine.dispose()
+
+    print(f"Messages:          {num_messages} over {num_channels} channel(s), batch size {batch_size}")  # noqa: T201
+    print(f"Record (hot path): {record_time / num_messages * 1e6:.2f} us per message")  # noqa: T201
+    print(f"Write throughput:  {archiver.num_archived / elapsed:,.0f} messages/s ({elapsed:.2f} s)")  # noqa: T201
+    print(f"Dropped:           {archiver.num_dropped}")  # noqa: T201
+    print(f"Search:            {search_time * 1000:.1f} ms for {len(results)} result(s)")  # noqa: T201
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--flush-interval", type=float, default=0.05)
+    args = parser.parse_args()
+    asyncio.run(flood(args.messages, args.channels, args.batch_size, args.flush_interval))
@@ -0,0 +1,47 @@
+"""add message archive
+
+Revision ID: 5e2b9d41a7c3
+Revises: c0736c9f5911
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+from slashbot.database.sql_models import ARCHIVE_FTS_DDL
+
+# revision identifiers, used by Alembic.
+revision: str = "5e2b9d41a7c3"
+down_revision: Union[str, Sequence[str], None] = "c0736c9f5911"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "archived_messages",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("message_id", sa.Integer(), nullable=False),
+        sa.Column("channel_id", sa.Integer(), nullable=False),
+        sa.Column("author", sa.String(length=64), nullable=False),
+        sa.Column("content", sa.String(length=4000), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("message_id"),
+    )
+    op.create_index(
+        "ix_archived_messages_channel_created_at", "archived_messages", ["channel_id", "created_at"], unique=False
+    )
+    for statement in ARCHIVE_FTS_DDL:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.execute("DROP TABLE IF EXISTS archived_messages_fts")
+    op.drop_index("ix_archived_messages_channel_created_at", table_name="archived_messages")
+    op.drop_table("archived_messages")
@@ -1,6 +1,6 @@
 """Slashbot discord bot."""
 
-from . import llm, bot, cli, clock, convertors, database, errors, logger, markov, scraper, settings, watchers
+from . import llm, bot, cli, clock, convertors, database, errors, logger, markov, scraper, settings, transport, watchers
 
 __all__ = [
     "llm",
@@ -14,5 +14,6 @@ __all__ = [
     "markov",
     "scraper",
     "settings",
+    "transport",
     "watchers",
 ]
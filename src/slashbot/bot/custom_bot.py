@@ -9,6 +9,7 @@ from slashbot import markov
 from slashbot.database import DatabaseSQL, DeclarativeBase
 from slashbot.logger import Logger
 from slashbot.settings import BotSettings
+from slashbot.transport import TRANSPORTS
 
 
 class CustomInteractionBot(InteractionBot, Logger):
@@ -32,6 +33,7 @@ class CustomInteractionBot(InteractionBot, Logger):
         super().__init__(**kwargs)
         Logger.__init__(self)
         self.cleanup_functions = []
+        self.add_function_to_cleanup("Closing shared HTTP clients", TRANSPORTS.aclose, None)
         self.times_connected = 0
         self.db = DatabaseSQL(BotSettings.files.database, DeclarativeBase)
         self.use_markov_cache = enable_markov_cache and markov.MARKOV_MODEL
@@ -56,8 +58,8 @@ class CustomInteractionBot(InteractionBot, Logger):
         """
         self.cleanup_functions.append({"message": message, "function": function, "args": args})
 
-    async def close(self) -> None:
-        """Clean up things on close."""
+    async def run_cleanup_functions(self) -> None:
+        """Run the functions in the cleanup list, e.g. before a restart."""
         for function in self.cleanup_functions:
             if function["message"]:
                 self.log_info("%s", function["message"])
@@ -67,6 +69,9 @@ class CustomInteractionBot(InteractionBot, Logger):
             else:
                 await function["function"]()
 
+    async def close(self) -> None:
+        """Clean up things on close."""
+        await self.run_cleanup_functions()
         await super().close()
 
     async def initialise_database(self) -> None:
@@ -15,6 +15,9 @@ from slashbot.bot.custom_bot import CustomInteractionBot
 from slashbot.bot.custom_cog import CustomCog
 from slashbot.bot.custom_command import slash_command_with_cooldown
 from slashbot.bot.custom_types import ApplicationCommandInteraction
+from slashbot.llm.clients.local import LOCAL_SERVER
+from slashbot.llm.clients.resilience import get_all_resilience
+from slashbot.llm.telemetry import TELEMETRY
 from slashbot.settings import BotSettings
 
 JERMA_GIFS = list(Path("data/images").glob("jerma*.gif"))
@@ -366,6 +369,50 @@ class AdminTools(CustomCog):
             content=f"```{last_error}```" if last_error else "There have been no errors since the last restart.",
         )
 
+    @slash_command_with_cooldown(name="llm_health")
+    async def print_llm_health(self, inter: ApplicationCommandInteraction) -> None:
+        """Print the health of each LLM provider which has been used.
+
+        Parameters
+        ----------
+        inter : ApplicationCommandInteraction
+            The interaction to respond to.
+
+        """
+        providers = get_all_resilience()
+        message = (
+            "\n".join(f"```{provider.describe()}```" for provider in providers)
+            if providers
+            else "No LLM clients have been created since the last restart."
+        )
+        if LOCAL_SERVER.timings:
+            timings = "\n".join(f"{model}: {timing}" for model, timing in LOCAL_SERVER.timings.items())
+            message += f"\n```Local model timings\n{timings}```"
+        await inter.response.send_message(message, ephemeral=True)
+
+    @slash_command_with_cooldown(name="llm_usage")
+    async def print_llm_usage(
+        self,
+        inter: ApplicationCommandInteraction,
+        group_by: str = commands.Param(
+            choices=["model", "channel"],
+            default="model",
+            description="Whether to show the usage of each model, or each channel",
+        ),
+    ) -> None:
+        """Print the token usage, cost and latency of LLM requests since the last restart.
+
+        Parameters
+        ----------
+        inter : ApplicationCommandInteraction
+            The interaction to respond to.
+        group_by : str
+            Whether to show the usage of each model, or each channel.
+
+        """
+        usage = TELEMETRY.describe("channel" if group_by == "channel" else "model", limit=10)
+        await inter.response.send_message(usage[: BotSettings.discord.max_chars], ephemeral=True)
+
     @slash_command_with_cooldown()
     async def restart_bot(
         self,
@@ -402,6 +449,7 @@ class AdminTools(CustomCog):
         else:
             await inter.response.send_message("Restarting the bot...", ephemeral=True)
 
+        await self.bot.run_cleanup_functions()
         restart_bot(arguments)
 
     @slash_command_with_cooldown(name="update_bot")
@@ -0,0 +1,148 @@
+"""Batched writes of channel messages to the message archive.
+
+Messages are recorded in memory as they arrive, which is cheap enough to do
+for every message, and are written to the database in batches by a
+background task so the database is never written to on the hot path.
+"""
+
+import datetime
+from collections import deque
+from collections.abc import AsyncIterator
+from typing import Any
+
+import disnake
+from sqlalchemy.exc import SQLAlchemyError
+
+from slashbot.cogs.chatbot.chat_registry import SummaryMessage
+from slashbot.database import ArchivedMessageSQL, DatabaseSQL
+from slashbot.logger import Logger
+
+
+def to_utc(time: datetime.datetime) -> datetime.datetime:
+    """Convert a time to a naive UTC time, as stored in the archive.
+
+    Parameters
+    ----------
+    time : datetime.datetime
+        The time. A naive time is assumed to be in UTC.
+
+    Returns
+    -------
+    datetime.datetime
+        The time in UTC, without a timezone.
+
+    """
+    if time.tzinfo is None:
+        return time
+    return time.astimezone(datetime.UTC).replace(tzinfo=None)
+
+
+async def as_summary_messages(
+    batches: AsyncIterator[list[ArchivedMessageSQL]],
+) -> AsyncIterator[list[SummaryMessage]]:
+    """Convert batches of archived messages for the summariser.
+
+    Parameters
+    ----------
+    batches : AsyncIterator[list[ArchivedMessageSQL]]
+        The batches of archived messages.
+
+    Yields
+    ------
+    list[SummaryMessage]
+        The messages in each batch.
+
+    """
+    async for batch in batches:
+        yield [
+            SummaryMessage(
+                user=message.author,
+                content=message.content,
+                timestamp=message.created_at.replace(tzinfo=datetime.UTC).timestamp(),
+            )
+            for message in batch
+        ]
+
+
+class MessageArchiver(Logger):
+    """Buffers messages for the message archive, and writes them in batches."""
+
+    def __init__(self, *, max_buffered: int) -> None:
+        """Initialise an empty buffer.
+
+        Parameters
+        ----------
+        max_buffered : int
+            The maximum number of messages to buffer. If the database can't
+            keep up, or is unavailable, the oldest messages are dropped.
+
+        """
+        super().__init__(prepend_msg="[MessageArchiver]")
+        self._buffer: deque[dict[str, Any]] = deque(maxlen=max_buffered)
+        self.num_archived = 0
+        self.num_dropped = 0
+
+    def __len__(self) -> int:
+        """Get the number of messages waiting to be written."""
+        return len(self._buffer)
+
+    def record(self, message: disnake.Message, *, author: str, content: str) -> None:
+        """Record a message to be archived.
+
+        Parameters
+        ----------
+        message : disnake.Message
+            The message.
+        author : str
+            The name to archive the message under.
+        content : str
+            The content to archive, e.g. with mentions replaced.
+
+        """
+        if len(self._buffer) == self._buffer.maxlen:
+            self.num_dropped += 1
+        self._buffer.append(
+            {
+                "message_id": message.id,
+                "channel_id": message.channel.id,
+                "author": author,
+                "content": content,
+                "created_at": to_utc(message.created_at),
+            }
+        )
+
+    async def flush(self, db: DatabaseSQL, *, batch_size: int) -> int:
+        """Write the buffered messages to the archive.
+
+        Messages recorded whilst the buffer is being written are written in
+        the same flush. If a batch can't be written, it is put back in the
+        buffer to be retried on the next flush.
+
+        Parameters
+        ----------
+        db : DatabaseSQL
+            The database to write to.
+        batch_size : int
+            The number of messages to write in each transaction.
+
+        Returns
+        -------
+        int
+            The number of messages written.
+
+        """
+        num_written = 0
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(batch_size, len(self._buffer)))]
+            try:
+                await db.archive_messages(batch)
+            except SQLAlchemyError as exc:
+                self.log_error("Unable to archive %d message(s): %s", len(batch), exc)
+                # If the buffer is full, the newest messages are dropped
+                self.num_dropped += max(0, len(self._buffer) + len(batch) - self._buffer.maxlen)
+                self._buffer.extendleft(reversed(batch))
+                break
+            num_written += len(batch)
+
+        self.num_archived += num_written
+        return num_written
@@ -1,9 +1,23 @@
+import asyncio
+import contextlib
+import datetime
+import sqlite3
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterable, AsyncIterator, Callable
 from dataclasses import dataclass
+from typing import Self
 
 import disnake
 
-from slashbot.llm import GenerationFailureError, TextGenerationInput, read_in_prompt
-from slashbot.llm.text_generator import TextGenerator
+from slashbot.cogs.chatbot.chat_store import ChannelRecord, ChatStore
+from slashbot.cogs.chatbot.retrieval import BM25Index
+from slashbot.cogs.chatbot.summariser import map_reduce_summary, map_reduce_summary_stream
+from slashbot.llm import TextGenerationInput, read_in_prompt
+from slashbot.llm.conversation import ConversationMessage
+from slashbot.llm.text_generator import HedgeSlotFactory, TextGenerator
+from slashbot.llm.tokenizer import PROMPT_TOKEN_CACHE
+from slashbot.logger import Logger
 from slashbot.settings import BotSettings
 
 DEFAULT_SYSTEM_PROMPT = read_in_prompt(BotSettings.cogs.chatbot.default_chat_prompt)
@@ -20,6 +34,9 @@ If a user's latest message clearly pivots to engage with another user's topic ra
 in the context of the topic they are now discussing. Use common sense to determine whether a message is a continuation
 of the user's own thread or a deliberate shift to join another conversation/query/prompt from another user.
 """.replace("\n", "")
+PROMPT_TOKEN_CACHE.add_variant_suffix(USER_CONVERSATION_CONTEXT_PROMPT)
+
+type SlotFactory = Callable[[], contextlib.AbstractAsyncContextManager]
 
 
 @dataclass
@@ -29,10 +46,19 @@ class SummaryMessage:
     user: str
     content: str
     tokens: int = 0
+    timestamp: float = 0.0
 
 
 class AIChatSummary(TextGenerator):
-    """Dataclass for generating AI summaries for text channels."""
+    """Dataclass for generating AI summaries for text channels.
+
+    The summary is a rolling summary. It is cached along with a watermark of
+    the messages it covers, and is updated by summarising only the messages
+    added since, together with the previous summary.
+
+    The history is also indexed, so messages relevant to a prompt can be
+    recalled for the chatbot.
+    """
 
     SUMMARY_PROMPT = read_in_prompt("data/prompts/_summarise.yaml").prompt
 
@@ -43,6 +69,13 @@ class AIChatSummary(TextGenerator):
         self._token_size = 0
         self._token_window_size = token_window_size
         self._history_context = []
+        self._index: BM25Index[SummaryMessage] = BM25Index()
+
+        self._summary = ""
+        self._num_messages_added = 0
+        self._summary_watermark = 0
+        self._last_message_time = time.monotonic()
+        self._summary_lock = asyncio.Lock()
 
     # --------------------------------------------------------------------------
 
@@ -59,9 +92,50 @@ class AIChatSummary(TextGenerator):
 
     # --------------------------------------------------------------------------
 
+    @property
+    def memory_bytes(self) -> int:
+        """Get the size of the history held in memory, in bytes."""
+        return sum(len(message.user) + len(message.content) for message in self._history_context)
+
+    @property
+    def summary(self) -> str:
+        """Get the rolling summary, which may not include the newest messages."""
+        return self._summary
+
+    @property
+    def num_unsummarised(self) -> int:
+        """Get the number of messages added since the summary was updated."""
+        return self._num_messages_added - self._summary_watermark
+
+    @property
+    def is_summary_stale(self) -> bool:
+        """Check if there are messages which are not in the cached summary."""
+        return self.num_unsummarised > 0
+
+    @property
+    def is_summarising(self) -> bool:
+        """Check if the summary is being updated."""
+        return self._summary_lock.locked()
+
+    @property
+    def quiet_time(self) -> float:
+        """Get the time, in seconds, since a message was added."""
+        return time.monotonic() - self._last_message_time
+
+    # --------------------------------------------------------------------------
+
     def _remove_message_from_history_context(self, index: int) -> None:
         removed_message = self._history_context.pop(index)
         self._token_size -= removed_message.tokens
+        if index == 0:
+            self._index.popleft()
+        else:
+            self._rebuild_index()
+
+    def _rebuild_index(self) -> None:
+        self._index.clear()
+        for message in self._history_context:
+            self._index.append(message, f"{message.user} {message.content}")
 
     def _shrink_history_to_token_window_size(self) -> None:
         while self._token_size > self._token_window_size and len(self) > 1:
@@ -80,11 +154,64 @@ class AIChatSummary(TextGenerator):
         """
         self._shrink_history_to_token_window_size()
         if message.tokens == 0:
-            try:
-                message.tokens = self.count_tokens_for_message(message.content)
-            except GenerationFailureError:
-                message.tokens = len(message.content)
+            message.tokens = self.count_tokens_for_message(message.content)
         self._history_context.append(message)
+        self._index.append(message, f"{message.user} {message.content}")
+        self._token_size += message.tokens
+        self._num_messages_added += 1
+        self._last_message_time = time.monotonic()
+
+    def restore_history(
+        self, messages: list[SummaryMessage], *, summary: str = "", num_unsummarised: int | None = None
+    ) -> None:
+        """Replace the history with previously recorded messages.
+
+        Parameters
+        ----------
+        messages : list[SummaryMessage]
+            The messages, which already have their tokens counted.
+        summary : str
+            The rolling summary of the messages, if there is one.
+        num_unsummarised : int | None
+            The number of messages, at the end of the history, which are not
+            in the summary. If None, none of the messages are.
+
+        """
+        self._history_context = list(messages)
+        self._rebuild_index()
+        self._token_size = sum(message.tokens for message in messages)
+        self._num_messages_added = len(messages)
+        self._summary = summary
+        self._summary_watermark = len(messages) - (len(messages) if num_unsummarised is None else num_unsummarised)
+
+    @classmethod
+    def from_record(cls, record: ChannelRecord, *, token_window_size: int, extra_print: str = "") -> Self:
+        """Restore a summary object from the chat store.
+
+        Parameters
+        ----------
+        record : ChannelRecord
+            The stored channel.
+        token_window_size : int
+            The maximum number of tokens in the history.
+        extra_print : str
+            Additional information to print at the start of the log message.
+
+        Returns
+        -------
+        AIChatSummary
+            The restored summary object.
+
+        """
+        summary = cls(token_window_size=token_window_size, extra_print=extra_print)
+        summary.set_model(record.summary_model)
+        summary.restore_history(
+            [SummaryMessage(**message) for _, message, _ in record.summary_messages],
+            summary=record.summary,
+            num_unsummarised=record.num_unsummarised if record.summary else None,
+        )
+
+        return summary
 
     def get_history(self, *, amount: int = 0) -> list[SummaryMessage]:
         """Get the current history.
@@ -106,32 +233,180 @@ class AIChatSummary(TextGenerator):
 
         return self._history_context
 
-    async def generate_summary(self, *, requesting_user: str | None = None) -> str:
+    def recall(self, query: str, *, k: int, skip_newest: int = 0) -> list[SummaryMessage]:
+        """Find the messages in the history most relevant to a query.
+
+        Parameters
+        ----------
+        query : str
+            The text to find relevant messages for, e.g. a prompt.
+        k : int
+            The maximum number of messages to return.
+        skip_newest : int
+            The number of the most recent messages to exclude.
+
+        Returns
+        -------
+        list[SummaryMessage]
+            The relevant messages, oldest first.
+
+        """
+        return self._index.search(query, k=k, skip_newest=skip_newest)
+
+    async def _request_summary(self, prompt: str, slot: SlotFactory) -> str:
+        """Send a summarisation prompt to the model.
+
+        Parameters
+        ----------
+        prompt : str
+            The prompt, including the messages to summarise.
+        slot : SlotFactory
+            Creates the context to run the request in, e.g. a scheduler slot.
+
+        Returns
+        -------
+        str
+            The response from the model.
+
+        """
+        request = self.create_request_json(TextGenerationInput(prompt), system_prompt=self.SUMMARY_PROMPT)
+        async with slot():
+            response = await self.send_response_request(request)
+
+        return response.message
+
+    async def _summarise(self, messages: list[SummaryMessage], *, previous_summary: str = "", slot: SlotFactory) -> str:
+        """Summarise messages, using map-reduce if there are too many for one request.
+
+        Parameters
+        ----------
+        messages : list[SummaryMessage]
+            The messages to summarise, oldest first.
+        previous_summary : str
+            The summary of the conversation before the messages.
+        slot : SlotFactory
+            Creates the context to run each request in.
+
+        Returns
+        -------
+        str
+            The summary.
+
+        """
+        return await map_reduce_summary(
+            messages,
+            lambda prompt: self._request_summary(prompt, slot),
+            self.count_tokens_for_message,
+            chunk_tokens=BotSettings.cogs.chatbot.summary_chunk_tokens,
+            max_fan_in=BotSettings.cogs.chatbot.summary_max_fan_in,
+            max_concurrency=BotSettings.cogs.chatbot.max_concurrent_requests,
+            previous_summary=previous_summary,
+        )
+
+    async def summarise_stream(
+        self, batches: AsyncIterable[list[SummaryMessage]], *, slot: SlotFactory = contextlib.nullcontext
+    ) -> str:
+        """Summarise messages which are read in batches, e.g. from the archive.
+
+        The summary is not cached.
+
+        Parameters
+        ----------
+        batches : AsyncIterable[list[SummaryMessage]]
+            The messages to summarise, oldest first, in batches.
+        slot : SlotFactory
+            Creates the context to run each request in.
+
+        Returns
+        -------
+        str
+            The summary, or an empty string if there were no messages.
+
+        """
+        return await map_reduce_summary_stream(
+            batches,
+            lambda prompt: self._request_summary(prompt, slot),
+            self.count_tokens_for_message,
+            chunk_tokens=BotSettings.cogs.chatbot.summary_chunk_tokens,
+            max_fan_in=BotSettings.cogs.chatbot.summary_max_fan_in,
+            max_concurrency=BotSettings.cogs.chatbot.max_concurrent_requests,
+        )
+
+    async def update_summary(self, *, slot: SlotFactory = contextlib.nullcontext) -> str:
+        """Update the rolling summary with the messages added since it was made.
+
+        Only the new messages, and the previous summary, are sent to the
+        model. If there are no new messages, the cached summary is returned
+        without making a request. Messages which are added whilst the summary
+        is being updated are included in the next update.
+
+        Parameters
+        ----------
+        slot : SlotFactory
+            Creates the context to run each request in, e.g. a scheduler slot.
+
+        Returns
+        -------
+        str
+            The updated summary.
+
+        """
+        async with self._summary_lock:
+            num_messages_added = self._num_messages_added
+            num_new = min(self.num_unsummarised, len(self._history_context))
+            if num_new <= 0:
+                return self._summary
+
+            self._summary = await self._summarise(
+                self._history_context[-num_new:], previous_summary=self._summary, slot=slot
+            )
+            self._summary_watermark = num_messages_added
+            self.log_debug("Updated summary with %d new message(s)", num_new)
+
+            return self._summary
+
+    async def generate_summary(
+        self, *, requesting_user: str | None = None, hours: float = 0, slot: SlotFactory = contextlib.nullcontext
+    ) -> str:
         """Generate a summary of the current history.
 
+        By default, the rolling summary is updated, if it is stale, and
+        returned.
+
         Parameters
         ----------
         requesting_user : str | None
             The user requesting the summary, to referred to in the summary as
-            "you".
+            "you". The summary is rewritten for the user, which is not cached.
+        hours : float
+            If greater than 0, summarise the messages from this many hours ago
+            instead, which is not cached.
+        slot : SlotFactory
+            Creates the context to run each request in, e.g. a scheduler slot.
 
         """
-        history_message = "Summarise the following conversation between multiple users:\n" + "\n".join(
-            [f"{message.user}: {message.content}" for message in self._history_context]
-        )
-        if requesting_user:
-            history_message += (
-                f".\nPlease refer to me, {requesting_user}, as 'you' in the summary like we were having a conversation."
+        if hours > 0:
+            cutoff = time.time() - hours * 3600
+            summary = await self._summarise(
+                [message for message in self._history_context if message.timestamp >= cutoff], slot=slot
             )
-        request = self.create_request_json(TextGenerationInput(history_message), system_prompt=self.SUMMARY_PROMPT)
-        response = await self.send_response_request(request)
-
-        return response.message
+        else:
+            summary = await self.update_summary(slot=slot)
+        if not requesting_user:
+            return summary
+
+        return await self._request_summary(
+            f"Rewrite this summary, referring to me, {requesting_user}, as 'you' like we were having a "
+            f"conversation:\n{summary}",
+            slot,
+        )
 
 
 class AIChat(TextGenerator):
     """AI Conversation class for an LLM chatbot."""
 
+    COMPACTION_PROMPT = read_in_prompt("data/prompts/_compact.yaml").prompt
+
     def __init__(
         self, *, system_prompt: str | None = None, prompt_name: str = "unset name", extra_print: str | None = None
     ) -> None:
@@ -151,6 +426,7 @@ class AIChat(TextGenerator):
         """
         extra_print = f"[ChatObject:{extra_print}] " if extra_print else ""
         super().__init__(extra_print=extra_print)
+        self._is_compacting = False
 
         if system_prompt:
             self.set_chat_prompt(system_prompt, prompt_name=prompt_name)
@@ -168,8 +444,54 @@ class AIChat(TextGenerator):
         """
         return self.size_messages
 
+    @property
+    def needs_compaction(self) -> bool:
+        """Check if the conversation has grown enough to be compacted."""
+        return (
+            BotSettings.cogs.chatbot.enable_context_compaction
+            and not self._is_compacting
+            and self.size_tokens
+            >= BotSettings.cogs.chatbot.context_compaction_threshold * BotSettings.cogs.chatbot.token_window_size
+        )
+
     # --------------------------------------------------------------------------
 
+    async def compact_history(self) -> bool:
+        """Replace the oldest turns of the conversation with a digest.
+
+        The digest is generated without holding up the conversation, which
+        can carry on in the meantime. The turns are only replaced if they are
+        still the oldest in the conversation once the digest is ready.
+
+        Returns
+        -------
+        bool
+            True if the conversation was compacted.
+
+        """
+        if self._is_compacting:
+            return False
+        messages = self._client.select_messages_to_compact(
+            int(BotSettings.cogs.chatbot.context_compaction_target * BotSettings.cogs.chatbot.token_window_size)
+        )
+        if not messages:
+            return False
+
+        self._is_compacting = True
+        try:
+            transcript = "\n".join(f"{message.role}: {message.text}" for message in messages)
+            request = self.create_request_json(
+                TextGenerationInput(f"Write a digest of the start of our conversation:\n{transcript}"),
+                system_prompt=self.COMPACTION_PROMPT,
+            )
+            response = await self.send_response_request(request)
+        finally:
+            self._is_compacting = False
+
+        # The model may have been changed whilst the digest was generated, but
+        # the conversation is shared between clients
+        return self._client.compact_context(messages, response.message)
+
     def reset_history(self) -> None:
         """Reset the conversation history back to the system prompt."""
         self.set_system_prompt(self.system_prompt, prompt_name=self.system_prompt_name)
@@ -177,6 +499,9 @@ class AIChat(TextGenerator):
     async def send_message(
         self,
         messages: TextGenerationInput | list[TextGenerationInput],
+        *,
+        recalled: str = "",
+        hedge_slot: HedgeSlotFactory | None = None,
     ) -> str:
         """Add a new message to the conversation history.
 
@@ -185,6 +510,12 @@ class AIChat(TextGenerator):
         messages : ContextMessage | list[ContextMessage]
             Input message(s), from the user, including attached images and
             videos.
+        recalled : str
+            Earlier messages from the channel relevant to the input, which
+            are sent with the input but are not kept in the history.
+        hedge_slot : HedgeSlotFactory | None
+            Creates the context a hedged request runs in, e.g. a scheduler
+            slot. If None, hedged requests are always made.
 
         Returns
         -------
@@ -192,11 +523,32 @@ class AIChat(TextGenerator):
             The message response from the AI.
 
         """
-        response = await self.generate_response_with_context(messages)
-        self._token_size = response.tokens_used
+        response = await self.generate_response_with_context(messages, recalled=recalled, hedge_slot=hedge_slot)
 
         return response.message
 
+    def stream_message(
+        self, messages: TextGenerationInput | list[TextGenerationInput], *, recalled: str = ""
+    ) -> AsyncIterator[str]:
+        """Add a new message to the conversation history and stream the response.
+
+        Parameters
+        ----------
+        messages : TextGenerationInput | list[TextGenerationInput]
+            Input message(s), from the user, including attached images and
+            videos.
+        recalled : str
+            Earlier messages from the channel relevant to the input, which
+            are sent with the input but are not kept in the history.
+
+        Returns
+        -------
+        AsyncIterator[str]
+            An iterator over the response from the AI, as it is generated.
+
+        """
+        return self.stream_response_with_context(messages, recalled=recalled)
+
     async def send_raw_request(self, content: list[dict] | dict) -> str:
         """Send a request to the API client.
 
@@ -210,6 +562,33 @@ class AIChat(TextGenerator):
 
         return response.message
 
+    @classmethod
+    def from_record(cls, record: ChannelRecord, *, extra_print: str | None = None) -> Self:
+        """Restore a conversation from the chat store.
+
+        Parameters
+        ----------
+        record : ChannelRecord
+            The stored channel.
+        extra_print : str, optional
+            Additional information to print at the start of the log message.
+
+        Returns
+        -------
+        AIChat
+            The restored conversation.
+
+        """
+        chat = cls(extra_print=extra_print)
+        chat.set_model(record.chat_model)
+        # The stored system prompt already includes the conversation context prompt
+        chat.set_system_prompt(record.system_prompt, prompt_name=record.prompt_name)
+        chat.restore_context(
+            [ConversationMessage.from_dict(message, tokens=tokens) for _, message, tokens in record.chat_messages]
+        )
+
+        return chat
+
     def set_chat_prompt(self, new_prompt: str, *, prompt_name: str = "unset name") -> None:
         """Set the system prompt and clear the conversation.
 
@@ -224,18 +603,99 @@ class AIChat(TextGenerator):
         self.set_system_prompt(new_prompt + USER_CONVERSATION_CONTEXT_PROMPT, prompt_name=prompt_name)
 
 
-class ChatRegistry:
+@dataclass
+class RegistryMetrics:
+    """Residency metrics for the chat registry.
+
+    Attributes
+    ----------
+    resident : int
+        The number of channels held in memory.
+    hibernated : int
+        The number of channels hibernated to disk.
+    hibernations : int
+        The number of times a channel has been hibernated.
+    rehydrations : int
+        The number of times a channel has been restored from disk.
+    total_rehydration_time : float
+        The total time (seconds) spent restoring channels.
+    max_rehydration_time : float
+        The longest time (seconds) spent restoring a channel.
+
+    """
+
+    resident: int = 0
+    hibernated: int = 0
+    hibernations: int = 0
+    rehydrations: int = 0
+    total_rehydration_time: float = 0.0
+    max_rehydration_time: float = 0.0
+
+    @property
+    def mean_rehydration_time(self) -> float:
+        """Get the mean time, in seconds, spent restoring a channel."""
+        return self.total_rehydration_time / self.rehydrations if self.rehydrations else 0.0
+
+
+class ChatRegistry(Logger):
     """Manages per-channel AIChat and AIChatSummary instances.
 
     One :class:`~slashbot.ai.AIChat` and one
     :class:`~slashbot.ai.AIChatSummary` are created lazily per Discord channel
     and stored by channel ID.
+
+    The number of channels, and the memory they use, held in memory is
+    bounded. When over budget, the least recently active channels are
+    hibernated to the chat store, as are channels which have been idle for a
+    while. Channels which are busy, e.g. waiting for a response, are never
+    hibernated. Channels in memory are periodically flushed to the store, so
+    every channel survives a restart. A channel which is not in memory is
+    restored from the store transparently the next time it is used.
     """
 
-    def __init__(self) -> None:
-        """Initialise empty chat and summary stores."""
+    def __init__(
+        self,
+        store: ChatStore | None = None,
+        *,
+        max_resident_channels: int = BotSettings.cogs.chatbot.max_resident_chats,
+        max_memory_bytes: int = BotSettings.cogs.chatbot.max_resident_chat_memory_mb * 1024 * 1024,
+    ) -> None:
+        """Initialise the registry, with no channels in memory.
+
+        Only the IDs of the channels in the store are read, the channels
+        themselves are loaded on first use.
+
+        Parameters
+        ----------
+        store : ChatStore | None
+            The store to persist channels to. If None, the store at
+            `BotSettings.files.chat_database` is used.
+        max_resident_channels : int
+            The maximum number of channels to hold in memory.
+        max_memory_bytes : int
+            The maximum size of the contexts and histories held in memory.
+
+        """
+        super().__init__(prepend_msg="[ChatRegistry]")
+        self.store = store or ChatStore(BotSettings.files.chat_database)
+        self.max_resident_channels = max_resident_channels
+        self.max_memory_bytes = max_memory_bytes
         self.chats: dict[int, AIChat] = {}
         self.channel_histories: dict[int, AIChatSummary] = {}
+        self.is_busy: Callable[[int], bool] = lambda _: False
+
+        self._metrics = RegistryMetrics()
+        self._last_active: OrderedDict[int, float] = OrderedDict()
+        self._labels: dict[int, str] = {}
+        self._hibernated: set[int] = self.store.channel_ids()
+        self._dirty: set[int] = set()
+
+    @property
+    def metrics(self) -> RegistryMetrics:
+        """Get the residency metrics of the registry."""
+        self._metrics.resident = len(self._last_active)
+        self._metrics.hibernated = len(self._hibernated)
+        return self._metrics
 
     @staticmethod
     def _context_id(obj: int | disnake.Message | disnake.ApplicationCommandInteraction) -> int:
@@ -276,6 +736,182 @@ class ChatRegistry:
             return str(obj.channel.recipient)
         return str(obj.channel.id)
 
+    def _channel_memory(self, cid: int) -> int:
+        """Get the memory used by a channel's context and history.
+
+        Parameters
+        ----------
+        cid : int
+            The channel ID.
+
+        Returns
+        -------
+        int
+            The size, in bytes, of the context and history held in memory.
+
+        """
+        size = 0
+        if cid in self.chats:
+            size += self.chats[cid].memory_usage.inline_bytes
+        if cid in self.channel_histories:
+            size += self.channel_histories[cid].memory_bytes
+        return size
+
+    def _touch(self, cid: int) -> None:
+        """Mark a channel as the most recently active.
+
+        Parameters
+        ----------
+        cid : int
+            The channel ID.
+
+        """
+        self._last_active[cid] = time.monotonic()
+        self._last_active.move_to_end(cid)
+        self._dirty.add(cid)
+
+    def _rehydrate(self, cid: int) -> None:
+        """Restore a hibernated channel into memory.
+
+        Parameters
+        ----------
+        cid : int
+            The channel ID. Nothing happens if the channel is not hibernated.
+
+        """
+        if cid not in self._hibernated:
+            return
+
+        start = time.perf_counter()
+        self._hibernated.discard(cid)
+        try:
+            record = self.store.load(cid)
+            if record is None:
+                return
+            chat = AIChat.from_record(record, extra_print=record.label) if record.chat_model is not None else None
+            summary = (
+                AIChatSummary.from_record(
+                    record, token_window_size=BotSettings.cogs.chatbot.summary_window_size, extra_print=record.label
+                )
+                if record.summary_model is not None
+                else None
+            )
+        except (sqlite3.Error, KeyError, NotImplementedError, TypeError, ValueError) as exc:
+            self.log_error("Unable to restore channel %d, starting afresh: %s", cid, exc)
+            self.store.invalidate([cid])
+            return
+
+        self._labels[cid] = record.label
+        if chat is not None:
+            chat.channel_id = cid
+            self.chats[cid] = chat
+        if summary is not None:
+            summary.channel_id = cid
+            self.channel_histories[cid] = summary
+        self.store.adopt(cid, record, chat, summary)
+        self._touch(cid)
+
+        elapsed = time.perf_counter() - start
+        self._metrics.rehydrations += 1
+        self._metrics.total_rehydration_time += elapsed
+        self._metrics.max_rehydration_time = max(self._metrics.max_rehydration_time, elapsed)
+        self.log_debug("Restored channel %d in %.1f ms", cid, elapsed * 1000)
+
+        self.enforce_budget(keep=cid)
+
+    def hibernate(self, cid: int) -> bool:
+        """Move a channel's chat and summary out of memory, into the store.
+
+        Parameters
+        ----------
+        cid : int
+            The channel ID.
+
+        Returns
+        -------
+        bool
+            True if the channel was hibernated, or False if it is busy or
+            could not be saved.
+
+        """
+        if cid not in self._last_active or self.is_busy(cid):
+            return False
+        if not self.store.save(
+            cid, self._labels.get(cid, str(cid)), self.chats.get(cid), self.channel_histories.get(cid)
+        ):
+            return False
+
+        self.chats.pop(cid, None)
+        self.channel_histories.pop(cid, None)
+        self.store.forget(cid)
+        del self._last_active[cid]
+        self._dirty.discard(cid)
+        self._hibernated.add(cid)
+        self._metrics.hibernations += 1
+        self.log_debug("Hibernated channel %d", cid)
+
+        return True
+
+    def mark_changed(self, cid: int) -> None:
+        """Mark a channel as changed, without marking it as active.
+
+        Parameters
+        ----------
+        cid : int
+            The channel ID.
+
+        """
+        if cid in self._last_active:
+            self._dirty.add(cid)
+
+    async def flush(self) -> None:
+        """Write the changes to the channels used since the last flush to the store."""
+        dirty = [cid for cid in self._dirty if cid in self._last_active]
+        self._dirty.clear()
+        await self.store.flush(
+            {
+                cid: (self._labels.get(cid, str(cid)), self.chats.get(cid), self.channel_histories.get(cid))
+                for cid in dirty
+            }
+        )
+
+    def enforce_budget(self, *, keep: int | None = None) -> None:
+        """Hibernate the least recently active channels until within budget.
+
+        Parameters
+        ----------
+        keep : int | None
+            A channel which should not be hibernated, e.g. the one which has
+            just been used.
+
+        """
+        memory = {cid: self._channel_memory(cid) for cid in self._last_active}
+        total_memory = sum(memory.values())
+        for cid in list(self._last_active):
+            if len(self._last_active) <= self.max_resident_channels and total_memory <= self.max_memory_bytes:
+                break
+            if cid != keep and self.hibernate(cid):
+                total_memory -= memory[cid]
+
+    def hibernate_idle_channels(self, idle_time: float) -> int:
+        """Hibernate channels which have not been active for a while.
+
+        Parameters
+        ----------
+        idle_time : float
+            The time, in seconds, since the last activity after which a
+            channel is hibernated.
+
+        Returns
+        -------
+        int
+            The number of channels hibernated.
+
+        """
+        cutoff = time.monotonic() - idle_time
+        idle = [cid for cid, last_active in self._last_active.items() if last_active < cutoff]
+        return sum(self.hibernate(cid) for cid in idle)
+
     def get_chat_object(self, obj: int | disnake.Message | disnake.ApplicationCommandInteraction) -> AIChat:
         """Retrieve or create the :class:`~slashbot.ai.AIChat` for a channel.
 
@@ -298,15 +934,21 @@ class ChatRegistry:
 
         """
         cid = self._context_id(obj)
+        self._rehydrate(cid)
         if cid not in self.chats:
             if isinstance(obj, int):
                 msg = "No AIChat found for this ID"
                 raise ValueError(msg)
+            self._labels[cid] = self._extra_print(obj)
             self.chats[cid] = AIChat(
                 system_prompt=DEFAULT_SYSTEM_PROMPT.prompt,
                 prompt_name=DEFAULT_SYSTEM_PROMPT.name,
-                extra_print=self._extra_print(obj),
+                extra_print=self._labels[cid],
             )
+            self.chats[cid].channel_id = cid
+            self._touch(cid)
+            self.enforce_budget(keep=cid)
+        self._touch(cid)
         return self.chats[cid]
 
     def get_summary_object(self, obj: int | disnake.Message | disnake.ApplicationCommandInteraction) -> AIChatSummary:
@@ -331,17 +973,95 @@ class ChatRegistry:
 
         """
         cid = self._context_id(obj)
+        self._rehydrate(cid)
         if cid not in self.channel_histories:
             if isinstance(obj, int):
                 msg = "No AIChatSummary found for this ID"
                 raise ValueError(msg)
+            self._labels[cid] = self._extra_print(obj)
             self.channel_histories[cid] = AIChatSummary(
-                token_window_size=BotSettings.cogs.chatbot.token_window_size,
-                extra_print=self._extra_print(obj),
+                token_window_size=BotSettings.cogs.chatbot.summary_window_size,
+                extra_print=self._labels[cid],
             )
+            self.channel_histories[cid].channel_id = cid
+            self._touch(cid)
+            self.enforce_budget(keep=cid)
+        self._touch(cid)
         return self.channel_histories[cid]
 
-    def append_to_history(self, message: disnake.Message, bot_name: str) -> None:
+    def recall(self, obj: int | disnake.Message, query: str) -> str:
+        """Recall earlier messages in a channel which are relevant to a query.
+
+        The most recent messages are skipped, as they are likely to still be
+        in the conversation.
+
+        Parameters
+        ----------
+        obj : int | disnake.Message
+            Used to determine the channel ID.
+        query : str
+            The text to find relevant messages for, e.g. a prompt.
+
+        Returns
+        -------
+        str
+            The relevant messages, formatted to send with the prompt, or an
+            empty string if there are none.
+
+        """
+        if not BotSettings.cogs.chatbot.enable_retrieval:
+            return ""
+        cid = self._context_id(obj)
+        self._rehydrate(cid)
+        summary = self.channel_histories.get(cid)
+        if summary is None:
+            return ""
+
+        messages = summary.recall(
+            query,
+            k=BotSettings.cogs.chatbot.retrieval_top_k,
+            skip_newest=BotSettings.cogs.chatbot.retrieval_skip_recent,
+        )
+        if not messages:
+            return ""
+        lines = "\n".join(
+            f"[{datetime.datetime.fromtimestamp(message.timestamp, tz=datetime.UTC):%Y-%m-%d %H:%M}] "
+            f"{message.user}: {message.content}"
+            if message.timestamp
+            else f"{message.user}: {message.content}"
+            for message in messages
+        )
+
+        return f"Earlier messages in this channel which may be relevant:\n{lines}\n\n"
+
+    def summaries_to_update(self, *, quiet_time: float, min_new_messages: int) -> list[AIChatSummary]:
+        """Get the summaries of quiet channels which have stale summaries.
+
+        Only channels in memory are considered.
+
+        Parameters
+        ----------
+        quiet_time : float
+            The time, in seconds, since the last message for a channel to be
+            quiet.
+        min_new_messages : int
+            The minimum number of messages not in the summary.
+
+        Returns
+        -------
+        list[AIChatSummary]
+            The summaries to update, which are not already being updated.
+
+        """
+        return [
+            summary
+            for summary in self.channel_histories.values()
+            if summary.num_unsummarised >= min_new_messages
+            and summary.quiet_time >= quiet_time
+            and not summary.is_summarising
+        ]
+
+    def append_to_history(self, message: disnake.Message, bot_name: str) -> SummaryMessage:
         """Append a Discord message to the channel's conversation history.
 
         Bot and user mentions are replaced with readable labels before the
@@ -355,14 +1075,21 @@ class ChatRegistry:
             The bot's current display name, used to identify bot-authored
             messages and to replace ``@bot`` mentions in the content.
 
+        Returns
+        -------
+        SummaryMessage
+            The message, as it was recorded.
+
         """
         clean = message.clean_content.replace(f"@{bot_name}", "[directed at me]")
         for user in message.mentions:
             clean = clean.replace(f"@{user.name}", f"[directed at {user.display_name}]")
         summary = self.get_summary_object(message)
-        summary.add_message_to_history(
-            SummaryMessage(
-                user=message.author.display_name if message.author.name != bot_name else "me",
-                content=clean,
-            )
+        recorded = SummaryMessage(
+            user=message.author.display_name if message.author.name != bot_name else "me",
+            content=clean,
+            timestamp=message.created_at.timestamp(),
         )
+        summary.add_message_to_history(recorded)
+
+        return recorded
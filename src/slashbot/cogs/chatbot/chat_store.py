@@ -0,0 +1,454 @@
+"""Write-behind persistence of chat contexts, using SQLite.
+
+The conversation and summary history of each channel are stored in SQLite,
+one row per message, so they survive a restart. Changes are not written as
+they happen. Instead, active channels are flushed periodically and only the
+messages which have been added or removed since the last flush are written.
+
+On start up only the IDs of the stored channels are read, and each channel
+is loaded the first time it is used.
+"""
+
+import asyncio
+import json
+import sqlite3
+import threading
+from collections.abc import Callable
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from slashbot.logger import Logger
+
+if TYPE_CHECKING:
+    from slashbot.cogs.chatbot.chat_registry import AIChat, AIChatSummary
+    from slashbot.llm.conversation import ConversationMessage
+
+CHAT = "chat"
+SUMMARY = "summary"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    label TEXT NOT NULL,
+    chat_model TEXT,
+    system_prompt TEXT,
+    prompt_name TEXT,
+    summary_model TEXT,
+    summary TEXT NOT NULL DEFAULT '',
+    num_unsummarised INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    channel_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    tokens INTEGER NOT NULL,
+    PRIMARY KEY (channel_id, kind, seq)
+);
+"""
+
+# Columns added to the channels table after it was first created, which are
+# added to existing databases when they are opened
+_ADDED_CHANNEL_COLUMNS = {
+    "summary": "TEXT NOT NULL DEFAULT ''",
+    "num_unsummarised": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+@dataclass
+class ChannelRecord:
+    """A channel's conversation and summary history, as stored.
+
+    Attributes
+    ----------
+    label : str
+        The label of the channel, used in log messages.
+    chat_model : str | None
+        The model of the conversation, or None if there is no conversation.
+    system_prompt : str | None
+        The system prompt of the conversation.
+    prompt_name : str | None
+        The name of the system prompt of the conversation.
+    summary_model : str | None
+        The model of the summary history, or None if there is no history.
+    summary : str
+        The rolling summary of the summary history.
+    num_unsummarised : int
+        The number of messages, at the end of the summary history, which are
+        not in the rolling summary.
+    chat_messages : list[tuple[int, dict, int]]
+        The sequence number, message and tokens of each message in the
+        conversation, oldest first. The message is stored in a provider
+        neutral format, see `ConversationMessage.to_dict()`.
+    summary_messages : list[tuple[int, dict, int]]
+        The sequence number, message and tokens of each message in the summary
+        history, oldest first.
+
+    """
+
+    label: str
+    chat_model: str | None
+    system_prompt: str | None
+    prompt_name: str | None
+    summary_model: str | None
+    summary: str = ""
+    num_unsummarised: int = 0
+    chat_messages: list[tuple[int, dict, int]] = field(default_factory=list)
+    summary_messages: list[tuple[int, dict, int]] = field(default_factory=list)
+
+
+@dataclass
+class _ChannelChanges:
+    """The changes to write for a channel."""
+
+    channel_id: int
+    metadata: tuple[str, str | None, str | None, str | None, str | None, str, int] | None
+    rewrite: bool
+    deleted: list[tuple[str, int]]
+    inserted: list[tuple[str, int, str, int]]
+
+
+def _serialise_chat_message(message: "ConversationMessage") -> str:
+    """Serialise a message in a conversation, including any media."""
+    return json.dumps(message.to_dict())
+
+
+def _serialise_summary_message(message: Any) -> str:
+    """Serialise a message in a summary history."""
+    return json.dumps(asdict(message))
+
+
+class ChatStore(Logger):
+    """Incremental, SQLite backed, storage of channel conversations.
+
+    Which messages have been written is tracked by the identity of the
+    message objects held in memory, which are never modified once added to a
+    context. The objects are referenced by the store until their row has been
+    deleted, so an identity is never reused whilst it is tracked.
+    """
+
+    def __init__(self, path: Path) -> None:
+        """Open the database, creating it if it does not exist.
+
+        Parameters
+        ----------
+        path : Path
+            The location of the database.
+
+        """
+        super().__init__(prepend_msg="[ChatStore]")
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript(_SCHEMA)
+            columns = {row[1] for row in self._connection.execute("PRAGMA table_info(channels)")}
+            for column, definition in _ADDED_CHANNEL_COLUMNS.items():
+                if column not in columns:
+                    self._connection.execute(f"ALTER TABLE channels ADD COLUMN {column} {definition}")
+
+        self._written: dict[tuple[int, str], dict[int, Any]] = {}
+        self._next_seq: dict[tuple[int, str], int] = {}
+        self._metadata: dict[int, tuple] = {}
+        self._stale: set[int] = set()
+
+    def channel_ids(self) -> set[int]:
+        """Get the IDs of the stored channels.
+
+        Returns
+        -------
+        set[int]
+            The channel IDs.
+
+        """
+        with self._lock:
+            return {row[0] for row in self._connection.execute("SELECT channel_id FROM channels")}
+
+    def _diff(
+        self, channel_id: int, kind: str, items: list[tuple[Any, int]], serialise: Callable[[Any], str]
+    ) -> tuple[list[tuple[str, int]], list[tuple[str, int, str, int]]]:
+        """Find the messages added and removed since the last write.
+
+        Parameters
+        ----------
+        channel_id : int
+            The channel ID.
+        kind : str
+            The kind of message, either CHAT or SUMMARY.
+        items : list[tuple[Any, int]]
+            The messages currently in memory and the tokens in each.
+        serialise : Callable[[Any], str]
+            The function to serialise a new message.
+
+        Returns
+        -------
+        tuple[list[tuple[str, int]], list[tuple[str, int, str, int]]]
+            The rows to delete, and the rows to insert.
+
+        """
+        key = (channel_id, kind)
+        written = self._written.setdefault(key, {})
+        current = {id(message) for message, _ in items}
+        deleted = [(kind, seq) for seq, message in written.items() if id(message) not in current]
+        for _, seq in deleted:
+            del written[seq]
+
+        # New messages are usually appended, but a compacted conversation has
+        # a new message at the start. The messages after the first new one
+        # are written again, so they are kept in order
+        written_seqs = {id(message): seq for seq, message in written.items()}
+        first_new = next((i for i, (message, _) in enumerate(items) if id(message) not in written_seqs), len(items))
+        for message, _ in items[first_new:]:
+            seq = written_seqs.get(id(message))
+            if seq is not None:
+                deleted.append((kind, seq))
+                del written[seq]
+
+        inserted = []
+        for message, tokens in items[first_new:]:
+            seq = self._next_seq.get(key, 0)
+            self._next_seq[key] = seq + 1
+            written[seq] = message
+            inserted.append((kind, seq, serialise(message), tokens))
+
+        return deleted, inserted
+
+    def _changes(
+        self, channel_id: int, label: str, chat: "AIChat | None", summary: "AIChatSummary | None"
+    ) -> _ChannelChanges:
+        """Find the changes to write for a channel.
+
+        Parameters
+        ----------
+        channel_id : int
+            The channel ID.
+        label : str
+            The label of the channel.
+        chat : AIChat | None
+            The conversation, if there is one.
+        summary : AIChatSummary | None
+            The summary history, if there is one.
+
+        Returns
+        -------
+        _ChannelChanges
+            The changes to write.
+
+        """
+        rewrite = channel_id in self._stale
+        if rewrite:
+            self.forget(channel_id)
+            self._stale.discard(channel_id)
+
+        metadata = (
+            label,
+            chat.model if chat is not None else None,
+            chat.system_prompt if chat is not None else None,
+            chat.system_prompt_name if chat is not None else None,
+            summary.model if summary is not None else None,
+            summary.summary if summary is not None else "",
+            summary.num_unsummarised if summary is not None else 0,
+        )
+        if self._metadata.get(channel_id) == metadata:
+            metadata = None
+        else:
+            self._metadata[channel_id] = metadata
+
+        chat_deleted, chat_inserted = self._diff(
+            channel_id,
+            CHAT,
+            [(message, message.tokens) for message in chat.get_context()] if chat is not None else [],
+            _serialise_chat_message,
+        )
+        summary_deleted, summary_inserted = self._diff(
+            channel_id,
+            SUMMARY,
+            [(message, message.tokens) for message in summary.get_history()] if summary is not None else [],
+            _serialise_summary_message,
+        )
+
+        return _ChannelChanges(
+            channel_id, metadata, rewrite, chat_deleted + summary_deleted, chat_inserted + summary_inserted
+        )
+
+    def _write(self, changes: list[_ChannelChanges]) -> None:
+        """Write changes to the database, in a single transaction.
+
+        Parameters
+        ----------
+        changes : list[_ChannelChanges]
+            The changes for each channel.
+
+        """
+        with self._lock, self._connection:
+            for channel in changes:
+                if channel.rewrite:
+                    self._connection.execute("DELETE FROM messages WHERE channel_id = ?", (channel.channel_id,))
+                if channel.metadata:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO channels (channel_id, label, chat_model, system_prompt, prompt_name, "
+                        "summary_model, summary, num_unsummarised) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (channel.channel_id, *channel.metadata),
+                    )
+                self._connection.executemany(
+                    "DELETE FROM messages WHERE channel_id = ? AND kind = ? AND seq = ?",
+                    [(channel.channel_id, kind, seq) for kind, seq in channel.deleted],
+                )
+                self._connection.executemany(
+                    "INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                    [(channel.channel_id, *row) for row in channel.inserted],
+                )
+
+    def invalidate(self, channel_ids: list[int]) -> None:
+        """Rewrite channels in full on the next write, after a failed write.
+
+        Parameters
+        ----------
+        channel_ids : list[int]
+            The channels to rewrite.
+
+        """
+        for channel_id in channel_ids:
+            self._metadata.pop(channel_id, None)
+            self._stale.add(channel_id)
+
+    def save(self, channel_id: int, label: str, chat: "AIChat | None", summary: "AIChatSummary | None") -> bool:
+        """Write the changes to a channel immediately.
+
+        Parameters
+        ----------
+        channel_id : int
+            The channel ID.
+        label : str
+            The label of the channel.
+        chat : AIChat | None
+            The conversation, if there is one.
+        summary : AIChatSummary | None
+            The summary history, if there is one.
+
+        Returns
+        -------
+        bool
+            True if the changes were written.
+
+        """
+        try:
+            self._write([self._changes(channel_id, label, chat, summary)])
+        except (sqlite3.Error, TypeError, ValueError) as exc:
+            self.log_error("Unable to save channel %d: %s", channel_id, exc)
+            self.invalidate([channel_id])
+            return False
+        return True
+
+    async def flush(self, channels: dict[int, tuple[str, "AIChat | None", "AIChatSummary | None"]]) -> None:
+        """Write the changes to channels, without blocking the event loop.
+
+        Parameters
+        ----------
+        channels : dict[int, tuple[str, AIChat | None, AIChatSummary | None]]
+            The label, conversation and summary history of each channel,
+            keyed by the channel ID.
+
+        """
+        if not channels:
+            return
+        try:
+            changes = [self._changes(channel_id, *channel) for channel_id, channel in channels.items()]
+            await asyncio.to_thread(self._write, changes)
+        except (sqlite3.Error, TypeError, ValueError) as exc:
+            self.log_error("Unable to flush %d channel(s): %s", len(channels), exc)
+            self.invalidate(list(channels))
+            return
+        self.log_debug("Flushed %d channel(s)", len(channels))
+
+    def load(self, channel_id: int) -> ChannelRecord | None:
+        """Read a channel from the database.
+
+        Parameters
+        ----------
+        channel_id : int
+            The channel ID.
+
+        Returns
+        -------
+        ChannelRecord | None
+            The stored channel, or None if it is not stored.
+
+        """
+        with self._lock:
+            metadata = self._connection.execute(
+                "SELECT label, chat_model, system_prompt, prompt_name, summary_model, summary, num_unsummarised "
+                "FROM channels WHERE channel_id = ?",
+                (channel_id,),
+            ).fetchone()
+            if metadata is None:
+                return None
+            rows = self._connection.execute(
+                "SELECT kind, seq, payload, tokens FROM messages WHERE channel_id = ? ORDER BY kind, seq",
+                (channel_id,),
+            ).fetchall()
+
+        record = ChannelRecord(*metadata)
+        for kind, seq, payload, tokens in rows:
+            messages = record.chat_messages if kind == CHAT else record.summary_messages
+            messages.append((seq, json.loads(payload), tokens))
+
+        return record
+
+    def adopt(
+        self, channel_id: int, record: ChannelRecord, chat: "AIChat | None", summary: "AIChatSummary | None"
+    ) -> None:
+        """Track the messages of a channel restored from the database.
+
+        Parameters
+        ----------
+        channel_id : int
+            The channel ID.
+        record : ChannelRecord
+            The stored channel, which was restored.
+        chat : AIChat | None
+            The restored conversation.
+        summary : AIChatSummary | None
+            The restored summary history.
+
+        """
+        self.forget(channel_id)
+        self._metadata[channel_id] = (
+            record.label,
+            record.chat_model,
+            record.system_prompt,
+            record.prompt_name,
+            record.summary_model,
+            record.summary,
+            record.num_unsummarised,
+        )
+        restored = [
+            (CHAT, record.chat_messages, chat.get_context() if chat is not None else []),
+            (SUMMARY, record.summary_messages, summary.get_history() if summary is not None else []),
+        ]
+        for kind, rows, messages in restored:
+            self._written[(channel_id, kind)] = {
+                seq: message for (seq, _, _), message in zip(rows, messages, strict=True)
+            }
+            self._next_seq[(channel_id, kind)] = rows[-1][0] + 1 if rows else 0
+
+    def forget(self, channel_id: int) -> None:
+        """Stop tracking the messages of a channel, once it is out of memory.
+
+        Parameters
+        ----------
+        channel_id : int
+            The channel ID.
+
+        """
+        self._metadata.pop(channel_id, None)
+        for kind in (CHAT, SUMMARY):
+            self._written.pop((channel_id, kind), None)
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self._lock:
+            self._connection.close()
@@ -1,19 +1,28 @@
+import datetime
 import logging
 import random
+import threading
 from textwrap import shorten
 
 import disnake
-from disnake.ext import commands
+from disnake.ext import commands, tasks
 from pyinstrument import Profiler
+from sqlalchemy.exc import SQLAlchemyError
 
 import slashbot.watchers
 from slashbot.bot.custom_bot import CustomInteractionBot
 from slashbot.bot.custom_cog import CustomCog
 from slashbot.bot.custom_command import slash_command_with_cooldown
+from slashbot.cogs.chatbot.archive import MessageArchiver, as_summary_messages, to_utc
 from slashbot.cogs.chatbot.chat_registry import ChatRegistry
 from slashbot.cogs.chatbot.response_generator import ResponseGenerator
+from slashbot.cogs.chatbot.scheduler import Priority, RequestDroppedError
 from slashbot.errors import deferred_error_response
 from slashbot.llm import SUPPORTED_MODELS, GenerationFailureError
+from slashbot.llm.clients.local import LOCAL_SERVER
+from slashbot.llm.request_log import REQUEST_LOG
+from slashbot.llm.telemetry import TELEMETRY
+from slashbot.llm.tokenizer import PROMPT_TOKEN_CACHE
 from slashbot.messages import is_reply_to_slash_command_response, send_message_to_channel
 from slashbot.settings import BotSettings
 
@@ -33,8 +42,23 @@ class ChatBot(CustomCog):
         super().__init__(bot)
         self._chat_registry = ChatRegistry()
         self._responder = ResponseGenerator(self._chat_registry, bot)
+        self._chat_registry.is_busy = self._responder.is_channel_busy
+        self._archiver = MessageArchiver(max_buffered=BotSettings.cogs.chatbot.archive_max_buffered)
+        self.bot.add_function_to_cleanup("Saving chat contexts", self._chat_registry.flush, None)
+        self.bot.add_function_to_cleanup("Writing message archive", self._write_archive, None)
+        self.bot.add_function_to_cleanup("Writing request log", REQUEST_LOG.aclose, None)
+        self.bot.add_function_to_cleanup("Writing LLM telemetry", TELEMETRY.aclose, None)
         self._profiler = Profiler(async_mode="enabled")
 
+        # Count the system prompts in the background, so new conversations
+        # don't have to
+        threading.Thread(
+            target=PROMPT_TOKEN_CACHE.prewarm,
+            args=([BotSettings.cogs.chatbot.default_model], list(slashbot.watchers.AVAILABLE_LLM_PROMPTS.values())),
+            name="PromptTokenPrewarm",
+            daemon=True,
+        ).start()
+
         file_handler = logging.FileHandler("logs/profile.log")
         file_handler.setFormatter(logging.Formatter("%(asctime)s | %(message)s"))
         self._profiler_logger = logging.getLogger("ProfilerLogger")
@@ -74,6 +98,7 @@ class ChatBot(CustomCog):
     async def _append_message_to_history(self, message: disnake.Message) -> None:
         """Record an incoming message in the channel's conversation history.
 
+        The message is also queued to be written to the message archive.
         Application command messages and messages with no text content are
         ignored.
 
@@ -87,7 +112,9 @@ class ChatBot(CustomCog):
             return
         if not message.content:
             return
-        self._chat_registry.append_to_history(message, self.bot.user.name)
+        recorded = self._chat_registry.append_to_history(message, self.bot.user.name)
+        if BotSettings.cogs.chatbot.enable_message_archive:
+            self._archiver.record(message, author=recorded.user, content=recorded.content)
 
     @commands.Cog.listener("on_message")
     async def _listen_for_prompts(self, message: disnake.Message) -> None:
@@ -122,6 +149,90 @@ class ChatBot(CustomCog):
         if random.random() < BotSettings.cogs.chatbot.random_response_chance:
             await self._responder.respond_to_unprompted(message)
 
+    # Tasks --------------------------------------------------------------------
+
+    @tasks.loop(minutes=1)
+    async def hibernate_idle_chats(self) -> None:
+        """Move idle conversations out of memory, and enforce the memory budget."""
+        hibernated = self._chat_registry.hibernate_idle_channels(BotSettings.cogs.chatbot.chat_idle_timeout)
+        self._chat_registry.enforce_budget()
+        if hibernated:
+            self.log_debug("Hibernated %d idle channel(s)", hibernated)
+
+    @tasks.loop(seconds=BotSettings.cogs.chatbot.chat_flush_interval)
+    async def flush_chats(self) -> None:
+        """Write changes to conversations to the chat store."""
+        await self._chat_registry.flush()
+
+    async def _write_archive(self) -> None:
+        """Write the buffered messages to the message archive."""
+        await self._archiver.flush(self.db, batch_size=BotSettings.cogs.chatbot.archive_batch_size)
+
+    @tasks.loop(seconds=BotSettings.cogs.chatbot.archive_flush_interval)
+    async def flush_archive(self) -> None:
+        """Write new messages to the message archive."""
+        await self._write_archive()
+
+    @tasks.loop(seconds=BotSettings.telemetry.flush_interval)
+    async def flush_telemetry(self) -> None:
+        """Write the LLM usage recorded since the last flush to the telemetry database."""
+        await TELEMETRY.flush()
+
+    @flush_telemetry.before_loop
+    async def start_metrics_server(self) -> None:
+        """Start the Prometheus metrics endpoint, if it is enabled."""
+        try:
+            await TELEMETRY.start_server()
+        except OSError as exc:
+            self.log_error("Unable to start the metrics endpoint: %s", exc)
+
+    @tasks.loop(seconds=BotSettings.local_models.keep_alive_interval)
+    async def keep_local_models_warm(self) -> None:
+        """Load the local models at startup, and keep them loaded."""
+        if not BotSettings.local_models.enabled:
+            return
+        await LOCAL_SERVER.warm_up_models()
+
+    @tasks.loop(hours=6)
+    async def prune_archive(self) -> None:
+        """Delete archived messages which are beyond the retention limits."""
+        if not BotSettings.cogs.chatbot.enable_message_archive:
+            return
+        older_than = datetime.datetime.now(tz=datetime.UTC) - datetime.timedelta(
+            days=BotSettings.cogs.chatbot.archive_retention_days
+        )
+        try:
+            num_deleted = await self.db.prune_archive(
+                older_than=to_utc(older_than),
+                max_messages_per_channel=BotSettings.cogs.chatbot.archive_max_messages_per_channel,
+            )
+        except SQLAlchemyError as exc:
+            self.log_error("Unable to prune the message archive: %s", exc)
+            return
+        if num_deleted:
+            self.log_info("Pruned %d message(s) from the message archive", num_deleted)
+
+    @tasks.loop(seconds=30)
+    async def update_summaries(self) -> None:
+        """Update the rolling summaries of channels which have gone quiet.
+
+        The updates run at the lowest priority, so are dropped when the bot is
+        busy and retried later.
+        """
+        if not BotSettings.cogs.chatbot.enable_rolling_summaries:
+            return
+        summaries = self._chat_registry.summaries_to_update(
+            quiet_time=BotSettings.cogs.chatbot.summary_quiet_time,
+            min_new_messages=BotSettings.cogs.chatbot.summary_min_new_messages,
+        )
+        for summary in summaries:
+            try:
+                await summary.update_summary(slot=lambda: self._responder.scheduler.slot(Priority.BACKGROUND))
+            except RequestDroppedError:
+                return
+            except GenerationFailureError as exc:
+                self.log_warning("Unable to update a rolling summary: %s", exc)
+
     # Commands -----------------------------------------------------------------
 
     @slash_command_with_cooldown(
@@ -129,13 +240,24 @@ class ChatBot(CustomCog):
         description="Generate a summary of the conversation",
         contexts=disnake.InteractionContextTypes(guild=True),
     )
-    async def create_chat_summary(self, inter: disnake.ApplicationCommandInteraction) -> None:
+    async def create_chat_summary(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        hours: float = commands.Param(
+            default=0, ge=0, description="Summarise the messages from this many hours ago, instead of the recent ones"
+        ),
+    ) -> None:
         """Summarise the recent channel conversation using the current LLM.
 
+        Long histories are summarised in chunks, concurrently, so a summary
+        of a long period does not take much longer than a short one.
+
         Parameters
         ----------
         inter : disnake.ApplicationCommandInteraction
             The slash command interaction.
+        hours : float
+            If given, summarise the messages from this many hours ago.
 
         """
         history = self._chat_registry.get_summary_object(inter)
@@ -143,14 +265,127 @@ class ChatBot(CustomCog):
             await inter.response.send_message("There are no messages to summarise.", ephemeral=True)
             return
         await inter.response.defer(ephemeral=True)
+        # The cached rolling summary is returned immediately if it is up to
+        # date, otherwise each request waits for a slot
         try:
-            summary = await history.generate_summary(requesting_user=None)
+            summary = await history.generate_summary(
+                hours=hours, slot=lambda: self._responder.scheduler.slot(Priority.SUMMARY)
+            )
+        except RequestDroppedError:
+            await deferred_error_response(inter, "I'm too busy to summarise the conversation right now")
+            return
         except GenerationFailureError:
             await deferred_error_response(inter, "There was an error trying to generate the summary")
             return
         await inter.delete_original_response()
         await send_message_to_channel(summary, inter)
 
+    @slash_command_with_cooldown(
+        name="search_chat_archive",
+        description="Search the archived messages in this channel",
+        contexts=disnake.InteractionContextTypes(guild=True),
+    )
+    async def search_chat_archive(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        query: str = commands.Param(description="The words to search for"),
+    ) -> None:
+        """Search the message archive of the current channel.
+
+        Parameters
+        ----------
+        inter : disnake.ApplicationCommandInteraction
+            The slash command interaction.
+        query : str
+            The words to search for. Messages must contain every word.
+
+        """
+        if not BotSettings.cogs.chatbot.enable_message_archive:
+            await inter.response.send_message("The message archive is disabled.", ephemeral=True)
+            return
+        await inter.response.defer(ephemeral=True)
+        await self._write_archive()
+        try:
+            messages = await self.db.search_archive(
+                inter.channel.id, query, limit=BotSettings.cogs.chatbot.archive_search_results
+            )
+        except SQLAlchemyError:
+            await deferred_error_response(inter, "There was an error trying to search the archive")
+            return
+        if not messages:
+            await inter.followup.send(f"No messages found for *{query}*.", ephemeral=True)
+            return
+
+        lines = [
+            f"`{message.created_at:%Y-%m-%d %H:%M}` **{message.author}**: {shorten(message.content, 200)}"
+            for message in messages
+        ]
+        while len("\n".join(lines)) > BotSettings.discord.max_chars:
+            lines.pop()
+        await inter.followup.send("\n".join(lines), ephemeral=True)
+
+    @slash_command_with_cooldown(
+        name="summarise_chat_archive",
+        description="Summarise the archived messages in this channel over a period",
+        contexts=disnake.InteractionContextTypes(guild=True),
+    )
+    async def summarise_chat_archive(
+        self,
+        inter: disnake.ApplicationCommandInteraction,
+        hours_ago: float = commands.Param(
+            gt=0,
+            le=BotSettings.cogs.chatbot.archive_max_summary_hours,
+            description="The start of the period, in hours ago",
+        ),
+        duration: float = commands.Param(
+            default=0, ge=0, description="The length of the period in hours, or 0 for up to now"
+        ),
+    ) -> None:
+        """Summarise the archived messages of the current channel over a period.
+
+        The messages are read from the archive in batches and summarised in
+        chunks as they are read, so only a bounded number are held in memory.
+        The period can start at most `archive_max_summary_hours` ago, which
+        bounds the number of requests made.
+
+        Parameters
+        ----------
+        inter : disnake.ApplicationCommandInteraction
+            The slash command interaction.
+        hours_ago : float
+            The start of the period, in hours before now.
+        duration : float
+            The length of the period, in hours. If 0, the period ends now.
+
+        """
+        if not BotSettings.cogs.chatbot.enable_message_archive:
+            await inter.response.send_message("The message archive is disabled.", ephemeral=True)
+            return
+        await inter.response.defer(ephemeral=True)
+        await self._archiver.flush(self.db, batch_size=BotSettings.cogs.chatbot.archive_batch_size)
+
+        start = to_utc(datetime.datetime.now(tz=datetime.UTC)) - datetime.timedelta(hours=hours_ago)
+        end = start + datetime.timedelta(hours=duration) if duration > 0 else datetime.datetime.max
+        history = self._chat_registry.get_summary_object(inter)
+        batches = self.db.iter_archive(
+            inter.channel.id, start, end, batch_size=BotSettings.cogs.chatbot.archive_batch_size
+        )
+        try:
+            summary = await history.summarise_stream(
+                as_summary_messages(batches), slot=lambda: self._responder.scheduler.slot(Priority.SUMMARY)
+            )
+        except RequestDroppedError:
+            await deferred_error_response(inter, "I'm too busy to summarise the archive right now")
+            return
+        except (GenerationFailureError, SQLAlchemyError):
+            await deferred_error_response(inter, "There was an error trying to summarise the archive")
+            return
+        if not summary:
+            await inter.followup.send("There are no archived messages in that period.", ephemeral=True)
+            return
+        await inter.delete_original_response()
+        await send_message_to_channel(summary, inter)
+
     @slash_command_with_cooldown(name="reset_chat_history", description="Reset the AI conversation history")
     async def reset_conversation(self, inter: disnake.ApplicationCommandInteraction) -> None:
         """Clear the AI conversation history for the current channel.
@@ -232,6 +467,8 @@ class ChatBot(CustomCog):
         original_model = chat.model
         chat.set_model(model_name)
         summary.set_model(model_name)
+        # The conversation is kept, but its tokens are re-counted for the new model
+        self._chat_registry.store.invalidate([inter.channel.id])
         self.log_info("%s set new model: %s", inter.author.display_name, model_name)
         await inter.edit_original_response(content=f"LLM model updated from {original_model} to {model_name}.")
 
@@ -269,7 +506,10 @@ class ChatBot(CustomCog):
         description="Print information about the current AI conversation",
     )
     async def show_prompt(self, inter: disnake.ApplicationCommandInteraction) -> None:
-        """Display the current model, token usage, and system prompt.
+        """Display the current model, token, cache and memory usage, and system prompt.
+
+        The token usage is broken down per message, for the most recent
+        messages which fit into a Discord message.
 
         Parameters
         ----------
@@ -278,9 +518,60 @@ class ChatBot(CustomCog):
 
         """
         chat = self._chat_registry.get_chat_object(inter)
+        system_entry, *message_entries = chat.token_ledger
+        cache_stats = chat.prompt_cache_stats
+        memory = chat.memory_usage
         response = (
             f"**Model**: {chat.model}\n"
-            f"**Token size**: {chat.size_tokens}\n"
-            f"**Prompt [*{chat.system_prompt_name}*]**:\n> {shorten(chat.system_prompt, 1500)}\n"
+            f"**Token size**: {chat.size_tokens} / {BotSettings.cogs.chatbot.context_window_size} "
+            f"(system prompt: {system_entry.tokens})\n"
+            f"**Prompt cache**: {cache_stats.cache_read_tokens} tokens read in {cache_stats.hits} / "
+            f"{cache_stats.requests} requests ({cache_stats.hit_rate:.0%} of input tokens)\n"
+            f"**Memory**: {memory.inline_bytes / 1024:.1f} KiB in context, "
+            f"{memory.blob_bytes / 1024:.1f} KiB in {memory.num_blobs} media blob(s) on disk\n"
+            f"**Prompt [*{chat.system_prompt_name}*]**:\n> {shorten(chat.system_prompt, 1000)}\n"
         )
+        if message_entries:
+            lines = [
+                f"{i}. {entry.role}: {entry.tokens} tokens"
+                + (f", {entry.num_images} image(s)" if entry.num_images else "")
+                + f" -- {shorten(entry.text, 60) or '...'}"
+                for i, entry in enumerate(message_entries, start=1)
+            ]
+            header = "**Messages**:\n"
+            while lines and len(response) + len(header) + len("\n".join(lines)) > BotSettings.discord.max_chars:
+                lines.pop(0)
+            if lines:
+                response += header + "\n".join(lines)
+        await inter.response.send_message(response, ephemeral=True)
+
+    @slash_command_with_cooldown(
+        name="show_chat_queue",
+        description="Print information about the queue of AI requests",
+    )
+    async def show_queue(self, inter: disnake.ApplicationCommandInteraction) -> None:
+        """Display the request scheduler's queue depth and wait times, and channel residency.
+
+        Parameters
+        ----------
+        inter : disnake.ApplicationCommandInteraction
+            The slash command interaction.
+
+        """
+        scheduler = self._responder.scheduler
+        metrics = scheduler.metrics
+        residency = self._chat_registry.metrics
+        response = (
+            f"**Channels**: {residency.resident} in memory, {residency.hibernated} hibernated, "
+            f"{residency.rehydrations} restored ({residency.mean_rehydration_time * 1000:.1f} ms mean / "
+            f"{residency.max_rehydration_time * 1000:.1f} ms max)\n"
+            f"**Active requests**: {metrics.active} / {scheduler.max_concurrency}\n"
+            f"**Queue depth**: {metrics.queue_depth} (max {metrics.max_queue_depth}, "
+            f"saturates at {scheduler.max_queue_size})\n"
+        )
+        for priority in Priority:
+            response += (
+                f"- {priority.name.lower()}: {metrics.completed[priority]} run, {metrics.dropped[priority]} dropped, "
+                f"wait {metrics.mean_wait_time(priority):.2f} s mean / {metrics.max_wait_time[priority]:.2f} s max\n"
+            )
         await inter.response.send_message(response, ephemeral=True)
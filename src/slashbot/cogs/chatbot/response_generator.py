@@ -1,14 +1,14 @@
 import asyncio
-import contextlib
 import datetime
 from collections import defaultdict
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import disnake
 
 from slashbot import markov
 from slashbot.bot.custom_types import Message
-from slashbot.cogs.chatbot.chat_registry import ChatRegistry
+from slashbot.cogs.chatbot.chat_registry import AIChat, ChatRegistry
+from slashbot.cogs.chatbot.scheduler import Priority, RequestDroppedError, RequestScheduler
 from slashbot.llm import (
     GenerationFailureError,
     TextGenerationInput,
@@ -16,7 +16,10 @@ from slashbot.llm import (
     VisionVideo,
     read_in_prompt,
 )
-from slashbot.messages import send_message_to_channel
+from slashbot.llm.conversation import ConversationMessage
+from slashbot.llm.images import ingest_images
+from slashbot.logger import Logger
+from slashbot.messages import StreamedReply, edit_message_in_channel, send_message_to_channel
 from slashbot.settings import BotSettings
 
 
@@ -37,8 +40,47 @@ class Cooldown:
     last_interaction: datetime.datetime
 
 
-class ResponseGenerator:
-    """Handles response generation and per-user rate limiting."""
+@dataclass
+class CoalescedTurn:
+    """Mentions in a channel which are answered with a single LLM request.
+
+    Attributes
+    ----------
+    messages : list[disnake.Message]
+        The messages in the turn, in the order they arrived.
+    inputs : list[asyncio.Task[TextGenerationInput]]
+        Tasks preparing the LLM input for each message.
+    context_messages : list[ConversationMessage]
+        The input and response added to the conversation for the turn, once
+        the response has been generated.
+
+    """
+
+    messages: list[disnake.Message]
+    inputs: list[asyncio.Task[TextGenerationInput]]
+    context_messages: list[ConversationMessage] = field(default_factory=list)
+
+    @property
+    def reply_to(self) -> disnake.Message:
+        """The message to reply to, which is the most recent."""
+        return self.messages[-1]
+
+    @property
+    def other_author_mentions(self) -> str:
+        """Mentions for the authors who are not being replied to."""
+        mentions = dict.fromkeys(
+            message.author.mention for message in self.messages if message.author != self.reply_to.author
+        )
+        return " ".join(mentions)
+
+
+class ResponseGenerator(Logger):
+    """Handles response generation and per-user rate limiting.
+
+    Requests in the same channel are serialised to keep the conversation
+    consistent, but channels are otherwise independent and share a global
+    request scheduler.
+    """
 
     def __init__(self, history_manager: ChatRegistry, bot: disnake.Client) -> None:
         """Initialise the responder with a chat registry and bot client.
@@ -51,12 +93,37 @@ class ResponseGenerator:
             The running bot client.
 
         """
+        super().__init__(prepend_msg="[ResponseGenerator]")
         self.bot = bot
         self.chat_registry = history_manager
-
-        self._lock = asyncio.Lock()
+        self.scheduler = RequestScheduler(
+            max_concurrency=BotSettings.cogs.chatbot.max_concurrent_requests,
+            max_queue_size=BotSettings.cogs.chatbot.max_queued_requests,
+        )
+
+        self._channel_locks: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self._pending_turns: dict[int, CoalescedTurn] = {}
+        self._background_tasks: set[asyncio.Task] = set()
         self._cooldowns: dict[int, Cooldown] = defaultdict(lambda: Cooldown(0, datetime.datetime.now(tz=datetime.UTC)))
 
+    def is_channel_busy(self, channel_id: int) -> bool:
+        """Determine whether a channel has a response being generated.
+
+        Parameters
+        ----------
+        channel_id : int
+            The ID of the channel.
+
+        Returns
+        -------
+        bool
+            True if a response is being generated, or a turn is waiting to be
+            responded to, in the channel.
+
+        """
+        lock = self._channel_locks.get(channel_id)
+        return channel_id in self._pending_turns or (lock is not None and lock.locked())
+
     def is_on_cooldown(self, user_id: int) -> bool:
         """Determine whether a user is currently rate-limited.
 
@@ -89,36 +156,36 @@ class ResponseGenerator:
 
         return False
 
-    async def get_attached_images(self, message: Message) -> list[VisionImage]:
-        """Extract image attachments and embeds from a Discord message.
+    async def get_attached_images(self, messages: list[Message], *, max_dimension: int) -> list[VisionImage]:
+        """Extract image attachments and embeds from Discord messages.
 
-        When BotSettings.cogs.chatbot.prefer_image_urls is False, each
-        image is downloaded and base64-encoded in place. Failures are
-        ignored so that a single bad URL does not abort the whole response.
+        When BotSettings.cogs.chatbot.prefer_image_urls is False, every image
+        is downloaded, downscaled and base64-encoded concurrently. Images which
+        fail to download are skipped so that a single bad URL does not abort
+        the whole response.
 
         Parameters
         ----------
-        message : Message
-            The Discord message to inspect for image content.
+        messages : list[Message]
+            The Discord messages to inspect for image content.
+        max_dimension : int
+            The maximum width and height of the images for the model.
 
         Returns
         -------
         list of VisionImage
             VisionImage instances for every image attachment or embed found in
-            the message.
+            the messages.
 
         """
-        image_urls = [a.url for a in message.attachments if a.content_type and a.content_type.startswith("image/")]
-        image_urls += [e.url for e in message.embeds if e.type == "image" and e.url]
-        images = []
-        for url in image_urls:
-            image = VisionImage(url)
-            if not BotSettings.cogs.chatbot.prefer_image_urls:
-                with contextlib.suppress(Exception):
-                    await image.download_and_encode()
-            images.append(image)
-
-        return images
+        image_urls = []
+        for message in messages:
+            image_urls += [a.url for a in message.attachments if a.content_type and a.content_type.startswith("image/")]
+            image_urls += [e.url for e in message.embeds if e.type == "image" and e.url]
+        if BotSettings.cogs.chatbot.prefer_image_urls:
+            return [VisionImage(url) for url in image_urls]
+
+        return await ingest_images(image_urls, max_dimension=max_dimension)
 
     async def get_attached_videos(self, message: Message) -> list[VisionVideo]:
         """Extract YouTube video embeds from a Discord message.
@@ -172,20 +239,19 @@ class ResponseGenerator:
                 if not ref.message_id:
                     return message
                 previous_message = await channel.fetch_message(ref.message_id)
-            except disnake.NotFound:
+            except disnake.HTTPException as exc:
+                self.log_debug("Unable to fetch referenced message %s: %s", ref.message_id, exc)
                 return message
 
         return previous_message
 
-    async def generate_response(self, discord_message: disnake.Message) -> str:
-        """Generate an AI response to a Discord message.
+    async def _get_prompt_and_media(
+        self, discord_message: disnake.Message
+    ) -> tuple[str, list[VisionImage], list[VisionVideo]]:
+        """Extract the user prompt and any attached media from a Discord message.
 
         Resolves the bot's display name, extracts any attached media, and
-        optionally injects a referenced message as context. Falls back to a
-        Markov-chain sentence if the AI generation fails.
-
-        The underlying conversation history is updated inside an async lock to
-        prevent race conditions when multiple users message simultaneously.
+        optionally injects a referenced message as context.
 
         Parameters
         ----------
@@ -194,12 +260,10 @@ class ResponseGenerator:
 
         Returns
         -------
-        str
-            The generated response text.
+        tuple[str, list[VisionImage], list[VisionVideo]]
+            The user prompt, and the attached images and videos.
 
         """
-        conversation = self.chat_registry.get_chat_object(discord_message)
-
         if discord_message.guild:
             bot_member = discord_message.guild.get_member(self.bot.user.id)
             bot_name = bot_member.display_name if bot_member else self.bot.user.name
@@ -207,51 +271,498 @@ class ResponseGenerator:
             bot_name = self.bot.user.name
 
         user_prompt = discord_message.clean_content.replace(f"@{bot_name}", "")
-        images = await self.get_attached_images(discord_message)
-        videos = await self.get_attached_videos(discord_message)
+        messages = [discord_message]
 
         if discord_message.reference:
             referenced = await self._resolve_referenced_message(discord_message)
-            images += await self.get_attached_images(referenced)
-            videos += await self.get_attached_videos(referenced)
+            messages.append(referenced)
             user_prompt = (
                 f'Previous message to respond to with the prompt: "{referenced.clean_content}"\nPrompt: {user_prompt}'
             )
 
-        async with self._lock:
-            timestamp = datetime.datetime.now(tz=datetime.UTC).strftime("%a %d %b %Y %H:%M:%S %Z")
-            user_label = f"{discord_message.author.display_name} ({timestamp}): "
+        max_dimension = self.chat_registry.get_chat_object(discord_message).image_max_dimension
+        images = await self.get_attached_images(messages, max_dimension=max_dimension)
+        videos = []
+        for message in messages:
+            videos += await self.get_attached_videos(message)
+
+        return user_prompt, images, videos
+
+    @staticmethod
+    def _get_user_label(discord_message: disnake.Message) -> str:
+        """Create the label which prefixes a user's message in the conversation.
+
+        Parameters
+        ----------
+        discord_message : disnake.Message
+            The message to label.
+
+        Returns
+        -------
+        str
+            The user's display name and the current time.
+
+        """
+        timestamp = datetime.datetime.now(tz=datetime.UTC).strftime("%a %d %b %Y %H:%M:%S %Z")
+        return f"{discord_message.author.display_name} ({timestamp}): "
+
+    @staticmethod
+    def _get_fallback_response() -> str:
+        """Generate a Markov-chain sentence to use when AI generation fails.
+
+        Returns
+        -------
+        str
+            The fallback response.
+
+        """
+        fallback = markov.generate_text_from_markov_chain(markov.MARKOV_MODEL, "?random", 1)
+        return fallback[0] if isinstance(fallback, list) else fallback
+
+    async def _create_input(self, discord_message: disnake.Message) -> TextGenerationInput:
+        """Create the LLM input for a Discord message.
+
+        Parameters
+        ----------
+        discord_message : disnake.Message
+            The message to respond to.
+
+        Returns
+        -------
+        TextGenerationInput
+            The labelled user prompt, including attached media.
+
+        """
+        user_prompt, images, videos = await self._get_prompt_and_media(discord_message)
+        return TextGenerationInput(self._get_user_label(discord_message) + user_prompt, images=images, videos=videos)
+
+    async def _gather_inputs(self, turn: CoalescedTurn) -> list[TextGenerationInput]:
+        """Wait for the LLM input for each message in a turn.
+
+        If the input for a message could not be prepared, e.g. the media could
+        not be downloaded, the message's text is used on its own so the rest
+        of the turn is still answered.
+
+        Parameters
+        ----------
+        turn : CoalescedTurn
+            The turn to prepare the inputs for.
+
+        Returns
+        -------
+        list[TextGenerationInput]
+            The input for each message, in the order they arrived.
+
+        """
+        results = await asyncio.gather(*turn.inputs, return_exceptions=True)
+        msg_inputs = []
+        for message, result in zip(turn.messages, results, strict=True):
+            if not isinstance(result, BaseException):
+                msg_inputs.append(result)
+                continue
+            self.log_error("Unable to prepare input for message %d, using its text only: %s", message.id, result)
+            msg_inputs.append(TextGenerationInput(self._get_user_label(message) + message.clean_content))
+
+        return msg_inputs
+
+    def _join_pending_turn(self, discord_message: disnake.Message) -> CoalescedTurn | None:
+        """Add a message to its channel's pending turn, or start a new turn.
+
+        A turn is pending whilst it waits for a request for the channel to
+        finish, or for a slot in the scheduler. The input for the message is
+        prepared in the background whilst it waits.
+
+        Parameters
+        ----------
+        discord_message : disnake.Message
+            The message to respond to.
+
+        Returns
+        -------
+        CoalescedTurn | None
+            The new turn, which the caller must respond to, or None if the
+            message joined a pending turn which will be responded to by
+            another caller.
+
+        """
+        channel_id = discord_message.channel.id
+        input_task = asyncio.create_task(self._create_input(discord_message))
+        turn = self._pending_turns.get(channel_id)
+        if (
+            turn
+            and BotSettings.cogs.chatbot.enable_message_coalescing
+            and len(turn.messages) < BotSettings.cogs.chatbot.max_coalesced_messages
+        ):
+            turn.messages.append(discord_message)
+            turn.inputs.append(input_task)
+            self.log_debug("Coalesced message into pending turn of %d messages", len(turn.messages))
+            return None
+
+        turn = CoalescedTurn([discord_message], [input_task])
+        self._pending_turns[channel_id] = turn
+
+        return turn
+
+    def _close_turn(self, turn: CoalescedTurn) -> None:
+        """Stop more messages joining a turn, as its request is starting.
+
+        Parameters
+        ----------
+        turn : CoalescedTurn
+            The turn to close.
+
+        """
+        channel_id = turn.messages[0].channel.id
+        if self._pending_turns.get(channel_id) is turn:
+            del self._pending_turns[channel_id]
+
+    async def _compact_conversation(self, channel_id: int, conversation: AIChat) -> None:
+        """Compact a conversation at the lowest priority.
+
+        Parameters
+        ----------
+        channel_id : int
+            The ID of the channel the conversation is in.
+        conversation : AIChat
+            The conversation to compact.
+
+        """
+        try:
+            async with self.scheduler.slot(Priority.BACKGROUND):
+                compacted = await conversation.compact_history()
+        except RequestDroppedError:
+            self.log_debug("Not compacting conversation in %d as the request was dropped", channel_id)
+            return
+        except GenerationFailureError as exc:
+            self.log_warning("Unable to compact conversation in %d: %s", channel_id, exc)
+            return
+        if compacted:
+            self.chat_registry.mark_changed(channel_id)
+
+    def _schedule_compaction(self, channel_id: int, conversation: AIChat) -> None:
+        """Compact a conversation in the background, if it has grown too large.
+
+        The compaction runs outside of the channel lock, so the next response
+        in the channel does not wait for it. If it is not ready in time, the
+        oldest messages are dropped as usual.
+
+        Parameters
+        ----------
+        channel_id : int
+            The ID of the channel the conversation is in.
+        conversation : AIChat
+            The conversation to compact.
+
+        """
+        if not conversation.needs_compaction:
+            return
+        task = asyncio.create_task(self._compact_conversation(channel_id, conversation))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def _recall(self, turn: CoalescedTurn, msg_inputs: list[TextGenerationInput]) -> str:
+        """Recall earlier messages in the channel which are relevant to a turn.
+
+        Parameters
+        ----------
+        turn : CoalescedTurn
+            The messages to respond to.
+        msg_inputs : list[TextGenerationInput]
+            The LLM input for each message.
+
+        Returns
+        -------
+        str
+            The relevant messages, or an empty string if there are none.
+
+        """
+        return self.chat_registry.recall(turn.messages[0], " ".join(msg_input.text for msg_input in msg_inputs))
+
+    @staticmethod
+    async def _wait_for_response(response: asyncio.Task[str | None], deadline: float) -> bool:
+        """Wait for a response to be generated, until a deadline.
+
+        The response continues to be generated if the deadline passes.
+
+        Parameters
+        ----------
+        response : asyncio.Task[str | None]
+            The task generating the response.
+        deadline : float
+            The time (seconds) to wait. Zero waits indefinitely.
+
+        Returns
+        -------
+        bool
+            True if the response is ready, False if the deadline passed.
+
+        """
+        done, _ = await asyncio.wait({response}, timeout=deadline or None)
+        return bool(done)
+
+    async def _edit_in_late_response(
+        self,
+        response: asyncio.Task[str | None],
+        placeholder: list[disnake.Message],
+        reply_to: disnake.Message,
+        *,
+        dont_tag_user: bool = False,
+    ) -> bool:
+        """Replace a placeholder with a response which missed its deadline.
+
+        The response is discarded if the conversation in the channel has moved
+        on since the placeholder was sent, or if it could not be generated.
+
+        Parameters
+        ----------
+        response : asyncio.Task[str | None]
+            The task generating the response.
+        placeholder : list[disnake.Message]
+            The message(s) sent in place of the response.
+        reply_to : disnake.Message
+            The message the placeholder replied to.
+        dont_tag_user : bool, optional
+            Whether the author mention was omitted from the placeholder.
+
+        Returns
+        -------
+        bool
+            True if the response replaced the placeholder.
+
+        """
+        try:
+            text = await response
+        except Exception:  # noqa: BLE001
+            self.log_exception("Unable to generate late response in %d", reply_to.channel.id)
+            return False
+        if not text:
+            return False
+        # IDs increase over time, so this is not fooled if the placeholder has
+        # not been received from the gateway yet
+        last_message_id = reply_to.channel.last_message_id
+        if last_message_id is not None and last_message_id > placeholder[-1].id:
+            self.log_debug("Discarding late response in %d as the conversation has moved on", reply_to.channel.id)
+            return False
+        try:
+            await edit_message_in_channel(placeholder[0], text, reply_to, dont_tag_user=dont_tag_user)
+            for message in placeholder[1:]:
+                await message.delete()
+        except disnake.HTTPException as exc:
+            self.log_warning("Unable to edit late response into placeholder in %d: %s", reply_to.channel.id, exc)
+            return False
+
+        return True
+
+    async def generate_response(self, turn: CoalescedTurn, *, use_fallback: bool = True) -> str | None:
+        """Generate an AI response to a turn of Discord messages.
+
+        Falls back to a Markov-chain sentence if the AI generation fails,
+        unless use_fallback is False.
+
+        The underlying conversation history is updated inside a per-channel
+        lock to prevent race conditions when multiple users message
+        simultaneously in the same channel. Messages which arrive whilst the
+        turn is waiting for the lock are answered in the same request.
+
+        Parameters
+        ----------
+        turn : CoalescedTurn
+            The messages to respond to.
+        use_fallback : bool, optional
+            When False, None is returned if the AI generation fails.
+
+        Returns
+        -------
+        str | None
+            The generated response text.
+
+        """
+        conversation = self.chat_registry.get_chat_object(turn.messages[0])
+
+        async with self._channel_locks[turn.messages[0].channel.id], self.scheduler.slot(Priority.PROMPTED):
+            self._close_turn(turn)
+            msg_inputs = await self._gather_inputs(turn)
+            recalled = self._recall(turn, msg_inputs)
             try:
-                msg_input = TextGenerationInput(user_label + user_prompt, images=images, videos=videos)
-                return await conversation.send_message(msg_input)
+                response = await conversation.send_message(
+                    msg_inputs, recalled=recalled, hedge_slot=lambda: self.scheduler.try_slot(Priority.PROMPTED)
+                )
             except GenerationFailureError:
-                fallback = markov.generate_text_from_markov_chain(markov.MARKOV_MODEL, "?random", 1)
-                return fallback[0] if isinstance(fallback, list) else fallback
+                return self._get_fallback_response() if use_fallback else None
+            turn.context_messages = conversation.get_last_turn()
 
-    async def respond_to_unprompted(self, message: disnake.Message) -> None:
-        """Send an unprompted AI reply to a message, without tagging the author.
+        self._schedule_compaction(turn.messages[0].channel.id, conversation)
 
-        Uses a dedicated random-response prompt rather than the main
-        conversation prompt, and does not prepend a user mention.
+        return response
+
+    async def _send_placeholder(self, reply: StreamedReply, deadline: float) -> None:
+        """Send a Markov-chain placeholder for a streamed reply after a deadline.
+
+        Parameters
+        ----------
+        reply : StreamedReply
+            The reply, which the placeholder is not sent to if anything has
+            already been sent.
+        deadline : float
+            The time (seconds) to wait before sending the placeholder. Zero
+            disables the placeholder.
+
+        """
+        if deadline <= 0:
+            return
+        await asyncio.sleep(deadline)
+        await reply.send_placeholder(self._get_fallback_response())
+
+    @staticmethod
+    def _with_mentions(turn: CoalescedTurn, text: str) -> str:
+        """Prepend the mentions for the other authors in a turn to a response.
+
+        Parameters
+        ----------
+        turn : CoalescedTurn
+            The messages being responded to.
+        text : str
+            The response text.
+
+        Returns
+        -------
+        str
+            The response, mentioning the other authors.
+
+        """
+        return f"{turn.other_author_mentions} {text}" if turn.other_author_mentions else text
+
+    async def _generate_mentioning_response(self, turn: CoalescedTurn) -> str | None:
+        """Generate a response to a turn, which mentions the other authors.
+
+        Parameters
+        ----------
+        turn : CoalescedTurn
+            The messages to respond to.
+
+        Returns
+        -------
+        str | None
+            The response text, or None if the AI generation failed.
+
+        """
+        response = await self.generate_response(turn, use_fallback=False)
+        return self._with_mentions(turn, response) if response else None
+
+    async def stream_response(self, turn: CoalescedTurn, *, dont_tag_user: bool = False) -> None:
+        """Stream an AI response to a turn of Discord messages, as it is generated.
+
+        The reply is sent once the first sentence has been generated, and is
+        then edited as the rest of the response arrives. Falls back to a
+        Markov-chain sentence if the AI generation fails before anything has
+        been sent. If nothing has been sent by the prompted reply deadline, a
+        Markov-chain sentence is sent as a placeholder, which is replaced by
+        the response unless the conversation has moved on by then.
+
+        Parameters
+        ----------
+        turn : CoalescedTurn
+            The messages to respond to.
+        dont_tag_user : bool, optional
+            When True, the author mention is omitted from the reply.
+
+        """
+        conversation = self.chat_registry.get_chat_object(turn.messages[0])
+        reply = StreamedReply(
+            turn.reply_to,
+            dont_tag_user=dont_tag_user,
+            edit_interval=BotSettings.cogs.chatbot.stream_edit_interval,
+        )
+        placeholder = asyncio.create_task(
+            self._send_placeholder(reply, BotSettings.cogs.chatbot.prompted_reply_deadline)
+        )
+
+        try:
+            async with self._channel_locks[turn.messages[0].channel.id], self.scheduler.slot(Priority.PROMPTED):
+                self._close_turn(turn)
+                msg_inputs = await self._gather_inputs(turn)
+                recalled = self._recall(turn, msg_inputs)
+                if turn.other_author_mentions:
+                    await reply.add_text(turn.other_author_mentions + " ")
+                try:
+                    async for text in conversation.stream_message(msg_inputs, recalled=recalled):
+                        await reply.add_text(text)
+                    turn.context_messages = conversation.get_last_turn()
+                except GenerationFailureError:
+                    if not reply.sent_messages or reply.showing_placeholder:
+                        await reply.add_text(self._get_fallback_response())
+        finally:
+            placeholder.cancel()
+
+        await reply.finish()
+        if reply.discarded:
+            self.log_debug("Discarded streamed response in %d as the conversation has moved on", reply.channel_id)
+            conversation.remove_messages(turn.context_messages)
+        self._schedule_compaction(turn.messages[0].channel.id, conversation)
+
+    async def _generate_unprompted_response(self, message: disnake.Message) -> str | None:
+        """Generate an unprompted AI reply to a message.
 
         Parameters
         ----------
         message : disnake.Message
             The message to respond to.
 
+        Returns
+        -------
+        str | None
+            The generated response text, or None if the request was dropped.
+
         """
         prompt = read_in_prompt("data/prompts/_random-response.yaml")
         chat = self.chat_registry.get_chat_object(message)
         content = chat.create_request_json(TextGenerationInput(message.clean_content), system_prompt=prompt.prompt)
-        response = await chat.send_raw_request(content)
+        try:
+            async with self.scheduler.slot(Priority.UNPROMPTED):
+                return await chat.send_raw_request(content)
+        except RequestDroppedError:
+            self.log_debug("Not sending unprompted response as the request was dropped")
+            return None
+
+    async def respond_to_unprompted(self, message: disnake.Message) -> None:
+        """Send an unprompted AI reply to a message, without tagging the author.
 
-        await send_message_to_channel(response, message, dont_tag_user=True)
+        Uses a dedicated random-response prompt rather than the main
+        conversation prompt, and does not prepend a user mention. The request
+        is low priority, so is dropped if the bot is busy. If the reply is not
+        ready by the unprompted reply deadline, a Markov-chain sentence is
+        sent and later edited into the reply.
+
+        Parameters
+        ----------
+        message : disnake.Message
+            The message to respond to.
+
+        """
+        response = asyncio.create_task(self._generate_unprompted_response(message))
+        if not await self._wait_for_response(response, BotSettings.cogs.chatbot.unprompted_reply_deadline):
+            sent = await send_message_to_channel(self._get_fallback_response(), message, dont_tag_user=True)
+            await self._edit_in_late_response(response, sent, message, dont_tag_user=True)
+            return
+
+        text = response.result()
+        if text:
+            await send_message_to_channel(text, message, dont_tag_user=True)
 
     async def respond_to_prompted(self, discord_message: disnake.Message, *, message_in_dm: bool = False) -> None:
         """Respond to a user-directed message, respecting rate limits.
 
-        Shows a typing indicator while the response is being generated. If the
-        user is on cooldown, sends an abuse warning instead of a real reply.
+        Shows a typing indicator while the response is being generated, or
+        streams the response if streaming is enabled. If the user is on
+        cooldown, sends an abuse warning instead of a real reply.
+
+        If a request for the channel is already in flight or queued, the
+        message is coalesced with any others which arrive in the meantime and
+        they are all answered by a single reply, which mentions every author.
+
+        If the reply is not ready by the prompted reply deadline, a
+        Markov-chain sentence is sent immediately and is edited into the reply
+        when it arrives, unless the conversation has moved on by then.
 
         Parameters
         ----------
@@ -262,13 +773,36 @@ class ResponseGenerator:
             Defaults to False.
 
         """
+        if self.is_on_cooldown(discord_message.author.id):
+            await send_message_to_channel(
+                f"Stop abusing me {discord_message.author.mention}!",
+                discord_message,
+                dont_tag_user=True,
+            )
+            return
+
+        turn = self._join_pending_turn(discord_message)
+        if not turn:
+            return  # the message will be answered with the turn it joined
+
+        if BotSettings.cogs.chatbot.enable_streaming:
+            # The typing indicator stops when the first part of the reply is sent
+            await discord_message.channel.trigger_typing()
+            await self.stream_response(turn, dont_tag_user=message_in_dm)
+            return
+
+        response = asyncio.create_task(self._generate_mentioning_response(turn))
         async with discord_message.channel.typing():
-            if self.is_on_cooldown(discord_message.author.id):
-                await send_message_to_channel(
-                    f"Stop abusing me {discord_message.author.mention}!",
-                    discord_message,
-                    dont_tag_user=True,
-                )
-            else:
-                response = await self.generate_response(discord_message)
-                await send_message_to_channel(response, discord_message, dont_tag_user=message_in_dm)
+            ready = await self._wait_for_response(response, BotSettings.cogs.chatbot.prompted_reply_deadline)
+            if ready:
+                text = response.result() or self._with_mentions(turn, self._get_fallback_response())
+                await send_message_to_channel(text, turn.reply_to, dont_tag_user=message_in_dm)
+                return
+            sent = await send_message_to_channel(
+                self._with_mentions(turn, self._get_fallback_response()), turn.reply_to, dont_tag_user=message_in_dm
+            )
+
+        if not await self._edit_in_late_response(response, sent, turn.reply_to, dont_tag_user=message_in_dm):
+            # Nobody saw the response, so the model should not remember it
+            conversation = self.chat_registry.get_chat_object(turn.reply_to)
+            conversation.remove_messages(turn.context_messages)
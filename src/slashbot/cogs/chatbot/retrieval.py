@@ -0,0 +1,186 @@
+"""Local BM25 retrieval over channel history.
+
+Each channel keeps an inverted index of its recent messages, so older
+messages which are relevant to a prompt can be recalled and sent alongside a
+small window of recent conversation, instead of sending the whole history.
+The index is updated incrementally as messages are added and removed, and
+everything runs locally without any requests.
+"""
+
+import heapq
+import math
+import re
+from collections import Counter, deque
+from dataclasses import dataclass
+
+_WORD_PATTERN = re.compile(r"\w+")
+_STOPWORDS = frozenset(
+    (
+        "a about an and are as at be but by can do for from has have he her him his how i if in is it its me my "
+        "no not of on or our she so that the their them there they this to too up us was we were what when where "
+        "which who why will with you your"
+    ).split()
+)
+
+
+def tokenise(text: str) -> list[str]:
+    """Split text into the terms which are indexed.
+
+    Parameters
+    ----------
+    text : str
+        The text to split.
+
+    Returns
+    -------
+    list[str]
+        The lower case words in the text, excluding stop words and single
+        characters.
+
+    """
+    return [word for word in _WORD_PATTERN.findall(text.lower()) if len(word) > 1 and word not in _STOPWORDS]
+
+
+@dataclass(slots=True)
+class _Document[T]:
+    """A document in the index.
+
+    Attributes
+    ----------
+    item : T
+        The object which was indexed, e.g. a message.
+    length : int
+        The number of terms in the document.
+    terms : tuple[str, ...]
+        The distinct terms in the document.
+
+    """
+
+    item: T
+    length: int
+    terms: tuple[str, ...]
+
+
+class BM25Index[T]:
+    """An incremental BM25 index over a first-in first-out history.
+
+    Documents are appended as they are added to the history, and removed from
+    the start as the history is trimmed, so both operations only touch the
+    postings of the terms in that document.
+    """
+
+    def __init__(self, *, k1: float = 1.5, b: float = 0.75) -> None:
+        """Initialise an empty index.
+
+        Parameters
+        ----------
+        k1 : float
+            Controls how quickly repeated terms stop increasing the score.
+        b : float
+            Controls how much the score is normalised by document length.
+
+        """
+        self.k1 = k1
+        self.b = b
+        self._documents: deque[_Document[T]] = deque()
+        self._postings: dict[str, dict[int, int]] = {}
+        self._first_id = 0
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        """Get the number of documents in the index."""
+        return len(self._documents)
+
+    @property
+    def num_terms(self) -> int:
+        """Get the number of distinct terms in the index."""
+        return len(self._postings)
+
+    def append(self, item: T, text: str) -> None:
+        """Add a document to the end of the index.
+
+        Parameters
+        ----------
+        item : T
+            The object to return when the document matches a query.
+        text : str
+            The text to index.
+
+        """
+        doc_id = self._first_id + len(self._documents)
+        counts = Counter(tokenise(text))
+        for term, count in counts.items():
+            self._postings.setdefault(term, {})[doc_id] = count
+        length = sum(counts.values())
+        self._documents.append(_Document(item, length, tuple(counts)))
+        self._total_length += length
+
+    def popleft(self) -> T:
+        """Remove the oldest document from the index.
+
+        Returns
+        -------
+        T
+            The object which was indexed.
+
+        """
+        document = self._documents.popleft()
+        doc_id = self._first_id
+        self._first_id += 1
+        for term in document.terms:
+            postings = self._postings[term]
+            del postings[doc_id]
+            if not postings:
+                del self._postings[term]
+        self._total_length -= document.length
+
+        return document.item
+
+    def clear(self) -> None:
+        """Remove every document from the index."""
+        self._first_id += len(self._documents)
+        self._documents.clear()
+        self._postings.clear()
+        self._total_length = 0
+
+    def search(self, query: str, *, k: int, skip_newest: int = 0) -> list[T]:
+        """Find the documents most relevant to a query.
+
+        Parameters
+        ----------
+        query : str
+            The text to search for.
+        k : int
+            The maximum number of documents to return.
+        skip_newest : int
+            The number of the most recent documents to exclude, e.g. because
+            they are already in the context.
+
+        Returns
+        -------
+        list[T]
+            The matching objects, oldest first.
+
+        """
+        num_searched = len(self._documents) - skip_newest
+        if k <= 0 or num_searched <= 0:
+            return []
+
+        end_id = self._first_id + num_searched
+        average_length = self._total_length / len(self._documents) or 1
+        scores: dict[int, float] = {}
+        for term in set(tokenise(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self._documents) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, count in postings.items():
+                if doc_id >= end_id:
+                    continue
+                length = self._documents[doc_id - self._first_id].length
+                norm = self.k1 * (1 - self.b + self.b * length / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+
+        best = heapq.nlargest(k, scores, key=scores.__getitem__)
+
+        return [self._documents[doc_id - self._first_id].item for doc_id in sorted(best)]
@@ -0,0 +1,288 @@
+"""Global scheduling of LLM requests.
+
+Requests for each channel are serialised by a per-channel lock, which is all
+that is needed to keep a conversation consistent. The scheduler sits behind
+those locks and limits how many LLM requests are in flight across every
+channel. When there are no free slots, requests wait in a priority queue so
+that direct replies are not stuck behind background work. When the queue is
+saturated, low priority requests are dropped.
+"""
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import time
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+from enum import IntEnum
+
+from slashbot.llm.telemetry import QUEUE_WAIT
+from slashbot.logger import Logger
+
+
+class Priority(IntEnum):
+    """Priority classes for LLM requests, where lower values run first."""
+
+    PROMPTED = 0  # DMs and mentions
+    UNPROMPTED = 1  # random replies
+    SUMMARY = 2  # /generate_chat_summary
+    BACKGROUND = 3  # rolling summaries and other opportunistic work
+
+
+class RequestDroppedError(Exception):
+    """Raised when a request is dropped because the queue is saturated."""
+
+
+@dataclass
+class SchedulerMetrics:
+    """Queue and wait-time metrics for the scheduler.
+
+    Attributes
+    ----------
+    active : int
+        The number of requests currently running.
+    queue_depth : int
+        The number of requests currently waiting.
+    max_queue_depth : int
+        The largest number of requests which have waited at once.
+    completed : dict[Priority, int]
+        The number of requests which have been given a slot, per priority.
+    dropped : dict[Priority, int]
+        The number of requests dropped, per priority.
+    total_wait_time : dict[Priority, float]
+        The total time (seconds) spent waiting for a slot, per priority.
+    max_wait_time : dict[Priority, float]
+        The longest time (seconds) spent waiting for a slot, per priority.
+
+    """
+
+    active: int = 0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    completed: dict[Priority, int] = field(default_factory=lambda: dict.fromkeys(Priority, 0))
+    dropped: dict[Priority, int] = field(default_factory=lambda: dict.fromkeys(Priority, 0))
+    total_wait_time: dict[Priority, float] = field(default_factory=lambda: dict.fromkeys(Priority, 0.0))
+    max_wait_time: dict[Priority, float] = field(default_factory=lambda: dict.fromkeys(Priority, 0.0))
+
+    def mean_wait_time(self, priority: Priority) -> float:
+        """Get the mean time spent waiting for a slot.
+
+        Parameters
+        ----------
+        priority : Priority
+            The priority class.
+
+        Returns
+        -------
+        float
+            The mean wait time in seconds.
+
+        """
+        completed = self.completed[priority]
+        return self.total_wait_time[priority] / completed if completed else 0.0
+
+
+@dataclass(order=True)
+class _QueuedRequest:
+    """A request waiting for a slot, ordered by priority then arrival."""
+
+    priority: Priority
+    sequence: int
+    enqueued_at: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class RequestScheduler(Logger):
+    """Limit the number of concurrent LLM requests, in priority order."""
+
+    def __init__(self, *, max_concurrency: int, max_queue_size: int) -> None:
+        """Initialise the scheduler.
+
+        Parameters
+        ----------
+        max_concurrency : int
+            The maximum number of requests which can run at once.
+        max_queue_size : int
+            The number of waiting requests at which the queue is saturated.
+            PROMPTED requests are always queued, but lower priority requests
+            are dropped when the queue is saturated.
+
+        """
+        super().__init__(prepend_msg="[RequestScheduler]")
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.metrics = SchedulerMetrics()
+        self._queue: list[_QueuedRequest] = []
+        self._sequence = itertools.count()
+
+    def _record_wait(self, priority: Priority, wait_time: float) -> None:
+        """Record that a request has been given a slot.
+
+        Parameters
+        ----------
+        priority : Priority
+            The priority of the request.
+        wait_time : float
+            The time, in seconds, the request waited.
+
+        """
+        self.metrics.active += 1
+        self.metrics.completed[priority] += 1
+        self.metrics.total_wait_time[priority] += wait_time
+        self.metrics.max_wait_time[priority] = max(self.metrics.max_wait_time[priority], wait_time)
+
+    def _update_queue_depth(self) -> None:
+        """Remove finished requests from the queue and update its depth."""
+        self._queue = [request for request in self._queue if not request.future.done()]
+        heapq.heapify(self._queue)
+        self.metrics.queue_depth = len(self._queue)
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self.metrics.queue_depth)
+
+    def _drop(self, priority: Priority) -> None:
+        """Record a dropped request and raise.
+
+        Parameters
+        ----------
+        priority : Priority
+            The priority of the dropped request.
+
+        Raises
+        ------
+        RequestDroppedError
+            Always.
+
+        """
+        self.metrics.dropped[priority] += 1
+        self.log_warning("Dropping %s request as the queue is saturated", priority.name)
+        msg = f"{priority.name} request dropped as the queue is saturated"
+        raise RequestDroppedError(msg)
+
+    def _make_room(self, priority: Priority) -> None:
+        """Make space in a saturated queue for a new request.
+
+        The lowest priority waiting request is evicted if it has a lower
+        priority than the new request. Otherwise, the new request is dropped
+        unless it is PROMPTED.
+
+        Parameters
+        ----------
+        priority : Priority
+            The priority of the new request.
+
+        Raises
+        ------
+        RequestDroppedError
+            If the new request is dropped.
+
+        """
+        victim = max(self._queue)
+        if victim.priority > priority:
+            self.metrics.dropped[victim.priority] += 1
+            self.log_warning("Evicting queued %s request for a %s request", victim.priority.name, priority.name)
+            victim.future.set_exception(RequestDroppedError(f"{victim.priority.name} request evicted from queue"))
+            self._update_queue_depth()
+        elif priority != Priority.PROMPTED:
+            self._drop(priority)
+
+    async def acquire(self, priority: Priority) -> None:
+        """Wait for a slot to run a request.
+
+        Parameters
+        ----------
+        priority : Priority
+            The priority of the request.
+
+        Raises
+        ------
+        RequestDroppedError
+            If the request was dropped, either immediately or whilst waiting.
+
+        """
+        if self.metrics.active < self.max_concurrency and not self._queue:
+            self._record_wait(priority, 0.0)
+            return
+
+        if len(self._queue) >= self.max_queue_size:
+            self._make_room(priority)
+
+        request = _QueuedRequest(
+            priority, next(self._sequence), time.monotonic(), asyncio.get_running_loop().create_future()
+        )
+        heapq.heappush(self._queue, request)
+        self._update_queue_depth()
+        try:
+            await request.future
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before cancellation
+            if request.future.done() and not request.future.cancelled() and request.future.exception() is None:
+                self.release()
+            self._update_queue_depth()
+            raise
+
+    def release(self) -> None:
+        """Release a slot, handing it to the next waiting request."""
+        self.metrics.active -= 1
+        while self._queue and self.metrics.active < self.max_concurrency:
+            request = heapq.heappop(self._queue)
+            if request.future.done():
+                continue
+            self._record_wait(request.priority, time.monotonic() - request.enqueued_at)
+            request.future.set_result(None)
+        self._update_queue_depth()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: Priority) -> AsyncIterator[None]:
+        """Run a request in a slot, waiting for one to be free.
+
+        Parameters
+        ----------
+        priority : Priority
+            The priority of the request.
+
+        Raises
+        ------
+        RequestDroppedError
+            If the request was dropped because the queue is saturated.
+
+        """
+        enqueued_at = time.monotonic()
+        await self.acquire(priority)
+        # The wait is recorded in the telemetry of the requests made in the slot
+        token = QUEUE_WAIT.set(time.monotonic() - enqueued_at)
+        try:
+            yield
+        finally:
+            QUEUE_WAIT.reset(token)
+            self.release()
+
+    @contextlib.asynccontextmanager
+    async def try_slot(self, priority: Priority) -> AsyncIterator[bool]:
+        """Run a request in a slot if one is free, without waiting for one.
+
+        This is for optional requests, such as hedged requests, which are
+        not worth queueing for.
+
+        Parameters
+        ----------
+        priority : Priority
+            The priority of the request.
+
+        Yields
+        ------
+        bool
+            True if a slot was acquired, otherwise the request should not be
+            made.
+
+        """
+        if self.metrics.active >= self.max_concurrency or self._queue:
+            yield False
+            return
+
+        self._record_wait(priority, 0.0)
+        token = QUEUE_WAIT.set(0.0)
+        try:
+            yield True
+        finally:
+            QUEUE_WAIT.reset(token)
+            self.release()
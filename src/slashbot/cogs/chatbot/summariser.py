@@ -0,0 +1,349 @@
+"""Map-reduce summarisation of long channel histories.
+
+A history which is too long to summarise in one request is split into
+chunks, bounded by the number of tokens in each message, which are
+summarised concurrently. The chunk summaries are then combined, a group at a
+time, until a single summary is left. The latency is bounded by the number of
+rounds, which grows logarithmically with the length of the history.
+
+Messages can also be streamed in, e.g. from the message archive, in which
+case each chunk is summarised as soon as it has been read.
+"""
+
+import asyncio
+from collections.abc import AsyncIterable, AsyncIterator, Awaitable, Callable, Coroutine
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from slashbot.cogs.chatbot.chat_registry import SummaryMessage
+
+
+def format_messages(messages: list["SummaryMessage"]) -> str:
+    """Format messages as a transcript.
+
+    Parameters
+    ----------
+    messages : list[SummaryMessage]
+        The messages to format.
+
+    Returns
+    -------
+    str
+        One line per message, prefixed with the user.
+
+    """
+    return "\n".join(f"{message.user}: {message.content}" for message in messages)
+
+
+def chunk_messages(messages: list["SummaryMessage"], max_tokens: int) -> list[list["SummaryMessage"]]:
+    """Split messages into consecutive chunks with a maximum number of tokens.
+
+    A message larger than the maximum is put into a chunk on its own.
+
+    Parameters
+    ----------
+    messages : list[SummaryMessage]
+        The messages to split, with their tokens counted.
+    max_tokens : int
+        The maximum number of tokens in a chunk.
+
+    Returns
+    -------
+    list[list[SummaryMessage]]
+        The chunks, oldest first.
+
+    """
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for message in messages:
+        if chunk and chunk_tokens + message.tokens > max_tokens:
+            chunks.append(chunk)
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(message)
+        chunk_tokens += message.tokens
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+async def _gather(coroutines: list[Coroutine[Any, Any, str]]) -> list[str]:
+    """Run coroutines concurrently, cancelling the rest if one fails.
+
+    Parameters
+    ----------
+    coroutines : list[Coroutine[Any, Any, str]]
+        The coroutines to run.
+
+    Returns
+    -------
+    list[str]
+        The results, in the same order as the coroutines.
+
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+def _chunk_prompt(chunk: list["SummaryMessage"]) -> str:
+    """Create the prompt to summarise a chunk of a longer conversation.
+
+    Parameters
+    ----------
+    chunk : list[SummaryMessage]
+        The messages in the chunk.
+
+    Returns
+    -------
+    str
+        The prompt.
+
+    """
+    return f"Summarise the following part of a conversation between multiple users:\n{format_messages(chunk)}"
+
+
+async def _reduce(
+    summaries: list[str],
+    request: Callable[[str], Awaitable[str]],
+    count_tokens: Callable[[str], int],
+    *,
+    chunk_tokens: int,
+    max_fan_in: int,
+) -> str:
+    """Combine summaries of consecutive parts of a conversation into one.
+
+    Parameters
+    ----------
+    summaries : list[str]
+        The summaries, oldest first.
+    request : Callable[[str], Awaitable[str]]
+        The function which sends a prompt to the model, with the concurrency
+        limited.
+    count_tokens : Callable[[str], int]
+        The function to count the tokens in a summary.
+    chunk_tokens : int
+        The maximum number of tokens in each request.
+    max_fan_in : int
+        The maximum number of summaries to combine in each request.
+
+    Returns
+    -------
+    str
+        The combined summary.
+
+    """
+    while len(summaries) > 1:
+        groups = []
+        group = []
+        group_tokens = 0
+        for summary in summaries:
+            tokens = count_tokens(summary)
+            if group and (len(group) >= max_fan_in or group_tokens + tokens > chunk_tokens):
+                groups.append(group)
+                group = []
+                group_tokens = 0
+            group.append(summary)
+            group_tokens += tokens
+        groups.append(group)
+        if len(groups) == len(summaries):
+            # Each summary is too large to combine with another, so combine
+            # them in pairs regardless to make progress
+            groups = [summaries[i : i + 2] for i in range(0, len(summaries), 2)]
+
+        summaries = await _gather(
+            [
+                request(
+                    "Combine these summaries of consecutive parts of a conversation between multiple users, oldest "
+                    "first, into a single summary:\n\n"
+                    + "\n\n".join(f"Part {i}:\n{summary}" for i, summary in enumerate(group, start=1))
+                )
+                if len(group) > 1
+                else asyncio.sleep(0, group[0])
+                for group in groups
+            ]
+        )
+
+    return summaries[0]
+
+
+async def map_reduce_summary(  # noqa: PLR0913
+    messages: list["SummaryMessage"],
+    request: Callable[[str], Awaitable[str]],
+    count_tokens: Callable[[str], int],
+    *,
+    chunk_tokens: int,
+    max_fan_in: int,
+    max_concurrency: int,
+    previous_summary: str = "",
+) -> str:
+    """Summarise messages, splitting them into chunks if there are too many.
+
+    Parameters
+    ----------
+    messages : list[SummaryMessage]
+        The messages to summarise, with their tokens counted, oldest first.
+    request : Callable[[str], Awaitable[str]]
+        The function which sends a prompt to the model, and returns the
+        response.
+    count_tokens : Callable[[str], int]
+        The function to count the tokens in a summary.
+    chunk_tokens : int
+        The maximum number of tokens in each request.
+    max_fan_in : int
+        The maximum number of summaries to combine in each request.
+    max_concurrency : int
+        The maximum number of requests to make at once. Each request is also
+        subject to the global limit of the scheduler.
+    previous_summary : str
+        A summary of the conversation before the messages, which is updated
+        with the messages.
+
+    Returns
+    -------
+    str
+        The summary.
+
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def limited_request(prompt: str) -> str:
+        async with semaphore:
+            return await request(prompt)
+
+    total_tokens = sum(message.tokens for message in messages)
+    if total_tokens + count_tokens(previous_summary) <= chunk_tokens:
+        if previous_summary:
+            return await request(
+                f"This is a summary of a conversation between multiple users:\n{previous_summary}\n\n"
+                f"Update the summary to include these new messages:\n{format_messages(messages)}"
+            )
+        return await request(
+            f"Summarise the following conversation between multiple users:\n{format_messages(messages)}"
+        )
+
+    summaries = await _gather(
+        [limited_request(_chunk_prompt(chunk)) for chunk in chunk_messages(messages, chunk_tokens)]
+    )
+    if previous_summary:
+        summaries.insert(0, previous_summary)
+
+    return await _reduce(summaries, limited_request, count_tokens, chunk_tokens=chunk_tokens, max_fan_in=max_fan_in)
+
+
+async def _stream_chunks(
+    batches: AsyncIterable[list["SummaryMessage"]], count_tokens: Callable[[str], int], max_tokens: int
+) -> AsyncIterator[list["SummaryMessage"]]:
+    """Split messages into chunks with a maximum number of tokens, as they are read.
+
+    Parameters
+    ----------
+    batches : AsyncIterable[list[SummaryMessage]]
+        The messages to split, oldest first, in batches.
+    count_tokens : Callable[[str], int]
+        The function to count the tokens in a message, if not counted.
+    max_tokens : int
+        The maximum number of tokens in a chunk.
+
+    Yields
+    ------
+    list[SummaryMessage]
+        Each chunk, oldest first.
+
+    """
+    chunk = []
+    chunk_tokens = 0
+    async for batch in batches:
+        for message in batch:
+            if not message.tokens:
+                message.tokens = count_tokens(message.content)
+            if chunk and chunk_tokens + message.tokens > max_tokens:
+                yield chunk
+                chunk = []
+                chunk_tokens = 0
+            chunk.append(message)
+            chunk_tokens += message.tokens
+    if chunk:
+        yield chunk
+
+
+async def map_reduce_summary_stream(  # noqa: PLR0913
+    batches: AsyncIterable[list["SummaryMessage"]],
+    request: Callable[[str], Awaitable[str]],
+    count_tokens: Callable[[str], int],
+    *,
+    chunk_tokens: int,
+    max_fan_in: int,
+    max_concurrency: int,
+) -> str:
+    """Summarise messages as they are read, splitting them into chunks.
+
+    Each chunk is summarised as soon as it is full, whilst the next is read.
+    Reading stops whilst the maximum number of chunks are being summarised,
+    so only a bounded number of messages are held in memory.
+
+    Parameters
+    ----------
+    batches : AsyncIterable[list[SummaryMessage]]
+        The messages to summarise, oldest first, in batches.
+    request : Callable[[str], Awaitable[str]]
+        The function which sends a prompt to the model, and returns the
+        response.
+    count_tokens : Callable[[str], int]
+        The function to count the tokens in a message or summary.
+    chunk_tokens : int
+        The maximum number of tokens in each request.
+    max_fan_in : int
+        The maximum number of summaries to combine in each request.
+    max_concurrency : int
+        The maximum number of requests to make at once.
+
+    Returns
+    -------
+    str
+        The summary, or an empty string if there were no messages.
+
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks: list[asyncio.Future[str]] = []
+
+    async def summarise_chunk(chunk: list["SummaryMessage"]) -> str:
+        try:
+            return await request(_chunk_prompt(chunk))
+        finally:
+            semaphore.release()
+
+    chunks = _stream_chunks(batches, count_tokens, chunk_tokens)
+    first = await anext(chunks, None)
+    if first is None:
+        return ""
+    second = await anext(chunks, None)
+    if second is None:
+        return await request(f"Summarise the following conversation between multiple users:\n{format_messages(first)}")
+
+    async def start_chunk(chunk: list["SummaryMessage"]) -> None:
+        await semaphore.acquire()
+        tasks.append(asyncio.ensure_future(summarise_chunk(chunk)))
+
+    try:
+        await start_chunk(first)
+        await start_chunk(second)
+        async for chunk in chunks:
+            await start_chunk(chunk)
+        summaries = list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    async def limited_request(prompt: str) -> str:
+        async with semaphore:
+            return await request(prompt)
+
+    return await _reduce(summaries, limited_request, count_tokens, chunk_tokens=chunk_tokens, max_fan_in=max_fan_in)
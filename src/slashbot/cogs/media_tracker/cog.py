@@ -4,12 +4,14 @@ from collections.abc import Awaitable, Callable
 
 import disnake
 import feedparser
+import httpx
 from disnake.ext import tasks
 from feedparser import FeedParserDict
 
 from slashbot.bot.custom_cog import CustomCog
 from slashbot.database.sql_models import LoggedGameSQL, WatchedMovieSQL
 from slashbot.settings import BotSettings
+from slashbot.transport import TRANSPORTS
 
 # Type alias for the per-entry upsert callables passed to _get_new_feed_entries
 type UpsertCallable[T] = Callable[[str, FeedParserDict], Awaitable[T]]
@@ -127,7 +129,14 @@ class MediaTrackers(CustomCog):
         results: dict[str, list[T]] = {}
 
         for username in usernames:
-            user_feed = feedparser.parse(feed_url_template.format(username))
+            try:
+                response = await TRANSPORTS.get_http_client("rss").get(feed_url_template.format(username))
+                response.raise_for_status()
+            except httpx.HTTPError as exc:
+                self.log_error("Failed to fetch %s feed for %s: %s", service_label, username, exc)
+                results[username] = []
+                continue
+            user_feed = feedparser.parse(response.content)
             if not user_feed.entries:
                 self.log_warning("%s has not logged any content in %s", username, service_label)
                 results[username] = []
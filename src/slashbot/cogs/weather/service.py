@@ -10,6 +10,7 @@ from geopy.exc import GeocoderQueryError
 from geopy.location import Location
 
 from slashbot.settings import BotSettings
+from slashbot.transport import TRANSPORTS
 
 
 class GeocodeError(Exception):
@@ -371,8 +372,7 @@ class WeatherService:
             key=BotSettings.keys.openweathermap,
         )
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, timeout=5)
+        response = await TRANSPORTS.get_http_client("weather").get(url, timeout=5)
 
         if response.status_code == httpx.codes.NOT_FOUND:
             msg = f"OWM could not find co-ordinates ({location.lat}, {location.lon})"
@@ -3,9 +3,10 @@
 from .kv_database import DatabaseKV
 from .kv_models import ReminderKV, UserKV
 from .sql_database import DatabaseSQL
-from .sql_models import DeclarativeBase, ReminderSQL, UserSQL, WatchedMovieSQL
+from .sql_models import ArchivedMessageSQL, DeclarativeBase, ReminderSQL, UserSQL, WatchedMovieSQL
 
 __all__ = [
+    "ArchivedMessageSQL",
     "DatabaseKV",
     "DatabaseSQL",
     "DeclarativeBase",
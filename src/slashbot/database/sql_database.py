@@ -1,9 +1,32 @@
+import datetime
+from collections.abc import AsyncIterator
 from typing import Any
 
-from sqlalchemy import select
+from sqlalchemy import delete, select, text
+from sqlalchemy.dialects.sqlite import insert
 
 from slashbot.database.base_sql import BaseDatabaseSQL
-from slashbot.database.sql_models import LoggedGameSQL, ReminderSQL, UserSQL, WatchedMovieSQL
+from slashbot.database.sql_models import ArchivedMessageSQL, LoggedGameSQL, ReminderSQL, UserSQL, WatchedMovieSQL
+
+
+def _fts_query(query: str) -> str:
+    """Convert free text into an FTS5 query which matches every word.
+
+    Each word is quoted, so punctuation in the query is not parsed as FTS5
+    syntax.
+
+    Parameters
+    ----------
+    query : str
+        The text to search for.
+
+    Returns
+    -------
+    str
+        The FTS5 query.
+
+    """
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
 
 
 class DatabaseSQL(BaseDatabaseSQL):
@@ -236,3 +259,139 @@ class DatabaseSQL(BaseDatabaseSQL):
                     .limit(1)
                 )
             ).scalar_one_or_none()
+
+    async def archive_messages(self, messages: list[dict[str, Any]]) -> None:
+        """Add a batch of messages to the archive.
+
+        Messages which are already archived are ignored.
+
+        Parameters
+        ----------
+        messages : list[dict[str, Any]]
+            The messages, with a key for each column of ArchivedMessageSQL
+            except the ID.
+
+        """
+        if not messages:
+            return
+        async with self._get_async_session() as session:
+            await session.execute(
+                insert(ArchivedMessageSQL).on_conflict_do_nothing(index_elements=["message_id"]), messages
+            )
+            await session.commit()
+
+    async def search_archive(self, channel_id: int, query: str, *, limit: int = 10) -> list[ArchivedMessageSQL]:
+        """Search the archived messages of a channel.
+
+        Parameters
+        ----------
+        channel_id : int
+            The Discord channel ID.
+        query : str
+            The words to search for. Messages must contain every word.
+        limit : int
+            The maximum number of messages to return.
+
+        Returns
+        -------
+        list[ArchivedMessageSQL]
+            The matching messages, most relevant first.
+
+        """
+        fts_query = _fts_query(query)
+        if not fts_query:
+            return []
+        statement = text(
+            "SELECT archived_messages.* FROM archived_messages_fts "
+            "JOIN archived_messages ON archived_messages.id = archived_messages_fts.rowid "
+            "WHERE archived_messages_fts MATCH :query AND archived_messages.channel_id = :channel_id "
+            "ORDER BY bm25(archived_messages_fts) LIMIT :limit"
+        )
+        async with self._get_async_session() as session:
+            result = await session.execute(
+                select(ArchivedMessageSQL).from_statement(statement),
+                {"query": fts_query, "channel_id": channel_id, "limit": limit},
+            )
+            return list(result.scalars().all())
+
+    async def iter_archive(
+        self, channel_id: int, start: datetime.datetime, end: datetime.datetime, *, batch_size: int = 500
+    ) -> AsyncIterator[list[ArchivedMessageSQL]]:
+        """Iterate over the archived messages of a channel in a time range.
+
+        The messages are read in batches, so a long time range is not held in
+        memory at once.
+
+        Parameters
+        ----------
+        channel_id : int
+            The Discord channel ID.
+        start : datetime.datetime
+            The start of the time range, in UTC.
+        end : datetime.datetime
+            The end of the time range (exclusive), in UTC.
+        batch_size : int
+            The number of messages in each batch.
+
+        Yields
+        ------
+        list[ArchivedMessageSQL]
+            A batch of messages, oldest first.
+
+        """
+        last_id = 0
+        while True:
+            async with self._get_async_session() as session:
+                batch = list(
+                    (
+                        await session.execute(
+                            select(ArchivedMessageSQL)
+                            .where(
+                                ArchivedMessageSQL.channel_id == channel_id,
+                                ArchivedMessageSQL.created_at >= start,
+                                ArchivedMessageSQL.created_at < end,
+                                ArchivedMessageSQL.id > last_id,
+                            )
+                            .order_by(ArchivedMessageSQL.id)
+                            .limit(batch_size)
+                        )
+                    )
+                    .scalars()
+                    .all()
+                )
+            if not batch:
+                return
+            yield batch
+            last_id = batch[-1].id
+
+    async def prune_archive(self, *, older_than: datetime.datetime, max_messages_per_channel: int) -> int:
+        """Delete archived messages which are beyond the retention limits.
+
+        Parameters
+        ----------
+        older_than : datetime.datetime
+            Messages sent before this time, in UTC, are deleted.
+        max_messages_per_channel : int
+            The number of the most recent messages to keep for each channel.
+
+        Returns
+        -------
+        int
+            The number of messages deleted.
+
+        """
+        async with self._get_async_session() as session:
+            expired = await session.execute(
+                delete(ArchivedMessageSQL).where(ArchivedMessageSQL.created_at < older_than)
+            )
+            excess = await session.execute(
+                text(
+                    "DELETE FROM archived_messages WHERE id IN ("
+                    "SELECT id FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY channel_id ORDER BY id DESC) AS n "
+                    "FROM archived_messages) WHERE n > :max_messages)"
+                ),
+                {"max_messages": max_messages_per_channel},
+            )
+            await session.commit()
+
+        return expired.rowcount + excess.rowcount
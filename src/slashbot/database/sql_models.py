@@ -1,6 +1,6 @@
 import datetime
 
-from sqlalchemy import Boolean, DateTime, Float, ForeignKey, Integer, String
+from sqlalchemy import DDL, Boolean, DateTime, Float, ForeignKey, Index, Integer, String, event
 from sqlalchemy.orm import Mapped, declarative_base, mapped_column, relationship
 
 DeclarativeBase = declarative_base()
@@ -151,3 +151,53 @@ class LoggedGameSQL(DeclarativeBase):
     poster_url: Mapped[str] = mapped_column(String(512))
 
     user: Mapped["UserSQL"] = relationship(back_populates="logged_games")
+
+
+class ArchivedMessageSQL(DeclarativeBase):
+    """SQLAlchemy ORM model for an archived channel message.
+
+    The archive is append-only, and is indexed for full-text search by the
+    `archived_messages_fts` FTS5 table, which is kept up to date by triggers.
+
+    Attributes
+    ----------
+    id : int
+        Primary key for the message, which increases with time.
+    message_id : int
+        Discord message ID (unique).
+    channel_id : int
+        Discord channel ID the message was sent in.
+    author : str
+        Display name of the author.
+    content : str
+        Content of the message.
+    created_at : datetime.datetime
+        Time the message was sent, in UTC.
+
+    """
+
+    __tablename__ = "archived_messages"
+    __table_args__ = (Index("ix_archived_messages_channel_created_at", "channel_id", "created_at"),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    message_id: Mapped[int] = mapped_column(Integer, unique=True)
+    channel_id: Mapped[int] = mapped_column(Integer)
+    author: Mapped[str] = mapped_column(String(64))
+    content: Mapped[str] = mapped_column(String(4000))
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime)
+
+
+# SQLAlchemy cannot declare virtual tables, so the full-text index is created
+# along with the archive table
+ARCHIVE_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS archived_messages_fts USING fts5("
+    "author, content, content='archived_messages', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS archived_messages_fts_insert AFTER INSERT ON archived_messages BEGIN "
+    "INSERT INTO archived_messages_fts(rowid, author, content) VALUES (new.id, new.author, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS archived_messages_fts_delete AFTER DELETE ON archived_messages BEGIN "
+    "INSERT INTO archived_messages_fts(archived_messages_fts, rowid, author, content) "
+    "VALUES ('delete', old.id, old.author, old.content); END",
+)
+for _statement in ARCHIVE_FTS_DDL:
+    event.listen(ArchivedMessageSQL.__table__, "after_create", DDL(_statement))
+event.listen(ArchivedMessageSQL.__table__, "after_drop", DDL("DROP TABLE IF EXISTS archived_messages_fts"))
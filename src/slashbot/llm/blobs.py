@@ -0,0 +1,253 @@
+"""Content-addressed storage for media in model contexts.
+
+Base64 encoded images are by far the largest part of a model context, and a
+context is kept in memory for every active channel. Instead of keeping the
+media inline, contexts hold a lightweight BlobRef and the data is stored once,
+on disk, by its hash. The data is only read back (memory mapped) when building
+the request which is sent to the provider.
+
+Blobs are reference counted by the lifetime of their BlobRef: when the last
+context which refers to a blob drops it, the blob is deleted from disk.
+"""
+
+import hashlib
+import mmap
+import weakref
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from slashbot.settings import BotSettings
+
+# Only the keys which hold media data are moved into the store, and only when
+# the value is large enough to be worth it
+BLOB_KEYS = ("data", "url")
+BLOB_MIN_SIZE = 1024
+
+
+@dataclass(frozen=True, eq=False)
+class BlobRef:
+    """A reference to a blob in the store.
+
+    Attributes
+    ----------
+    digest : str
+        The SHA-256 hash of the blob.
+    size : int
+        The size of the blob, in bytes.
+
+    """
+
+    digest: str
+    size: int
+
+    def __str__(self) -> str:
+        """Print the string representation."""
+        return f"BlobRef({self.digest[:12]}, {self.size} bytes)"
+
+
+@dataclass
+class MemoryUsage:
+    """The memory used by a model context.
+
+    Attributes
+    ----------
+    inline_bytes : int
+        The size of the strings held in memory.
+    blob_bytes : int
+        The size of the blobs referenced by the context, which are on disk.
+    num_blobs : int
+        The number of blob references in the context.
+
+    """
+
+    inline_bytes: int = 0
+    blob_bytes: int = 0
+    num_blobs: int = 0
+
+
+class BlobStore:
+    """A deduplicated, on-disk, store of blobs."""
+
+    def __init__(self, directory: Path) -> None:
+        """Initialise the store.
+
+        Blobs left over from a previous run are not referenced by anything,
+        so are removed.
+
+        Parameters
+        ----------
+        directory : Path
+            The directory to store the blobs in.
+
+        """
+        self.directory = directory
+        self._refs: weakref.WeakValueDictionary[str, BlobRef] = weakref.WeakValueDictionary()
+        if self.directory.is_dir():
+            for path in self.directory.iterdir():
+                path.unlink(missing_ok=True)
+
+    def __len__(self) -> int:
+        """Get the number of blobs in the store."""
+        return len(self._refs)
+
+    def _delete(self, digest: str) -> None:
+        """Delete a blob once it is no longer referenced.
+
+        Parameters
+        ----------
+        digest : str
+            The hash of the blob.
+
+        """
+        (self.directory / digest).unlink(missing_ok=True)
+
+    def put(self, data: str) -> BlobRef:
+        """Add a blob to the store, if it is not already stored.
+
+        Parameters
+        ----------
+        data : str
+            The blob to store.
+
+        Returns
+        -------
+        BlobRef
+            A reference to the stored blob.
+
+        """
+        encoded = data.encode("utf-8")
+        digest = hashlib.sha256(encoded).hexdigest()
+        ref = self._refs.get(digest)
+        if ref is not None:
+            return ref
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / digest).write_bytes(encoded)
+        ref = BlobRef(digest, len(encoded))
+        self._refs[digest] = ref
+        weakref.finalize(ref, self._delete, digest)
+
+        return ref
+
+    def read(self, ref: BlobRef) -> str:
+        """Read a blob from the store.
+
+        Parameters
+        ----------
+        ref : BlobRef
+            The reference to the blob.
+
+        Returns
+        -------
+        str
+            The blob.
+
+        """
+        with (
+            (self.directory / ref.digest).open("rb") as file_in,
+            mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ) as mapped,
+        ):
+            return mapped[:].decode("utf-8")
+
+    def intern(self, obj: Any) -> Any:
+        """Replace large media values in a payload with blob references.
+
+        The payload is not modified, a new payload is returned.
+
+        Parameters
+        ----------
+        obj : Any
+            The payload, e.g. a message in a model context.
+
+        Returns
+        -------
+        Any
+            The payload, with media replaced by BlobRefs.
+
+        """
+        if isinstance(obj, dict):
+            return {
+                key: self.put(value)
+                if key in BLOB_KEYS and isinstance(value, str) and len(value) >= BLOB_MIN_SIZE
+                else self.intern(value)
+                for key, value in obj.items()
+            }
+        if isinstance(obj, list):
+            return [self.intern(item) for item in obj]
+        return obj
+
+    def materialise(self, obj: Any) -> Any:
+        """Replace blob references in a payload with the blob data.
+
+        Only the parts of the payload which contain references are copied,
+        so nothing is allocated for the parts of a context without media.
+
+        Parameters
+        ----------
+        obj : Any
+            The payload, e.g. a request built from a model context.
+
+        Returns
+        -------
+        Any
+            The payload, with BlobRefs replaced by their data.
+
+        """
+        if isinstance(obj, BlobRef):
+            return self.read(obj)
+        if isinstance(obj, dict):
+            materialised = None
+            for key, value in obj.items():
+                new_value = self.materialise(value)
+                if new_value is not value:
+                    if materialised is None:
+                        materialised = dict(obj)
+                    materialised[key] = new_value
+            return obj if materialised is None else materialised
+        if isinstance(obj, list):
+            materialised = None
+            for i, item in enumerate(obj):
+                new_item = self.materialise(item)
+                if new_item is not item:
+                    if materialised is None:
+                        materialised = list(obj)
+                    materialised[i] = new_item
+            return obj if materialised is None else materialised
+        return obj
+
+    @staticmethod
+    def measure(obj: Any, usage: MemoryUsage | None = None) -> MemoryUsage:
+        """Measure the memory used by a payload.
+
+        Parameters
+        ----------
+        obj : Any
+            The payload, e.g. a model context.
+        usage : MemoryUsage | None
+            The usage to add to, used when recursing.
+
+        Returns
+        -------
+        MemoryUsage
+            The bytes held inline, and the bytes and number of blobs referenced.
+
+        """
+        usage = usage or MemoryUsage()
+        if isinstance(obj, BlobRef):
+            usage.blob_bytes += obj.size
+            usage.num_blobs += 1
+        elif isinstance(obj, str):
+            usage.inline_bytes += len(obj)
+        elif isinstance(obj, dict):
+            for key, value in obj.items():
+                usage.inline_bytes += len(key)
+                BlobStore.measure(value, usage)
+        elif isinstance(obj, list):
+            for item in obj:
+                BlobStore.measure(item, usage)
+
+        return usage
+
+
+BLOB_STORE = BlobStore(BotSettings.files.blob_store)
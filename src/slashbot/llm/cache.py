@@ -0,0 +1,172 @@
+"""Tracking for provider-side prompt caches.
+
+Every request re-sends the system prompt and the conversation history, which
+the provider has to prefill again unless the stable prefix of the request is
+cached. Anthropic caches prefixes marked with `cache_control` breakpoints, and
+Gemini caches explicitly created `cachedContents`. The classes in this module
+keep track of what is (probably) cached for a conversation, when it expires,
+and how many tokens have been read from and written to the cache.
+"""
+
+import hashlib
+import json
+import time
+from dataclasses import dataclass
+from typing import Any
+
+# The longest time to wait before trying to write an explicit cache again,
+# after writes have failed
+MAX_WRITE_BACKOFF = 3600.0
+
+
+@dataclass
+class PromptCacheStats:
+    """Running totals of prompt cache usage.
+
+    Attributes
+    ----------
+    requests : int
+        The number of requests which have reported usage.
+    hits : int
+        The number of requests where tokens were read from the cache.
+    cache_read_tokens : int
+        The total number of input tokens read from the cache.
+    cache_write_tokens : int
+        The total number of input tokens written to the cache.
+    input_tokens : int
+        The total number of input tokens, including cached tokens.
+
+    """
+
+    requests: int = 0
+    hits: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+    input_tokens: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """The fraction of input tokens which were read from the cache."""
+        return self.cache_read_tokens / self.input_tokens if self.input_tokens else 0.0
+
+
+def fingerprint_prefix(*parts: Any) -> str:
+    """Create a fingerprint for the content of a cached prefix.
+
+    Parameters
+    ----------
+    *parts : Any
+        JSON serialisable parts of the request which make up the prefix.
+
+    Returns
+    -------
+    str
+        A hash of the prefix.
+
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class PromptCache:
+    """The prompt cache state for a single conversation.
+
+    For providers with implicit prefix caching (Anthropic), this only tracks
+    the expiry time and usage. For providers with explicit caches (Gemini), it
+    also keeps the name of the cache, the number of context messages it covers
+    and a fingerprint of those messages, so that it is only reused whilst the
+    prefix of the conversation is unchanged. Replaced caches are kept in
+    `retired` until they are deleted, and writes back off after a failure.
+    """
+
+    def __init__(self, *, ttl: float) -> None:
+        """Initialise an empty cache.
+
+        Parameters
+        ----------
+        ttl : float
+            The number of seconds a cache lives for after being written (or
+            refreshed).
+
+        """
+        self.ttl = ttl
+        self.name: str | None = None
+        self.fingerprint: str | None = None
+        self.num_messages = 0
+        self.expires_at = 0.0
+        self.retired: list[str] = []
+        self.write_failures = 0
+        self.retry_write_at = 0.0
+        self.stats = PromptCacheStats()
+
+    @property
+    def is_warm(self) -> bool:
+        """Whether the cache is believed to still exist on the provider."""
+        return time.monotonic() < self.expires_at
+
+    @property
+    def can_write(self) -> bool:
+        """Whether a cache can be written, i.e. writes are not backing off."""
+        return time.monotonic() >= self.retry_write_at
+
+    def invalidate(self) -> None:
+        """Forget the cached prefix, e.g. when the system prompt changes."""
+        if self.name is not None:
+            self.retired.append(self.name)
+        self.name = None
+        self.fingerprint = None
+        self.num_messages = 0
+        self.expires_at = 0.0
+
+    def refresh(self, *, name: str | None = None, fingerprint: str | None = None, num_messages: int = 0) -> None:
+        """Mark the cache as (re)written, resetting its expiry time.
+
+        Parameters
+        ----------
+        name : str | None
+            The provider's name for an explicitly created cache.
+        fingerprint : str | None
+            The fingerprint of the cached prefix.
+        num_messages : int
+            The number of context messages in the cached prefix.
+
+        """
+        if name is not None:
+            if self.name is not None and self.name != name:
+                self.retired.append(self.name)
+            self.name = name
+            self.fingerprint = fingerprint
+            self.num_messages = num_messages
+        self.expires_at = time.monotonic() + self.ttl
+        self.write_failures = 0
+
+    def record_write_failure(self) -> None:
+        """Back off from writing a cache, after a write failed.
+
+        The first retry is after the lifetime of a cache, and the wait doubles
+        with each consecutive failure, up to an hour. This stops a model which
+        cannot cache the prefix, e.g. as it is below the model's minimum size,
+        from trying on every request.
+        """
+        self.write_failures += 1
+        backoff = min(self.ttl * 2 ** (self.write_failures - 1), MAX_WRITE_BACKOFF)
+        self.retry_write_at = time.monotonic() + backoff
+
+    def record_usage(self, input_tokens: int, cache_read_tokens: int, cache_write_tokens: int) -> None:
+        """Record the cache usage reported for a request.
+
+        Parameters
+        ----------
+        input_tokens : int
+            The total number of input tokens, including cached tokens.
+        cache_read_tokens : int
+            The number of input tokens read from the cache.
+        cache_write_tokens : int
+            The number of input tokens written to the cache.
+
+        """
+        self.stats.requests += 1
+        self.stats.input_tokens += input_tokens
+        self.stats.cache_read_tokens += cache_read_tokens
+        self.stats.cache_write_tokens += cache_write_tokens
+        if cache_read_tokens:
+            self.stats.hits += 1
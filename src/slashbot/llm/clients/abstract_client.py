@@ -1,16 +1,24 @@
-import asyncio
-import logging
-import logging.handlers
+import dataclasses
+import itertools
 from abc import ABCMeta, abstractmethod
+from collections.abc import AsyncIterator, Iterable, Sequence
 from typing import Any
 
+from slashbot.llm.blobs import BLOB_STORE, MemoryUsage
+from slashbot.llm.cache import PromptCache
+from slashbot.llm.clients.resilience import get_resilience
+from slashbot.llm.conversation import Conversation, ConversationMessage
 from slashbot.llm.models import (
     TextGenerationInput,
     TextGenerationResponse,
+    TokenLedgerEntry,
     VisionImage,
     VisionVideo,
 )
 from slashbot.llm.prompts import read_in_prompt
+from slashbot.llm.request_log import REQUEST_LOG
+from slashbot.llm.telemetry import TELEMETRY, RequestTrace
+from slashbot.llm.tokenizer import PROMPT_TOKEN_CACHE, TokenReconciler, get_tokenizer
 from slashbot.logger import Logger
 from slashbot.settings import BotSettings
 
@@ -19,6 +27,7 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
     """Abstract class for a TextGenerationClient."""
 
     DEFAULT_SYSTEM_PROMPT = read_in_prompt(BotSettings.cogs.chatbot.default_chat_prompt)
+    COMPACTION_REQUEST = "Remind me what we have talked about so far."
 
     def __init__(self, model_name: str, **kwargs: Any) -> None:
         """Initialise the text generation class.
@@ -36,22 +45,96 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
         self.system_prompt = kwargs.get("system_prompt", self.DEFAULT_SYSTEM_PROMPT.prompt)
         self.system_prompt_name = kwargs.get("system_prompt_name", self.DEFAULT_SYSTEM_PROMPT.name)
 
-        self._model_context = []
+        self.conversation = Conversation()
+        self._system_prompt_tokens = 0
         self._client = None
         self._base_url = None
         self._async_timeout = 240  # seconds
-        self._token_window_size = BotSettings.cogs.chatbot.token_window_size
+        self._token_window_size = BotSettings.cogs.chatbot.context_window_size
         self._max_completion_tokens = BotSettings.cogs.chatbot.max_output_tokens
 
-        self._response_logger = logging.getLogger(f"TextGenerationAbstractClient-{model_name}")
-        self._logger_lock = asyncio.Lock()
+        # The channel the client makes requests for, if any, which is used to
+        # sample the request log
+        self.channel_id: int | None = None
 
-        self.init_client(self.model_name)
-        self.token_size = self.count_tokens(self.system_prompt)
-        self._setup_response_logger(self.model_name)
+        self.prompt_cache = PromptCache(ttl=self._prompt_cache_ttl)
+        self.tokenizer = get_tokenizer(self.client_type)
+        self.resilience = get_resilience(self.client_type)
+        self._token_reconciler = (
+            TokenReconciler(self.tokenizer, self.count_tokens_exact)
+            if BotSettings.cogs.chatbot.enable_exact_token_counts
+            else None
+        )
 
-    def _add_to_model_context(self, new_content: dict) -> None:
-        """Add new contents to the model context.
+        # The client is initialised on the first request, so creating a client
+        # does not do any I/O
+        self._reset_token_ledger()
+
+    def __len__(self) -> int:
+        """Get the length of the conversation, excluding the system prompt.
+
+        Returns
+        -------
+        int
+            The length of the conversation.
+
+        """
+        return len(self.conversation)
+
+    @property
+    def _model_context_message_content(self) -> list[dict]:
+        """Return the messages in the context, in the provider's format.
+
+        Messages added since the last request are rendered, and the rest are
+        taken from the conversation's cache.
+
+        Returns
+        -------
+        list[dict]
+            The contents of the context.
+
+        """
+        return self.conversation.render(self._render_key, self._render_message)
+
+    @property
+    def _render_key(self) -> tuple[str, str]:
+        """Get the key identifying the format messages are rendered in.
+
+        Returns
+        -------
+        tuple[str, str]
+            The client type and model, as the model determines which media is
+            included.
+
+        """
+        return self.client_type, self.model_name
+
+    @property
+    def token_size(self) -> int:
+        """Get the size of the context, including the system prompt, in tokens.
+
+        Returns
+        -------
+        int
+            The number of tokens in the context.
+
+        """
+        return self._system_prompt_tokens + self.conversation.token_total
+
+    @property
+    def _prompt_cache_ttl(self) -> float:
+        """Get the lifetime of the provider's prompt cache, in seconds.
+
+        Returns
+        -------
+        float
+            The number of seconds a cache lives for once written.
+
+        """
+        return BotSettings.cogs.chatbot.prompt_cache_ttl
+
+    def _add_to_model_context(self, message: ConversationMessage, *, tokens: int | None = None) -> None:
+        """Add a new message to the model context.
 
         This has various pre-processing steps for adding new messages, such as
         making sure there is only a certain number of images in the model
@@ -59,32 +142,86 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
 
         Parameters
         ----------
-        new_content : dict
-            The new content to add to the model context.
+        message : ConversationMessage
+            The new message to add to the model context.
+        tokens : int | None
+            The number of tokens in the new message, if already known. If
+            None, the tokens are counted.
 
         """
         # Keep some variable amount of images in the request. If we have too
-        # many images, then the latency is too high
-        i = 0
-        num_images = 0
-        while i < len(self._model_context_message_content):
-            contents = self._model_context_message_content[i]
-            # can only be an image of contents is a dict or a list
-            if not isinstance(contents, str):
-                if self._check_context_contains_images(contents):
-                    num_images += 1
-                if num_images > BotSettings.cogs.chatbot.max_images_in_window:
-                    self.log_debug("Removing an image from model context")
-                    self._remove_message_from_model_context(i)
-                    continue  # don't increment as the lift has been shifted
-            i += 1
-
-        # But we still include new video request here, we are only removing OLD
-        # youtube links. The one added to the context here will be removed
-        # before the next request is sent
-        self.log_debug("Model context before append: %s", self._model_context)
-        self._model_context_message_content.append(new_content)
-        self.log_debug("Updated model context: %s", self._model_context)
+        # many images, then the latency is too high. The conversation keeps an
+        # index of the messages with images, so the oldest are removed without
+        # searching the context
+        while self.conversation.num_with_images > BotSettings.cogs.chatbot.max_images_in_window:
+            self.log_debug("Removing an image from model context")
+            self._remove_message_from_model_context(self.conversation.positions_with_images()[0])
+
+        self._append_to_model_context(message, tokens=tokens)
+        self.log_debug("Added %s to model context", message)
+
+    def _append_to_model_context(self, message: ConversationMessage, *, tokens: int | None = None) -> None:
+        """Append a message to the model context and the token ledger.
+
+        The message is rendered in the provider's format once, when it is
+        added, which is also when the number of tokens is counted.
+
+        Parameters
+        ----------
+        message : ConversationMessage
+            The new message to add to the model context.
+        tokens : int | None
+            The number of tokens in the new message, if already known. If
+            None, the tokens are counted.
+
+        """
+        rendered = self._render_message(message)
+        message.tokens = self.count_tokens(rendered) if tokens is None else tokens
+        self.conversation.append(message, rendered=rendered, key=self._render_key)
+
+    def _render_message(self, message: ConversationMessage) -> dict:
+        """Render a message in the conversation in the provider's format.
+
+        Parameters
+        ----------
+        message : ConversationMessage
+            The message to render.
+
+        Returns
+        -------
+        dict
+            The message, with media as blob references.
+
+        """
+        if message.role == "assistant":
+            return self._create_assistant_response_object(message.text)
+        return BLOB_STORE.intern(self._create_user_payload(message.texts, message.images, message.videos))
+
+    def _create_user_payload(
+        self, texts: Iterable[str], images: Sequence[VisionImage], videos: Sequence[VisionVideo]
+    ) -> dict | list[dict]:
+        """Create the payload for a user message with text, images and videos.
+
+        Parameters
+        ----------
+        texts : Iterable[str]
+            The text of the message.
+        images : Sequence[VisionImage]
+            The images in the message.
+        videos : Sequence[VisionVideo]
+            The videos in the message.
+
+        Returns
+        -------
+        dict | list[dict]
+            An appropriately formatted payload for the current active client.
+
+        """
+        text_content = [self._create_text_input_object(text) for text in texts]
+        image_content = self._create_image_input_object(list(images)) if images else []
+        video_content = self._create_video_input_object(list(videos)) if videos else []
+
+        return self._create_user_input_object(text_content, image_content, video_content)
 
     def _create_content_payload(self, messages: TextGenerationInput | list[TextGenerationInput]) -> dict | list[dict]:
         """Create the contents payload for a request.
@@ -110,18 +247,15 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
 
         self.log_debug("Creating request payload for %s using %s", self.model_name, messages)
 
-        text_content = []
-        image_content = []
-        video_content = []
-
+        images = []
+        videos = []
         for message in messages:
-            text_content.append(self._create_text_input_object(message.text))
             if message.images:
-                image_content.extend(self._create_image_input_object(message.images))
+                images.extend(message.images if isinstance(message.images, list) else [message.images])
             if message.videos:
-                video_content.extend(self._create_video_input_object(message.videos))
+                videos.extend(message.videos if isinstance(message.videos, list) else [message.videos])
 
-        user_request_object = self._create_user_input_object(text_content, image_content, video_content)
+        user_request_object = self._create_user_payload([message.text for message in messages], images, videos)
         self.log_debug("Created request object %s", user_request_object)
 
         return user_request_object
@@ -139,8 +273,83 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
             msg2 = self._remove_message_from_model_context(0)
             self.log_debug("Removed messages\n\t[1] %s\n\t[2] %s", msg1, msg2)
 
-    def _remove_message_from_model_context(self, index: int) -> dict:
-        """Remove an image from the conversation context.
+    def select_messages_to_compact(self, target_tokens: int) -> list[ConversationMessage]:
+        """Select the oldest turns to replace with a digest.
+
+        Only whole turns, ending with a response, are selected so the digest
+        is followed by a user message. The most recent turn is never selected.
+
+        Parameters
+        ----------
+        target_tokens : int
+            The size of the context, in tokens, to shrink to.
+
+        Returns
+        -------
+        list[ConversationMessage]
+            The messages to compact, oldest first, or an empty list if the
+            context is small enough already or there is nothing to compact.
+
+        """
+        excess_tokens = self.token_size - target_tokens
+        if excess_tokens <= 0:
+            return []
+
+        min_messages_to_keep = 2
+        num_to_compact = 0
+        num_tokens = 0
+        for i, message in enumerate(itertools.islice(self.conversation, len(self) - min_messages_to_keep)):
+            num_tokens += message.tokens
+            if message.role == "assistant":
+                num_to_compact = i + 1
+                if num_tokens >= excess_tokens:
+                    break
+
+        # Compacting a single turn would replace it with another
+        if num_to_compact <= min_messages_to_keep:
+            return []
+
+        return list(itertools.islice(self.conversation, num_to_compact))
+
+    def compact_context(self, messages: list[ConversationMessage], digest: str) -> bool:
+        """Replace the oldest messages in the context with a digest of them.
+
+        The digest is added as a turn, so the roles still alternate. If the
+        messages are no longer the oldest in the context, e.g. because the
+        context was reset whilst the digest was generated, nothing is changed.
+
+        Parameters
+        ----------
+        messages : list[ConversationMessage]
+            The messages to replace, as returned by
+            `select_messages_to_compact()`.
+        digest : str
+            The digest of the messages.
+
+        Returns
+        -------
+        bool
+            True if the messages were replaced.
+
+        """
+        replacements = [
+            ConversationMessage("user", (self.COMPACTION_REQUEST,)),
+            ConversationMessage("assistant", (digest,)),
+        ]
+        rendered = [self._render_message(message) for message in replacements]
+        for message, payload in zip(replacements, rendered, strict=True):
+            message.tokens = self.count_tokens(payload)
+        if not self.conversation.replace_oldest(messages, replacements, rendered=rendered, key=self._render_key):
+            return False
+
+        # The start of the context has changed, so the cached prefix is no use
+        self.prompt_cache.invalidate()
+        self.log_debug("Compacted %d messages into a digest of %d tokens", len(messages), replacements[1].tokens)
+
+        return True
+
+    def _remove_message_from_model_context(self, index: int) -> ConversationMessage:
+        """Remove a message from the conversation context.
 
         Parameters
         ----------
@@ -149,7 +358,7 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
 
         Returns
         -------
-        dict
+        ConversationMessage
             The removed message, including all content (text, image, video).
 
         """
@@ -160,68 +369,366 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
             msg = "Cannot remove message at index greater than number of messages"
             raise IndexError(msg)
 
-        message = self._model_context_message_content[index]
-        removed_message_tokens = self.count_tokens(message)
-        self.token_size -= removed_message_tokens
-        self.log_debug("Removed %s tokens with message %s", removed_message_tokens, message)
+        message = self.conversation.pop(index)
+        self.log_debug("Removed %s tokens with message %s", message.tokens, message)
 
-        return self._model_context_message_content.pop(index)
+        return message
 
-    def _setup_response_logger(self, model_name: str) -> None:
-        """Set up a debug logger for logging responses and requests.
+    def _get_context_request(self, *, recalled: str = "") -> dict | list[dict]:
+        """Get the request payload for the current model context.
 
         Parameters
         ----------
-        model_name : str
-            The name of the model.
+        recalled : str
+            Earlier messages recalled for the newest message, if any.
 
         Returns
         -------
-        logging.Logger
-            The initialised logger.
+        dict | list[dict]
+            The payload to send to the API for the model context.
 
         """
-        logger = logging.getLogger(f"TextGenerationAbstractClient-{model_name}")
+        return self._request_message_content(recalled)
+
+    def _request_message_content(self, recalled: str) -> list[dict]:
+        """Get the messages to send for the model context.
+
+        Recalled messages are added to the start of the newest message for
+        this request only, so they are not kept in the context and the rest
+        of the rendered context, and any prompt cache, is unaffected.
 
-        if not logger.handlers:
-            handler = logging.handlers.RotatingFileHandler(
-                f"logs/{model_name}-requests.log", mode="a", maxBytes=int(5 * 1e6), backupCount=1
+        Parameters
+        ----------
+        recalled : str
+            Earlier messages recalled for the newest message, if any.
+
+        Returns
+        -------
+        list[dict]
+            The messages, in the provider's format.
+
+        """
+        content = self._model_context_message_content
+        if not recalled or not content or self.conversation[-1].role != "user":
+            return content
+
+        newest = self.conversation[-1]
+        return [*content[:-1], self._render_message(dataclasses.replace(newest, texts=(recalled, *newest.texts)))]
+
+    def _estimate_request_tokens(self, recalled: str) -> int:
+        """Estimate the input tokens for a request for the model context.
+
+        Parameters
+        ----------
+        recalled : str
+            Earlier messages recalled for the newest message, if any.
+
+        Returns
+        -------
+        int
+            The size of the context, and the recalled messages, in tokens.
+
+        """
+        return self.token_size + (self.count_tokens(recalled) if recalled else 0)
+
+    def _reset_token_ledger(self) -> None:
+        """Reset the token ledger for an empty context and the system prompt.
+
+        As this is done when the context is replaced, the prompt cache is also
+        forgotten. The system prompt is counted using the process-wide cache,
+        so this is cheap for prompts which have already been seen.
+        """
+        self.prompt_cache.invalidate()
+        self._system_prompt_tokens = round(
+            PROMPT_TOKEN_CACHE.count(self.model_name, self.system_prompt) * self.tokenizer.scale
+        )
+
+    def _log_request(self, content: Any) -> RequestTrace:
+        """Log a request to an LLM API, and start timing it.
+
+        The request is written to the request log in the background.
+
+        Parameters
+        ----------
+        content : Any
+            The content of the request.
+
+        Returns
+        -------
+        RequestTrace
+            The trace to log the response and record the request with.
+
+        """
+        log_id = REQUEST_LOG.log_request(self.model_name, self.channel_id, content)
+        return TELEMETRY.start_request(self.client_type, self.model_name, self.channel_id, log_id)
+
+    def _log_response(self, trace: RequestTrace, response: Any) -> None:
+        """Log the response to a request to an LLM API.
+
+        Parameters
+        ----------
+        trace : RequestTrace
+            The trace returned when the request was logged.
+        response : Any
+            The response.
+
+        """
+        REQUEST_LOG.log_response(trace.log_id, self.model_name, self.channel_id, response)
+
+    @staticmethod
+    def _record_failed_request(trace: RequestTrace) -> None:
+        """Record a failed request in the telemetry.
+
+        Parameters
+        ----------
+        trace : RequestTrace
+            The trace returned when the request was logged.
+
+        """
+        TELEMETRY.record_failure(trace)
+
+    def _record_token_usage(self, trace: RequestTrace, estimated_tokens: int, response: TextGenerationResponse) -> None:
+        """Calibrate the local token estimator against reported usage.
+
+        The prompt cache usage, and the telemetry, for the request are also
+        recorded.
+
+        Parameters
+        ----------
+        trace : RequestTrace
+            The trace returned when the request was logged.
+        estimated_tokens : int
+            The local estimate of the input tokens for the request.
+        response : TextGenerationResponse
+            The response, which includes the input tokens reported by the
+            provider.
+
+        """
+        TELEMETRY.record(trace, response)
+        if not response.input_tokens:
+            return
+        self.prompt_cache.record_usage(response.input_tokens, response.cached_tokens, response.cache_creation_tokens)
+        if response.cached_tokens or response.cache_creation_tokens:
+            self.log_debug(
+                "Prompt cache read %d and wrote %d of %d input tokens",
+                response.cached_tokens,
+                response.cache_creation_tokens,
+                response.input_tokens,
             )
-            formatter = logging.Formatter("%(asctime)s | %(message)s", "%Y-%m-%d %H:%M:%S")
-            handler.setFormatter(formatter)
-            logger.setLevel(logging.INFO)
-            logger.addHandler(handler)
-            logger.propagate = False
+        self.tokenizer.record_usage(estimated_tokens, response.input_tokens)
+        self.log_debug(
+            "Estimated %d input tokens, provider reported %d (scale=%.3f)",
+            estimated_tokens,
+            response.input_tokens,
+            self.tokenizer.scale,
+        )
 
-        self._response_logger = logger
+    def count_tokens(self, messages: dict | list[dict[str, str]] | str) -> int:
+        """Estimate the number of tokens in a message for the current model.
 
-    async def _log_request(self, message: str, *args: Any) -> None:
-        """Log a request to an LLM API.
+        The count is made locally and does not make any network requests. If
+        exact token counting is enabled, the message is also queued to be
+        counted by the provider in the background to calibrate the estimate.
 
         Parameters
         ----------
-        message : str
-            The message string to love.
-        *args : Any
-            Additional arguments, typically used for string interpolation.
+        messages : dict | list[dict[str, str]] | str
+            The message to count the number of tokens.
+
+        Returns
+        -------
+        int
+            The estimated number of tokens.
 
         """
-        async with self._logger_lock:
-            self._response_logger.info("Request  | %s", message % args)
+        tokens = self.tokenizer.count(messages)
+        if self._token_reconciler:
+            self._token_reconciler.submit(messages, tokens)
 
-    async def _log_response(self, message: str, *args: Any) -> None:
-        """Log a response for a LLM API.
+        return tokens
+
+    def get_context(self) -> list[ConversationMessage]:
+        """Get the messages in the model context.
+
+        Returns
+        -------
+        list[ConversationMessage]
+            Each message, with media as blob references, oldest first.
+
+        """
+        return list(self.conversation)
+
+    def restore_context(self, messages: list[ConversationMessage]) -> None:
+        """Restore previously recorded messages, after the system prompt.
+
+        The messages are assumed to have been counted for this provider.
 
         Parameters
         ----------
-        message : str
-            The message string to love.
-        *args : Any
-            Additional arguments, typically used for string interpolation.
+        messages : list[ConversationMessage]
+            Each message, oldest first.
 
         """
-        async with self._logger_lock:
-            self._response_logger.info("Response | %s", message % args)
+        for message in messages:
+            self.conversation.append(message)
+        self.conversation.counted_by = self.client_type
+
+    def remove_messages(self, messages: list[ConversationMessage]) -> None:
+        """Remove messages from the context, if they are still in it.
+
+        The messages are found by identity, searching from the newest, so this
+        is cheap for recent messages.
+
+        Parameters
+        ----------
+        messages : list[ConversationMessage]
+            The messages to remove.
+
+        """
+        for message in messages:
+            index = next(
+                (i for i in range(len(self.conversation) - 1, -1, -1) if self.conversation[i] is message), None
+            )
+            if index is not None:
+                self._remove_message_from_model_context(index)
+
+    def use_conversation(self, conversation: Conversation) -> None:
+        """Use a conversation, e.g. one which was used with another model.
+
+        The conversation is rendered in the provider's format, and the tokens
+        in each message are re-counted if they were counted for a different
+        provider.
+
+        Parameters
+        ----------
+        conversation : Conversation
+            The conversation to use as the model context.
+
+        """
+        self.conversation = conversation
+        self.prompt_cache.invalidate()
+        rendered = self._model_context_message_content
+        if conversation.counted_by != self.client_type:
+            conversation.recount(self.client_type, [self.tokenizer.count(message) for message in rendered])
+
+    def get_memory_usage(self) -> MemoryUsage:
+        """Get the memory used by the model context.
+
+        Returns
+        -------
+        MemoryUsage
+            The bytes held in memory, and the bytes of media held in the blob
+            store.
+
+        """
+        return self.conversation.memory_usage()
+
+    def get_token_ledger(self) -> list[TokenLedgerEntry]:
+        """Get the number of tokens for each message in the context.
+
+        Returns
+        -------
+        list[TokenLedgerEntry]
+            An entry for the system prompt, followed by an entry for each
+            message in the context, oldest first.
+
+        """
+        ledger = [TokenLedgerEntry("system", self.system_prompt, self._system_prompt_tokens)]
+        ledger.extend(
+            TokenLedgerEntry(message.role, message.text, message.tokens, len(message.images))
+            for message in self.conversation
+        )
+
+        return ledger
+
+    async def stream_response_with_context(
+        self, messages: TextGenerationInput | list[TextGenerationInput], *, recalled: str = ""
+    ) -> AsyncIterator[str]:
+        """Stream a text response, given new text input and previous context.
+
+        The response is added to the context once the stream has completed. If
+        the stream fails part way through, the partial response is discarded.
+
+        Parameters
+        ----------
+        messages : TextGenerationInput | list[TextGenerationInput]
+            Input message(s), from the user, including attached images and
+            videos.
+        recalled : str
+            Earlier messages relevant to the input, which are sent with the
+            input but are not kept in the context.
+
+        Yields
+        ------
+        str
+            The response text, as it is generated.
+
+        """
+        self._shrink_model_context_to_window_size()
+        self._add_to_model_context(ConversationMessage.from_inputs(messages))
+
+        response = TextGenerationResponse("", 0)
+        async for text in self.stream_response(
+            self._get_context_request(recalled=recalled),
+            response,
+            estimated_tokens=self._estimate_request_tokens(recalled),
+        ):
+            yield text
+
+        if not response.message:
+            msg = f"A valid response was not streamed by the {self.client_type} client."
+            raise ValueError(msg)
+
+        self._add_to_model_context(
+            ConversationMessage("assistant", (response.message,)), tokens=response.output_tokens or None
+        )
+
+    def add_input_to_context(self, messages: TextGenerationInput | list[TextGenerationInput]) -> None:
+        """Add new input to the context, making room for it if required.
+
+        Parameters
+        ----------
+        messages : TextGenerationInput | list[TextGenerationInput]
+            Input message(s), from the user, including attached images and
+            videos.
+
+        """
+        self._shrink_model_context_to_window_size()
+        self._add_to_model_context(ConversationMessage.from_inputs(messages))
+
+    def add_response_to_context(self, response: TextGenerationResponse) -> None:
+        """Add a response to the newest input to the context.
+
+        Parameters
+        ----------
+        response : TextGenerationResponse
+            The response, which may have been generated by another client
+            sharing the conversation.
+
+        """
+        if not response.message:
+            msg = f"A valid response was not generated for the {self.client_type} client."
+            raise ValueError(msg)
+        self._append_to_model_context(
+            ConversationMessage("assistant", (response.message,)), tokens=response.output_tokens or None
+        )
+
+    def create_context_request(self, *, recalled: str = "") -> tuple[dict | list[dict], int]:
+        """Create a request for the current context, in the provider's format.
+
+        Parameters
+        ----------
+        recalled : str
+            Earlier messages relevant to the newest input, which are sent with
+            it but are not kept in the context.
+
+        Returns
+        -------
+        tuple[dict | list[dict], int]
+            The request, and the local estimate of its input tokens.
+
+        """
+        return self._get_context_request(recalled=recalled), self._estimate_request_tokens(recalled)
 
     def create_content_payload_object(self, messages: TextGenerationInput | list[TextGenerationInput]) -> dict | list:
         """Create a request JSON for the current LLM model.
@@ -253,39 +760,8 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
 
     @property
     @abstractmethod
-    def _model_context_message_content(self) -> list[dict]:
-        """Return a reference to the contents of the context.
-
-        This reference exists because the request objects are different for
-        each LLM.
-
-        Returns
-        -------
-        list[dict]
-            The contents of the context.
-
-        """
-
-    @abstractmethod
-    def __len__(self) -> int:
-        """Get the length of the conversation."""
-
-    @abstractmethod
-    def _check_context_contains_images(self, contents: dict) -> bool:
-        """Check if an image is present in the client's content.
-
-        Parameters
-        ----------
-        contents : dict
-            An individual message object which has been passed to LLM, e.g.
-            {"role": "user", "content": [{"type": "text", "text": "hello"}]}
-
-        Returns
-        -------
-        bool
-            If an image, returns True. Otherwise, returns False.
-
-        """
+    def client_type(self) -> str:
+        """Get the client type, used to identify the provider."""
 
     @abstractmethod
     def _create_assistant_response_object(self, message: str) -> dict:
@@ -374,19 +850,24 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
         """
 
     @abstractmethod
-    def count_tokens(self, messages: dict | list[dict[str, str]] | str) -> int:
-        """Count the number of tokens in a message.
+    async def count_tokens_exact(self, messages: dict | list[dict[str, str]] | str) -> int:
+        """Count the number of tokens in a message using the provider's API.
 
         Parameters
         ----------
         messages : dict | list[dict[str, str]] | str
             The message to count the number of tokens.
 
+        Returns
+        -------
+        int
+            The number of tokens, as counted by the provider.
+
         """
 
     @abstractmethod
     async def generate_response_with_context(
-        self, messages: TextGenerationInput | list[TextGenerationInput]
+        self, messages: TextGenerationInput | list[TextGenerationInput], *, recalled: str = ""
     ) -> TextGenerationResponse:
         """Generate a text response, given new text input and previous context.
 
@@ -398,6 +879,9 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
         messages : ContextMessage | list[ContextMessage]
             Input message(s), from the user, including attached images and
             videos.
+        recalled : str
+            Earlier messages relevant to the input, which are sent with the
+            input but are not kept in the context.
 
         """
 
@@ -413,13 +897,43 @@ class TextGenerationAbstractClient(Logger, metaclass=ABCMeta):
         """
 
     @abstractmethod
-    async def generate_response(self, content: dict | list[dict]) -> TextGenerationResponse:
+    async def generate_response(
+        self, content: dict | list[dict], *, estimated_tokens: int | None = None
+    ) -> TextGenerationResponse:
         """Send a request to the API client.
 
         Parameters
         ----------
         content : list[dict] | dict
             The (correctly) formatted content to send to the API.
+        estimated_tokens : int | None
+            The local estimate of the input tokens, if already known. Requests
+            for the model context pass the size of the context, so the context
+            is not re-counted for every request.
+
+        """
+
+    @abstractmethod
+    def stream_response(
+        self, content: dict | list[dict], response: TextGenerationResponse, *, estimated_tokens: int | None = None
+    ) -> AsyncIterator[str]:
+        """Send a request to the API client and stream the response.
+
+        Parameters
+        ----------
+        content : list[dict] | dict
+            The (correctly) formatted content to send to the API.
+        response : TextGenerationResponse
+            The response to populate. The text is accumulated into the message
+            as it is streamed, and the token usage is set once the stream has
+            completed.
+        estimated_tokens : int | None
+            The local estimate of the input tokens, if already known.
+
+        Yields
+        ------
+        str
+            The response text, as it is generated.
 
         """
 
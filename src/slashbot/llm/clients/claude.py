@@ -1,7 +1,12 @@
+from collections.abc import AsyncIterator
+from typing import Any, ClassVar
+
 import anthropic
-from anthropic import Anthropic, AsyncAnthropic
+from anthropic import AsyncAnthropic
 
+from slashbot.llm.blobs import BLOB_STORE
 from slashbot.llm.clients.abstract_client import TextGenerationAbstractClient
+from slashbot.llm.conversation import ConversationMessage
 from slashbot.llm.models import (
     GenerationFailureError,
     TextGenerationInput,
@@ -10,6 +15,7 @@ from slashbot.llm.models import (
     VisionVideo,
 )
 from slashbot.settings import BotSettings
+from slashbot.transport import TRANSPORTS
 
 
 class ClaudeClient(TextGenerationAbstractClient):
@@ -20,37 +26,16 @@ class ClaudeClient(TextGenerationAbstractClient):
     SEARCH_MODELS = ()
     AUDIO_MODELS = ()
     VIDEO_MODELS = ()
+    # Images are resized to fit within 1568 px before being tokenised
+    IMAGE_MAX_DIMENSION = 1568
 
-    # --------------------------------------------------------------------------
-
-    def __len__(self) -> int:
-        """Get the length of the conversation, excluding the system prompt.
-
-        Returns
-        -------
-        int
-            The length of the conversation.
-
-        """
-        return len(self._model_context)
+    # Anthropic's ephemeral cache lives for five minutes, and is refreshed each
+    # time it is read
+    CACHE_CONTROL: ClassVar[dict[str, str]] = {"type": "ephemeral"}
+    CACHE_TTL = 300
 
     # --------------------------------------------------------------------------
 
-    @property
-    def _model_context_message_content(self) -> list[dict]:
-        """Return a reference to the contents of the context.
-
-        This reference exists because the request objects are different for
-        each LLM.
-
-        Returns
-        -------
-        list[dict]
-            The contents of the context.
-
-        """
-        return self._model_context
-
     @property
     def client_type(self) -> str:
         """Get the client type.
@@ -63,25 +48,19 @@ class ClaudeClient(TextGenerationAbstractClient):
         """
         return "claude"
 
-    # --------------------------------------------------------------------------
-
-    def _check_context_contains_images(self, contents: dict) -> bool:
-        """Check if an image is present in the client's content.
-
-        Parameters
-        ----------
-        contents : dict
-            An individual message object which has been passed to LLM, e.g.
-            {"role": "user", "content": [{"type": "text", "text": "hello"}]}
+    @property
+    def _prompt_cache_ttl(self) -> float:
+        """Get the lifetime of the provider's prompt cache, in seconds.
 
         Returns
         -------
-        bool
-            If an image, returns True. Otherwise, returns False.
+        float
+            The number of seconds a cache lives for once written.
 
         """
-        content_blocks = contents["content"]
-        return any(block["type"] == "image" for block in content_blocks)
+        return self.CACHE_TTL
+
+    # --------------------------------------------------------------------------
 
     def _create_image_input_object(self, images: VisionImage | list[VisionImage]) -> list[dict]:
         """Create a payload for an image request.
@@ -107,7 +86,7 @@ class ClaudeClient(TextGenerationAbstractClient):
                 "source": {
                     "type": "base64",
                     "media_type": f"{image.mime_type}",
-                    "data": f"{image.b64image}",
+                    "data": image.b64image,
                 },
             }
             for image in images
@@ -183,8 +162,66 @@ class ClaudeClient(TextGenerationAbstractClient):
         """
         return {"role": "user", "content": [*text_content, *image_content, *video_content]}
 
-    def count_tokens(self, messages: dict | list[dict[str, str]] | str) -> int:
-        """Get the token count for a given message for the current LLM model.
+    def _create_cacheable_request(self, content: list[dict] | dict) -> tuple[str | list[dict], list[dict] | dict]:
+        """Add prompt cache breakpoints to a request.
+
+        A breakpoint is added to the system prompt and to the final block of
+        the last message. Anthropic caches the prefix of the request up to each
+        breakpoint, so the next request in the conversation reads everything
+        but the newest messages from the cache. The context itself is not
+        modified.
+
+        Parameters
+        ----------
+        content : list[dict] | dict
+            The (correctly) formatted content to send to the API.
+
+        Returns
+        -------
+        tuple[str | list[dict], list[dict] | dict]
+            The system prompt and content to send to the API.
+
+        """
+        if not BotSettings.cogs.chatbot.enable_prompt_caching:
+            return self.system_prompt, content
+
+        system = [{"type": "text", "text": self.system_prompt, "cache_control": self.CACHE_CONTROL}]
+        if isinstance(content, list) and content and isinstance(content[-1].get("content"), list):
+            *history, last_message = content
+            *blocks, last_block = last_message["content"]
+            content = [
+                *history,
+                {**last_message, "content": [*blocks, {**last_block, "cache_control": self.CACHE_CONTROL}]},
+            ]
+
+        return system, content
+
+    def _update_response_usage(self, response: TextGenerationResponse, usage: Any) -> None:
+        """Set the token usage of a response, including cached tokens.
+
+        Anthropic reports the input tokens read from and written to the cache
+        separately to the rest of the input tokens.
+
+        Parameters
+        ----------
+        response : TextGenerationResponse
+            The response to update.
+        usage : Any
+            The usage object returned by the Anthropic API.
+
+        """
+        if not usage:
+            return
+        response.cached_tokens = usage.cache_read_input_tokens or 0
+        response.cache_creation_tokens = usage.cache_creation_input_tokens or 0
+        response.input_tokens = usage.input_tokens + response.cached_tokens + response.cache_creation_tokens
+        response.output_tokens = usage.output_tokens
+        response.tokens_used = response.input_tokens + response.output_tokens
+        if response.cached_tokens or response.cache_creation_tokens:
+            self.prompt_cache.refresh()
+
+    async def count_tokens_exact(self, messages: dict | list[dict[str, str]] | str) -> int:
+        """Count the number of tokens in a message using the Anthropic API.
 
         Parameters
         ----------
@@ -198,15 +235,16 @@ class ClaudeClient(TextGenerationAbstractClient):
 
         """
         if not self._client:
-            msg = "No API client is available to query the tokens endpoint"
-            raise ValueError(msg)
+            self.init_client(self.model_name)
         if isinstance(messages, str):
             messages = [{"role": "user", "content": messages}]
         if isinstance(messages, dict):
             messages = [messages]
 
-        client = Anthropic(api_key=self._client.api_key, base_url=self._client.base_url)
-        response = client.messages.count_tokens(model=self.model_name, messages=messages)  # type: ignore
+        response = await self._client.messages.count_tokens(
+            model=self.model_name,
+            messages=BLOB_STORE.materialise(messages),  # type: ignore
+        )
         self.log_debug("Count token response %s for messages %s", response, messages)
 
         return response.input_tokens
@@ -221,33 +259,50 @@ class ClaudeClient(TextGenerationAbstractClient):
 
         """
         self.model_name = model_name
-        self._client = AsyncAnthropic(api_key=BotSettings.keys.claude)
+        self._client = TRANSPORTS.get_sdk_client(
+            "anthropic",
+            lambda http_client: AsyncAnthropic(
+                api_key=BotSettings.keys.claude,
+                http_client=http_client,
+                max_retries=0,  # requests are retried by the resilience layer
+            ),
+        )
 
-    async def generate_response(self, content: list[dict] | dict) -> TextGenerationResponse:
+    async def generate_response(
+        self, content: list[dict] | dict, *, estimated_tokens: int | None = None
+    ) -> TextGenerationResponse:
         """Send a request to the API client.
 
         Parameters
         ----------
         content : list[dict]
             The (correctly) formatted content to send to the API.
+        estimated_tokens : int | None
+            The local estimate of the input tokens, if already known.
 
         """
         if not self._client:
             self.init_client(self.model_name)
 
-        await self._log_request("%s", content)
+        if estimated_tokens is None:
+            estimated_tokens = self.tokenizer.count(content) + self.tokenizer.count(self.system_prompt)
+        system, content = self._create_cacheable_request(content)
+        trace = self._log_request(content)
         try:
-            response = await self._client.messages.create(
-                model=self.model_name,
-                messages=content,  # type: ignore
-                max_tokens=self._max_completion_tokens,
-                system=self.system_prompt,
+            response = await self.resilience.call(
+                lambda: self._client.messages.create(
+                    model=self.model_name,
+                    messages=BLOB_STORE.materialise(content),  # type: ignore
+                    max_tokens=self._max_completion_tokens,
+                    system=system,  # type: ignore
+                )
             )
         except Exception as exc:
             msg = f"Claude API failed to generate response due to exception: {exc}"
             self.log_error("%s", msg)
+            self._record_failed_request(trace)
             raise GenerationFailureError(msg) from exc
-        await self._log_response("%s", response)
+        self._log_response(trace, response)
 
         if not response.content:
             msg = "A valid response was not generated by the Anthropic client."
@@ -260,13 +315,14 @@ class ClaudeClient(TextGenerationAbstractClient):
             msg = "A text response was not generated"
             raise ValueError(msg)
 
-        return TextGenerationResponse(
-            text_response.text,
-            response.usage.input_tokens + response.usage.output_tokens if response.usage else self.token_size,
-        )
+        generation_response = TextGenerationResponse(text_response.text, self.token_size)
+        self._update_response_usage(generation_response, response.usage)
+        self._record_token_usage(trace, estimated_tokens, generation_response)
+
+        return generation_response
 
     async def generate_response_with_context(
-        self, messages: TextGenerationInput | list[TextGenerationInput]
+        self, messages: TextGenerationInput | list[TextGenerationInput], *, recalled: str = ""
     ) -> TextGenerationResponse:
         """Generate a text response, gievn a message and image inputs.
 
@@ -278,30 +334,84 @@ class ClaudeClient(TextGenerationAbstractClient):
         messages : ContextMessage | list[ContextMessage]
             Input message(s), from the user, including attached images and
             videos.
+        recalled : str
+            Earlier messages relevant to the input, which are sent with the
+            input but are not kept in the context.
 
         """
         if not self._client:
             self.init_client(self.model_name)
 
         self._shrink_model_context_to_window_size()
+        self._add_to_model_context(ConversationMessage.from_inputs(messages))
 
-        user_contents = self._create_content_payload(messages)
-        if isinstance(user_contents, list):
-            for content in user_contents:
-                self._add_to_model_context(content)
-        else:
-            self._add_to_model_context(user_contents)
-
-        response = await self.generate_response(self._model_context)
+        response = await self.generate_response(
+            self._get_context_request(recalled=recalled), estimated_tokens=self._estimate_request_tokens(recalled)
+        )
         if not response.message:
             msg = "A valid response was not generated by the Anthropic client."
             raise ValueError(msg)
 
-        self._model_context.append(self._create_assistant_response_object(response.message))
-        self.token_size = response.tokens_used
+        self._append_to_model_context(
+            ConversationMessage("assistant", (response.message,)), tokens=response.output_tokens or None
+        )
 
         return response
 
+    async def stream_response(
+        self, content: list[dict] | dict, response: TextGenerationResponse, *, estimated_tokens: int | None = None
+    ) -> AsyncIterator[str]:
+        """Send a request to the API client and stream the response.
+
+        Parameters
+        ----------
+        content : list[dict] | dict
+            The (correctly) formatted content to send to the API.
+        response : TextGenerationResponse
+            The response to populate as the stream progresses.
+        estimated_tokens : int | None
+            The local estimate of the input tokens, if already known.
+
+        Yields
+        ------
+        str
+            The response text, as it is generated.
+
+        """
+        if not self._client:
+            self.init_client(self.model_name)
+
+        if estimated_tokens is None:
+            estimated_tokens = self.tokenizer.count(content) + self.tokenizer.count(self.system_prompt)
+        system, content = self._create_cacheable_request(content)
+        trace = self._log_request(content)
+
+        async def open_stream() -> AsyncIterator[str]:
+            async with self._client.messages.stream(
+                model=self.model_name,
+                messages=BLOB_STORE.materialise(content),  # type: ignore
+                max_tokens=self._max_completion_tokens,
+                system=system,  # type: ignore
+            ) as stream:
+                async for text in stream.text_stream:
+                    yield text
+                final_message = await stream.get_final_message()
+            self._log_response(trace, final_message)
+            self._update_response_usage(response, final_message.usage)
+
+        try:
+            async for text in self.resilience.stream(open_stream):
+                trace.mark_first_token()
+                response.message += text
+                yield text
+        except Exception as exc:
+            msg = f"Claude API failed to stream response due to exception: {exc}"
+            self.log_error("%s", msg)
+            self._record_failed_request(trace)
+            raise GenerationFailureError(msg) from exc
+
+        self._record_token_usage(trace, estimated_tokens, response)
+
     def set_system_prompt(self, prompt: str, *, prompt_name: str = "unset name") -> None:
         """Set the system prompt.
 
@@ -315,5 +425,5 @@ class ClaudeClient(TextGenerationAbstractClient):
         """
         self.system_prompt = prompt
         self.system_prompt_name = prompt_name
-        self._model_context = []
-        self.token_size = self.count_tokens(prompt)
+        self.conversation.clear()
+        self._reset_token_ledger()
@@ -1,8 +1,16 @@
+import asyncio
+import itertools
+import json
+from collections.abc import AsyncIterator
 from typing import Any
 
 import httpx
 
+from slashbot.llm.blobs import BLOB_STORE
+from slashbot.llm.cache import fingerprint_prefix
 from slashbot.llm.clients.abstract_client import TextGenerationAbstractClient
+from slashbot.llm.clients.resilience import RETRYABLE_STATUS_CODES
+from slashbot.llm.conversation import ConversationMessage
 from slashbot.llm.models import (
     GenerationFailureError,
     TextGenerationInput,
@@ -10,7 +18,11 @@ from slashbot.llm.models import (
     VisionImage,
     VisionVideo,
 )
+from slashbot.llm.telemetry import TELEMETRY
 from slashbot.settings import BotSettings
+from slashbot.transport import TRANSPORTS
+
+GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta"
 
 
 class GeminiClient(TextGenerationAbstractClient):
@@ -25,6 +37,8 @@ class GeminiClient(TextGenerationAbstractClient):
     SEARCH_MODELS = SUPPORTED_MODELS
     AUDIO_MODELS = SUPPORTED_MODELS
     VIDEO_MODELS = SUPPORTED_MODELS
+    # Images are tiled into 768 px squares, each costing the same number of tokens
+    IMAGE_MAX_DIMENSION = 768
     GOOGLE_MAPS_MODELS = SUPPORTED_MODELS
 
     # --------------------------------------------------------------------------
@@ -41,27 +55,16 @@ class GeminiClient(TextGenerationAbstractClient):
 
         """
         self._count_tokens_url = ""
+        self._stream_url = ""
+        self._cache_url = ""
+        self._cache_task: asyncio.Task | None = None
         super().__init__(model_name, **kwargs)
-
-    # --------------------------------------------------------------------------
-
-    def __len__(self) -> int:
-        """Get the length of the conversation, excluding the system prompt.
-
-        Returns
-        -------
-        int
-            The length of the conversation.
-
-        """
-        return len(self._model_context["contents"])
+        # The model context lives on the client, so this is not deferred. It
+        # does not do any I/O
+        self.init_client(model_name)
 
     # --------------------------------------------------------------------------
 
-    @property
-    def _model_context_message_content(self) -> list[dict]:
-        return self._model_context["contents"]
-
     @property
     def client_type(self) -> str:
         """Get the model type."""
@@ -69,49 +72,8 @@ class GeminiClient(TextGenerationAbstractClient):
 
     # --------------------------------------------------------------------------
 
-    def _check_context_contains_images(self, contents: dict | list[dict]) -> bool:
-        """Check if an image is present in the client's content.
-
-        Parameters
-        ----------
-        contents : dict
-            An individual message object which has been passed to LLM, e.g.
-            {"role": "user", "content": [{"type": "text", "text": "hello"}]}
-
-        Returns
-        -------
-        bool
-            If an image, returns True. Otherwise, returns False.
-
-        """
-        if isinstance(contents, list):
-            msg = f"Invalid data type {type(contents)} for contents"
-            raise TypeError(msg)
-        return any("inline_data" in part for part in contents.get("parts", []))
-
-    def _content_contains_youtube_video_type(self, content: dict) -> bool:
-        """Check if a youtube link or video is present in the client's content.
-
-        Parameters
-        ----------
-        content : dict
-            An individual message object which has been passed to LLM, e.g.
-            {"role": "user", "content": [{"type": "text", "text": "hello"}]}
-
-        Returns
-        -------
-        bool
-            If there is a youtube link returns True. Otherwise, returns False.
-
-        """
-        for part in content.get("parts", []):
-            if "file_data" in part:
-                uri = part["file_data"].get("file_uri", "")
-                return "youtube.com" in uri or "youtu.be" in uri
-        return False
-
-    def _add_to_model_context(self, new_content: dict) -> None:
-        """Add new contents to the model context.
+    def _add_to_model_context(self, message: ConversationMessage, *, tokens: int | None = None) -> None:
+        """Add a new message to the model context.
 
         This has various pre-processing steps for adding new messages, such as
         making sure there is only a certain number of images in the model
@@ -123,21 +85,19 @@ class GeminiClient(TextGenerationAbstractClient):
 
         Parameters
         ----------
-        new_content : dict
-            The new content to add to the model context.
+        message : ConversationMessage
+            The new message to add to the model context.
+        tokens : int | None
+            The number of tokens in the new message, if already known.
 
         """
-        self.log_debug("Adding %s to model context", new_content)
-
-        # Remove any existing YouTube links from the context for the same reason
-        i = 0
-        while i < len(self):
-            content = self._model_context["contents"][i]
-            if self._content_contains_youtube_video_type(content):
-                self._remove_message_from_model_context(i)
-            i += 1
+        # Remove any existing YouTube links from the context for the same
+        # reason. Newest first, so the indices of the others do not change
+        for index in reversed(self.conversation.positions_with_videos()):
+            if self.conversation[index].has_youtube_video:
+                self._remove_message_from_model_context(index)
 
-        super()._add_to_model_context(new_content)
+        super()._add_to_model_context(message, tokens=tokens)
 
     def _create_assistant_response_object(self, message: str) -> dict:
         """Create a payload for the response from the LLM.
@@ -251,27 +211,185 @@ class GeminiClient(TextGenerationAbstractClient):
 
     # --------------------------------------------------------------------------
 
-    def count_tokens(self, messages: dict | list[dict[str, str]] | str) -> int:
-        """Count the number of tokens in a message.
+    async def _create_cached_content(self, request: dict, fingerprint: str, num_messages: int) -> None:
+        """Create an explicit cache for the system prompt and stable messages.
+
+        This runs in the background, so the cache is used from the next
+        request. Caches it replaces are deleted once it has been created, and
+        further writes back off if it cannot be created.
+
+        Parameters
+        ----------
+        request : dict
+            The cachedContents request.
+        fingerprint : str
+            The fingerprint of the cached prefix.
+        num_messages : int
+            The number of messages, from the start of the context, to cache.
+
+        """
+        trace = self._log_request(request)
+
+        async def post() -> httpx.Response:
+            http_response = await TRANSPORTS.get_http_client("gemini").post(
+                url=self._cache_url,
+                json=BLOB_STORE.materialise(request),
+                headers={"Content-Type": "application/json"},
+                timeout=self._async_timeout,
+            )
+            if http_response.status_code in RETRYABLE_STATUS_CODES:
+                http_response.raise_for_status()
+            if http_response.status_code != httpx.codes.OK:
+                error = http_response.json().get("error", {}).get("message")
+                msg = f"Gemini cachedContents request failed with {error}"
+                raise GenerationFailureError(msg, code=http_response.status_code)
+            return http_response
+
+        try:
+            response = await self.resilience.call(post)
+        except Exception as exc:  # noqa: BLE001
+            self.log_warning("Unable to create Gemini prompt cache, sending full requests for now: %s", exc)
+            self._record_failed_request(trace)
+            self.prompt_cache.record_write_failure()
+            return
+
+        response_json = response.json()
+        self._log_response(trace, response_json)
+        tokens = response_json.get("usageMetadata", {}).get("totalTokenCount", 0)
+        TELEMETRY.record(trace, TextGenerationResponse("", tokens, input_tokens=tokens, cache_creation_tokens=tokens))
+        self.prompt_cache.refresh(name=response_json["name"], fingerprint=fingerprint, num_messages=num_messages)
+        self.prompt_cache.stats.cache_write_tokens += tokens
+        self.log_debug("Created Gemini prompt cache %s for %d messages", self.prompt_cache.name, num_messages)
+
+        await self._delete_retired_caches()
+
+    async def _delete_retired_caches(self) -> None:
+        """Delete the cachedContents which have been replaced or invalidated.
+
+        Otherwise, their storage is paid for until they expire.
+        """
+        while self.prompt_cache.retired:
+            name = self.prompt_cache.retired.pop()
+            try:
+                response = await TRANSPORTS.get_http_client("gemini").delete(
+                    url=f"{GEMINI_API_URL}/{name}?key={BotSettings.keys.gemini}", timeout=self._async_timeout
+                )
+            except httpx.HTTPError as exc:
+                self.log_warning("Unable to delete Gemini prompt cache %s: %s", name, exc)
+                continue
+            if response.status_code not in (httpx.codes.OK, httpx.codes.NOT_FOUND):
+                self.log_warning("Unable to delete Gemini prompt cache %s: status %d", name, response.status_code)
+
+    def _start_cache_refresh(self, content: dict) -> None:
+        """Start creating a cache for the stable prefix of a request.
+
+        The system prompt and every message except the newest are cached, if
+        there are enough tokens to be worth caching. Only one cache is created
+        at a time, and none are created whilst writes are backing off.
+
+        Parameters
+        ----------
+        content : dict
+            The request for the model context.
+
+        """
+        if (self._cache_task is not None and not self._cache_task.done()) or not self.prompt_cache.can_write:
+            return
+
+        num_messages = len(content["contents"]) - 1
+        stable_tokens = self._system_prompt_tokens + sum(
+            message.tokens for message in itertools.islice(self.conversation, num_messages)
+        )
+        if stable_tokens < BotSettings.cogs.chatbot.prompt_cache_min_tokens:
+            return
+
+        # The context is updated in place, so the prefix is copied now
+        cached_messages = content["contents"][:num_messages]
+        request = {
+            "model": f"models/{self.model_name}",
+            "system_instruction": content["system_instruction"],
+            "ttl": f"{self.prompt_cache.ttl}s",
+        }
+        if cached_messages:
+            request["contents"] = cached_messages
+        if "tools" in content:
+            request["tools"] = content["tools"]
+        fingerprint = fingerprint_prefix(content["system_instruction"], cached_messages)
+
+        self._cache_task = asyncio.create_task(self._create_cached_content(request, fingerprint, num_messages))
+
+    def _create_cacheable_request(self, content: list[dict] | dict) -> list[dict] | dict:
+        """Replace the stable prefix of a request with a cached content.
+
+        The cache is reused until it expires or the prefix changes, e.g. when
+        the context is shrunk. Until then, the full request is sent and a
+        cache for the current context is created in the background, to be used
+        from the next request.
+
+        Parameters
+        ----------
+        content : list[dict] | dict
+            The (correctly) formatted content to send to the API.
+
+        Returns
+        -------
+        list[dict] | dict
+            The content to send to the API. This is the original content if
+            caching is disabled or the prefix is not cached (yet).
+
+        """
+        if not BotSettings.cogs.chatbot.enable_prompt_caching or content is not self._model_context:
+            return content
+
+        cache = self.prompt_cache
+        contents = content["contents"]
+        prefix_is_cached = (
+            cache.is_warm
+            and cache.num_messages < len(contents)
+            and cache.fingerprint == fingerprint_prefix(content["system_instruction"], contents[: cache.num_messages])
+        )
+        if not prefix_is_cached:
+            self._start_cache_refresh(content)
+            return content
+
+        request = {"cachedContent": cache.name, "contents": contents[cache.num_messages :]}
+        if "generationConfig" in content:
+            request["generationConfig"] = content["generationConfig"]
+
+        return request
+
+    async def count_tokens_exact(self, messages: dict | list[dict[str, str]] | str) -> int:
+        """Count the number of tokens in a message using the Gemini API.
 
         Parameters
         ----------
         messages : dict | list[dict[str, str]] | str
             The message to count the number of tokens. Formatted either as a
-            request, or as a str or list of strings.
+            request, a single content, a list of contents or a str.
+
+        Returns
+        -------
+        int
+            The number of tokens, as counted by the Gemini API.
 
         """
         if not self._count_tokens_url:
             self.init_client(self.model_name)
         if isinstance(messages, str):
             messages = {"contents": [{"parts": [{"text": messages}]}]}
-
-        with httpx.Client(timeout=self._async_timeout) as client:
-            response = client.post(
-                url=self._count_tokens_url,
-                json=messages,
-                headers={"Content-Type": "application/json"},
-            )
+        elif isinstance(messages, list):
+            messages = {"contents": messages}
+        elif "contents" not in messages:
+            messages = {"contents": [messages]}
+        if "system_instruction" in messages:
+            messages = {"generateContentRequest": {"model": f"models/{self.model_name}", **messages}}
+
+        response = await TRANSPORTS.get_http_client("gemini").post(
+            url=self._count_tokens_url,
+            json=BLOB_STORE.materialise(messages),
+            headers={"Content-Type": "application/json"},
+            timeout=self._async_timeout,
+        )
 
         if response.status_code != httpx.codes.OK:
             status_code = response.status_code
@@ -329,7 +447,7 @@ class GeminiClient(TextGenerationAbstractClient):
         return request
 
     async def generate_response_with_context(
-        self, messages: TextGenerationInput | list[TextGenerationInput]
+        self, messages: TextGenerationInput | list[TextGenerationInput], *, recalled: str = ""
     ) -> TextGenerationResponse:
         """Generate a text response, given new text input and previous context.
 
@@ -338,29 +456,52 @@ class GeminiClient(TextGenerationAbstractClient):
         messages : ContextMessage | list[ContextMessage]
             Input message(s), from the user, including attached images and
             videos.
+        recalled : str
+            Earlier messages relevant to the input, which are sent with the
+            input but are not kept in the context.
 
         """
         if not self._base_url:
             self.init_client(self.model_name)
 
         self._shrink_model_context_to_window_size()
+        self._add_to_model_context(ConversationMessage.from_inputs(messages))
 
-        user_contents = self._create_content_payload(messages)
-        if not isinstance(user_contents, dict):
-            msg = f"Incorrect content payload created for Gemini, should be a dict: {user_contents}"
-            raise TypeError(msg)
-        self._add_to_model_context(user_contents)
-
-        response = await self.generate_response(self._model_context)
+        response = await self.generate_response(
+            self._get_context_request(recalled=recalled), estimated_tokens=self._estimate_request_tokens(recalled)
+        )
         if not response.message:
             msg = "A valid response was not generated by the Gemini API."
             raise ValueError(msg)
 
-        self._add_to_model_context(self._create_assistant_response_object(response.message))
-        self.token_size = response.tokens_used
+        self._add_to_model_context(
+            ConversationMessage("assistant", (response.message,)), tokens=response.output_tokens or None
+        )
 
         return response
 
+    def _get_context_request(self, *, recalled: str = "") -> dict:
+        """Get the request payload for the current model context.
+
+        The request also includes the system prompt, tools and generation
+        config, which are kept in the same request object so a prompt cache
+        can be matched to the request.
+
+        Parameters
+        ----------
+        recalled : str
+            Earlier messages recalled for the newest message, if any.
+
+        Returns
+        -------
+        dict
+            The payload to send to the API for the model context.
+
+        """
+        self._model_context["contents"] = self._request_message_content(recalled)
+
+        return self._model_context
+
     def init_client(self, model_name: str) -> None:
         """Initialise the client to use a model.
 
@@ -370,10 +511,12 @@ class GeminiClient(TextGenerationAbstractClient):
             The name of the model to initialise the client for.
 
         """
-        gen_ai_url = "https://generativelanguage.googleapis.com/v1beta/models"
+        gen_ai_url = f"{GEMINI_API_URL}/models"
         self.model_name = model_name
         self._base_url = f"{gen_ai_url}/{model_name}:generateContent?key={BotSettings.keys.gemini}"
         self._count_tokens_url = f"{gen_ai_url}/{model_name}:countTokens?key={BotSettings.keys.gemini}"
+        self._stream_url = f"{gen_ai_url}/{model_name}:streamGenerateContent?alt=sse&key={BotSettings.keys.gemini}"
+        self._cache_url = f"{GEMINI_API_URL}/cachedContents?key={BotSettings.keys.gemini}"
         self._model_context = {
             "system_instruction": {
                 "parts": [
@@ -395,35 +538,48 @@ class GeminiClient(TextGenerationAbstractClient):
             if self.model_name in self.GOOGLE_MAPS_MODELS:
                 self._model_context["tools"]["googleMaps"] = {}
 
-        self._setup_response_logger(model_name)
-
-    async def generate_response(self, content: list[dict] | dict) -> TextGenerationResponse:
+    async def generate_response(
+        self, content: list[dict] | dict, *, estimated_tokens: int | None = None
+    ) -> TextGenerationResponse:
         """Send a request to the API client.
 
         Parameters
         ----------
         content : list[dict]
             The (correctly) formatted content to send to the API.
+        estimated_tokens : int | None
+            The local estimate of the input tokens, if already known.
 
         """
         if not self._base_url:
             self.init_client(self.model_name)
 
         self.log_debug("Sending request to Gemini. Url=%s, content=%s", self._base_url, content)
-        await self._log_request("%s", content)
+        if estimated_tokens is None:
+            estimated_tokens = self.tokenizer.count(content)
+        content = self._create_cacheable_request(content)
+        trace = self._log_request(content)
+
+        async def post() -> httpx.Response:
+            http_response = await TRANSPORTS.get_http_client("gemini").post(
+                url=self._base_url,
+                json=BLOB_STORE.materialise(content),
+                headers={"Content-Type": "application/json"},
+                timeout=self._async_timeout,
+            )
+            if http_response.status_code in RETRYABLE_STATUS_CODES:
+                http_response.raise_for_status()
+            return http_response
+
         try:
-            async with httpx.AsyncClient(timeout=self._async_timeout) as client:
-                response = await client.post(
-                    url=self._base_url,
-                    json=content,
-                    headers={"Content-Type": "application/json"},
-                )
+            response = await self.resilience.call(post)
         except Exception as exc:
             msg = f"Gemini API failed to generate response due to exception: {exc}"
             self.log_error("%s", msg)
+            self._record_failed_request(trace)
             raise GenerationFailureError(msg) from exc
 
-        await self._log_response("%s", response.json())
+        self._log_response(trace, response.json())
 
         if response.status_code != httpx.codes.OK:
             error_response = response.json()
@@ -433,6 +589,7 @@ class GeminiClient(TextGenerationAbstractClient):
                 self.log_error("Gemini API request failed: %s", error_response)
             status_code = response.status_code
             exc_msg = f"Gemini API request failed with {response.json()['error']['message']}"
+            self._record_failed_request(trace)
             raise GenerationFailureError(exc_msg, code=status_code)
 
         response_json = response.json()
@@ -444,10 +601,132 @@ class GeminiClient(TextGenerationAbstractClient):
                 0,
             )
 
-        return TextGenerationResponse(
+        usage = response_json["usageMetadata"]
+        generation_response = TextGenerationResponse(
             response_json["candidates"][0]["content"]["parts"][0]["text"],
-            response_json["usageMetadata"]["totalTokenCount"],
+            usage["totalTokenCount"],
+            input_tokens=usage.get("promptTokenCount", 0),
+            output_tokens=usage.get("candidatesTokenCount", 0),
+            cached_tokens=usage.get("cachedContentTokenCount", 0),
         )
+        self._record_token_usage(trace, estimated_tokens, generation_response)
+
+        return generation_response
+
+    @staticmethod
+    async def _check_stream_status(http_response: httpx.Response) -> None:
+        """Raise an exception if a streamed request failed.
+
+        Parameters
+        ----------
+        http_response : httpx.Response
+            The streamed response, before any of the body has been read.
+
+        Raises
+        ------
+        httpx.HTTPStatusError
+            If the request failed for a reason which can be retried.
+        GenerationFailureError
+            If the request failed for any other reason.
+
+        """
+        if http_response.status_code in RETRYABLE_STATUS_CODES:
+            http_response.raise_for_status()
+        if http_response.status_code != httpx.codes.OK:
+            error_response = json.loads(await http_response.aread())
+            msg = f"Gemini API request failed with {error_response.get('error', {}).get('message')}"
+            raise GenerationFailureError(msg, code=http_response.status_code)
+
+    @staticmethod
+    def _read_stream_event(line: str, response: TextGenerationResponse) -> list[str]:
+        """Read a server-sent event from a streamed response.
+
+        Parameters
+        ----------
+        line : str
+            A line of the stream.
+        response : TextGenerationResponse
+            The response, whose token usage is updated from the event.
+
+        Returns
+        -------
+        list[str]
+            The text in the event, if the line is an event.
+
+        """
+        if not line.startswith("data:"):
+            return []
+        event = json.loads(line.removeprefix("data:"))
+        usage = event.get("usageMetadata", {})
+        response.input_tokens = usage.get("promptTokenCount", response.input_tokens)
+        response.output_tokens = usage.get("candidatesTokenCount", response.output_tokens)
+        response.tokens_used = usage.get("totalTokenCount", response.tokens_used)
+        response.cached_tokens = usage.get("cachedContentTokenCount", response.cached_tokens)
+        parts = event.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+        return [part["text"] for part in parts if part.get("text")]
+
+    async def stream_response(
+        self, content: list[dict] | dict, response: TextGenerationResponse, *, estimated_tokens: int | None = None
+    ) -> AsyncIterator[str]:
+        """Send a request to the API client and stream the response.
+
+        The response is streamed as server-sent events, where each event is a
+        partial GenerateContentResponse. The token usage is taken from the
+        final event.
+
+        Parameters
+        ----------
+        content : list[dict] | dict
+            The (correctly) formatted content to send to the API.
+        response : TextGenerationResponse
+            The response to populate as the stream progresses.
+        estimated_tokens : int | None
+            The local estimate of the input tokens, if already known.
+
+        Yields
+        ------
+        str
+            The response text, as it is generated.
+
+        """
+        if not self._stream_url:
+            self.init_client(self.model_name)
+
+        if estimated_tokens is None:
+            estimated_tokens = self.tokenizer.count(content)
+        content = self._create_cacheable_request(content)
+        trace = self._log_request(content)
+
+        async def open_stream() -> AsyncIterator[str]:
+            async with TRANSPORTS.get_http_client("gemini").stream(
+                "POST",
+                url=self._stream_url,
+                json=BLOB_STORE.materialise(content),
+                headers={"Content-Type": "application/json"},
+                timeout=self._async_timeout,
+            ) as http_response:
+                await self._check_stream_status(http_response)
+                async for line in http_response.aiter_lines():
+                    for text in self._read_stream_event(line, response):
+                        yield text
+
+        try:
+            async for text in self.resilience.stream(open_stream):
+                trace.mark_first_token()
+                response.message += text
+                yield text
+        except GenerationFailureError as exc:
+            self.log_error("Gemini API stream failed: %s", exc)
+            self._record_failed_request(trace)
+            raise
+        except Exception as exc:
+            msg = f"Gemini API failed to stream response due to exception: {exc}"
+            self.log_error("%s", msg)
+            self._record_failed_request(trace)
+            raise GenerationFailureError(msg) from exc
+        self._log_response(trace, response)
+
+        self._record_token_usage(trace, estimated_tokens, response)
 
     def set_system_prompt(self, prompt: str, *, prompt_name: str = "unset name") -> None:
         """Set the system prompt.
@@ -462,14 +741,12 @@ class GeminiClient(TextGenerationAbstractClient):
         """
         self.system_prompt = prompt
         self.system_prompt_name = prompt_name
-        self._model_context = {
-            "system_instruction": {
-                "parts": [
-                    {
-                        "text": prompt,
-                    }
-                ]
-            },
-            "contents": [],
+        self._model_context["system_instruction"] = {
+            "parts": [
+                {
+                    "text": prompt,
+                }
+            ]
         }
-        self.token_size = self.count_tokens(prompt)
+        self.conversation.clear()
+        self._reset_token_ledger()
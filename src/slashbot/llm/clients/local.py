@@ -0,0 +1,295 @@
+"""Client for models served by a local OpenAI-compatible server.
+
+Local servers, such as Ollama or llama.cpp, load a model into memory on the
+first request and unload it again once it has been idle for a while, so the
+first request after a quiet period is slow. They also only process a fixed
+number of requests in parallel, and requests beyond that thrash the server.
+The models are therefore loaded at startup with a warm-up request, which is
+repeated to keep them loaded, and requests are queued by the bot to match the
+server's parallelism.
+
+Ollama's OpenAI-compatible API ignores keep_alive and does not report timings,
+so it is warmed up through its native API, which does both. llama.cpp keeps
+its model loaded and reports its timings with every completion.
+"""
+
+import asyncio
+import contextlib
+import time
+from dataclasses import dataclass
+from typing import Any
+
+import openai
+
+from slashbot.llm.clients.openai import OpenAIClient
+from slashbot.logger import Logger
+from slashbot.settings import BotSettings
+from slashbot.transport import TRANSPORTS
+
+NANOSECONDS_PER_SECOND = 1e9
+
+
+@dataclass
+class LocalTimings:
+    """Timings reported by a local server for a request.
+
+    Attributes
+    ----------
+    load_seconds : float
+        Time spent loading the model.
+    prompt_eval_seconds : float
+        Time spent processing the prompt.
+    eval_seconds : float
+        Time spent generating the response.
+    eval_tokens : int
+        Number of tokens generated.
+
+    """
+
+    load_seconds: float = 0.0
+    prompt_eval_seconds: float = 0.0
+    eval_seconds: float = 0.0
+    eval_tokens: int = 0
+
+    @property
+    def tokens_per_second(self) -> float:
+        """The rate tokens were generated at."""
+        return self.eval_tokens / self.eval_seconds if self.eval_seconds else 0.0
+
+    def __str__(self) -> str:
+        """Print the timings."""
+        return (
+            f"load {self.load_seconds:.2f} s, prompt eval {self.prompt_eval_seconds:.2f} s, "
+            f"eval {self.eval_seconds:.2f} s ({self.tokens_per_second:.1f} tokens/s)"
+        )
+
+
+def read_local_timings(fields: dict[str, Any]) -> LocalTimings | None:
+    """Read the timings from a response from a local server.
+
+    llama.cpp reports a `timings` object in milliseconds with each completion,
+    and Ollama's native API reports `*_duration` fields in nanoseconds.
+
+    Parameters
+    ----------
+    fields : dict[str, Any]
+        The fields of the response, or of a chunk of a streamed completion.
+
+    Returns
+    -------
+    LocalTimings | None
+        The timings, or None if the response does not include any.
+
+    """
+    if timings := fields.get("timings"):
+        return LocalTimings(
+            prompt_eval_seconds=timings.get("prompt_ms", 0) / 1000,
+            eval_seconds=timings.get("predicted_ms", 0) / 1000,
+            eval_tokens=timings.get("predicted_n", 0),
+        )
+    if "eval_duration" in fields:
+        return LocalTimings(
+            load_seconds=fields.get("load_duration", 0) / NANOSECONDS_PER_SECOND,
+            prompt_eval_seconds=fields.get("prompt_eval_duration", 0) / NANOSECONDS_PER_SECOND,
+            eval_seconds=fields["eval_duration"] / NANOSECONDS_PER_SECOND,
+            eval_tokens=fields.get("eval_count", 0),
+        )
+    return None
+
+
+class LocalServer(Logger):
+    """Process-wide state for the local model server."""
+
+    def __init__(self) -> None:
+        """Initialise with no requests in flight."""
+        super().__init__(prepend_msg="[LocalServer]")
+        self.timings: dict[str, LocalTimings] = {}
+        self._slots: asyncio.Semaphore | None = None
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        """The semaphore limiting requests to the server's parallelism."""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(BotSettings.local_models.num_parallel)
+        return self._slots
+
+    @staticmethod
+    def get_client() -> openai.AsyncClient:
+        """Get the shared SDK client for the server.
+
+        Returns
+        -------
+        openai.AsyncClient
+            The client, which uses the pooled HTTP client for the server.
+
+        """
+        return TRANSPORTS.get_sdk_client(
+            "local",
+            lambda http_client: openai.AsyncClient(
+                api_key="local",
+                base_url=BotSettings.local_models.base_url,
+                http_client=http_client,
+                max_retries=0,  # requests are retried by the resilience layer
+            ),
+        )
+
+    @staticmethod
+    def get_native_url() -> str:
+        """Get the URL of Ollama's native API.
+
+        Returns
+        -------
+        str
+            The base URL without the OpenAI-compatible `/v1` path.
+
+        """
+        return BotSettings.local_models.base_url.rstrip("/").removesuffix("/v1")
+
+    def record_timings(self, model: str, fields: dict[str, Any]) -> None:
+        """Record the timings reported in a response, if there are any.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model.
+        fields : dict[str, Any]
+            The fields of the response, or of a chunk of a streamed completion.
+
+        """
+        timings = read_local_timings(fields)
+        if timings:
+            self.timings[model] = timings
+            self.log_debug("%s timings: %s", model, timings)
+
+    async def _warm_up_ollama(self, model: str) -> dict[str, Any]:
+        """Generate one token through Ollama's native API, setting keep_alive.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model.
+
+        Returns
+        -------
+        dict[str, Any]
+            The response, including the load and evaluation durations.
+
+        """
+        response = await TRANSPORTS.get_http_client("local").post(
+            f"{self.get_native_url()}/api/generate",
+            json={
+                "model": model,
+                "prompt": "Hello",
+                "stream": False,
+                "keep_alive": BotSettings.local_models.keep_alive,
+                "options": {"num_predict": 1},
+            },
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def _warm_up_llama_cpp(self, model: str) -> dict[str, Any]:
+        """Generate one token through the OpenAI-compatible API.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model.
+
+        Returns
+        -------
+        dict[str, Any]
+            The non-standard fields of the completion, including its timings.
+
+        """
+        response = await self.get_client().chat.completions.create(
+            model=model, messages=[{"role": "user", "content": "Hello"}], max_completion_tokens=1
+        )
+        return response.model_extra or {}
+
+    async def warm_up(self, model: str) -> None:
+        """Load a model on the server, and keep it loaded.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model.
+
+        """
+        start = time.monotonic()
+        async with self.slots:
+            if BotSettings.local_models.backend == "ollama":
+                fields = await self._warm_up_ollama(model)
+            else:
+                fields = await self._warm_up_llama_cpp(model)
+        self.record_timings(model, fields)
+        self.log_debug("Warmed up %s in %.2f seconds", model, time.monotonic() - start)
+
+    async def warm_up_models(self) -> None:
+        """Load every configured model on the server, and keep them loaded."""
+        models = BotSettings.local_models.models
+        results = await asyncio.gather(*(self.warm_up(model) for model in models), return_exceptions=True)
+        for model, result in zip(models, results, strict=True):
+            if isinstance(result, Exception):
+                self.log_warning("Unable to warm up local model %s: %s", model, result)
+
+
+LOCAL_SERVER = LocalServer()
+
+
+class LocalClient(OpenAIClient):
+    """Asynchronous client for models served by a local OpenAI-compatible server."""
+
+    SUPPORTED_MODELS = tuple(BotSettings.local_models.models) if BotSettings.local_models.enabled else ()
+    VISION_MODELS = tuple(BotSettings.local_models.vision_models)
+    SEARCH_MODELS = ()
+    AUDIO_MODELS = ()
+    VIDEO_MODELS = ()
+
+    # --------------------------------------------------------------------------
+
+    @property
+    def client_type(self) -> str:
+        """Get the client type.
+
+        Returns
+        -------
+        str
+            A string representation of the client type.
+
+        """
+        return "local"
+
+    def init_client(self, model_name: str) -> None:
+        """Initialise the client to use a model.
+
+        Parameters
+        ----------
+        model_name : str
+            The name of the model to initialise the client for.
+
+        """
+        self.model_name = model_name
+        self._client = LOCAL_SERVER.get_client()
+
+    def _request_slot(self) -> contextlib.AbstractAsyncContextManager:
+        """Get the slot each attempt at a request is sent in.
+
+        Returns
+        -------
+        contextlib.AbstractAsyncContextManager
+            A slot on the server, which queues requests beyond its parallelism.
+
+        """
+        return LOCAL_SERVER.slots
+
+    def _read_response_extras(self, response: Any) -> None:
+        """Record the server's evaluation timings.
+
+        Parameters
+        ----------
+        response : Any
+            The completion, or a chunk of a streamed completion.
+
+        """
+        LOCAL_SERVER.record_timings(self.model_name, getattr(response, "model_extra", None) or {})
@@ -1,6 +1,12 @@
+import contextlib
+from collections.abc import AsyncIterator
+from typing import Any
+
 import openai
 
+from slashbot.llm.blobs import BLOB_STORE, BlobRef
 from slashbot.llm.clients.abstract_client import TextGenerationAbstractClient
+from slashbot.llm.conversation import ConversationMessage
 from slashbot.llm.models import (
     GenerationFailureError,
     TextGenerationInput,
@@ -9,6 +15,7 @@ from slashbot.llm.models import (
     VisionVideo,
 )
 from slashbot.settings import BotSettings
+from slashbot.transport import TRANSPORTS
 
 
 class OpenAIClient(TextGenerationAbstractClient):
@@ -19,37 +26,11 @@ class OpenAIClient(TextGenerationAbstractClient):
     SEARCH_MODELS = ()
     AUDIO_MODELS = ()
     VIDEO_MODELS = ()
-
-    # --------------------------------------------------------------------------
-
-    def __len__(self) -> int:
-        """Get the length of the conversation, excluding the system prompt.
-
-        Returns
-        -------
-        int
-            The length of the conversation.
-
-        """
-        return len(self._model_context_message_content)
+    # Images are scaled so the shortest side is 768 px, and tiled into 512 px squares
+    IMAGE_MAX_DIMENSION = 768
 
     # --------------------------------------------------------------------------
 
-    @property
-    def _model_context_message_content(self) -> list[dict]:
-        """Return a reference to the contents of the context.
-
-        This reference exists because the request objects are different for
-        each LLM.
-
-        Returns
-        -------
-        list[dict]
-            The contents of the context.
-
-        """
-        return self._model_context[1:]  # first message is system prompt
-
     @property
     def client_type(self) -> str:
         """Get the client type.
@@ -64,24 +45,6 @@ class OpenAIClient(TextGenerationAbstractClient):
 
     # --------------------------------------------------------------------------
 
-    def _check_context_contains_images(self, contents: dict) -> bool:
-        """Check if an image is present in the client's content.
-
-        Parameters
-        ----------
-        contents : dict
-            An individual message object which has been passed to LLM, e.g.
-            {"role": "user", "content": [{"type": "text", "text": "hello"}]}
-
-        Returns
-        -------
-        bool
-            If an image, returns True. Otherwise, returns False.
-
-        """
-        content_blocks = contents["content"]
-        return any(block["type"] == "image" for block in content_blocks)
-
     def _create_image_input_object(self, images: VisionImage | list[VisionImage]) -> list[dict]:
         """Create a payload for an image request.
 
@@ -104,13 +67,35 @@ class OpenAIClient(TextGenerationAbstractClient):
             {
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/{image.mime_type};base64,{image.b64image}" if image.b64image else image.url,
+                    "url": f"data:image/{image.mime_type};base64,{self._read_image_data(image)}"
+                    if image.b64image
+                    else image.url,
                     "detail": "low",
                 },
             }
             for image in images
         ]
 
+    @staticmethod
+    def _read_image_data(image: VisionImage) -> str:
+        """Get the encoded data of an image.
+
+        The data is embedded into a data URL, so is read back from the blob
+        store for images in the conversation.
+
+        Parameters
+        ----------
+        image : VisionImage
+            The image.
+
+        Returns
+        -------
+        str
+            The base64 encoded image.
+
+        """
+        return BLOB_STORE.read(image.b64image) if isinstance(image.b64image, BlobRef) else str(image.b64image)
+
     def _create_text_input_object(self, text: str | list[str]) -> dict | list[dict]:
         """Create a payload for a text request.
 
@@ -183,8 +168,8 @@ class OpenAIClient(TextGenerationAbstractClient):
 
     # --------------------------------------------------------------------------
 
-    def count_tokens(self, messages: dict | list[dict[str, str]] | str) -> int:
-        """Get the token count for a given message for the current LLM model.
+    async def count_tokens_exact(self, messages: dict | list[dict[str, str]] | str) -> int:
+        """Count the number of tokens in a message using the OpenAI API.
 
         Parameters
         ----------
@@ -198,13 +183,14 @@ class OpenAIClient(TextGenerationAbstractClient):
 
         """
         if not self._client:
-            msg = "No API client is available to query the tokens endpoint"
-            raise ValueError(msg)
+            self.init_client(self.model_name)
         if isinstance(messages, str):
             messages = [{"role": "user", "content": messages}]
 
-        client = openai.Client(api_key=self._client.api_key, base_url=self._client.base_url)
-        response = client.responses.input_tokens.count(model=self.model_name, input=messages)  # type: ignore
+        response = await self._client.responses.input_tokens.count(
+            model=self.model_name,
+            input=BLOB_STORE.materialise(messages),  # type: ignore
+        )
         self.log_debug("Count token response %s for messages %s", response, messages)
 
         return response.input_tokens
@@ -219,7 +205,14 @@ class OpenAIClient(TextGenerationAbstractClient):
 
         """
         self.model_name = model_name
-        self._client = openai.AsyncClient(api_key=BotSettings.keys.openai, base_url="http://localhost:11434/v1")
+        self._client = TRANSPORTS.get_sdk_client(
+            "openai",
+            lambda http_client: openai.AsyncClient(
+                api_key=BotSettings.keys.openai,
+                http_client=http_client,
+                max_retries=0,  # requests are retried by the resilience layer
+            ),
+        )
 
     def create_content_payload_object(
         self, messages: TextGenerationInput | list[TextGenerationInput], *, system_prompt: str | None = None
@@ -247,45 +240,106 @@ class OpenAIClient(TextGenerationAbstractClient):
 
         return request
 
-    async def generate_response(self, content: list[dict] | dict) -> TextGenerationResponse:
+    def _request_slot(self) -> contextlib.AbstractAsyncContextManager:
+        """Get the slot each attempt at a request is sent in.
+
+        The slot is held for a single attempt, and not while the resilience
+        layer waits to retry.
+
+        Returns
+        -------
+        contextlib.AbstractAsyncContextManager
+            The slot, which by default does not limit requests.
+
+        """
+        return contextlib.nullcontext()
+
+    def _read_response_extras(self, response: Any) -> None:
+        """Read any non-standard fields in a chat completion response.
+
+        Parameters
+        ----------
+        response : Any
+            The completion, or a chunk of a streamed completion.
+
+        """
+
+    async def generate_response(
+        self, content: list[dict] | dict, *, estimated_tokens: int | None = None
+    ) -> TextGenerationResponse:
         """Send a request to the API client.
 
         Parameters
         ----------
         content : list[dict]
             The (correctly) formatted content to send to the API.
+        estimated_tokens : int | None
+            The local estimate of the input tokens, if already known.
 
         """
         if not self._client:
             self.init_client(self.model_name)
 
-        await self._log_request("%s", content)
+        if estimated_tokens is None:
+            estimated_tokens = self.tokenizer.count(content)
+        trace = self._log_request(content)
+
+        async def send() -> Any:
+            async with self._request_slot():
+                return await self._client.chat.completions.create(
+                    model=self.model_name,
+                    messages=BLOB_STORE.materialise(content),  # type: ignore
+                    max_completion_tokens=self._max_completion_tokens,
+                    temperature=BotSettings.cogs.chatbot.model_temperature,
+                )
 
         try:
-            response = await self._client.chat.completions.create(
-                model=self.model_name,
-                messages=content,  # type: ignore
-                max_completion_tokens=self._max_completion_tokens,
-                temperature=BotSettings.cogs.chatbot.model_temperature,
-            )
+            response = await self.resilience.call(send)
         except Exception as exc:
             msg = f"OpenAI API failed to generate response due to exception: {exc}"
             self.log_error("%s", msg)
+            self._record_failed_request(trace)
             raise GenerationFailureError(msg) from exc
 
-        await self._log_response("%s", response)
+        self._log_response(trace, response)
+        self._read_response_extras(response)
 
         response_message = response.choices[0].message.content
         if not response_message:
             msg = "A valid response was not generated by the OpenAI client."
             raise ValueError(msg)
 
-        return TextGenerationResponse(  # Ternary to shut the linter up
-            response_message, response.usage.total_tokens if response.usage else self.token_size
+        generation_response = TextGenerationResponse(  # Ternary to shut the linter up
+            response_message,
+            response.usage.total_tokens if response.usage else self.token_size,
+            input_tokens=response.usage.prompt_tokens if response.usage else 0,
+            output_tokens=response.usage.completion_tokens if response.usage else 0,
         )
+        self._record_token_usage(trace, estimated_tokens, generation_response)
+
+        return generation_response
+
+    def _get_context_request(self, *, recalled: str = "") -> list[dict]:
+        """Get the request payload for the current model context.
+
+        The system prompt is not kept in the model context, so is added to the
+        start of the payload.
+
+        Parameters
+        ----------
+        recalled : str
+            Earlier messages recalled for the newest message, if any.
+
+        Returns
+        -------
+        list[dict]
+            The payload to send to the API for the model context.
+
+        """
+        return [{"role": "system", "content": self.system_prompt}, *self._request_message_content(recalled)]
 
     async def generate_response_with_context(
-        self, messages: TextGenerationInput | list[TextGenerationInput]
+        self, messages: TextGenerationInput | list[TextGenerationInput], *, recalled: str = ""
     ) -> TextGenerationResponse:
         """Generate a text response, gievn a message and image inputs.
 
@@ -297,30 +351,90 @@ class OpenAIClient(TextGenerationAbstractClient):
         messages : ContextMessage | list[ContextMessage]
             Input message(s), from the user, including attached images and
             videos.
+        recalled : str
+            Earlier messages relevant to the input, which are sent with the
+            input but are not kept in the context.
 
         """
         if not self._client:
             self.init_client(self.model_name)
 
         self._shrink_model_context_to_window_size()
+        self._add_to_model_context(ConversationMessage.from_inputs(messages))
 
-        user_contents = self._create_content_payload(messages)
-        if isinstance(user_contents, list):
-            for content in user_contents:
-                self._add_to_model_context(content)
-        else:
-            self._add_to_model_context(user_contents)
-
-        response = await self.generate_response(self._model_context)
+        response = await self.generate_response(
+            self._get_context_request(recalled=recalled), estimated_tokens=self._estimate_request_tokens(recalled)
+        )
         if not response.message:
             msg = "A valid response was not generated by the OpenAI client."
             raise ValueError(msg)
 
-        self._model_context.append(self._create_assistant_response_object(response.message))
-        self.token_size = response.tokens_used
+        self._append_to_model_context(
+            ConversationMessage("assistant", (response.message,)), tokens=response.output_tokens or None
+        )
 
         return response
 
+    async def stream_response(
+        self, content: list[dict] | dict, response: TextGenerationResponse, *, estimated_tokens: int | None = None
+    ) -> AsyncIterator[str]:
+        """Send a request to the API client and stream the response.
+
+        Parameters
+        ----------
+        content : list[dict] | dict
+            The (correctly) formatted content to send to the API.
+        response : TextGenerationResponse
+            The response to populate as the stream progresses.
+        estimated_tokens : int | None
+            The local estimate of the input tokens, if already known.
+
+        Yields
+        ------
+        str
+            The response text, as it is generated.
+
+        """
+        if not self._client:
+            self.init_client(self.model_name)
+
+        if estimated_tokens is None:
+            estimated_tokens = self.tokenizer.count(content)
+        trace = self._log_request(content)
+
+        async def open_stream() -> AsyncIterator[str]:
+            async with self._request_slot():
+                stream = await self._client.chat.completions.create(
+                    model=self.model_name,
+                    messages=BLOB_STORE.materialise(content),  # type: ignore
+                    max_completion_tokens=self._max_completion_tokens,
+                    temperature=BotSettings.cogs.chatbot.model_temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                async for chunk in stream:
+                    if chunk.usage:
+                        response.input_tokens = chunk.usage.prompt_tokens
+                        response.output_tokens = chunk.usage.completion_tokens
+                        response.tokens_used = chunk.usage.total_tokens
+                    self._read_response_extras(chunk)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+
+        try:
+            async for text in self.resilience.stream(open_stream):
+                trace.mark_first_token()
+                response.message += text
+                yield text
+        except Exception as exc:
+            msg = f"OpenAI API failed to stream response due to exception: {exc}"
+            self.log_error("%s", msg)
+            self._record_failed_request(trace)
+            raise GenerationFailureError(msg) from exc
+        self._log_response(trace, response)
+
+        self._record_token_usage(trace, estimated_tokens, response)
+
     def set_system_prompt(self, prompt: str, *, prompt_name: str = "unset name") -> None:
         """Set the system prompt.
 
@@ -334,5 +448,5 @@ class OpenAIClient(TextGenerationAbstractClient):
         """
         self.system_prompt = prompt
         self.system_prompt_name = prompt_name
-        self._model_context = [{"role": "system", "content": prompt}]
-        self.token_size = self.count_tokens(prompt)
+        self.conversation.clear()
+        self._reset_token_ledger()
@@ -0,0 +1,365 @@
+"""Retries, adaptive timeouts and circuit breakers for LLM providers.
+
+Requests to a provider can fail for reasons which go away on their own, such
+as rate limiting, an overloaded server or a dropped connection. These requests
+are retried after a jittered, exponentially increasing delay, or after the
+delay the provider asks for with a `Retry-After` header. Each request has a
+timeout derived from the provider's recent latency, so a hung connection is
+given up on after a few multiples of the usual response time rather than
+minutes. If a provider keeps failing, its circuit breaker opens and requests
+fail immediately, until a trial request after a cool-down succeeds.
+"""
+
+import asyncio
+import datetime
+import random
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+from email.utils import parsedate_to_datetime
+from enum import StrEnum
+
+import anthropic
+import httpx
+import openai
+
+from slashbot.llm.hedging import LatencyHistogram
+from slashbot.llm.models import GenerationFailureError
+from slashbot.logger import Logger
+from slashbot.settings import BotSettings
+
+RETRYABLE_STATUS_CODES = frozenset({408, 409, 425, 429, 500, 502, 503, 504, 529})
+TRANSIENT_EXCEPTIONS = (TimeoutError, httpx.TransportError, openai.APIConnectionError, anthropic.APIConnectionError)
+
+
+class CircuitState(StrEnum):
+    """States of a provider's circuit breaker."""
+
+    CLOSED = "closed"  # requests are sent as usual
+    OPEN = "open"  # requests fail immediately
+    HALF_OPEN = "half-open"  # a single trial request is sent
+
+
+class CircuitOpenError(GenerationFailureError):
+    """Exception for requests which are not sent as the provider is unhealthy."""
+
+
+def get_retry_after(exc: BaseException) -> float | None:
+    """Get the delay a provider has asked for before a request is retried.
+
+    Parameters
+    ----------
+    exc : BaseException
+        The exception raised for the failed request.
+
+    Returns
+    -------
+    float | None
+        The delay (seconds), or None if the provider did not ask for one.
+
+    """
+    response = getattr(exc, "response", None)
+    if not isinstance(response, httpx.Response):
+        return None
+    if retry_after_ms := response.headers.get("retry-after-ms"):
+        try:
+            return max(float(retry_after_ms) / 1000, 0.0)
+        except ValueError:
+            pass
+    retry_after = response.headers.get("retry-after")
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.datetime.now(tz=datetime.UTC)).total_seconds(), 0.0)
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    """Determine whether a request failed for a reason which may go away.
+
+    Parameters
+    ----------
+    exc : BaseException
+        The exception raised for the failed request.
+
+    Returns
+    -------
+    bool
+        True for timeouts, connection errors and retryable HTTP statuses.
+
+    """
+    if isinstance(exc, TRANSIENT_EXCEPTIONS):
+        return True
+    response = getattr(exc, "response", None)
+    return isinstance(response, httpx.Response) and response.status_code in RETRYABLE_STATUS_CODES
+
+
+class ProviderResilience(Logger):
+    """Retries, timeouts and circuit breaker for requests to one provider."""
+
+    def __init__(self, provider: str) -> None:
+        """Initialise with a closed circuit and no recorded latencies.
+
+        Parameters
+        ----------
+        provider : str
+            The provider name, i.e. the `client_type` of a client.
+
+        """
+        super().__init__(prepend_msg=f"[{provider}]")
+        self.provider = provider
+        self.latency = LatencyHistogram()
+        self.state = CircuitState.CLOSED
+        self.consecutive_failures = 0
+        self.last_error = ""
+        self.last_error_time: datetime.datetime | None = None
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def timeout(self) -> float:
+        """The timeout (seconds) for a request, based on recent latencies."""
+        settings = BotSettings.resilience
+        if self.latency.total < settings.timeout_min_samples:
+            return settings.max_timeout
+        latency = self.latency.quantile(settings.timeout_latency_quantile) or settings.max_timeout
+        return min(max(latency * settings.timeout_multiplier, settings.min_timeout), settings.max_timeout)
+
+    def _start_attempt(self) -> None:
+        """Check the circuit breaker allows a request to be sent.
+
+        Raises
+        ------
+        CircuitOpenError
+            If the circuit is open, or a trial request is already in flight.
+
+        """
+        if self.state == CircuitState.OPEN:
+            if time.monotonic() - self._opened_at < BotSettings.resilience.breaker_reset_timeout:
+                msg = f"Not sending request as {self.provider} is unhealthy: {self.last_error}"
+                raise CircuitOpenError(msg)
+            self.state = CircuitState.HALF_OPEN
+        if self.state == CircuitState.HALF_OPEN:
+            if self._trial_in_flight:
+                msg = f"Not sending request as a trial request to {self.provider} is in flight"
+                raise CircuitOpenError(msg)
+            self._trial_in_flight = True
+
+    def _record_success(self, seconds: float) -> None:
+        """Record a successful request, closing the circuit.
+
+        Parameters
+        ----------
+        seconds : float
+            The time taken for the request.
+
+        """
+        self.latency.record(seconds)
+        self.consecutive_failures = 0
+        if self.state != CircuitState.CLOSED:
+            self.log_info("Circuit closed as a request to %s succeeded", self.provider)
+            self.state = CircuitState.CLOSED
+
+    def _record_failure(self, exc: BaseException) -> None:
+        """Record a failed request, opening the circuit if it keeps failing.
+
+        Parameters
+        ----------
+        exc : BaseException
+            The exception raised for the failed request.
+
+        """
+        self.consecutive_failures += 1
+        self.last_error = f"{type(exc).__name__}: {exc}"
+        self.last_error_time = datetime.datetime.now(tz=datetime.UTC)
+        threshold = BotSettings.resilience.breaker_failure_threshold
+        if self.state == CircuitState.HALF_OPEN or self.consecutive_failures >= threshold:
+            if self.state != CircuitState.OPEN:
+                self.log_warning("Circuit opened after %d failed requests", self.consecutive_failures)
+            self.state = CircuitState.OPEN
+            self._opened_at = time.monotonic()
+
+    def _get_retry_delay(self, exc: BaseException, attempt: int) -> float | None:
+        """Record a failed request, and get how long to wait before retrying.
+
+        Parameters
+        ----------
+        exc : BaseException
+            The exception raised for the failed request.
+        attempt : int
+            The number of the failed attempt, starting at 0.
+
+        Returns
+        -------
+        float | None
+            The delay (seconds), or None if the request should not be retried.
+
+        """
+        if not is_transient_error(exc):
+            return None
+        self._record_failure(exc)
+        settings = BotSettings.resilience
+        if attempt >= settings.max_retries or self.state == CircuitState.OPEN:
+            return None
+        retry_after = get_retry_after(exc)
+        if retry_after is not None:
+            return retry_after if retry_after <= settings.retry_max_delay else None
+        return random.uniform(0, min(settings.retry_base_delay * 2**attempt, settings.retry_max_delay))
+
+    async def call[T](self, request: Callable[[], Awaitable[T]]) -> T:
+        """Send a request, retrying it if it fails for a transient reason.
+
+        Parameters
+        ----------
+        request : Callable[[], Awaitable[T]]
+            A function which sends the request.
+
+        Returns
+        -------
+        T
+            The result of the request.
+
+        Raises
+        ------
+        CircuitOpenError
+            If the circuit is open.
+
+        """
+        attempt = 0
+        while True:
+            self._start_attempt()
+            start = time.monotonic()
+            try:
+                async with asyncio.timeout(self.timeout):
+                    result = await request()
+            except Exception as exc:
+                delay = self._get_retry_delay(exc, attempt)
+                if delay is None:
+                    raise
+                self.log_warning("Retrying request in %.1f seconds after: %s", delay, exc)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            finally:
+                self._trial_in_flight = False
+            self._record_success(time.monotonic() - start)
+            return result
+
+    async def stream[T](self, open_stream: Callable[[], AsyncIterator[T]]) -> AsyncIterator[T]:
+        """Stream a response, retrying if it fails before anything is received.
+
+        The timeout applies to receiving the first item, so the time taken to
+        receive it is the latency recorded, however long the rest of the
+        stream takes. Once an item has been yielded, a failure is raised rather
+        than retried.
+
+        Parameters
+        ----------
+        open_stream : Callable[[], AsyncIterator[T]]
+            A function which sends the request and iterates over the response.
+
+        Yields
+        ------
+        T
+            The items in the response.
+
+        Raises
+        ------
+        CircuitOpenError
+            If the circuit is open.
+
+        """
+        attempt = 0
+        while True:
+            self._start_attempt()
+            start = time.monotonic()
+            iterator = aiter(open_stream())
+            try:
+                try:
+                    async with asyncio.timeout(self.timeout):
+                        first = await anext(iterator)
+                except StopAsyncIteration:
+                    self._record_success(time.monotonic() - start)
+                    return
+                except Exception as exc:
+                    delay = self._get_retry_delay(exc, attempt)
+                    if delay is None:
+                        raise
+                    self.log_warning("Retrying stream in %.1f seconds after: %s", delay, exc)
+                    await asyncio.sleep(delay)
+                    attempt += 1
+                    continue
+                finally:
+                    self._trial_in_flight = False
+
+                first_item_seconds = time.monotonic() - start
+                yield first
+                try:
+                    async for item in iterator:
+                        yield item
+                except Exception as exc:
+                    if is_transient_error(exc):
+                        self._record_failure(exc)
+                    raise
+                self._record_success(first_item_seconds)
+                return
+            finally:
+                if hasattr(iterator, "aclose"):
+                    await iterator.aclose()
+
+    def describe(self) -> str:
+        """Describe the health of the provider.
+
+        Returns
+        -------
+        str
+            The circuit state, timeout, recent latency and most recent error.
+
+        """
+        p95 = self.latency.quantile(0.95)
+        lines = [
+            f"{self.provider}: circuit {self.state}, {self.consecutive_failures} consecutive failures",
+            f"  timeout {self.timeout:.1f} s, p95 latency {f'{p95:.1f} s' if p95 else 'unknown'}",
+        ]
+        if self.last_error_time:
+            lines.append(f"  last error at {self.last_error_time:%Y-%m-%d %H:%M:%S %Z}: {self.last_error}")
+        return "\n".join(lines)
+
+
+_PROVIDERS: dict[str, ProviderResilience] = {}
+
+
+def get_resilience(provider: str) -> ProviderResilience:
+    """Get the process-wide resilience layer for a provider.
+
+    Parameters
+    ----------
+    provider : str
+        The provider name, i.e. the `client_type` of a client.
+
+    Returns
+    -------
+    ProviderResilience
+        The shared resilience layer, which is created on first use.
+
+    """
+    if provider not in _PROVIDERS:
+        _PROVIDERS[provider] = ProviderResilience(provider)
+    return _PROVIDERS[provider]
+
+
+def get_all_resilience() -> list[ProviderResilience]:
+    """Get the resilience layer for every provider which has been used.
+
+    Returns
+    -------
+    list[ProviderResilience]
+        The resilience layers, sorted by provider name.
+
+    """
+    return [_PROVIDERS[provider] for provider in sorted(_PROVIDERS)]
@@ -0,0 +1,500 @@
+"""Provider-neutral conversation history.
+
+Each provider expects a conversation in its own format: Gemini uses
+`contents/parts`, whilst Anthropic and OpenAI use `content` blocks. The
+conversation is instead kept in a single, compact, format which is owned by
+the text generator and survives switching model, even between providers.
+
+The payload for the current provider is rendered from the conversation on
+demand. The rendered messages are cached, so only new messages are rendered
+for each request and the payload is not rebuilt from scratch every turn.
+
+The messages are held in a deque, so the oldest messages are removed in
+constant time when the context is shrunk. The conversation also keeps an index
+of the messages which include images or videos, so the context does not have
+to be searched to limit the number of images or videos in it.
+"""
+
+import itertools
+from collections import deque
+from collections.abc import Callable, Hashable, Iterator, Sequence
+from dataclasses import dataclass
+from typing import Self
+
+from slashbot.llm.blobs import BLOB_MIN_SIZE, BLOB_STORE, BlobRef, MemoryUsage
+from slashbot.llm.models import TextGenerationInput, VisionImage, VisionVideo
+
+# The number of formats the payload is cached in, e.g. for the current model
+# and the hedge model, which share a conversation
+MAX_CACHED_VIEWS = 2
+
+
+def _intern_image(image: VisionImage) -> VisionImage:
+    """Move the data of an image into the blob store.
+
+    Parameters
+    ----------
+    image : VisionImage
+        The image, with the data held inline.
+
+    Returns
+    -------
+    VisionImage
+        A copy of the image, with the data as a BlobRef.
+
+    """
+    if isinstance(image.b64image, str) and len(image.b64image) >= BLOB_MIN_SIZE:
+        return VisionImage(image.url, BLOB_STORE.put(image.b64image), image.mime_type)
+    return image
+
+
+@dataclass(slots=True)
+class ConversationMessage:
+    """A message in a conversation.
+
+    Messages are not modified once they are added to a conversation, other
+    than to re-count the tokens when the provider is changed.
+
+    Attributes
+    ----------
+    role : str
+        The role of the message, either "user" or "assistant".
+    texts : tuple[str, ...]
+        The text of the message. A user message may combine the text of
+        several Discord messages.
+    images : tuple[VisionImage, ...]
+        The images in the message, with the data held in the blob store.
+    videos : tuple[VisionVideo, ...]
+        The videos in the message.
+    tokens : int
+        The number of tokens in the message, as counted for the current
+        provider.
+
+    """
+
+    role: str
+    texts: tuple[str, ...]
+    images: tuple[VisionImage, ...] = ()
+    videos: tuple[VisionVideo, ...] = ()
+    tokens: int = 0
+
+    @property
+    def text(self) -> str:
+        """Get the text of the message."""
+        return " ".join(self.texts)
+
+    @property
+    def has_youtube_video(self) -> bool:
+        """Check if the message includes a YouTube video."""
+        return any("youtube.com" in video.url or "youtu.be" in video.url for video in self.videos)
+
+    @classmethod
+    def from_inputs(cls, messages: TextGenerationInput | list[TextGenerationInput]) -> Self:
+        """Create a user message from one or more inputs.
+
+        Parameters
+        ----------
+        messages : TextGenerationInput | list[TextGenerationInput]
+            The input(s), including attached images and videos.
+
+        Returns
+        -------
+        ConversationMessage
+            A single message, combining the inputs.
+
+        """
+        if isinstance(messages, TextGenerationInput):
+            messages = [messages]
+        images = []
+        videos = []
+        for message in messages:
+            if message.images:
+                images.extend(message.images if isinstance(message.images, list) else [message.images])
+            if message.videos:
+                videos.extend(message.videos if isinstance(message.videos, list) else [message.videos])
+
+        return cls(
+            "user",
+            tuple(message.text for message in messages),
+            tuple(_intern_image(image) for image in images),
+            tuple(videos),
+        )
+
+    @classmethod
+    def from_dict(cls, payload: dict, *, tokens: int = 0) -> Self:
+        """Create a message from its stored representation.
+
+        Parameters
+        ----------
+        payload : dict
+            The message, as returned by `to_dict()`.
+        tokens : int
+            The number of tokens in the message.
+
+        Returns
+        -------
+        ConversationMessage
+            The message, with the media moved into the blob store.
+
+        """
+        return cls(
+            payload["role"],
+            tuple(payload["texts"]),
+            tuple(
+                _intern_image(VisionImage(image["url"], image["data"], image["mime_type"]))
+                for image in payload.get("images", [])
+            ),
+            tuple(VisionVideo(video["url"], mime_type=video["mime_type"]) for video in payload.get("videos", [])),
+            tokens,
+        )
+
+    def to_dict(self) -> dict:
+        """Get a JSON serialisable representation of the message.
+
+        Returns
+        -------
+        dict
+            The message, including the data of any media.
+
+        """
+        return {
+            "role": self.role,
+            "texts": list(self.texts),
+            "images": [
+                {"url": image.url, "mime_type": image.mime_type, "data": BLOB_STORE.materialise(image.b64image)}
+                for image in self.images
+            ],
+            "videos": [{"url": video.url, "mime_type": video.mime_type} for video in self.videos],
+        }
+
+
+class Conversation:
+    """The messages in a conversation, and the payload rendered from them.
+
+    The rendered payload is cached for up to MAX_CACHED_VIEWS serialisers,
+    keyed by the provider and model which it is rendered for, so a hedge model
+    does not invalidate the payload of the current model. Messages appended to
+    the conversation are rendered on the next request, and messages removed
+    from it are also removed from each rendered payload. The payloads are
+    deques, so removing the oldest message takes constant time, and are only
+    copied into a list for a request.
+
+    The media indexes hold the sequence number of each message with images or
+    videos, oldest first. A message's sequence number is its index plus the
+    sequence number of the oldest message, so removing the oldest message does
+    not change the indexes of the other messages.
+    """
+
+    __slots__ = (
+        "_first",
+        "_messages",
+        "_token_total",
+        "_views",
+        "_with_images",
+        "_with_videos",
+        "counted_by",
+    )
+
+    def __init__(self) -> None:
+        """Initialise an empty conversation."""
+        self._messages: deque[ConversationMessage] = deque()
+        self._first = 0
+        self._token_total = 0
+        self._with_images: deque[int] = deque()
+        self._with_videos: deque[int] = deque()
+        self._views: dict[Hashable, deque[dict]] = {}
+        self.counted_by = ""
+
+    def __len__(self) -> int:
+        """Get the number of messages in the conversation."""
+        return len(self._messages)
+
+    def __iter__(self) -> Iterator[ConversationMessage]:
+        """Iterate over the messages, oldest first."""
+        return iter(self._messages)
+
+    def __getitem__(self, index: int) -> ConversationMessage:
+        """Get a message in the conversation."""
+        return self._messages[index]
+
+    @property
+    def token_total(self) -> int:
+        """Get the number of tokens in the conversation."""
+        return self._token_total
+
+    @property
+    def num_with_images(self) -> int:
+        """Get the number of messages which include an image."""
+        return len(self._with_images)
+
+    @property
+    def num_with_videos(self) -> int:
+        """Get the number of messages which include a video."""
+        return len(self._with_videos)
+
+    def positions_with_images(self) -> list[int]:
+        """Get the index of each message which includes an image.
+
+        Returns
+        -------
+        list[int]
+            The indices of the messages, oldest first.
+
+        """
+        return [seq - self._first for seq in self._with_images]
+
+    def positions_with_videos(self) -> list[int]:
+        """Get the index of each message which includes a video.
+
+        Returns
+        -------
+        list[int]
+            The indices of the messages, oldest first.
+
+        """
+        return [seq - self._first for seq in self._with_videos]
+
+    def _add(self, message: ConversationMessage, *, oldest: bool = False) -> None:
+        """Add a message to the conversation, the running total and the indexes.
+
+        Parameters
+        ----------
+        message : ConversationMessage
+            The message.
+        oldest : bool
+            If True, the message is added before the oldest message rather than
+            after the newest.
+
+        """
+        if oldest:
+            self._first -= 1
+            seq = self._first
+            self._messages.appendleft(message)
+        else:
+            seq = self._first + len(self._messages)
+            self._messages.append(message)
+        self._token_total += message.tokens
+        for index, has_media in ((self._with_images, message.images), (self._with_videos, message.videos)):
+            if has_media and oldest:
+                index.appendleft(seq)
+            elif has_media:
+                index.append(seq)
+
+    def _remove(self, position: int) -> ConversationMessage:
+        """Remove a message from the conversation, the running total and the indexes.
+
+        Removing the oldest message takes constant time. Otherwise, the
+        messages after it are moved along and the sequence numbers after it
+        in the indexes are reduced by one.
+
+        Parameters
+        ----------
+        position : int
+            The index of the message, which must not be negative.
+
+        Returns
+        -------
+        ConversationMessage
+            The removed message.
+
+        """
+        seq = self._first + position
+        if position == 0:
+            message = self._messages.popleft()
+            self._first += 1
+        else:
+            message = self._messages[position]
+            del self._messages[position]
+        self._token_total -= message.tokens
+
+        for index in (self._with_images, self._with_videos):
+            if position == 0:
+                if index and index[0] == seq:
+                    index.popleft()
+                continue
+            if not index or index[-1] < seq:
+                continue
+            for _ in range(len(index)):
+                entry = index.popleft()
+                if entry != seq:
+                    index.append(entry - 1 if entry > seq else entry)
+
+        return message
+
+    def append(self, message: ConversationMessage, *, rendered: dict | None = None, key: Hashable = None) -> None:
+        """Append a message to the conversation.
+
+        Parameters
+        ----------
+        message : ConversationMessage
+            The message to append.
+        rendered : dict | None
+            The message, if it has already been rendered. It is added to the
+            cached payload with the same key, if that payload is up to date.
+        key : Hashable
+            The key of the format the message was rendered in.
+
+        """
+        view = self._views.get(key)
+        if rendered is not None and view is not None and len(view) == len(self._messages):
+            view.append(rendered)
+        self._add(message)
+
+    def pop(self, index: int) -> ConversationMessage:
+        """Remove a message from the conversation.
+
+        Parameters
+        ----------
+        index : int
+            The index of the message to remove.
+
+        Returns
+        -------
+        ConversationMessage
+            The removed message.
+
+        """
+        if index < 0:
+            index += len(self._messages)
+        if not 0 <= index < len(self._messages):
+            msg = "Conversation index out of range"
+            raise IndexError(msg)
+        message = self._remove(index)
+        for view in self._views.values():
+            if index == 0 and view:
+                view.popleft()
+            elif index < len(view):
+                del view[index]
+
+        return message
+
+    def replace_oldest(
+        self,
+        messages: Sequence[ConversationMessage],
+        replacements: list[ConversationMessage],
+        *,
+        rendered: list[dict],
+        key: Hashable,
+    ) -> bool:
+        """Replace the oldest messages in the conversation, e.g. with a digest.
+
+        The messages are only replaced if they are still the oldest messages,
+        as the conversation may have changed since they were read. A new
+        payload is created, so a request built from the old payload is not
+        modified. Payloads in other formats are rendered again from scratch.
+
+        Parameters
+        ----------
+        messages : Sequence[ConversationMessage]
+            The messages to replace, oldest first.
+        replacements : list[ConversationMessage]
+            The messages to replace them with, with their tokens counted.
+        rendered : list[dict]
+            The replacement messages, rendered in the format given by key.
+        key : Hashable
+            The key of the format the replacements were rendered in.
+
+        Returns
+        -------
+        bool
+            True if the messages were replaced.
+
+        """
+        num_messages = len(messages)
+        if num_messages > len(self._messages) or any(
+            old is not new for old, new in zip(self._messages, messages, strict=False)
+        ):
+            return False
+
+        for _ in range(num_messages):
+            self._remove(0)
+        for message in reversed(replacements):
+            self._add(message, oldest=True)
+        view = self._views.get(key)
+        self._views = {}
+        if view is not None and len(view) >= num_messages:
+            self._views[key] = deque([*rendered, *itertools.islice(view, num_messages, None)])
+
+        return True
+
+    def clear(self) -> None:
+        """Remove every message from the conversation.
+
+        A new payload is created, so a request built from the old payload is
+        not modified.
+        """
+        self._messages = deque()
+        self._first = 0
+        self._views = {}
+        self._token_total = 0
+        self._with_images = deque()
+        self._with_videos = deque()
+
+    def recount(self, counted_by: str, tokens: list[int]) -> None:
+        """Replace the number of tokens in each message.
+
+        Parameters
+        ----------
+        counted_by : str
+            The provider which the tokens were counted for.
+        tokens : list[int]
+            The number of tokens in each message, oldest first.
+
+        """
+        for message, message_tokens in zip(self._messages, tokens, strict=True):
+            message.tokens = message_tokens
+        self._token_total = sum(tokens)
+        self.counted_by = counted_by
+
+    def render(self, key: Hashable, serialise: Callable[[ConversationMessage], dict]) -> list[dict]:
+        """Get the payload for the conversation, rendering new messages.
+
+        Parameters
+        ----------
+        key : Hashable
+            Identifies the format of the payload, e.g. the provider and model.
+            If the payload is not cached in this format, it is rendered from
+            scratch and the least recently used format is evicted.
+        serialise : Callable[[ConversationMessage], dict]
+            The function to render a message in the format of the payload.
+
+        Returns
+        -------
+        list[dict]
+            The rendered messages. This is a copy of the cached payload, so it
+            is not changed by later changes to the conversation.
+
+        """
+        view = self._views.pop(key, None)
+        if view is None:
+            view = deque()
+            while len(self._views) >= MAX_CACHED_VIEWS:
+                del self._views[next(iter(self._views))]
+        self._views[key] = view  # most recently used last
+        if len(view) < len(self._messages):
+            # Indexing a deque is quick near either end, where new messages are
+            view.extend(serialise(self._messages[i]) for i in range(len(view), len(self._messages)))
+
+        return list(view)
+
+    def memory_usage(self) -> MemoryUsage:
+        """Get the memory used by the conversation.
+
+        Returns
+        -------
+        MemoryUsage
+            The bytes of text held in memory, and the bytes of media held in
+            the blob store.
+
+        """
+        usage = MemoryUsage()
+        for message in self._messages:
+            usage.inline_bytes += sum(len(text) for text in message.texts)
+            for image in message.images:
+                if isinstance(image.b64image, BlobRef):
+                    usage.blob_bytes += image.b64image.size
+                    usage.num_blobs += 1
+                else:
+                    usage.inline_bytes += len(image.b64image or "")
+
+        return usage
@@ -0,0 +1,168 @@
+"""Hedged requests, which are also sent to a second model if the first is slow.
+
+A request is sent to the primary model first. If it has not responded within
+its latency budget, the same request is sent to a secondary model and
+whichever responds first is used, with the other request being cancelled. If
+the primary model fails, the request is sent to the secondary model straight
+away. The latency budget is a high percentile of each model's recent response
+times, so a request is only hedged when it is unusually slow.
+"""
+
+import asyncio
+import bisect
+from collections import defaultdict
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+T = TypeVar("T")
+
+# Bucket upper bounds (seconds), spaced by a factor of sqrt(2) from 0.25 s
+LATENCY_BUCKETS = tuple(0.25 * 2 ** (i / 2) for i in range(20))
+MAX_LATENCY_SAMPLES = 1000
+
+
+class LatencyHistogram:
+    """A histogram of recent request latencies.
+
+    Once the histogram holds MAX_LATENCY_SAMPLES samples, every count is
+    halved so that older samples decay and the percentiles follow changes in
+    the provider's latency.
+    """
+
+    def __init__(self) -> None:
+        """Initialise an empty histogram."""
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0
+
+    def record(self, seconds: float) -> None:
+        """Record the latency of a request.
+
+        Parameters
+        ----------
+        seconds : float
+            The time taken for the request.
+
+        """
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += 1
+        if self.total >= MAX_LATENCY_SAMPLES:
+            self.counts = [count // 2 for count in self.counts]
+            self.total = sum(self.counts)
+
+    def quantile(self, q: float) -> float | None:
+        """Estimate a latency quantile.
+
+        Parameters
+        ----------
+        q : float
+            The quantile, between 0 and 1.
+
+        Returns
+        -------
+        float | None
+            The upper bound of the bucket containing the quantile, or None if
+            no latencies have been recorded.
+
+        """
+        if self.total == 0:
+            return None
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts, strict=False):
+            cumulative += count
+            if cumulative >= q * self.total:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+
+class LatencyTracker:
+    """Latency histograms for each model, used to set hedging delays."""
+
+    def __init__(self) -> None:
+        """Initialise with no recorded latencies."""
+        self._histograms: dict[str, LatencyHistogram] = defaultdict(LatencyHistogram)
+
+    def record(self, model: str, seconds: float) -> None:
+        """Record the latency of a request, including one which failed or was cancelled.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model.
+        seconds : float
+            The time taken for the request.
+
+        """
+        self._histograms[model].record(seconds)
+
+    def get_hedge_delay(self, model: str, *, quantile: float, min_samples: int, default: float) -> float:
+        """Get how long to wait for a model before hedging a request.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model.
+        quantile : float
+            The latency quantile to wait for.
+        min_samples : int
+            The number of latencies which need to be recorded before the
+            quantile is used.
+        default : float
+            The delay to use until enough latencies have been recorded.
+
+        Returns
+        -------
+        float
+            The delay, in seconds.
+
+        """
+        histogram = self._histograms.get(model)
+        if histogram is None or histogram.total < min_samples:
+            return default
+        return histogram.quantile(quantile) or default
+
+
+LATENCY_TRACKER = LatencyTracker()
+
+
+async def hedge_request(
+    primary: Callable[[], Awaitable[T]], secondary: Callable[[], Awaitable[T]], *, delay: float
+) -> T:
+    """Send a request, and send it again to a secondary if it is slow or fails.
+
+    Parameters
+    ----------
+    primary : Callable[[], Awaitable[T]]
+        A function which sends the request to the primary model.
+    secondary : Callable[[], Awaitable[T]]
+        A function which sends the request to the secondary model.
+    delay : float
+        The time (seconds) to wait for the primary before also sending the
+        request to the secondary.
+
+    Returns
+    -------
+    T
+        The first successful response.
+
+    Raises
+    ------
+    Exception
+        The exception raised by the primary, if both requests fail.
+
+    """
+    tasks = [asyncio.create_task(primary())]
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=delay)
+        if done and tasks[0].exception() is None:
+            return tasks[0].result()
+        tasks.append(asyncio.create_task(secondary()))
+        pending.add(tasks[1])
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task in done and task.exception() is None:
+                    return task.result()
+        raise tasks[0].exception()  # type: ignore[misc]
+    finally:
+        for task in tasks:
+            task.cancel()
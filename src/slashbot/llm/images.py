@@ -0,0 +1,401 @@
+"""Image ingestion for vision requests.
+
+Images attached to a message are downloaded concurrently, with caps on the
+size and download time of each image. Each image is then downscaled to the
+resolution the provider will use anyway, and re-encoded, before being base64
+encoded. This keeps the request payload (and the vision prefill) small.
+
+The results are kept in a content-addressed cache, which is held in memory
+and spills to disk, so the same image is not downloaded and processed again
+when it is replied to repeatedly.
+"""
+
+import asyncio
+import base64
+import hashlib
+import io
+import urllib.parse
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import aiofiles
+from PIL import Image, ImageOps
+
+from slashbot.llm.models import VisionImage
+from slashbot.logger import Logger
+from slashbot.settings import BotSettings
+from slashbot.transport import TRANSPORTS
+
+LOGGER = Logger(prepend_msg="[Images]")
+
+# Discord CDN links carry signed, expiring query parameters. The path alone
+# identifies the attachment
+_DISCORD_CDN_HOSTS = ("cdn.discordapp.com", "media.discordapp.net")
+
+
+class ImageTooLargeError(Exception):
+    """Raised when an image is larger than the maximum download size."""
+
+
+@dataclass
+class EncodedImage:
+    """A processed, base64 encoded, image.
+
+    Attributes
+    ----------
+    mime_type : str
+        The MIME type of the encoded image.
+    b64image : str
+        The base64 encoded image.
+
+    """
+
+    mime_type: str
+    b64image: str
+
+    def __len__(self) -> int:
+        """Get the size of the encoded image, in bytes."""
+        return len(self.b64image)
+
+
+def _normalise_url(url: str) -> str:
+    """Normalise a URL to use as a cache key.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the image.
+
+    Returns
+    -------
+    str
+        The URL, without the query for Discord CDN links.
+
+    """
+    parsed = urllib.parse.urlsplit(url)
+    if parsed.hostname in _DISCORD_CDN_HOSTS:
+        return urllib.parse.urlunsplit((parsed.scheme, parsed.netloc, parsed.path, "", ""))
+    return url
+
+
+class ImageCache:
+    """Content-addressed cache of processed images.
+
+    URLs are mapped to the hash of the downloaded content, and the processed
+    images are stored by the content hash and the resolution they were
+    processed for. The least recently used images are spilled from memory to
+    disk, and removed from disk once it is full.
+    """
+
+    def __init__(self, directory: Path, *, max_memory_bytes: int, max_disk_bytes: int, max_urls: int = 4096) -> None:
+        """Initialise the cache, indexing any images already on disk.
+
+        Parameters
+        ----------
+        directory : Path
+            The directory to spill images to.
+        max_memory_bytes : int
+            The maximum size of the images held in memory.
+        max_disk_bytes : int
+            The maximum size of the images held on disk.
+        max_urls : int
+            The maximum number of URLs to remember the content hash of.
+
+        """
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.max_urls = max_urls
+        self._urls: OrderedDict[str, str] = OrderedDict()
+        self._memory: OrderedDict[str, EncodedImage] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_bytes = 0
+
+        if self.directory.is_dir():
+            for path in sorted(self.directory.iterdir(), key=lambda path: path.stat().st_mtime):
+                self._disk[path.name] = path.stat().st_size
+                self._disk_bytes += self._disk[path.name]
+
+    @staticmethod
+    def key(digest: str, max_dimension: int) -> str:
+        """Create the key for a processed image.
+
+        Parameters
+        ----------
+        digest : str
+            The hash of the original image.
+        max_dimension : int
+            The resolution the image was processed for.
+
+        Returns
+        -------
+        str
+            The cache key.
+
+        """
+        return f"{digest}-{max_dimension}"
+
+    def digest_for_url(self, url: str) -> str | None:
+        """Get the content hash of a previously downloaded URL.
+
+        Parameters
+        ----------
+        url : str
+            The URL of the image.
+
+        Returns
+        -------
+        str | None
+            The hash of the content, or None if the URL has not been seen.
+
+        """
+        url = _normalise_url(url)
+        digest = self._urls.get(url)
+        if digest:
+            self._urls.move_to_end(url)
+        return digest
+
+    def remember_url(self, url: str, digest: str) -> None:
+        """Record the content hash of a downloaded URL.
+
+        Parameters
+        ----------
+        url : str
+            The URL of the image.
+        digest : str
+            The hash of the content.
+
+        """
+        self._urls[_normalise_url(url)] = digest
+        self._urls.move_to_end(_normalise_url(url))
+        while len(self._urls) > self.max_urls:
+            self._urls.popitem(last=False)
+
+    async def get(self, key: str) -> EncodedImage | None:
+        """Get a processed image, from memory or disk.
+
+        Parameters
+        ----------
+        key : str
+            The key of the image.
+
+        Returns
+        -------
+        EncodedImage | None
+            The image, or None if it is not in the cache.
+
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if key not in self._disk:
+            return None
+
+        try:
+            async with aiofiles.open(self.directory / key, encoding="utf-8") as file_in:
+                mime_type, b64image = (await file_in.read()).split("\n", maxsplit=1)
+        except (OSError, ValueError):
+            self._disk_bytes -= self._disk.pop(key)
+            return None
+        image = EncodedImage(mime_type, b64image)
+        await self.put(key, image)
+
+        return image
+
+    async def put(self, key: str, image: EncodedImage) -> None:
+        """Add a processed image to the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key of the image.
+        image : EncodedImage
+            The image to add.
+
+        """
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = image
+        self._memory_bytes += len(image)
+        while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+            spilled_key, spilled = self._memory.popitem(last=False)
+            self._memory_bytes -= len(spilled)
+            await self._spill(spilled_key, spilled)
+
+    async def _spill(self, key: str, image: EncodedImage) -> None:
+        """Write an image evicted from memory to disk.
+
+        Parameters
+        ----------
+        key : str
+            The key of the image.
+        image : EncodedImage
+            The image to write.
+
+        """
+        if self.max_disk_bytes <= 0 or key in self._disk:
+            return
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            async with aiofiles.open(self.directory / key, "w", encoding="utf-8") as file_out:
+                await file_out.write(f"{image.mime_type}\n{image.b64image}")
+        except OSError as exc:
+            LOGGER.log_warning("Unable to spill image %s to disk: %s", key, exc)
+            return
+        self._disk[key] = len(image) + len(image.mime_type) + 1
+        self._disk_bytes += self._disk[key]
+
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            removed_key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            (self.directory / removed_key).unlink(missing_ok=True)
+
+
+IMAGE_CACHE = ImageCache(
+    BotSettings.files.image_cache,
+    max_memory_bytes=BotSettings.cogs.chatbot.image_cache_memory_mb * 1024 * 1024,
+    max_disk_bytes=BotSettings.cogs.chatbot.image_cache_disk_mb * 1024 * 1024,
+)
+
+
+def downscale_image(data: bytes, mime_type: str, max_dimension: int) -> tuple[bytes, str]:
+    """Downscale and re-encode an image, if it is larger than required.
+
+    Images with transparency are re-encoded as PNG, and everything else as
+    JPEG. The EXIF orientation is applied first, as the EXIF data is not
+    kept. Animated images, and images which cannot be decoded, are returned
+    unchanged.
+
+    Parameters
+    ----------
+    data : bytes
+        The original image.
+    mime_type : str
+        The MIME type of the original image.
+    max_dimension : int
+        The maximum width and height of the image.
+
+    Returns
+    -------
+    tuple[bytes, str]
+        The processed image and its MIME type.
+
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as original:
+            if getattr(original, "is_animated", False) or max(original.size) <= max_dimension:
+                return data, mime_type
+            image = ImageOps.exif_transpose(original)
+            image.thumbnail((max_dimension, max_dimension))
+            output = io.BytesIO()
+            if image.mode in ("RGBA", "LA", "P"):
+                image.save(output, format="PNG", optimize=True)
+                return output.getvalue(), "image/png"
+            image.convert("RGB").save(output, format="JPEG", quality=85)
+            return output.getvalue(), "image/jpeg"
+    except (OSError, ValueError) as exc:
+        LOGGER.log_debug("Unable to downscale image, using the original: %s", exc)
+        return data, mime_type
+
+
+async def _download_image(url: str) -> tuple[bytes, str]:
+    """Download an image, aborting if it is too large.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the image.
+
+    Returns
+    -------
+    tuple[bytes, str]
+        The image and its MIME type.
+
+    Raises
+    ------
+    ImageTooLargeError
+        If the image is larger than the maximum size.
+
+    """
+    max_bytes = BotSettings.cogs.chatbot.max_image_bytes
+    async with TRANSPORTS.get_http_client("images").stream("GET", url) as response:
+        response.raise_for_status()
+        if int(response.headers.get("Content-Length", 0)) > max_bytes:
+            msg = f"{url} is larger than {max_bytes} bytes"
+            raise ImageTooLargeError(msg)
+        data = bytearray()
+        async for chunk in response.aiter_bytes():
+            data.extend(chunk)
+            if len(data) > max_bytes:
+                msg = f"{url} is larger than {max_bytes} bytes"
+                raise ImageTooLargeError(msg)
+        mime_type = response.headers.get("Content-Type", "image/png").split(";")[0]
+
+    return bytes(data), mime_type
+
+
+async def ingest_image(url: str, *, max_dimension: int) -> VisionImage:
+    """Download, process and encode an image, using the cache if possible.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the image.
+    max_dimension : int
+        The maximum width and height of the image for the provider.
+
+    Returns
+    -------
+    VisionImage
+        The encoded image.
+
+    """
+    digest = IMAGE_CACHE.digest_for_url(url)
+    encoded = await IMAGE_CACHE.get(ImageCache.key(digest, max_dimension)) if digest else None
+
+    if not encoded:
+        async with asyncio.timeout(BotSettings.cogs.chatbot.image_download_timeout):
+            data, mime_type = await _download_image(url)
+        digest = hashlib.sha256(data).hexdigest()
+        IMAGE_CACHE.remember_url(url, digest)
+        key = ImageCache.key(digest, max_dimension)
+        encoded = await IMAGE_CACHE.get(key)
+        if not encoded:
+            data, mime_type = await asyncio.to_thread(downscale_image, data, mime_type, max_dimension)
+            encoded = EncodedImage(mime_type, base64.b64encode(data).decode("utf-8"))
+            await IMAGE_CACHE.put(key, encoded)
+
+    return VisionImage(url, encoded.b64image, encoded.mime_type)
+
+
+async def ingest_images(urls: list[str], *, max_dimension: int) -> list[VisionImage]:
+    """Download, process and encode images concurrently.
+
+    Images which fail to download, or are too large, are skipped.
+
+    Parameters
+    ----------
+    urls : list[str]
+        The URLs of the images.
+    max_dimension : int
+        The maximum width and height of the images for the provider.
+
+    Returns
+    -------
+    list[VisionImage]
+        The encoded images, in the same order as the URLs.
+
+    """
+    results = await asyncio.gather(
+        *(ingest_image(url, max_dimension=max_dimension) for url in urls), return_exceptions=True
+    )
+    images = []
+    for url, result in zip(urls, results, strict=True):
+        if isinstance(result, Exception):
+            LOGGER.log_warning("Unable to ingest image %s: %s", url, str(result) or type(result).__name__)
+            continue
+        images.append(result)
+
+    return images
@@ -1,15 +1,20 @@
 import base64
 from dataclasses import dataclass
 
-import httpx
+from slashbot.llm.blobs import BlobRef
+from slashbot.transport import TRANSPORTS
 
 
 @dataclass
 class VisionImage:
-    """Dataclass for images for LLM vision."""
+    """Dataclass for images for LLM vision.
+
+    Once an image is added to a conversation, the encoded image is moved into
+    the blob store and `b64image` is a BlobRef.
+    """
 
     url: str
-    b64image: str | None = None
+    b64image: str | BlobRef | None = None
     mime_type: str | None = None
 
     def __len__(self) -> int:
@@ -29,9 +34,8 @@ class VisionImage:
             The timeout for the HTTP request. Default is 60 seconds.
 
         """
-        async with httpx.AsyncClient() as client:
-            response = await client.get(self.url, timeout=httpx_timeout)
-            response.raise_for_status()
+        response = await TRANSPORTS.get_http_client("images").get(self.url, timeout=httpx_timeout)
+        response.raise_for_status()
         self.mime_type = response.headers["Content-Type"]
         self.b64image = base64.b64encode(response.content).decode("utf-8")
 
@@ -71,10 +75,56 @@ class TextGenerationInput:
 
 @dataclass
 class TextGenerationResponse:
-    """Response object for text generation."""
+    """Response object for text generation.
+
+    Attributes
+    ----------
+    message : str
+        The generated text.
+    tokens_used : int
+        The total number of tokens used by the request and response.
+    input_tokens : int
+        The number of input tokens reported by the provider, or 0 if unknown.
+    output_tokens : int
+        The number of output tokens reported by the provider, or 0 if unknown.
+    cached_tokens : int
+        The number of input tokens which were read from the provider's prompt
+        cache.
+    cache_creation_tokens : int
+        The number of input tokens which were written to the provider's prompt
+        cache.
+
+    """
 
     message: str
     tokens_used: int
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    cache_creation_tokens: int = 0
+
+
+@dataclass
+class TokenLedgerEntry:
+    """The token count for a message in a model context.
+
+    Attributes
+    ----------
+    role : str
+        The role of the message, e.g. "user" or "assistant".
+    text : str
+        The text content of the message.
+    tokens : int
+        The number of tokens counted for the message when it was added.
+    num_images : int
+        The number of images in the message.
+
+    """
+
+    role: str
+    text: str
+    tokens: int
+    num_images: int = 0
 
 
 class GenerationFailureError(Exception):
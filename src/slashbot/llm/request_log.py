@@ -0,0 +1,355 @@
+"""Log of the requests sent to, and responses received from, LLM providers.
+
+A request includes the whole model context, so it can be large and writing it
+to a file on the event loop stalls the bot. Instead, requests and responses
+are put on a bounded queue and a background thread serialises and writes them.
+If the queue is full, records are dropped rather than slowing the bot down.
+
+Base64 encoded media is replaced by its hash and size, and records are written
+as gzip compressed JSON lines, so that weeks of history can be kept. Each
+process writes one gzip member to its own file for each day, so records are
+compressed against each other, and the compressor is sync flushed whenever the
+writer is idle. If the bot does not exit cleanly, the flushed records can still
+be decompressed and the file is never appended to again. Requests can be
+sampled, globally or per channel, and a sampled request is always logged
+together with its response.
+"""
+
+import asyncio
+import dataclasses
+import datetime
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import queue
+import random
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+from slashbot.llm.blobs import BlobRef
+from slashbot.logger import Logger
+from slashbot.settings import BotSettings
+
+# Time (seconds) the writer waits for a record before flushing to disk
+FLUSH_INTERVAL = 1.0
+BASE64_PATTERN = re.compile(r"(data:[^,]*;base64,)?[A-Za-z0-9+/_-]+={0,2}")
+
+
+@dataclasses.dataclass(slots=True)
+class RequestLogRecord:
+    """A request or response waiting to be written.
+
+    Attributes
+    ----------
+    timestamp : float
+        The time the record was created, as a Unix timestamp.
+    kind : str
+        Either "request" or "response".
+    request_id : int
+        The ID which links a response to its request.
+    model : str
+        The name of the model.
+    channel_id : int | None
+        The channel the request was made for, if known.
+    payload : Any
+        The request content or the response.
+
+    """
+
+    timestamp: float
+    kind: str
+    request_id: int
+    model: str
+    channel_id: int | None
+    payload: Any
+
+
+def redact(obj: Any, *, inline_limit: int) -> Any:
+    """Convert a payload to JSON compatible types, replacing media by its hash.
+
+    Parameters
+    ----------
+    obj : Any
+        The payload, which may include SDK response objects and BlobRefs.
+    inline_limit : int
+        Strings which look like base64 and are longer than this are replaced.
+
+    Returns
+    -------
+    Any
+        The redacted payload.
+
+    """
+    if isinstance(obj, BlobRef):
+        return {"sha256": obj.digest, "bytes": obj.size}
+    # SDK response objects and dataclasses are converted to dicts first
+    if hasattr(obj, "model_dump"):
+        obj = obj.model_dump(mode="json")
+    elif dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        obj = dataclasses.asdict(obj)
+
+    if isinstance(obj, dict):
+        return {str(key): redact(value, inline_limit=inline_limit) for key, value in obj.items()}
+    if isinstance(obj, list | tuple):
+        return [redact(value, inline_limit=inline_limit) for value in obj]
+    if isinstance(obj, str) and len(obj) > inline_limit and BASE64_PATTERN.fullmatch(obj):
+        return {"sha256": hashlib.sha256(obj.encode()).hexdigest(), "bytes": len(obj)}
+    if obj is None or isinstance(obj, str | int | float | bool):
+        return obj
+    return str(obj)
+
+
+def _snapshot(content: Any) -> Any:
+    """Copy the lists and dicts of a request, before it is queued.
+
+    The model context can change before the record is written, e.g. a Gemini
+    request holds the conversation's rendered messages, which are updated in
+    place. The messages themselves are not modified once added, so lists are
+    copied without copying the messages in them.
+
+    Parameters
+    ----------
+    content : Any
+        The content of the request.
+
+    Returns
+    -------
+    Any
+        The content, with its own lists and dicts.
+
+    """
+    if isinstance(content, list):
+        return list(content)
+    if isinstance(content, dict):
+        return {key: _snapshot(value) for key, value in content.items()}
+    return content
+
+
+class RequestLog(Logger):
+    """Background writer for the request log."""
+
+    def __init__(self) -> None:
+        """Initialise the log. The writer thread is started on first use."""
+        super().__init__(prepend_msg="[RequestLog]")
+        self.dropped = 0
+        self._queue: queue.Queue[RequestLogRecord | None] = queue.Queue(
+            maxsize=BotSettings.logging.request_log_queue_size
+        )
+        self._ids = itertools.count(1)
+        self._thread: threading.Thread | None = None
+        self._file: io.TextIOWrapper | None = None
+        self._file_date: datetime.date | None = None
+        self._unflushed = False
+
+    @staticmethod
+    def _is_sampled(channel_id: int | None) -> bool:
+        """Decide whether to log a request.
+
+        Parameters
+        ----------
+        channel_id : int | None
+            The channel the request was made for, if known.
+
+        Returns
+        -------
+        bool
+            True if the request should be logged.
+
+        """
+        settings = BotSettings.logging
+        if not settings.enable_request_log:
+            return False
+        rate = settings.request_log_channel_sample_rates.get(channel_id or 0, settings.request_log_sample_rate)
+        return rate >= 1 or random.random() < rate
+
+    def _put(self, record: RequestLogRecord) -> None:
+        """Queue a record for the writer, dropping it if the queue is full.
+
+        Parameters
+        ----------
+        record : RequestLogRecord
+            The record to write.
+
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="RequestLogWriter", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def log_request(self, model: str, channel_id: int | None, content: Any) -> int | None:
+        """Log a request, if it is sampled.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model.
+        channel_id : int | None
+            The channel the request was made for, if known.
+        content : Any
+            The content of the request.
+
+        Returns
+        -------
+        int | None
+            The ID to log the response with, or None if the request is not
+            logged.
+
+        """
+        if not self._is_sampled(channel_id):
+            return None
+        request_id = next(self._ids)
+        self._put(RequestLogRecord(time.time(), "request", request_id, model, channel_id, _snapshot(content)))
+        return request_id
+
+    def log_response(self, request_id: int | None, model: str, channel_id: int | None, response: Any) -> None:
+        """Log the response to a logged request.
+
+        Parameters
+        ----------
+        request_id : int | None
+            The ID returned when the request was logged. Nothing is logged if
+            this is None.
+        model : str
+            The name of the model.
+        channel_id : int | None
+            The channel the request was made for, if known.
+        response : Any
+            The response.
+
+        """
+        if request_id is None:
+            return
+        self._put(RequestLogRecord(time.time(), "response", request_id, model, channel_id, response))
+
+    # --------------------------------------------------------------------------
+
+    def _open(self, date: datetime.date) -> io.TextIOWrapper:
+        """Get the file for a day, removing files which have expired.
+
+        A new file is created for the first record of each day, and is kept
+        open until the next day. A file from another process, or a previous
+        run, is never appended to as its last member may be incomplete.
+
+        Parameters
+        ----------
+        date : datetime.date
+            The day, in UTC.
+
+        Returns
+        -------
+        io.TextIOWrapper
+            The open file.
+
+        """
+        if self._file is not None and self._file_date == date:
+            return self._file
+        self._close_file()
+
+        directory = Path(BotSettings.logging.request_log_directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        oldest = date - datetime.timedelta(days=BotSettings.logging.request_log_retention_days)
+        for path in directory.glob("requests-*.jsonl.gz"):
+            try:
+                file_date = datetime.date.fromisoformat(path.name.removeprefix("requests-")[:10])
+            except ValueError:
+                continue
+            if file_date < oldest:
+                path.unlink(missing_ok=True)
+
+        for segment in itertools.count():
+            path = directory / f"requests-{date.isoformat()}-{segment}.jsonl.gz"
+            try:
+                self._file = gzip.open(path, "xt", encoding="utf-8")  # noqa: SIM115
+            except FileExistsError:
+                continue
+            break
+        self._file_date = date
+        return self._file
+
+    def _close_file(self) -> None:
+        """Close the current file, so the next record starts a new file."""
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._file_date = None
+        self._unflushed = False
+
+    def _write(self, record: RequestLogRecord) -> None:
+        """Serialise and write a record.
+
+        Parameters
+        ----------
+        record : RequestLogRecord
+            The record to write.
+
+        """
+        timestamp = datetime.datetime.fromtimestamp(record.timestamp, tz=datetime.UTC)
+        line = json.dumps(
+            {
+                "time": timestamp.isoformat(timespec="milliseconds"),
+                "kind": record.kind,
+                "id": record.request_id,
+                "model": record.model,
+                "channel": record.channel_id,
+                "payload": redact(record.payload, inline_limit=BotSettings.logging.request_log_inline_limit),
+            },
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        self._open(timestamp.date()).write(line + "\n")
+        self._unflushed = True
+
+    def _flush(self) -> None:
+        """Write records to disk, with a sync flush of the compressor.
+
+        A sync flush ends the compressed data on a byte boundary without
+        resetting the compressor, so the records written so far can be
+        decompressed whilst later records are still compressed against them.
+        """
+        if self._unflushed and self._file is not None:
+            # Flushing the text wrapper flushes the GzipFile, with Z_SYNC_FLUSH
+            self._file.flush()
+            self._unflushed = False
+        if self.dropped:
+            self.log_warning("Dropped %d records as the request log queue was full", self.dropped)
+            self.dropped = 0
+
+    def _run(self) -> None:
+        """Write records until the log is closed."""
+        while True:
+            try:
+                record = self._queue.get(timeout=FLUSH_INTERVAL)
+            except queue.Empty:
+                self._flush()
+                continue
+            if record is None:
+                break
+            try:
+                self._write(record)
+            except Exception:  # noqa: BLE001
+                self.log_exception("Unable to write %s %d to the request log", record.kind, record.request_id)
+        self._flush()
+        self._close_file()
+
+    def close(self) -> None:
+        """Write the queued records and stop the writer thread."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    async def aclose(self) -> None:
+        """Write the queued records and stop the writer thread, without blocking the event loop."""
+        await asyncio.to_thread(self.close)
+
+
+REQUEST_LOG = RequestLog()
@@ -0,0 +1,574 @@
+"""Telemetry for LLM requests.
+
+Every request records its provider, model and channel, the tokens it used and
+how many were read from the prompt cache, its estimated cost, how long it
+waited for a scheduler slot, its time to first token (when streamed) and its
+total latency. The metrics are kept in memory in fixed-bucket histograms, per
+provider, model and channel, so recording a request is cheap.
+
+The usage totals are periodically added to hourly rows in a SQLite database,
+to keep a history of spend. The in-memory metrics can be viewed with an admin
+command, or scraped in the Prometheus text format from a local endpoint.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import dataclasses
+import datetime
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Literal
+
+from slashbot.llm.hedging import LATENCY_BUCKETS
+from slashbot.llm.models import TextGenerationResponse
+from slashbot.logger import Logger
+from slashbot.settings import BotSettings
+
+# Bucket upper bounds for the input tokens of a request, from 64 to 256k
+TOKEN_BUCKETS = tuple(2**i for i in range(6, 19))
+TOKENS_PER_MILLION = 1_000_000
+
+# The time (seconds) the current task waited for a scheduler slot
+QUEUE_WAIT: contextvars.ContextVar[float] = contextvars.ContextVar("queue_wait", default=0.0)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_usage (
+    hour TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    model TEXT NOT NULL,
+    channel_id INTEGER NOT NULL,
+    requests INTEGER NOT NULL,
+    failures INTEGER NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    cached_tokens INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    latency_seconds REAL NOT NULL,
+    PRIMARY KEY (hour, provider, model, channel_id)
+);
+"""
+
+_UPSERT = """
+INSERT INTO llm_usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (hour, provider, model, channel_id) DO UPDATE SET
+    requests = requests + excluded.requests,
+    failures = failures + excluded.failures,
+    input_tokens = input_tokens + excluded.input_tokens,
+    output_tokens = output_tokens + excluded.output_tokens,
+    cached_tokens = cached_tokens + excluded.cached_tokens,
+    cost = cost + excluded.cost,
+    latency_seconds = latency_seconds + excluded.latency_seconds
+"""
+
+type SeriesKey = tuple[str, str, int | None]
+
+
+@dataclasses.dataclass
+class RequestTrace:
+    """The timing of a request, from when it is sent until it completes.
+
+    Attributes
+    ----------
+    provider : str
+        The provider name, i.e. the `client_type` of the client.
+    model : str
+        The name of the model.
+    channel_id : int | None
+        The channel the request was made for, if known.
+    log_id : int | None
+        The ID the request was logged with, if it was logged.
+    queue_wait : float
+        The time (seconds) spent waiting for a scheduler slot.
+    started_at : float
+        The monotonic time the request was sent.
+    first_token_at : float | None
+        The monotonic time the first token was received, for streamed
+        responses.
+
+    """
+
+    provider: str
+    model: str
+    channel_id: int | None
+    log_id: int | None = None
+    queue_wait: float = dataclasses.field(default_factory=QUEUE_WAIT.get)
+    started_at: float = dataclasses.field(default_factory=time.monotonic)
+    first_token_at: float | None = None
+
+    def mark_first_token(self) -> None:
+        """Record that the first token has been received."""
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+
+
+class Histogram:
+    """A histogram with fixed buckets, for exporting and estimating quantiles."""
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        """Initialise an empty histogram.
+
+        Parameters
+        ----------
+        buckets : tuple[float, ...]
+            The upper bounds of the buckets, in increasing order. Larger values
+            are counted in an overflow bucket.
+
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Record a value.
+
+        Parameters
+        ----------
+        value : float
+            The value to record.
+
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram") -> None:
+        """Add the values recorded by another histogram with the same buckets.
+
+        Parameters
+        ----------
+        other : Histogram
+            The histogram to add.
+
+        """
+        self.counts = [a + b for a, b in zip(self.counts, other.counts, strict=True)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q: float) -> float | None:
+        """Estimate a quantile.
+
+        Parameters
+        ----------
+        q : float
+            The quantile, between 0 and 1.
+
+        Returns
+        -------
+        float | None
+            The upper bound of the bucket containing the quantile, or None if
+            nothing has been recorded.
+
+        """
+        if self.count == 0:
+            return None
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts, strict=False):
+            cumulative += count
+            if cumulative >= q * self.count:
+                return bound
+        return self.buckets[-1]
+
+
+@dataclasses.dataclass
+class UsageTotals:
+    """Running totals of the usage of a model.
+
+    Attributes
+    ----------
+    requests : int
+        The number of successful requests.
+    failures : int
+        The number of failed requests.
+    input_tokens : int
+        The number of input tokens, including cached tokens.
+    output_tokens : int
+        The number of output tokens.
+    cached_tokens : int
+        The number of input tokens read from the prompt cache.
+    cost : float
+        The estimated cost, in USD.
+    latency_seconds : float
+        The total latency of the successful requests.
+
+    """
+
+    requests: int = 0
+    failures: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    cost: float = 0.0
+    latency_seconds: float = 0.0
+
+    def add(self, other: "UsageTotals") -> None:
+        """Add another set of totals to these.
+
+        Parameters
+        ----------
+        other : UsageTotals
+            The totals to add.
+
+        """
+        for item in dataclasses.fields(self):
+            setattr(self, item.name, getattr(self, item.name) + getattr(other, item.name))
+
+
+class ModelMetrics:
+    """The metrics for requests to a model from a channel."""
+
+    def __init__(self) -> None:
+        """Initialise with no recorded requests."""
+        self.totals = UsageTotals()
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.time_to_first_token = Histogram(LATENCY_BUCKETS)
+        self.queue_wait = Histogram(LATENCY_BUCKETS)
+        self.input_tokens = Histogram(TOKEN_BUCKETS)
+
+    def merge(self, other: "ModelMetrics") -> None:
+        """Add the metrics recorded for another model or channel.
+
+        Parameters
+        ----------
+        other : ModelMetrics
+            The metrics to add.
+
+        """
+        self.totals.add(other.totals)
+        self.latency.merge(other.latency)
+        self.time_to_first_token.merge(other.time_to_first_token)
+        self.queue_wait.merge(other.queue_wait)
+        self.input_tokens.merge(other.input_tokens)
+
+    def describe(self) -> str:
+        """Describe the usage and latency.
+
+        Returns
+        -------
+        str
+            A one line summary.
+
+        """
+        totals = self.totals
+        cached = totals.cached_tokens / totals.input_tokens if totals.input_tokens else 0.0
+        p50, p95 = self.latency.quantile(0.5), self.latency.quantile(0.95)
+        ttft = self.time_to_first_token.quantile(0.95)
+        wait = self.queue_wait.sum / self.queue_wait.count if self.queue_wait.count else 0.0
+        return (
+            f"{totals.requests} requests ({totals.failures} failed), {totals.input_tokens} tokens in "
+            f"({cached:.0%} cached), {totals.output_tokens} out, ${totals.cost:.2f}, "
+            f"p50/p95 {p50 or 0:.1f}/{p95 or 0:.1f} s"
+            + (f", p95 first token {ttft:.1f} s" if ttft is not None else "")
+            + f", mean wait {wait:.2f} s"
+        )
+
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int, cached_tokens: int, cache_write: int) -> float:
+    """Estimate the cost of a request from the configured model prices.
+
+    Parameters
+    ----------
+    model : str
+        The name of the model.
+    input_tokens : int
+        The number of input tokens, including cached tokens.
+    output_tokens : int
+        The number of output tokens.
+    cached_tokens : int
+        The number of input tokens read from the prompt cache.
+    cache_write : int
+        The number of input tokens written to the prompt cache.
+
+    Returns
+    -------
+    float
+        The cost in USD, or 0 if the model has no configured price.
+
+    """
+    price = BotSettings.telemetry.model_prices.get(model)
+    if price is None:
+        return 0.0
+    uncached = max(input_tokens - cached_tokens - cache_write, 0)
+    return (
+        uncached * price.input
+        + cached_tokens * price.cached_input
+        + cache_write * price.cache_write
+        + output_tokens * price.output
+    ) / TOKENS_PER_MILLION
+
+
+def _escape_label(value: str) -> str:
+    """Escape a Prometheus label value."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class TelemetryRegistry(Logger):
+    """In-memory registry of the metrics for LLM requests."""
+
+    def __init__(self) -> None:
+        """Initialise with no recorded requests."""
+        super().__init__(prepend_msg="[Telemetry]")
+        self._metrics: dict[SeriesKey, ModelMetrics] = defaultdict(ModelMetrics)
+        self._unflushed: dict[tuple[str, str, str, int], UsageTotals] = defaultdict(UsageTotals)
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+        self._server: asyncio.Server | None = None
+
+    def start_request(self, provider: str, model: str, channel_id: int | None, log_id: int | None) -> RequestTrace:
+        """Start timing a request.
+
+        Parameters
+        ----------
+        provider : str
+            The provider name, i.e. the `client_type` of the client.
+        model : str
+            The name of the model.
+        channel_id : int | None
+            The channel the request was made for, if known.
+        log_id : int | None
+            The ID the request was logged with, if it was logged.
+
+        Returns
+        -------
+        RequestTrace
+            The trace to record the request with once it completes.
+
+        """
+        return RequestTrace(provider, model, channel_id, log_id)
+
+    def _record_totals(self, trace: RequestTrace, totals: UsageTotals) -> ModelMetrics:
+        """Add to the totals for a model and channel.
+
+        Parameters
+        ----------
+        trace : RequestTrace
+            The trace of the request.
+        totals : UsageTotals
+            The usage of the request.
+
+        Returns
+        -------
+        ModelMetrics
+            The metrics for the model and channel.
+
+        """
+        metrics = self._metrics[(trace.provider, trace.model, trace.channel_id)]
+        metrics.totals.add(totals)
+        hour = datetime.datetime.now(tz=datetime.UTC).strftime("%Y-%m-%dT%H:00")
+        with self._lock:
+            self._unflushed[(hour, trace.provider, trace.model, trace.channel_id or 0)].add(totals)
+        return metrics
+
+    def record(self, trace: RequestTrace, response: TextGenerationResponse) -> None:
+        """Record a successful request.
+
+        Parameters
+        ----------
+        trace : RequestTrace
+            The trace of the request.
+        response : TextGenerationResponse
+            The response, including the token usage reported by the provider.
+
+        """
+        latency = time.monotonic() - trace.started_at
+        cost = estimate_cost(
+            trace.model,
+            response.input_tokens,
+            response.output_tokens,
+            response.cached_tokens,
+            response.cache_creation_tokens,
+        )
+        metrics = self._record_totals(
+            trace,
+            UsageTotals(
+                requests=1,
+                input_tokens=response.input_tokens,
+                output_tokens=response.output_tokens,
+                cached_tokens=response.cached_tokens,
+                cost=cost,
+                latency_seconds=latency,
+            ),
+        )
+        metrics.latency.observe(latency)
+        metrics.queue_wait.observe(trace.queue_wait)
+        metrics.input_tokens.observe(response.input_tokens)
+        if trace.first_token_at is not None:
+            metrics.time_to_first_token.observe(trace.first_token_at - trace.started_at)
+
+    def record_failure(self, trace: RequestTrace) -> None:
+        """Record a failed request.
+
+        Parameters
+        ----------
+        trace : RequestTrace
+            The trace of the request.
+
+        """
+        self._record_totals(trace, UsageTotals(failures=1))
+
+    def describe(self, group_by: Literal["model", "channel"], *, limit: int = 15) -> str:
+        """Describe the usage and latency of each model or channel.
+
+        Parameters
+        ----------
+        group_by : Literal["model", "channel"]
+            Whether to summarise each model, or each channel.
+        limit : int
+            The maximum number of models or channels to include, which are
+            those with the most requests.
+
+        Returns
+        -------
+        str
+            A line for each model or channel.
+
+        """
+        groups: dict[str, ModelMetrics] = defaultdict(ModelMetrics)
+        for (provider, model, channel_id), metrics in list(self._metrics.items()):
+            channel = f"<#{channel_id}>" if channel_id else "no channel"
+            label = f"{provider}/{model}" if group_by == "model" else channel
+            groups[label].merge(metrics)
+        if not groups:
+            return "No LLM requests have been made since the last restart."
+        ranked = sorted(groups.items(), key=lambda item: item[1].totals.requests, reverse=True)
+        return "\n".join(f"**{label}**: {metrics.describe()}" for label, metrics in ranked[:limit])
+
+    # --------------------------------------------------------------------------
+
+    def to_prometheus(self) -> str:
+        """Export the metrics in the Prometheus text format.
+
+        Returns
+        -------
+        str
+            The metrics.
+
+        """
+        counters = {
+            "requests": ("Successful LLM requests.", lambda m: m.totals.requests),
+            "failures": ("Failed LLM requests.", lambda m: m.totals.failures),
+            "input_tokens": ("Input tokens, including cached tokens.", lambda m: m.totals.input_tokens),
+            "output_tokens": ("Output tokens.", lambda m: m.totals.output_tokens),
+            "cached_tokens": ("Input tokens read from the prompt cache.", lambda m: m.totals.cached_tokens),
+            "cost_usd": ("Estimated cost in USD.", lambda m: m.totals.cost),
+        }
+        histograms = {
+            "request_duration_seconds": ("Latency of LLM requests.", lambda m: m.latency),
+            "time_to_first_token_seconds": ("Time to first streamed token.", lambda m: m.time_to_first_token),
+            "queue_wait_seconds": ("Time spent waiting for a scheduler slot.", lambda m: m.queue_wait),
+            "request_input_tokens": ("Input tokens per LLM request.", lambda m: m.input_tokens),
+        }
+        series = [
+            (f'provider="{_escape_label(p)}",model="{_escape_label(m)}",channel="{c or ""}"', metrics)
+            for (p, m, c), metrics in list(self._metrics.items())
+        ]
+
+        lines = []
+        for name, (description, get_value) in counters.items():
+            lines += [f"# HELP slashbot_llm_{name}_total {description}", f"# TYPE slashbot_llm_{name}_total counter"]
+            lines += [f"slashbot_llm_{name}_total{{{labels}}} {get_value(metrics)}" for labels, metrics in series]
+        for name, (description, get_histogram) in histograms.items():
+            lines += [f"# HELP slashbot_llm_{name} {description}", f"# TYPE slashbot_llm_{name} histogram"]
+            for labels, metrics in series:
+                histogram = get_histogram(metrics)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts, strict=False):
+                    cumulative += count
+                    lines.append(f'slashbot_llm_{name}_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+                lines.append(f'slashbot_llm_{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"slashbot_llm_{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"slashbot_llm_{name}_count{{{labels}}} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    async def _handle_scrape(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Respond to a request to the metrics endpoint.
+
+        Parameters
+        ----------
+        reader : asyncio.StreamReader
+            The stream to read the HTTP request from.
+        writer : asyncio.StreamWriter
+            The stream to write the HTTP response to.
+
+        """
+        try:
+            async with asyncio.timeout(5):
+                request_line = await reader.readline()
+                while await reader.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+            method, path, *_ = [*request_line.decode(errors="replace").split(), "", ""]
+            if method == "GET" and path.split("?")[0] == "/metrics":
+                status, body = "200 OK", self.to_prometheus().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (TimeoutError, ConnectionError) as exc:
+            self.log_debug("Unable to respond to metrics request: %s", exc)
+        finally:
+            writer.close()
+
+    async def start_server(self) -> None:
+        """Start the metrics endpoint, if a port is configured."""
+        settings = BotSettings.telemetry
+        if self._server is not None or not settings.metrics_port:
+            return
+        self._server = await asyncio.start_server(self._handle_scrape, settings.metrics_host, settings.metrics_port)
+        self.log_info("Serving metrics on http://%s:%d/metrics", settings.metrics_host, settings.metrics_port)
+
+    # --------------------------------------------------------------------------
+
+    def _write(self, rows: list[tuple]) -> None:
+        """Add usage totals to the database.
+
+        Parameters
+        ----------
+        rows : list[tuple]
+            The rows to add to the existing totals.
+
+        """
+        if self._connection is None:
+            path = Path(BotSettings.files.telemetry_database)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            with self._connection:
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.executescript(_SCHEMA)
+        with self._connection:
+            self._connection.executemany(_UPSERT, rows)
+
+    async def flush(self) -> None:
+        """Add the usage recorded since the last flush to the database."""
+        with self._lock:
+            unflushed, self._unflushed = self._unflushed, defaultdict(UsageTotals)
+        if not unflushed:
+            return
+        rows = [(*key, *dataclasses.astuple(totals)) for key, totals in unflushed.items()]
+        try:
+            await asyncio.to_thread(self._write, rows)
+        except sqlite3.Error as exc:
+            self.log_error("Unable to write %d usage rows, will retry: %s", len(rows), exc)
+            with self._lock:
+                for key, totals in unflushed.items():
+                    self._unflushed[key].add(totals)
+            return
+        self.log_debug("Wrote %d usage rows", len(rows))
+
+    async def aclose(self) -> None:
+        """Stop the metrics endpoint, and write the remaining usage."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        await self.flush()
+
+
+TELEMETRY = TelemetryRegistry()
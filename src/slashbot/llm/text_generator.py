@@ -1,25 +1,53 @@
+import asyncio
+import contextlib
+import time
+from collections.abc import AsyncIterator, Callable
 from typing import cast
 
+from slashbot.llm.blobs import MemoryUsage
+from slashbot.llm.cache import PromptCacheStats
 from slashbot.llm.clients.claude import ClaudeClient
 from slashbot.llm.clients.gemini import GeminiClient
+from slashbot.llm.clients.local import LocalClient
 from slashbot.llm.clients.openai import OpenAIClient
-from slashbot.llm.models import TextGenerationInput, TextGenerationResponse
+from slashbot.llm.conversation import Conversation, ConversationMessage
+from slashbot.llm.hedging import LATENCY_TRACKER, hedge_request
+from slashbot.llm.models import GenerationFailureError, TextGenerationInput, TextGenerationResponse, TokenLedgerEntry
 from slashbot.logger import Logger
 from slashbot.settings import BotSettings
 
+# Creates the context a hedged request runs in, which yields whether the
+# request can be made, e.g. if a scheduler slot is free
+type HedgeSlotFactory = Callable[[], contextlib.AbstractAsyncContextManager[bool]]
+
 
 class TextGenerator(Logger):
     """Text generator class.
 
     This class is used to generate text using different LLM models. It is a
-    wrapper around multiple LLM clients, initialised using `set_model()`.
+    wrapper around multiple LLM clients, initialised using `set_model()`. The
+    conversation is owned by the generator, rather than the client, so it is
+    kept when the model is changed.
+
+    If a hedge model is configured, requests are also sent to it when the
+    model is slower than usual, or sent to it instead when the model fails.
+    Streamed requests are not hedged, but fail over to the hedge model if
+    the model fails before anything has been streamed.
     """
 
     SUPPORTED_OPENAI_MODELS = OpenAIClient.SUPPORTED_MODELS
     SUPPORTED_GOOGLE_MODELS = GeminiClient.SUPPORTED_MODELS
     SUPPORTED_CLAUDE_MODELS = ClaudeClient.SUPPORTED_MODELS
-    SUPPORTED_MODELS = SUPPORTED_OPENAI_MODELS + SUPPORTED_GOOGLE_MODELS + SUPPORTED_CLAUDE_MODELS
-    VISION_MODELS = (*OpenAIClient.VISION_MODELS, *GeminiClient.VISION_MODELS, *ClaudeClient.VISION_MODELS)
+    SUPPORTED_LOCAL_MODELS = LocalClient.SUPPORTED_MODELS
+    SUPPORTED_MODELS = (
+        SUPPORTED_OPENAI_MODELS + SUPPORTED_GOOGLE_MODELS + SUPPORTED_CLAUDE_MODELS + SUPPORTED_LOCAL_MODELS
+    )
+    VISION_MODELS = (
+        *OpenAIClient.VISION_MODELS,
+        *GeminiClient.VISION_MODELS,
+        *ClaudeClient.VISION_MODELS,
+        *LocalClient.VISION_MODELS,
+    )
     SEARCH_MODELS = (*OpenAIClient.SEARCH_MODELS, *GeminiClient.SEARCH_MODELS, *ClaudeClient.SEARCH_MODELS)
     AUDIO_MODELS = (*OpenAIClient.AUDIO_MODELS, *GeminiClient.AUDIO_MODELS, *ClaudeClient.AUDIO_MODELS)
     VIDEO_MODELS = (*OpenAIClient.VIDEO_MODELS, *GeminiClient.VIDEO_MODELS, *ClaudeClient.VIDEO_MODELS)
@@ -38,7 +66,10 @@ class TextGenerator(Logger):
         super().__init__(prepend_msg=extra_print)
         model: str = model_name or BotSettings.cogs.chatbot.default_model
         self._extra_print: str = extra_print
+        self._channel_id: int | None = None
+        self.conversation = Conversation()
         self._client = cast(OpenAIClient | GeminiClient | ClaudeClient, None)
+        self._hedge_client: OpenAIClient | GeminiClient | ClaudeClient | None = None
         self.set_model(model)
 
     # --------------------------------------------------------------------------
@@ -48,6 +79,19 @@ class TextGenerator(Logger):
         """Get the current LLM model name."""
         return self._client.model_name
 
+    @property
+    def channel_id(self) -> int | None:
+        """Get the channel the generator makes requests for."""
+        return self._channel_id
+
+    @channel_id.setter
+    def channel_id(self, channel_id: int | None) -> None:
+        """Set the channel the generator makes requests for."""
+        self._channel_id = channel_id
+        self._client.channel_id = channel_id
+        if self._hedge_client is not None:
+            self._hedge_client.channel_id = channel_id
+
     @property
     def system_prompt(self) -> str:
         """Get the system prompt of the client."""
@@ -58,6 +102,11 @@ class TextGenerator(Logger):
         """Get the name of the system prompt of the client."""
         return self._client.system_prompt_name
 
+    @property
+    def image_max_dimension(self) -> int:
+        """Get the largest image dimension which is useful to the model."""
+        return self._client.IMAGE_MAX_DIMENSION
+
     @property
     def size_messages(self) -> int:
         """Get the size of the context, in messages."""
@@ -68,11 +117,73 @@ class TextGenerator(Logger):
         """Get the size of the context, in tokens."""
         return self._client.token_size
 
+    @property
+    def token_ledger(self) -> list[TokenLedgerEntry]:
+        """Get the number of tokens for the system prompt and each message."""
+        return self._client.get_token_ledger()
+
+    @property
+    def memory_usage(self) -> MemoryUsage:
+        """Get the memory used by the context, and the media it references."""
+        return self._client.get_memory_usage()
+
+    @property
+    def prompt_cache_stats(self) -> PromptCacheStats:
+        """Get the prompt cache usage for the conversation."""
+        return self._client.prompt_cache.stats
+
     # --------------------------------------------------------------------------
 
+    def get_context(self) -> list[ConversationMessage]:
+        """Get the messages in the conversation context.
+
+        Returns
+        -------
+        list[ConversationMessage]
+            Each message, oldest first.
+
+        """
+        return self._client.get_context()
+
+    def get_last_turn(self) -> list[ConversationMessage]:
+        """Get the newest input in the conversation context, and its response.
+
+        Returns
+        -------
+        list[ConversationMessage]
+            The input and response, or fewer messages if the context is
+            shorter.
+
+        """
+        return [self.conversation[i] for i in range(max(len(self.conversation) - 2, 0), len(self.conversation))]
+
+    def remove_messages(self, messages: list[ConversationMessage]) -> None:
+        """Remove messages from the conversation context, e.g. an unseen reply.
+
+        Parameters
+        ----------
+        messages : list[ConversationMessage]
+            The messages to remove, if they are still in the context.
+
+        """
+        self._client.remove_messages(messages)
+
+    def restore_context(self, messages: list[ConversationMessage]) -> None:
+        """Restore previously recorded messages into the conversation context.
+
+        Parameters
+        ----------
+        messages : list[ConversationMessage]
+            Each message, oldest first.
+
+        """
+        self._client.restore_context(messages)
+
     def count_tokens_for_message(self, message: dict | list[dict[str, str]] | str) -> int:
         """Get the token count for a given message for the current LLM model.
 
+        The count is a local estimate, so this is safe to call on the hot path.
+
         Parameters
         ----------
         message : list[str] | str
@@ -112,7 +223,11 @@ class TextGenerator(Logger):
         return self._client.create_content_payload_object(messages)
 
     async def generate_response_with_context(
-        self, messages: TextGenerationInput | list[TextGenerationInput]
+        self,
+        messages: TextGenerationInput | list[TextGenerationInput],
+        *,
+        recalled: str = "",
+        hedge_slot: HedgeSlotFactory | None = None,
     ) -> TextGenerationResponse:
         """Generate text from the current LLM model.
 
@@ -121,9 +236,160 @@ class TextGenerator(Logger):
         messages : ContextMessage | list[ContextMessage]
             Input message(s), from the user, including attached images and
             videos.
+        recalled : str
+            Earlier messages relevant to the input, which are sent with the
+            input but are not kept in the context.
+        hedge_slot : HedgeSlotFactory | None
+            Creates the context a hedged request runs in, e.g. a scheduler
+            slot of its own. If the request cannot be made, the hedge model is
+            only used once the model has failed, as the model's request is no
+            longer using its slot. If None, hedged requests are always made.
+
+        """
+        if self._hedge_client is None:
+            return await self._client.generate_response_with_context(messages, recalled=recalled)
+
+        self._client.add_input_to_context(messages)
+        primary_failed = asyncio.Event()
+
+        async def primary() -> TextGenerationResponse:
+            try:
+                return await self._send_timed_request(self._client, recalled)
+            except Exception:
+                primary_failed.set()
+                raise
+
+        async def secondary() -> TextGenerationResponse:
+            if not primary_failed.is_set():
+                slot = hedge_slot() if hedge_slot is not None else contextlib.nullcontext(enter_result=True)
+                async with slot as can_hedge:
+                    if can_hedge:
+                        return await self._send_timed_request(self._hedge_client, recalled)
+                # There is no room to hedge, so only fail over in the primary's place
+                await primary_failed.wait()
+            return await self._send_timed_request(self._hedge_client, recalled)
+
+        response = await hedge_request(
+            primary,
+            secondary,
+            delay=LATENCY_TRACKER.get_hedge_delay(
+                self._client.model_name,
+                quantile=BotSettings.cogs.chatbot.hedge_latency_quantile,
+                min_samples=BotSettings.cogs.chatbot.hedge_min_samples,
+                default=BotSettings.cogs.chatbot.hedge_default_delay,
+            ),
+        )
+        self._client.add_response_to_context(response)
+
+        return response
+
+    async def _send_timed_request(
+        self, client: OpenAIClient | GeminiClient | ClaudeClient, recalled: str
+    ) -> TextGenerationResponse:
+        """Send a request for the context to a client, and record its latency.
+
+        The latency is also recorded if the request fails or is cancelled, e.g.
+        because it lost the race to the other client. Otherwise, only fast
+        responses would be recorded and the hedge delay would keep shrinking.
+
+        Parameters
+        ----------
+        client : OpenAIClient | GeminiClient | ClaudeClient
+            The client to send the request to, which shares the conversation.
+        recalled : str
+            Earlier messages relevant to the newest input, which are sent with
+            it but are not kept in the context.
+
+        Returns
+        -------
+        TextGenerationResponse
+            The response.
+
+        """
+        content, estimated_tokens = client.create_context_request(recalled=recalled)
+        start = time.monotonic()
+        try:
+            response = await client.generate_response(content, estimated_tokens=estimated_tokens)
+        finally:
+            LATENCY_TRACKER.record(client.model_name, time.monotonic() - start)
+        if client is not self._client:
+            self.log_info("Using response from hedge model %s", client.model_name)
+
+        return response
+
+    async def stream_response_with_context(
+        self, messages: TextGenerationInput | list[TextGenerationInput], *, recalled: str = ""
+    ) -> AsyncIterator[str]:
+        """Stream text from the current LLM model.
+
+        If the model fails before any text has been streamed, the response is
+        streamed from the hedge model instead, if there is one.
+
+        Parameters
+        ----------
+        messages : TextGenerationInput | list[TextGenerationInput]
+            Input message(s), from the user, including attached images and
+            videos.
+        recalled : str
+            Earlier messages relevant to the input, which are sent with the
+            input but are not kept in the context.
+
+        Yields
+        ------
+        str
+            The response text, as it is generated.
 
         """
-        return await self._client.generate_response_with_context(messages)
+        if self._hedge_client is None:
+            async for text in self._client.stream_response_with_context(messages, recalled=recalled):
+                yield text
+            return
+
+        self._client.add_input_to_context(messages)
+        response = TextGenerationResponse("", 0)
+        streamed = False
+        try:
+            async for text in self._stream_context_request(self._client, response, recalled):
+                streamed = True
+                yield text
+        except GenerationFailureError as exc:
+            if streamed:
+                raise
+            self.log_warning(
+                "Streaming from %s failed, failing over to %s: %s",
+                self._client.model_name,
+                self._hedge_client.model_name,
+                exc,
+            )
+            response = TextGenerationResponse("", 0)
+            async for text in self._stream_context_request(self._hedge_client, response, recalled):
+                yield text
+        self._client.add_response_to_context(response)
+
+    @staticmethod
+    def _stream_context_request(
+        client: OpenAIClient | GeminiClient | ClaudeClient, response: TextGenerationResponse, recalled: str
+    ) -> AsyncIterator[str]:
+        """Stream a response to the context from a client.
+
+        Parameters
+        ----------
+        client : OpenAIClient | GeminiClient | ClaudeClient
+            The client to send the request to, which shares the conversation.
+        response : TextGenerationResponse
+            The response to populate as the stream progresses.
+        recalled : str
+            Earlier messages relevant to the newest input, which are sent with
+            it but are not kept in the context.
+
+        Returns
+        -------
+        AsyncIterator[str]
+            An iterator over the response text, as it is generated.
+
+        """
+        content, estimated_tokens = client.create_context_request(recalled=recalled)
+        return client.stream_response(content, response, estimated_tokens=estimated_tokens)
 
     async def send_response_request(self, content: list[dict] | dict) -> TextGenerationResponse:
         """Send a request to the API client.
@@ -139,21 +405,70 @@ class TextGenerator(Logger):
     def set_model(self, model: str) -> None:
         """Set the current LLM model.
 
+        The system prompt and conversation are kept when switching model, even
+        if the new model is from a different provider.
+
         Parameters
         ----------
         model : str
             The name of the model to use.
 
+        """
+        previous_client = self._client
+        self._client = self._create_client(model)
+        if previous_client is not None:
+            self._client.set_system_prompt(
+                previous_client.system_prompt, prompt_name=previous_client.system_prompt_name
+            )
+        self._client.use_conversation(self.conversation)
+        self._set_hedge_client()
+
+    def _create_client(self, model: str) -> OpenAIClient | GeminiClient | ClaudeClient:
+        """Create a client for a model.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model.
+
+        Returns
+        -------
+        OpenAIClient | GeminiClient | ClaudeClient
+            The client for the model's provider. Local models use a
+            LocalClient, which is an OpenAIClient.
+
         """
         if model in self.SUPPORTED_OPENAI_MODELS:
-            self._client = OpenAIClient(model)
+            client = OpenAIClient(model)
         elif model in self.SUPPORTED_CLAUDE_MODELS:
-            self._client = ClaudeClient(model)
+            client = ClaudeClient(model)
         elif model in self.SUPPORTED_GOOGLE_MODELS:
-            self._client = GeminiClient(model)
+            client = GeminiClient(model)
+        elif model in self.SUPPORTED_LOCAL_MODELS:
+            client = LocalClient(model)
         else:
             msg = f"{model} is not available"
             raise NotImplementedError(msg)
+        client.channel_id = self._channel_id
+        return client
+
+    def _set_hedge_client(self) -> None:
+        """Create the client for the hedge model, if one is configured.
+
+        The hedge client shares the conversation, but the tokens in each
+        message are counted for the current model.
+        """
+        hedge_model = BotSettings.cogs.chatbot.hedge_model
+        self._hedge_client = None
+        if not hedge_model or hedge_model == self.model:
+            return
+        if hedge_model not in self.SUPPORTED_MODELS:
+            self.log_warning("Hedge model %s is not available, so requests will not be hedged", hedge_model)
+            return
+
+        self._hedge_client = self._create_client(hedge_model)
+        self._hedge_client.set_system_prompt(self._client.system_prompt, prompt_name=self._client.system_prompt_name)
+        self._hedge_client.conversation = self.conversation
 
     def set_system_prompt(self, prompt: str, *, prompt_name: str = "unset name") -> None:
         """Set the system prompt.
@@ -167,3 +482,5 @@ class TextGenerator(Logger):
 
         """
         self._client.set_system_prompt(prompt, prompt_name=prompt_name)
+        if self._hedge_client is not None:
+            self._hedge_client.set_system_prompt(prompt, prompt_name=prompt_name)
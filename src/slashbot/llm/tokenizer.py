@@ -0,0 +1,480 @@
+"""Local, offline token counting for LLM clients.
+
+Counting tokens through a provider's API is a blocking network round trip,
+which is far too slow for the hot path (every message seen by the bot is
+counted). Instead, token counts are estimated locally using a tiktoken encoding
+which is scaled by a per-provider calibration factor. The calibration factor is
+continually corrected using the token usage reported by each provider, and can
+optionally be reconciled against the provider's exact token counting endpoint
+in the background.
+
+System prompts are long, and are counted every time a client is created or
+its prompt is changed, so their counts are memoised in a process-wide cache.
+"""
+
+import asyncio
+import functools
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Awaitable, Callable, Iterable
+from dataclasses import dataclass
+from typing import Any
+
+import tiktoken
+
+from slashbot.logger import Logger
+
+ENCODING_NAME = "o200k_base"
+CHARS_PER_TOKEN = 4
+MIN_TOKENS_FOR_CALIBRATION = 32
+LOGGER = Logger()
+
+# Keys which contain (or lead to) text which is sent to the model. Anything
+# else, e.g. "role" or "generationConfig", is not counted
+_TEXT_KEYS = ("text", "content", "parts", "contents", "messages", "system", "system_instruction")
+
+
+@functools.cache
+def _get_encoding() -> tiktoken.Encoding | None:
+    """Load the tiktoken encoding, once per process.
+
+    Returns
+    -------
+    tiktoken.Encoding | None
+        The encoding, or None if it could not be loaded (e.g. the BPE file
+        could not be downloaded).
+
+    """
+    try:
+        return tiktoken.get_encoding(ENCODING_NAME)
+    except Exception:  # noqa: BLE001
+        LOGGER.log_warning("Unable to load tiktoken encoding %s, falling back to character counts", ENCODING_NAME)
+        return None
+
+
+def count_text_tokens(text: str) -> int:
+    """Count the number of tokens in a string, using the base encoding.
+
+    Parameters
+    ----------
+    text : str
+        The text to count.
+
+    Returns
+    -------
+    int
+        The number of tokens, uncalibrated.
+
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+class PromptTokenCache:
+    """Process-wide cache of the number of tokens in system prompts.
+
+    The uncalibrated count of each prompt is stored, keyed by the model and
+    the hash of the prompt, so the cache remains valid as the estimators are
+    calibrated. Prompts can be counted ahead of time with variants, e.g. with
+    the conversation instructions which are appended for chats. The cache is
+    thread safe, so it can be warmed from a background thread.
+    """
+
+    def __init__(self, max_size: int = 1024) -> None:
+        """Initialise an empty cache.
+
+        Parameters
+        ----------
+        max_size : int
+            The maximum number of counts to keep. The least recently used are
+            discarded first.
+
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._counts: OrderedDict[tuple[str, str], int] = OrderedDict()
+        self._suffixes: list[str] = [""]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model: str, prompt: str) -> tuple[str, str]:
+        """Create the key for a prompt.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model.
+        prompt : str
+            The system prompt.
+
+        Returns
+        -------
+        tuple[str, str]
+            The model and the SHA-256 hash of the prompt.
+
+        """
+        return model, hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def add_variant_suffix(self, suffix: str) -> None:
+        """Register text which is appended to prompts, to count when warming.
+
+        Parameters
+        ----------
+        suffix : str
+            The text appended to the prompts.
+
+        """
+        with self._lock:
+            if suffix not in self._suffixes:
+                self._suffixes.append(suffix)
+
+    def count(self, model: str, prompt: str) -> int:
+        """Get the uncalibrated number of tokens in a prompt, counting on a miss.
+
+        Parameters
+        ----------
+        model : str
+            The name of the model.
+        prompt : str
+            The system prompt.
+
+        Returns
+        -------
+        int
+            The number of tokens in the prompt, using the base encoding.
+
+        """
+        key = self._key(model, prompt)
+        with self._lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return self._counts[key]
+            self.misses += 1
+
+        tokens = count_text_tokens(prompt)
+        with self._lock:
+            self._counts[key] = tokens
+            while len(self._counts) > self.max_size:
+                self._counts.popitem(last=False)
+
+        return tokens
+
+    def prewarm(self, models: Iterable[str], prompts: Iterable[str]) -> None:
+        """Count prompts, and their variants, ahead of time.
+
+        Prompts which have changed are counted again, as the key is the hash
+        of the prompt.
+
+        Parameters
+        ----------
+        models : Iterable[str]
+            The names of the models to count for.
+        prompts : Iterable[str]
+            The system prompts.
+
+        """
+        with self._lock:
+            suffixes = list(self._suffixes)
+        prompts = list(prompts)
+        for model in models:
+            for prompt in prompts:
+                for suffix in suffixes:
+                    self.count(model, prompt + suffix)
+
+
+PROMPT_TOKEN_CACHE = PromptTokenCache()
+
+
+@dataclass
+class PayloadSummary:
+    """The countable parts of a request payload.
+
+    Attributes
+    ----------
+    text : list[str]
+        All text fragments found in the payload.
+    num_messages : int
+        The number of role-tagged messages.
+    num_images : int
+        The number of image parts.
+    num_videos : int
+        The number of video parts.
+
+    """
+
+    text: list[str]
+    num_messages: int = 0
+    num_images: int = 0
+    num_videos: int = 0
+
+
+def summarise_payload(messages: dict | list | str) -> PayloadSummary:  # noqa: C901
+    """Walk a provider payload and extract the parts which cost tokens.
+
+    This understands the payload formats for all the clients: Anthropic and
+    OpenAI `content` blocks and Gemini `contents/parts`. Base64 data is never
+    treated as text.
+
+    Parameters
+    ----------
+    messages : dict | list | str
+        The payload, a single message or a string.
+
+    Returns
+    -------
+    PayloadSummary
+        The text fragments and counts of messages, images and videos.
+
+    """
+    summary = PayloadSummary(text=[])
+
+    def _walk(obj: Any) -> None:
+        if isinstance(obj, str):
+            summary.text.append(obj)
+        elif isinstance(obj, list):
+            for item in obj:
+                _walk(item)
+        elif isinstance(obj, dict):
+            if obj.get("type") in ("image", "image_url") or "inline_data" in obj:
+                summary.num_images += 1
+                return
+            if "file_data" in obj:
+                summary.num_videos += 1
+                return
+            if "role" in obj:
+                summary.num_messages += 1
+            for key in _TEXT_KEYS:
+                if key in obj:
+                    _walk(obj[key])
+
+    _walk(messages)
+
+    return summary
+
+
+@dataclass
+class DriftStats:
+    """Drift between local estimates and provider reported token counts.
+
+    Attributes
+    ----------
+    samples : int
+        The number of observations used for calibration.
+    mean_relative_error : float
+        Exponential moving average of (estimate - reported) / reported.
+    last_relative_error : float
+        The relative error of the most recent observation.
+
+    """
+
+    samples: int = 0
+    mean_relative_error: float = 0.0
+    last_relative_error: float = 0.0
+
+
+class ProviderTokenizer:
+    """Calibrated token estimator for a single provider.
+
+    The base tiktoken count of the text is multiplied by `scale`, and a fixed
+    cost is added for each message, image and video. The scale is adjusted as
+    real usage is reported by the provider.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        provider: str,
+        *,
+        scale: float = 1.0,
+        image_tokens: int = 0,
+        video_tokens: int = 0,
+        message_overhead: int = 0,
+        smoothing: float = 0.1,
+    ) -> None:
+        """Initialise the estimator.
+
+        Parameters
+        ----------
+        provider : str
+            The provider name, e.g. "claude".
+        scale : float
+            Initial ratio of provider tokens to base encoding tokens.
+        image_tokens : int
+            The estimated number of tokens for an image.
+        video_tokens : int
+            The estimated number of tokens for a video.
+        message_overhead : int
+            The number of tokens added for each message by the chat template.
+        smoothing : float
+            The weight given to each new observation when re-calibrating.
+
+        """
+        self.provider = provider
+        self.scale = scale
+        self.image_tokens = image_tokens
+        self.video_tokens = video_tokens
+        self.message_overhead = message_overhead
+        self.drift = DriftStats()
+        self._smoothing = smoothing
+
+    def count(self, messages: dict | list | str) -> int:
+        """Estimate the number of tokens in a payload.
+
+        Parameters
+        ----------
+        messages : dict | list | str
+            The payload, a single message or a string.
+
+        Returns
+        -------
+        int
+            The estimated number of tokens.
+
+        """
+        summary = summarise_payload(messages)
+        text_tokens = sum(count_text_tokens(text) for text in summary.text)
+
+        return (
+            round(text_tokens * self.scale)
+            + summary.num_messages * self.message_overhead
+            + summary.num_images * self.image_tokens
+            + summary.num_videos * self.video_tokens
+        )
+
+    def record_usage(self, estimated: int, reported: int) -> None:
+        """Record a provider reported token count against a local estimate.
+
+        The calibration scale is nudged towards the observed ratio. Small
+        requests are ignored, as the fixed overheads dominate their error.
+
+        Parameters
+        ----------
+        estimated : int
+            The local estimate for the request.
+        reported : int
+            The number of input tokens reported by the provider.
+
+        """
+        if estimated < MIN_TOKENS_FOR_CALIBRATION or reported < MIN_TOKENS_FOR_CALIBRATION:
+            return
+
+        error = (estimated - reported) / reported
+        self.drift.samples += 1
+        self.drift.last_relative_error = error
+        self.drift.mean_relative_error += self._smoothing * (error - self.drift.mean_relative_error)
+
+        target_scale = self.scale * reported / estimated
+        self.scale += self._smoothing * (target_scale - self.scale)
+        self.scale = min(max(self.scale, 0.5), 2.0)
+
+
+class TokenReconciler:
+    """Reconcile local estimates against exact counts in the background.
+
+    Payloads are queued on the hot path and are periodically counted in
+    batches using the provider's (asynchronous) token counting endpoint. The
+    results are only used to calibrate the estimator.
+    """
+
+    def __init__(
+        self,
+        tokenizer: ProviderTokenizer,
+        exact_counter: Callable[[Any], Awaitable[int]],
+        *,
+        batch_size: int = 8,
+        interval: float = 5.0,
+        max_pending: int = 64,
+    ) -> None:
+        """Initialise the reconciler.
+
+        Parameters
+        ----------
+        tokenizer : ProviderTokenizer
+            The estimator to calibrate.
+        exact_counter : Callable[[Any], Awaitable[int]]
+            An async function which returns the exact token count for a
+            payload.
+        batch_size : int
+            The maximum number of payloads to count concurrently.
+        interval : float
+            The number of seconds to wait between batches.
+        max_pending : int
+            The maximum number of payloads waiting to be counted. The oldest
+            are discarded first.
+
+        """
+        self._tokenizer = tokenizer
+        self._exact_counter = exact_counter
+        self._batch_size = batch_size
+        self._interval = interval
+        self._pending: deque[tuple[Any, int]] = deque(maxlen=max_pending)
+        self._task: asyncio.Task | None = None
+
+    def submit(self, messages: dict | list | str, estimated: int) -> None:
+        """Queue a payload for exact counting.
+
+        Nothing is queued when there is no running event loop.
+
+        Parameters
+        ----------
+        messages : dict | list | str
+            The payload which was estimated.
+        estimated : int
+            The local estimate for the payload.
+
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._pending.append((messages, estimated))
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        """Count pending payloads, in batches, until the queue is empty."""
+        while self._pending:
+            await asyncio.sleep(self._interval)
+            batch = [self._pending.popleft() for _ in range(min(self._batch_size, len(self._pending)))]
+            results = await asyncio.gather(
+                *(self._exact_counter(messages) for messages, _ in batch), return_exceptions=True
+            )
+            for (_, estimated), result in zip(batch, results, strict=True):
+                if isinstance(result, BaseException):
+                    LOGGER.log_debug("Exact token count failed for %s: %s", self._tokenizer.provider, result)
+                    continue
+                self._tokenizer.record_usage(estimated, result)
+
+
+_PROVIDER_DEFAULTS = {
+    "claude": {"scale": 1.2, "image_tokens": 1600, "message_overhead": 4},
+    "gemini": {"scale": 1.0, "image_tokens": 258, "message_overhead": 2},
+    "openai": {"scale": 1.0, "image_tokens": 85, "message_overhead": 3},
+    "local": {"scale": 1.0, "image_tokens": 85, "message_overhead": 3},
+}
+_TOKENIZERS: dict[str, ProviderTokenizer] = {}
+
+
+def get_tokenizer(provider: str) -> ProviderTokenizer:
+    """Get the process-wide token estimator for a provider.
+
+    Parameters
+    ----------
+    provider : str
+        The provider name, i.e. the `client_type` of a client.
+
+    Returns
+    -------
+    ProviderTokenizer
+        The shared estimator, which is created on first use.
+
+    """
+    if provider not in _TOKENIZERS:
+        _TOKENIZERS[provider] = ProviderTokenizer(provider, **_PROVIDER_DEFAULTS.get(provider, {}))
+    return _TOKENIZERS[provider]
@@ -1,8 +1,13 @@
+import asyncio
+import re
+import time
+
 import disnake
 
 from slashbot.settings import BotSettings
 
 MAX_MESSAGE_LENGTH = BotSettings.discord.max_chars
+SENTENCE_END = re.compile(r"[.!?]\s|\n")
 
 
 async def is_reply_to_slash_command_response(message: disnake.Message) -> bool:
@@ -73,6 +78,54 @@ def split_text_into_chunks(text: str, chunk_length: int) -> list[str]:
     return chunks
 
 
+def _get_edit_prefix(obj: disnake.Message | disnake.ApplicationCommandInteraction, *, dont_tag_user: bool) -> str:
+    """Get the mention which `_reply` prepended to a message, if any.
+
+    The mention has to be kept when the message is edited.
+
+    Parameters
+    ----------
+    obj : disnake.Message or disnake.ApplicationCommandInteraction
+        The Discord object which was replied to.
+    dont_tag_user : bool
+        Whether the author mention was omitted.
+
+    Returns
+    -------
+    str
+        The mention, or an empty string if one was not prepended.
+
+    """
+    can_reply = isinstance(obj, disnake.Message) and isinstance(obj.channel, disnake.TextChannel)
+    return "" if can_reply or dont_tag_user else f"{obj.author.mention} "
+
+
+async def _reply(
+    obj: disnake.Message | disnake.ApplicationCommandInteraction, message: str, *, dont_tag_user: bool = False
+) -> disnake.Message:
+    """Reply to a message, or send a message mentioning the author.
+
+    Parameters
+    ----------
+    obj : disnake.Message or disnake.ApplicationCommandInteraction
+        The Discord object to reply to.
+    message : str
+        The text content to send.
+    dont_tag_user : bool, optional
+        When True, the author is not mentioned if a reply is not possible.
+
+    Returns
+    -------
+    disnake.Message
+        The sent message.
+
+    """
+    if isinstance(obj, disnake.Message) and isinstance(obj.channel, disnake.TextChannel):
+        return await obj.reply(f"{message}")
+    mention = obj.author.mention if not dont_tag_user else ""
+    return await obj.channel.send(f"{mention} {message}")
+
+
 async def send_message_to_channel(
     message: str,
     obj: disnake.Message | disnake.ApplicationCommandInteraction,
@@ -102,23 +155,198 @@ async def send_message_to_channel(
         All message objects sent to the channel, in order.
 
     """
-
-    async def _reply(obj: disnake.Message | disnake.ApplicationCommandInteraction, message: str) -> disnake.Message:
-        if isinstance(obj, disnake.Message) and isinstance(obj.channel, disnake.TextChannel):
-            sent = await obj.reply(f"{message}")
-        else:
-            mention = obj.author.mention if not dont_tag_user else ""
-            sent = await obj.channel.send(f"{mention} {message}")
-        return sent
-
     sent_messages = []
     if len(message) > MAX_MESSAGE_LENGTH:
         for i, chunk in enumerate(split_text_into_chunks(message, MAX_MESSAGE_LENGTH)):
             if i == 0:
-                sent = await _reply(obj, chunk)
+                sent = await _reply(obj, chunk, dont_tag_user=dont_tag_user)
             else:
                 sent = await obj.channel.send(f"{chunk}")
             sent_messages.append(sent)
     else:
-        sent_messages.append(await _reply(obj, message))
+        sent_messages.append(await _reply(obj, message, dont_tag_user=dont_tag_user))
     return sent_messages
+
+
+async def edit_message_in_channel(
+    sent_message: disnake.Message,
+    message: str,
+    obj: disnake.Message | disnake.ApplicationCommandInteraction,
+    *,
+    dont_tag_user: bool = False,
+) -> list[disnake.Message]:
+    """Replace the content of a message sent by `send_message_to_channel`.
+
+    If message exceeds MAX_MESSAGE_LENGTH, the first chunk is edited into the
+    sent message and the rest are sent as new messages.
+
+    Parameters
+    ----------
+    sent_message : disnake.Message
+        The message to edit.
+    message : str
+        The new text content.
+    obj : disnake.Message or disnake.ApplicationCommandInteraction
+        The Discord object which sent_message was sent in response to.
+    dont_tag_user : bool, optional
+        Whether the author mention was omitted from sent_message.
+
+    Returns
+    -------
+    list of disnake.Message
+        The edited message, and any new messages, in order.
+
+    """
+    chunks = split_text_into_chunks(message, MAX_MESSAGE_LENGTH) if len(message) > MAX_MESSAGE_LENGTH else [message]
+    await sent_message.edit(content=_get_edit_prefix(obj, dont_tag_user=dont_tag_user) + chunks[0])
+    return [sent_message, *[await obj.channel.send(f"{chunk}") for chunk in chunks[1:]]]
+
+
+class StreamedReply:
+    """Progressively send streamed text as a reply to a Discord message.
+
+    The first message is sent as soon as the first sentence is complete, and
+    is then edited as more text arrives. Edits are throttled to stay within
+    Discord's rate limits. When the text grows beyond MAX_MESSAGE_LENGTH, the
+    reply rolls over into a new message.
+
+    A placeholder can be sent if nothing has been sent in time, which is
+    replaced by the streamed text as soon as any arrives. If another message
+    has been sent in the channel since the placeholder, the conversation has
+    moved on and the streamed text is discarded instead.
+    """
+
+    def __init__(
+        self,
+        obj: disnake.Message | disnake.ApplicationCommandInteraction,
+        *,
+        dont_tag_user: bool = False,
+        edit_interval: float = 1.0,
+    ) -> None:
+        """Initialise the reply.
+
+        Parameters
+        ----------
+        obj : disnake.Message or disnake.ApplicationCommandInteraction
+            The Discord object to reply to.
+        dont_tag_user : bool, optional
+            When True, the author mention is omitted.
+        edit_interval : float, optional
+            The minimum number of seconds between edits.
+
+        """
+        self.sent_messages: list[disnake.Message] = []
+        self.showing_placeholder = False
+        self.discarded = False
+        self._obj = obj
+        self._dont_tag_user = dont_tag_user
+        self._edit_interval = edit_interval
+        self._first_message_prefix = _get_edit_prefix(obj, dont_tag_user=dont_tag_user)
+        self._write_lock = asyncio.Lock()
+        self._text = ""  # the text for the current (last) message
+        self._current_message: disnake.Message | None = None
+        self._current_message_text = ""
+        self._last_write = 0.0
+
+    async def _write(self, text: str) -> None:
+        """Send or edit the current message to contain text.
+
+        Parameters
+        ----------
+        text : str
+            The full text of the current message.
+
+        """
+        if self._current_message is None:
+            if not self.sent_messages:
+                self._current_message = await _reply(self._obj, text, dont_tag_user=self._dont_tag_user)
+            else:
+                self._current_message = await self._obj.channel.send(text)
+            self.sent_messages.append(self._current_message)
+        elif text != self._current_message_text:
+            prefix = self._first_message_prefix if self._current_message is self.sent_messages[0] else ""
+            await self._current_message.edit(content=prefix + text)
+        self._current_message_text = text
+        self._last_write = time.monotonic()
+        self.showing_placeholder = False
+
+    @property
+    def channel_id(self) -> int:
+        """The ID of the channel the reply is sent in."""
+        return self._obj.channel.id
+
+    def _placeholder_is_stale(self) -> bool:
+        """Check if the conversation has moved on since the placeholder was sent.
+
+        Returns
+        -------
+        bool
+            True if a placeholder is showing and a newer message has been
+            sent in the channel.
+
+        """
+        if not self.showing_placeholder or self._current_message is None:
+            return False
+        # IDs increase over time, so this is not fooled if the placeholder
+        # has not been received from the gateway yet
+        last_message_id = self._obj.channel.last_message_id
+        return last_message_id is not None and last_message_id > self._current_message.id
+
+    async def _flush(self) -> None:
+        """Write the pending text, rolling over into new messages if required."""
+        async with self._write_lock:
+            if self.discarded:
+                return
+            if self._placeholder_is_stale():
+                self.discarded = True
+                return
+            while len(self._text) > MAX_MESSAGE_LENGTH:
+                head = split_text_into_chunks(self._text, MAX_MESSAGE_LENGTH)[0]
+                await self._write(head)
+                self._text = self._text[len(head) :].lstrip()
+                self._current_message = None
+            if self._text.strip():
+                await self._write(self._text)
+
+    async def send_placeholder(self, text: str) -> None:
+        """Send a placeholder, if nothing has been sent yet.
+
+        Parameters
+        ----------
+        text : str
+            The placeholder text, which is replaced by the streamed text.
+
+        """
+        async with self._write_lock:
+            if self.sent_messages:
+                return
+            await self._write(text)
+            self.showing_placeholder = True
+
+    async def add_text(self, text: str) -> None:
+        """Add streamed text to the reply.
+
+        Parameters
+        ----------
+        text : str
+            The new text to add.
+
+        """
+        self._text += text
+        if not self.sent_messages and not SENTENCE_END.search(self._text):
+            return
+        if time.monotonic() - self._last_write < self._edit_interval:
+            return
+        await self._flush()
+
+    async def finish(self) -> list[disnake.Message]:
+        """Write any remaining text.
+
+        Returns
+        -------
+        list of disnake.Message
+            All message objects sent to the channel, in order.
+
+        """
+        await self._flush()
+        return self.sent_messages
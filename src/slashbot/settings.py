@@ -2,7 +2,7 @@ import os
 import sys
 import tomllib
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal
 
 from pydantic import BaseModel, Field
 
@@ -41,7 +41,8 @@ class ChatBotCogSettings(BaseCogSettings):
     enabled : bool
         Whether the chatbot cog is enabled.
     token_window_size : int
-        Number of tokens to keep in context window.
+        Number of tokens to keep in context window, when retrieval is
+        disabled.
     max_images_in_window : int
         Maximum number of images allowed in context window.
     max_output_tokens : int
@@ -66,6 +67,120 @@ class ChatBotCogSettings(BaseCogSettings):
         Prefer using image URLs in request to chat API.
     enable_web_search : bool
         Enable using web searching.
+    enable_exact_token_counts : bool
+        Reconcile local token estimates against the provider's token counting
+        API in the background.
+    enable_streaming : bool
+        Stream responses, progressively editing the reply as text arrives.
+    stream_edit_interval : float
+        Minimum time (seconds) between edits of a streamed reply.
+    prompted_reply_deadline : float
+        Time (seconds) to wait for a reply to a mention before a Markov
+        sentence is sent in its place. The sentence is edited into the real
+        reply when it arrives. Zero disables the deadline.
+    unprompted_reply_deadline : float
+        As prompted_reply_deadline, but for unprompted replies.
+    hedge_model : str
+        Model to also send a chat request to if the chat model is slower
+        than usual, or to send it to if the chat model fails. Empty disables
+        hedging.
+    hedge_latency_quantile : float
+        Quantile of the chat model's recent latency to wait for before
+        hedging a request.
+    hedge_min_samples : int
+        Number of latencies to record for a model before its quantile is used.
+    hedge_default_delay : float
+        Time (seconds) to wait before hedging a request until enough
+        latencies have been recorded.
+    enable_prompt_caching : bool
+        Cache the system prompt and stable conversation prefix with the
+        provider, to reduce prefill latency and cost.
+    prompt_cache_ttl : int
+        Lifetime (seconds) of explicitly created prompt caches.
+    prompt_cache_min_tokens : int
+        Minimum size (tokens) of a prefix for an explicit prompt cache to be
+        created.
+    max_concurrent_requests : int
+        Maximum number of LLM requests in flight across all channels.
+    max_queued_requests : int
+        Number of waiting LLM requests at which low priority requests are
+        dropped.
+    enable_message_coalescing : bool
+        Answer mentions which arrive whilst a request for the channel is in
+        flight or queued with a single, combined, request.
+    max_coalesced_messages : int
+        Maximum number of mentions combined into a single request.
+    max_image_bytes : int
+        Maximum size (bytes) of an image to download.
+    image_download_timeout : float
+        Maximum time (seconds) to spend downloading an image.
+    image_cache_memory_mb : int
+        Maximum size (MB) of processed images to keep in memory.
+    image_cache_disk_mb : int
+        Maximum size (MB) of processed images to spill to disk.
+    max_resident_chats : int
+        Maximum number of channels to keep conversations in memory for.
+    max_resident_chat_memory_mb : int
+        Maximum size (MB) of the conversations to keep in memory.
+    chat_idle_timeout : int
+        Time (seconds) without activity after which a channel's conversation
+        is moved out of memory onto disk.
+    chat_flush_interval : float
+        Interval (seconds) between writing changed conversations to disk.
+    enable_rolling_summaries : bool
+        Update channel summaries in the background when a channel goes quiet.
+    summary_quiet_time : float
+        Time (seconds) without messages after which a channel's summary is
+        updated in the background.
+    summary_min_new_messages : int
+        Minimum number of new messages for a background summary update.
+    summary_window_size : int
+        Maximum number of tokens of channel history to keep for summaries.
+    summary_chunk_tokens : int
+        Maximum number of tokens in each summarisation request. Longer
+        histories are split into chunks which are summarised concurrently.
+    summary_max_fan_in : int
+        Maximum number of chunk summaries to combine in each request.
+    enable_context_compaction : bool
+        Replace the oldest turns of a conversation with a digest, in the
+        background, instead of dropping them when the context is full.
+    context_compaction_threshold : float
+        Fraction of token_window_size at which a conversation is compacted.
+        This does not depend on the retrieval window, which is smaller by
+        default, so a conversation which is recalled from is not compacted.
+    context_compaction_target : float
+        Fraction of token_window_size to compact a conversation down to.
+    enable_retrieval : bool
+        Send earlier channel messages relevant to a prompt along with it,
+        which allows a smaller token window to be used.
+    retrieval_window_size : int
+        Number of tokens of recent conversation to keep in the context
+        window when retrieval is enabled, instead of token_window_size. Older
+        messages are recalled when they are relevant.
+    retrieval_top_k : int
+        Maximum number of earlier messages to send with a prompt.
+    retrieval_skip_recent : int
+        Number of the most recent channel messages which are not recalled,
+        as they are likely to still be in the conversation.
+    enable_message_archive : bool
+        Archive channel messages in the database, so they can be searched
+        and summarised over a time range.
+    archive_flush_interval : float
+        Interval (seconds) between writing new messages to the archive.
+    archive_batch_size : int
+        Number of messages written to the archive in each transaction.
+    archive_max_buffered : int
+        Maximum number of messages waiting to be archived. The oldest are
+        dropped if the database can't keep up.
+    archive_retention_days : int
+        Number of days to keep archived messages for.
+    archive_max_messages_per_channel : int
+        Maximum number of archived messages to keep for each channel.
+    archive_search_results : int
+        Number of messages to show when searching the archive.
+    archive_max_summary_hours : float
+        Maximum number of hours ago a summary of the archive can start, which
+        limits the number of requests made for one summary.
 
     """
 
@@ -82,6 +197,64 @@ class ChatBotCogSettings(BaseCogSettings):
     enable_profiling: bool
     prefer_image_urls: bool
     enable_web_search: bool
+    enable_exact_token_counts: bool = False
+    enable_streaming: bool = False
+    stream_edit_interval: float = 1.0
+    prompted_reply_deadline: float = 20.0
+    unprompted_reply_deadline: float = 0.0
+    hedge_model: str = ""
+    hedge_latency_quantile: float = 0.95
+    hedge_min_samples: int = 20
+    hedge_default_delay: float = 15.0
+    enable_prompt_caching: bool = True
+    prompt_cache_ttl: int = 300
+    prompt_cache_min_tokens: int = 1024
+    max_concurrent_requests: int = 4
+    max_queued_requests: int = 16
+    enable_message_coalescing: bool = True
+    max_coalesced_messages: int = 5
+    max_image_bytes: int = 20_000_000
+    image_download_timeout: float = 10.0
+    image_cache_memory_mb: int = 64
+    image_cache_disk_mb: int = 512
+    max_resident_chats: int = 256
+    max_resident_chat_memory_mb: int = 256
+    chat_idle_timeout: int = 3600
+    chat_flush_interval: float = 10.0
+    enable_rolling_summaries: bool = True
+    summary_quiet_time: float = 60.0
+    summary_min_new_messages: int = 5
+    summary_window_size: int = 65536
+    summary_chunk_tokens: int = 4096
+    summary_max_fan_in: int = 8
+    enable_context_compaction: bool = True
+    context_compaction_threshold: float = 0.75
+    context_compaction_target: float = 0.5
+    enable_retrieval: bool = True
+    retrieval_window_size: int = 1536
+    retrieval_top_k: int = 5
+    retrieval_skip_recent: int = 20
+    enable_message_archive: bool = True
+    archive_flush_interval: float = 5.0
+    archive_batch_size: int = 500
+    archive_max_buffered: int = 50_000
+    archive_retention_days: int = 90
+    archive_max_messages_per_channel: int = 100_000
+    archive_search_results: int = 10
+    archive_max_summary_hours: float = 168.0
+
+    @property
+    def context_window_size(self) -> int:
+        """Get the number of tokens to keep in a conversation's context window.
+
+        Returns
+        -------
+        int
+            The retrieval window size if retrieval is enabled, otherwise the
+            token window size.
+
+        """
+        return self.retrieval_window_size if self.enable_retrieval else self.token_window_size
 
 
 class MarkovCogSettings(BaseCogSettings):
@@ -369,6 +542,14 @@ class Files(BaseModel):
         Path to the god words file.
     scheduled_posts : Path
         Path to the scheduled posts file.
+    image_cache : Path
+        Path to the directory for cached images.
+    blob_store : Path
+        Path to the directory for media referenced by chat contexts.
+    chat_database : Path
+        Path to the SQLite database where conversations are persisted.
+    telemetry_database : Path
+        Path to the SQLite database where LLM usage is recorded.
 
     """
 
@@ -376,6 +557,10 @@ class Files(BaseModel):
     bad_words: Path
     god_words: Path
     scheduled_posts: Path
+    image_cache: Path = Path("data/cache/images")
+    blob_store: Path = Path("data/cache/blobs")
+    chat_database: Path = Path("data/chats.sqlite.db")
+    telemetry_database: Path = Path("data/telemetry.sqlite.db")
 
 
 class LoggingSettings(BaseModel):
@@ -389,12 +574,35 @@ class LoggingSettings(BaseModel):
         Path to the debug log file.
     logger_name : str
         Name of the logger.
+    enable_request_log : bool
+        Log the requests sent to, and responses received from, LLM providers.
+    request_log_directory : str
+        Directory for the request log, which has one file per day.
+    request_log_retention_days : int
+        Number of days of request logs to keep.
+    request_log_sample_rate : float
+        Fraction of requests to log.
+    request_log_channel_sample_rates : dict[int, float]
+        Fraction of requests to log for specific channels, overriding
+        `request_log_sample_rate`.
+    request_log_queue_size : int
+        Maximum number of records waiting to be written. Further records are
+        dropped.
+    request_log_inline_limit : int
+        Base64 strings longer than this are replaced by their hash and size.
 
     """
 
     log_location: str = "logs/slashbot.log"
     debug_log_location: str = "logs/slashbot_debug.log"
     logger_name: str = "slashbot"
+    enable_request_log: bool = True
+    request_log_directory: str = "logs/requests"
+    request_log_retention_days: int = 28
+    request_log_sample_rate: float = 1.0
+    request_log_channel_sample_rates: dict[int, float] = Field(default_factory=dict)
+    request_log_queue_size: int = 1000
+    request_log_inline_limit: int = 256
 
 
 class MarkovSettings(BaseModel):
@@ -422,6 +630,160 @@ class MarkovSettings(BaseModel):
     current_chain_location: Path = Path("data/markov/chain.pickle")
 
 
+class TransportSettings(BaseModel):
+    """Settings for the shared HTTP clients.
+
+    Attributes
+    ----------
+    max_connections : int
+        Maximum number of concurrent connections per service.
+    max_keepalive_connections : int
+        Maximum number of idle connections kept alive per service.
+    keepalive_expiry : float
+        Time (seconds) an idle connection is kept alive for.
+    timeout : float
+        Default timeout (seconds) for requests.
+    http2 : bool
+        Use HTTP/2 where available.
+
+    """
+
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    timeout: float = 30.0
+    http2: bool = True
+
+
+class LocalModelSettings(BaseModel):
+    """Settings for models served by a local OpenAI-compatible server.
+
+    Attributes
+    ----------
+    enabled : bool
+        Make the local models available.
+    backend : Literal["ollama", "llama.cpp"]
+        The server. Ollama's OpenAI-compatible API ignores keep_alive and does
+        not report timings, so models are loaded and kept loaded through its
+        native API instead, and only their load times are recorded.
+    base_url : str
+        URL of the server's OpenAI-compatible API.
+    models : list[str]
+        Names of the models served by the server.
+    vision_models : list[str]
+        Names of the models which accept images.
+    keep_alive : int | str
+        How long Ollama keeps a model loaded after a warm-up request, e.g.
+        "30m". -1 keeps the models loaded indefinitely.
+    keep_alive_interval : float
+        Interval (seconds) between warm-up requests, which load the models at
+        startup and keep them loaded. Ollama resets keep_alive to its default
+        (OLLAMA_KEEP_ALIVE, 5 minutes) after each chat request, so this must be
+        shorter than that.
+    num_parallel : int
+        Number of requests the server processes in parallel. Any more are
+        queued by the bot.
+
+    """
+
+    enabled: bool = False
+    backend: Literal["ollama", "llama.cpp"] = "ollama"
+    base_url: str = "http://localhost:11434/v1"
+    models: list[str] = Field(default_factory=list)
+    vision_models: list[str] = Field(default_factory=list)
+    keep_alive: int | str = -1
+    keep_alive_interval: float = 240.0
+    num_parallel: int = 1
+
+
+class ModelPrice(BaseModel):
+    """The price of a model, in USD per million tokens.
+
+    Attributes
+    ----------
+    input : float
+        Price of uncached input tokens.
+    output : float
+        Price of output tokens.
+    cached_input : float
+        Price of input tokens read from the prompt cache.
+    cache_write : float
+        Price of input tokens written to the prompt cache.
+
+    """
+
+    input: float = 0.0
+    output: float = 0.0
+    cached_input: float = 0.0
+    cache_write: float = 0.0
+
+
+class TelemetrySettings(BaseModel):
+    """Settings for recording the usage and latency of LLM requests.
+
+    Attributes
+    ----------
+    flush_interval : float
+        Interval (seconds) between writing usage to the telemetry database.
+    metrics_host : str
+        Address the Prometheus metrics endpoint listens on.
+    metrics_port : int
+        Port for the Prometheus metrics endpoint. 0 disables the endpoint.
+    model_prices : dict[str, ModelPrice]
+        Prices used to estimate the cost of requests, keyed by model name.
+
+    """
+
+    flush_interval: float = 60.0
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0
+    model_prices: dict[str, ModelPrice] = Field(default_factory=dict)
+
+
+class ResilienceSettings(BaseModel):
+    """Settings for retrying LLM requests and detecting unhealthy providers.
+
+    Attributes
+    ----------
+    max_retries : int
+        Maximum number of times a failed request is retried.
+    retry_base_delay : float
+        Delay (seconds) before the first retry, which doubles for each retry
+        and is jittered.
+    retry_max_delay : float
+        Maximum delay (seconds) before a retry. A request is not retried if
+        the provider asks to wait for longer.
+    min_timeout : float
+        Shortest timeout (seconds) for a request.
+    max_timeout : float
+        Longest timeout (seconds) for a request, which is also used until
+        enough latencies have been recorded.
+    timeout_latency_quantile : float
+        Quantile of the provider's recent latency the timeout is based on.
+    timeout_multiplier : float
+        Multiple of the latency quantile to use as the timeout.
+    timeout_min_samples : int
+        Number of latencies to record before the timeout is adapted.
+    breaker_failure_threshold : int
+        Number of consecutive failures before requests to a provider fail
+        fast.
+    breaker_reset_timeout : float
+        Time (seconds) to fail fast for, before a trial request is sent.
+
+    """
+
+    max_retries: int = 2
+    retry_base_delay: float = 0.5
+    retry_max_delay: float = 10.0
+    min_timeout: float = 15.0
+    max_timeout: float = 240.0
+    timeout_latency_quantile: float = 0.99
+    timeout_multiplier: float = 3.0
+    timeout_min_samples: int = 20
+    breaker_failure_threshold: int = 5
+    breaker_reset_timeout: float = 30.0
+
+
 class KeyStore(BaseModel):
     """Storage for API keys and the like.
 
@@ -473,6 +835,14 @@ class Settings(BaseModel):
         Settings which configure the logging.
     markov : MarkovSettings
         Settings for Markov chain generation.
+    transport : TransportSettings
+        Settings for the shared HTTP clients.
+    resilience : ResilienceSettings
+        Settings for retrying LLM requests and detecting unhealthy providers.
+    local_models : LocalModelSettings
+        Settings for models served by a local OpenAI-compatible server.
+    telemetry : TelemetrySettings
+        Settings for recording the usage and latency of LLM requests.
     key : KeyStore
         API keys.
 
@@ -485,6 +855,10 @@ class Settings(BaseModel):
     files: Files
     logging: LoggingSettings
     markov: MarkovSettings
+    transport: TransportSettings = Field(default_factory=TransportSettings)
+    resilience: ResilienceSettings = Field(default_factory=ResilienceSettings)
+    local_models: LocalModelSettings = Field(default_factory=LocalModelSettings)
+    telemetry: TelemetrySettings = Field(default_factory=TelemetrySettings)
     keys: KeyStore = Field(default_factory=KeyStore)
 
     @classmethod
@@ -0,0 +1,108 @@
+"""Shared, pooled HTTP clients for the bot.
+
+Creating a new HTTP client for every request means paying for a new TCP
+connection and TLS handshake each time. Instead, one pooled, keep-alive client
+is created for each provider or service and is shared by everything which talks
+to it. The clients are created lazily and are closed when the bot shuts down.
+"""
+
+import importlib.util
+from collections.abc import Callable
+from typing import Any
+
+import httpx
+
+from slashbot.logger import Logger
+from slashbot.settings import BotSettings
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class TransportRegistry(Logger):
+    """Process-wide registry of pooled HTTP and SDK clients."""
+
+    def __init__(self) -> None:
+        """Initialise an empty registry."""
+        super().__init__(prepend_msg="[TransportRegistry]")
+        self._http_clients: dict[str, httpx.AsyncClient] = {}
+        self._sdk_clients: dict[str, Any] = {}
+
+    def _create_http_client(self) -> httpx.AsyncClient:
+        """Create a new pooled HTTP client using the transport settings.
+
+        HTTP/2 is only enabled when the optional `h2` package is installed.
+
+        Returns
+        -------
+        httpx.AsyncClient
+            The new client.
+
+        """
+        settings = BotSettings.transport
+        limits = httpx.Limits(
+            max_connections=settings.max_connections,
+            max_keepalive_connections=settings.max_keepalive_connections,
+            keepalive_expiry=settings.keepalive_expiry,
+        )
+        return httpx.AsyncClient(
+            limits=limits,
+            timeout=settings.timeout,
+            http2=settings.http2 and HTTP2_AVAILABLE,
+            follow_redirects=True,
+        )
+
+    def get_http_client(self, service: str) -> httpx.AsyncClient:
+        """Get the shared HTTP client for a service.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service, e.g. "gemini" or "weather".
+
+        Returns
+        -------
+        httpx.AsyncClient
+            The shared client, created on first use or if it has been closed.
+
+        """
+        client = self._http_clients.get(service)
+        if client is None or client.is_closed:
+            self.log_debug("Creating pooled HTTP client for %s", service)
+            client = self._create_http_client()
+            self._http_clients[service] = client
+            self._sdk_clients.pop(service, None)
+        return client
+
+    def get_sdk_client[T](self, service: str, factory: Callable[[httpx.AsyncClient], T]) -> T:
+        """Get a shared SDK client which uses the pooled HTTP client for a service.
+
+        Parameters
+        ----------
+        service : str
+            The name of the service, e.g. "anthropic".
+        factory : Callable[[httpx.AsyncClient], T]
+            A function which creates the SDK client given the HTTP client to
+            use. Only called when there is no existing SDK client.
+
+        Returns
+        -------
+        T
+            The shared SDK client.
+
+        """
+        http_client = self.get_http_client(service)
+        if service not in self._sdk_clients:
+            self._sdk_clients[service] = factory(http_client)
+        return self._sdk_clients[service]
+
+    async def aclose(self) -> None:
+        """Close all of the HTTP clients."""
+        for service, client in self._http_clients.items():
+            if not client.is_closed:
+                self.log_debug("Closing pooled HTTP client for %s", service)
+                await client.aclose()
+        self._http_clients.clear()
+        self._sdk_clients.clear()
+
+
+TRANSPORTS = TransportRegistry()
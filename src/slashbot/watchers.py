@@ -6,6 +6,7 @@ from watchdog.events import FileSystemEvent, FileSystemEventHandler
 from watchdog.observers import Observer
 
 from slashbot.llm.prompts import create_prompt_dict, read_in_prompt
+from slashbot.llm.tokenizer import PROMPT_TOKEN_CACHE
 from slashbot.logger import Logger
 from slashbot.settings import BotSettings
 
@@ -21,7 +22,8 @@ class PromptFileWatcher(FileSystemEventHandler):
 
         This method is called when any file system event occurs.
         It updates the `PROMPT_CHOICES` dictionary based on the event type and
-        source path.
+        source path. The token count of new and changed prompts is refreshed
+        in the prompt token cache.
         """
         global AVAILABLE_LLM_PROMPTS  # noqa: PLW0603
         if event.is_directory and not event.src_path.endswith(".yaml"):
@@ -30,6 +32,7 @@ class PromptFileWatcher(FileSystemEventHandler):
             if event.event_type in ["created", "modified"]:
                 prompt = read_in_prompt(event.src_path)
                 AVAILABLE_LLM_PROMPTS[prompt.name] = prompt.prompt
+                PROMPT_TOKEN_CACHE.prewarm([BotSettings.cogs.chatbot.default_model], [prompt.prompt])
                 LOGGER.log_debug("%s prompt %s", event.event_type.capitalize(), event.src_path)
             if event.event_type == "deleted":
                 AVAILABLE_LLM_PROMPTS = create_prompt_dict()
@@ -1,9 +1,18 @@
 from collections.abc import AsyncGenerator
 from pathlib import Path
 
+import pytest
 import pytest_asyncio
 
 from slashbot.database import DatabaseSQL, DeclarativeBase
+from slashbot.settings import BotSettings
+
+
+@pytest.fixture(autouse=True)
+def isolate_request_log(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Fixture which stops tests writing the request log into the repository."""
+    monkeypatch.setattr(BotSettings.logging, "enable_request_log", False)
+    monkeypatch.setattr(BotSettings.logging, "request_log_directory", str(tmp_path / "requests"))
 
 
 @pytest_asyncio.fixture
@@ -0,0 +1,32 @@
+import gc
+from pathlib import Path
+
+from slashbot.llm.blobs import BlobRef, BlobStore
+
+
+def test_media_is_interned_materialised_and_released(tmp_path: Path) -> None:
+    """Test that media is stored once, read back on demand and then deleted."""
+    store = BlobStore(tmp_path)
+    image = "A" * 2048
+    message = {
+        "role": "user",
+        "content": [{"type": "text", "text": "look"}, {"type": "image", "source": {"data": image}}],
+    }
+
+    interned = store.intern(message)
+    duplicate = store.intern(message)
+    ref = interned["content"][1]["source"]["data"]
+    assert isinstance(ref, BlobRef)
+    assert duplicate["content"][1]["source"]["data"] is ref
+    assert message["content"][1]["source"]["data"] == image
+    assert len(list(tmp_path.iterdir())) == 1
+
+    assert store.materialise(interned) == message
+    assert store.materialise(interned)["content"][0] is interned["content"][0]
+    usage = BlobStore.measure(interned)
+    assert usage.blob_bytes == len(image)
+    assert usage.num_blobs == 1
+
+    del interned, duplicate, ref
+    gc.collect()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,145 @@
+import json
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from slashbot.cogs.chatbot.chat_registry import AIChatSummary, ChatRegistry, SummaryMessage
+from slashbot.cogs.chatbot.chat_store import ChatStore
+from slashbot.llm import TextGenerationResponse
+from slashbot.llm.conversation import ConversationMessage
+
+
+def fake_message(channel_id: int) -> SimpleNamespace:
+    """Create a fake Discord message in a channel."""
+    return SimpleNamespace(channel=SimpleNamespace(id=channel_id))
+
+
+def add_reply(registry: ChatRegistry, channel_id: int, text: str) -> None:
+    """Add a reply from the model to a channel's conversation."""
+    client = registry.get_chat_object(channel_id)._client  # noqa: SLF001
+    client._append_to_model_context(ConversationMessage("assistant", (text,)))  # noqa: SLF001
+
+
+def test_least_recently_active_channels_are_hibernated_and_restored(tmp_path: Path) -> None:
+    """Test that channels over budget are moved to the store, and restored on use."""
+    registry = ChatRegistry(ChatStore(tmp_path / "chats.db"), max_resident_channels=2, max_memory_bytes=1_000_000)
+    first, second, third = (fake_message(channel_id) for channel_id in (1, 2, 3))
+
+    chat = registry.get_chat_object(first)
+    chat.set_chat_prompt("Be helpful.", prompt_name="helpful")
+    add_reply(registry, 1, "hello")
+    registry.get_summary_object(first).add_message_to_history(SummaryMessage("alice", "hi there", tokens=3))
+    registry.get_chat_object(second)
+    registry.get_chat_object(third)
+
+    assert 1 not in registry.chats
+    assert registry.metrics.resident == 1 + 1
+    assert registry.metrics.hibernated == 1
+
+    registry.is_busy = lambda channel_id: channel_id == 1 + 1
+    restored = registry.get_chat_object(1)
+    assert restored is not chat
+    assert restored.system_prompt == chat.system_prompt
+    assert restored.get_context() == chat.get_context()
+    assert restored.size_tokens == chat.size_tokens
+    assert [message.content for message in registry.get_summary_object(1).get_history()] == ["hi there"]
+    assert registry.metrics.rehydrations == 1
+    assert registry.metrics.max_rehydration_time > 0
+
+    # The busy channel is skipped, so the next least recently active goes
+    assert 1 + 1 in registry.chats
+    assert 1 + 1 + 1 not in registry.chats
+
+
+@pytest.mark.asyncio
+async def test_channels_survive_a_restart(tmp_path: Path) -> None:
+    """Test that flushed changes are restored, lazily, by a new registry."""
+    registry = ChatRegistry(ChatStore(tmp_path / "chats.db"), max_resident_channels=10, max_memory_bytes=1_000_000)
+    registry.get_chat_object(fake_message(1)).set_chat_prompt("Be terse.", prompt_name="terse")
+    for text in ("one", "two", "three"):
+        add_reply(registry, 1, text)
+    await registry.flush()
+
+    # Only the changes are written by the next flush
+    client = registry.get_chat_object(1)._client  # noqa: SLF001
+    client._remove_message_from_model_context(0)  # noqa: SLF001
+    add_reply(registry, 1, "four")
+    changes = registry.store._changes(1, "1", registry.chats[1], None)  # noqa: SLF001
+    assert changes.metadata is None
+    assert [seq for _, seq in changes.deleted] == [0]
+    assert [seq for _, seq, _, _ in changes.inserted] == [1 + 1 + 1]
+    registry.store.invalidate([1])
+    await registry.flush()
+    registry.store.close()
+
+    restarted = ChatRegistry(ChatStore(tmp_path / "chats.db"), max_resident_channels=10, max_memory_bytes=1_000_000)
+    assert restarted.metrics.resident == 0
+    assert restarted.metrics.hibernated == 1
+
+    chat = restarted.get_chat_object(1)
+    assert chat.system_prompt_name == "terse"
+    assert [message.text for message in chat.get_context()] == ["two", "three", "four"]
+    assert restarted.get_chat_object(1) is chat
+
+
+def test_idle_channels_are_hibernated(tmp_path: Path) -> None:
+    """Test that channels which have been idle are hibernated."""
+    registry = ChatRegistry(ChatStore(tmp_path / "chats.db"), max_resident_channels=10, max_memory_bytes=1_000_000)
+    registry.get_chat_object(fake_message(1))
+
+    assert registry.hibernate_idle_channels(60) == 0
+    assert registry.hibernate_idle_channels(0) == 1
+    assert registry.metrics.resident == 0
+    assert registry.get_chat_object(1).size_messages == 0
+
+
+@pytest.mark.asyncio
+async def test_rolling_summary_only_summarises_new_messages(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a summary update sends the previous summary and the new messages only."""
+    summary = AIChatSummary(token_window_size=1000)
+    requests = []
+
+    async def send_response_request(content: list[dict] | dict) -> TextGenerationResponse:
+        requests.append(json.dumps(content))
+        return TextGenerationResponse(f"summary {len(requests)}", 0)
+
+    monkeypatch.setattr(summary, "send_response_request", send_response_request)
+    for text in ("one", "two"):
+        summary.add_message_to_history(SummaryMessage("alice", text))
+    assert await summary.generate_summary() == "summary 1"
+
+    summary.add_message_to_history(SummaryMessage("bob", "three"))
+    assert summary.is_summary_stale
+    assert await summary.generate_summary() == "summary 2"
+    assert "summary 1" in requests[-1]
+    assert "bob: three" in requests[-1]
+    assert "alice: one" not in requests[-1]
+
+    # Nothing new, so the cached summary is used
+    assert await summary.generate_summary() == "summary 2"
+    assert len(requests) == 1 + 1
+
+
+@pytest.mark.asyncio
+async def test_rolling_summary_survives_a_restart(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the summary, and which messages it covers, are restored from the store."""
+    registry = ChatRegistry(ChatStore(tmp_path / "chats.db"), max_resident_channels=10, max_memory_bytes=1_000_000)
+    summary = registry.get_summary_object(fake_message(1))
+
+    async def send_response_request(_content: list[dict] | dict) -> TextGenerationResponse:
+        return TextGenerationResponse("the summary", 0)
+
+    monkeypatch.setattr(summary, "send_response_request", send_response_request)
+    for text in ("one", "two"):
+        summary.add_message_to_history(SummaryMessage("alice", text, tokens=1))
+    await summary.update_summary()
+    summary.add_message_to_history(SummaryMessage("bob", "three", tokens=1))
+    await registry.flush()
+    registry.store.close()
+
+    restarted = ChatRegistry(ChatStore(tmp_path / "chats.db"), max_resident_channels=10, max_memory_bytes=1_000_000)
+    restored = restarted.get_summary_object(fake_message(1))
+    assert restored.summary == "the summary"
+    assert restored.num_unsummarised == 1
+    assert [message.content for message in restored.get_history()] == ["one", "two", "three"]
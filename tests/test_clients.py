@@ -0,0 +1,257 @@
+import asyncio
+from collections.abc import AsyncIterator
+
+import pytest
+
+from slashbot.cogs.chatbot.scheduler import Priority, RequestScheduler
+from slashbot.llm import (
+    GenerationFailureError,
+    TextGenerationInput,
+    TextGenerationResponse,
+    TextGenerator,
+    text_generator,
+)
+from slashbot.llm.clients.claude import ClaudeClient
+from slashbot.llm.conversation import ConversationMessage
+from slashbot.llm.hedging import LatencyTracker
+from slashbot.llm.models import VisionImage, VisionVideo
+from slashbot.settings import BotSettings
+
+REPORTED_OUTPUT_TOKENS = 7
+
+
+@pytest.fixture
+def client(monkeypatch: pytest.MonkeyPatch) -> ClaudeClient:
+    """Fixture yielding a Claude client which does not make any requests."""
+    client = ClaudeClient("claude-haiku-4-5")
+    client.set_system_prompt("You are a test.")
+
+    async def generate_response(_content: list[dict] | dict, **_kwargs: int | None) -> TextGenerationResponse:
+        return TextGenerationResponse("a reply", 0, input_tokens=0, output_tokens=REPORTED_OUTPUT_TOKENS)
+
+    monkeypatch.setattr(client, "generate_response", generate_response)
+
+    return client
+
+
+@pytest.mark.asyncio
+async def test_token_ledger_is_maintained_incrementally(client: ClaudeClient) -> None:
+    """Test that tokens are recorded per message and summed into token_size."""
+    system_tokens = client.token_size
+    await client.generate_response_with_context(TextGenerationInput("hello there, how are you today?"))
+
+    system_entry, user_entry, assistant_entry = client.get_token_ledger()
+    assert system_entry.tokens == system_tokens
+    assert user_entry.role == "user"
+    assert user_entry.text == "hello there, how are you today?"
+    assert assistant_entry.role == "assistant"
+    assert assistant_entry.tokens == REPORTED_OUTPUT_TOKENS
+    assert client.token_size == system_entry.tokens + user_entry.tokens + assistant_entry.tokens
+
+
+@pytest.mark.asyncio
+async def test_shrinking_context_does_not_recount(client: ClaudeClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that trimming the context to the window is pure arithmetic."""
+    for i in range(4):
+        await client.generate_response_with_context(TextGenerationInput(f"message number {i}"))
+    ledger = client.get_token_ledger()
+
+    def fail(_messages: dict | list | str) -> int:
+        msg = "Tokens should not be recounted"
+        raise AssertionError(msg)
+
+    monkeypatch.setattr(client, "count_tokens", fail)
+    monkeypatch.setattr(client, "_token_window_size", client.token_size - 1)
+    client._shrink_model_context_to_window_size()  # noqa: SLF001
+
+    assert len(client) == len(ledger) - 3
+    assert client.token_size == sum(entry.tokens for entry in ledger) - ledger[1].tokens - ledger[2].tokens
+
+
+@pytest.mark.asyncio
+async def test_oldest_turns_are_compacted_into_a_digest(client: ClaudeClient) -> None:
+    """Test that whole turns are replaced by a digest, unless the context changed in the meantime."""
+    for i in range(4):
+        await client.generate_response_with_context(TextGenerationInput(f"message number {i}"))
+    kept = client.get_context()[-2:]
+
+    messages = client.select_messages_to_compact(0)
+    assert len(messages) == len(client) - 2
+    assert messages[-1].role == "assistant"
+    assert client.compact_context(messages, "we counted")
+
+    context = client.get_context()
+    assert [message.text for message in context[:2]] == [client.COMPACTION_REQUEST, "we counted"]
+    assert context[2:] == kept
+    assert client.token_size == sum(entry.tokens for entry in client.get_token_ledger())
+    assert len(client._get_context_request()) == len(context)  # noqa: SLF001
+
+    # The conversation has changed since the messages were selected
+    assert not client.compact_context(messages, "stale")
+
+
+def stub_responses(generator: TextGenerator, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Replace the generator's client's requests with a canned reply."""
+
+    async def generate_response(_content: list[dict] | dict, **_kwargs: int | None) -> TextGenerationResponse:
+        return TextGenerationResponse("a reply", 0, input_tokens=0, output_tokens=REPORTED_OUTPUT_TOKENS)
+
+    monkeypatch.setattr(generator._client, "generate_response", generate_response)  # noqa: SLF001
+
+
+@pytest.mark.asyncio
+async def test_conversation_is_kept_when_switching_provider(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the conversation is rendered for a new provider, and only new messages are rendered."""
+    generator = TextGenerator(model_name="claude-haiku-4-5")
+    stub_responses(generator, monkeypatch)
+    await generator.generate_response_with_context(TextGenerationInput("hello"))
+
+    generator.set_model("gemini-2.5-flash")
+    client = generator._client  # noqa: SLF001
+    contents = client._get_context_request()["contents"]  # noqa: SLF001
+    assert [content["role"] for content in contents] == ["user", "model"]
+    assert contents[0]["parts"] == [{"text": "hello"}]
+    assert generator.size_tokens == sum(entry.tokens for entry in generator.token_ledger)
+
+    rendered = []
+    render_message = client._render_message  # noqa: SLF001
+    monkeypatch.setattr(client, "_render_message", lambda message: rendered.append(message) or render_message(message))
+    stub_responses(generator, monkeypatch)
+    await generator.generate_response_with_context(TextGenerationInput("hello again"))
+
+    assert [message.role for message in rendered] == ["user", "assistant"]
+    new_contents = client._get_context_request()["contents"]  # noqa: SLF001
+    assert new_contents[0] is contents[0]
+    assert len(contents) == len(new_contents) - 2
+    assert [message.text for message in generator.get_context()] == ["hello", "a reply", "hello again", "a reply"]
+
+
+@pytest.mark.asyncio
+async def test_an_unseen_turn_can_be_removed_from_the_context(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a turn is removed, even once the conversation has moved on."""
+    generator = TextGenerator(model_name="claude-haiku-4-5")
+    stub_responses(generator, monkeypatch)
+    await generator.generate_response_with_context(TextGenerationInput("hello"))
+    unseen = generator.get_last_turn()
+    await generator.generate_response_with_context(TextGenerationInput("hello again"))
+
+    generator.remove_messages(unseen)
+
+    assert [message.text for message in generator.get_context()] == ["hello again", "a reply"]
+    assert generator.size_tokens == sum(entry.tokens for entry in generator.token_ledger)
+
+
+def test_oldest_images_are_removed_using_the_media_index(client: ClaudeClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the media index follows messages as others are removed around them."""
+    monkeypatch.setattr(BotSettings.cogs.chatbot, "max_images_in_window", 2)
+    image = VisionImage("https://example.com/image.png", "aGk=", "image/png")
+    video = VisionVideo("https://youtu.be/video", mime_type="video/mp4")
+    for text in ("text", "image 1", "video", "image 2", "image 3"):
+        inputs = TextGenerationInput(
+            text, images=image if text.startswith("image") else None, videos=video if text == "video" else None
+        )
+        client._add_to_model_context(ConversationMessage.from_inputs(inputs))  # noqa: SLF001
+
+    conversation = client.conversation
+    assert conversation.positions_with_images() == [1, 3, 4]
+    assert conversation.positions_with_videos() == [2]
+
+    client._remove_message_from_model_context(0)  # noqa: SLF001
+    client._remove_message_from_model_context(1)  # noqa: SLF001
+    assert conversation.positions_with_images() == [0, 1, 2]
+    assert conversation.num_with_videos == 0
+
+    client._add_to_model_context(ConversationMessage.from_inputs(TextGenerationInput("more text")))  # noqa: SLF001
+    assert [message.text for message in conversation] == ["image 2", "image 3", "more text"]
+    assert conversation.positions_with_images() == [0, 1]
+
+
+@pytest.mark.asyncio
+async def test_hedged_turns_keep_the_primary_payload_and_latency(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a winning hedge does not invalidate the primary's payload, or hide its latency."""
+    monkeypatch.setattr(BotSettings.cogs.chatbot, "hedge_model", "gemini-2.5-flash")
+    monkeypatch.setattr(BotSettings.cogs.chatbot, "hedge_default_delay", 0.01)
+    tracker = LatencyTracker()
+    monkeypatch.setattr(text_generator, "LATENCY_TRACKER", tracker)
+    generator = TextGenerator(model_name="claude-haiku-4-5")
+    primary, hedge = generator._client, generator._hedge_client  # noqa: SLF001
+
+    async def slow_response(_content: list[dict] | dict, **_kwargs: int | None) -> TextGenerationResponse:
+        await asyncio.sleep(10)
+        return TextGenerationResponse("too late", 0)
+
+    stub_responses(generator, monkeypatch)
+    monkeypatch.setattr(hedge, "generate_response", primary.generate_response)
+    monkeypatch.setattr(primary, "generate_response", slow_response)
+
+    first_turn, second_turn = "hello", "hello again"
+    await generator.generate_response_with_context(TextGenerationInput(first_turn))
+    rendered = []
+    render_message = primary._render_message  # noqa: SLF001
+    monkeypatch.setattr(primary, "_render_message", lambda message: rendered.append(message) or render_message(message))
+    response = await generator.generate_response_with_context(TextGenerationInput(second_turn))
+
+    assert response.message == "a reply"
+    assert [message.text for message in rendered] == [second_turn, "a reply"]
+    await asyncio.sleep(0)  # let the cancelled primary request finish
+    assert tracker._histograms["claude-haiku-4-5"].total == len((first_turn, second_turn))  # noqa: SLF001
+
+
+@pytest.mark.asyncio
+async def test_hedges_only_run_in_a_free_slot(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a slow request is not hedged without a slot, but still fails over."""
+    monkeypatch.setattr(BotSettings.cogs.chatbot, "hedge_model", "gemini-2.5-flash")
+    monkeypatch.setattr(BotSettings.cogs.chatbot, "hedge_default_delay", 0)
+    monkeypatch.setattr(text_generator, "LATENCY_TRACKER", LatencyTracker())
+    generator = TextGenerator(model_name="claude-haiku-4-5")
+    primary, hedge = generator._client, generator._hedge_client  # noqa: SLF001
+    scheduler = RequestScheduler(max_concurrency=1, max_queue_size=1)
+    hedged = []
+
+    async def failing_response(_content: list[dict] | dict, **_kwargs: int | None) -> TextGenerationResponse:
+        await asyncio.sleep(0.01)
+        msg = "overloaded"
+        raise GenerationFailureError(msg)
+
+    async def hedge_response(_content: list[dict] | dict, **_kwargs: int | None) -> TextGenerationResponse:
+        hedged.append(scheduler.metrics.active)
+        return TextGenerationResponse("a hedged reply", 0)
+
+    monkeypatch.setattr(primary, "generate_response", failing_response)
+    monkeypatch.setattr(hedge, "generate_response", hedge_response)
+
+    async with scheduler.slot(Priority.PROMPTED):
+        response = await generator.generate_response_with_context(
+            TextGenerationInput("hello"), hedge_slot=lambda: scheduler.try_slot(Priority.PROMPTED)
+        )
+
+    assert response.message == "a hedged reply"
+    assert hedged == [1]
+
+
+@pytest.mark.asyncio
+async def test_streams_fail_over_before_the_first_chunk(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a stream which fails before sending anything is streamed from the hedge model."""
+    monkeypatch.setattr(BotSettings.cogs.chatbot, "hedge_model", "gemini-2.5-flash")
+    generator = TextGenerator(model_name="claude-haiku-4-5")
+    primary, hedge = generator._client, generator._hedge_client  # noqa: SLF001
+
+    async def failing_stream(*_args: object, **_kwargs: int | None) -> AsyncIterator[str]:
+        msg = "overloaded"
+        raise GenerationFailureError(msg)
+        yield ""
+
+    async def hedge_stream(
+        _content: list[dict] | dict, response: TextGenerationResponse, **_kwargs: int | None
+    ) -> AsyncIterator[str]:
+        for text in ("a hedged ", "reply"):
+            response.message += text
+            yield text
+
+    monkeypatch.setattr(primary, "stream_response", failing_stream)
+    monkeypatch.setattr(hedge, "stream_response", hedge_stream)
+
+    streamed = [text async for text in generator.stream_response_with_context(TextGenerationInput("hello"))]
+
+    assert streamed == ["a hedged ", "reply"]
+    assert [message.text for message in generator.get_context()] == ["hello", "a hedged reply"]
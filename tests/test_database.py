@@ -1,3 +1,5 @@
+import datetime
+
 import pytest
 from sqlalchemy import inspect
 
@@ -118,3 +120,41 @@ async def test_mark_reminder_as_notified(test_db: DatabaseSQL) -> None:
 @pytest.mark.asyncio
 async def test_reminder_deletion(test_db: DatabaseSQL) -> None:
     """Test that a reminder can be deleted."""
+
+
+@pytest.mark.asyncio
+async def test_message_archive_search_range_and_retention(test_db: DatabaseSQL) -> None:
+    """Test that archived messages can be searched, read by time and pruned."""
+    start = datetime.datetime(2026, 1, 1)  # noqa: DTZ001
+    contents = ["the wifi is down", "lunch at noon?", "wifi is back up", "nobody asked"]
+    messages = [
+        {
+            "message_id": i,
+            "channel_id": 1,
+            "author": "alice",
+            "content": content,
+            "created_at": start + datetime.timedelta(hours=i),
+        }
+        for i, content in enumerate(contents)
+    ]
+    await test_db.archive_messages(messages)
+    await test_db.archive_messages(messages[:1])  # duplicates are ignored
+
+    found = await test_db.search_archive(1, "wifi")
+    assert {message.content for message in found} == {"the wifi is down", "wifi is back up"}
+    assert await test_db.search_archive(2, "wifi") == []
+    assert await test_db.search_archive(1, 'wifi" OR') == []
+
+    batches = [
+        batch
+        async for batch in test_db.iter_archive(
+            1, start + datetime.timedelta(hours=1), start + datetime.timedelta(hours=4), batch_size=2
+        )
+    ]
+    assert [[message.content for message in batch] for batch in batches] == [contents[1:3], contents[3:]]
+
+    num_deleted = await test_db.prune_archive(
+        older_than=start + datetime.timedelta(hours=1), max_messages_per_channel=2
+    )
+    assert num_deleted == len(contents) - 2
+    assert [message.content for message in await test_db.search_archive(1, "wifi")] == ["wifi is back up"]
@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from slashbot.llm.hedging import LatencyTracker, hedge_request
+
+MIN_SAMPLES = 10
+DEFAULT_DELAY = 15.0
+TYPICAL_LATENCY = 1.0
+SLOW_LATENCY = 30.0
+
+
+def hedge_delay(tracker: LatencyTracker, quantile: float) -> float:
+    """Get the hedge delay for the test model."""
+    return tracker.get_hedge_delay("model", quantile=quantile, min_samples=MIN_SAMPLES, default=DEFAULT_DELAY)
+
+
+def test_hedge_delay_follows_latency_quantile() -> None:
+    """Test that the hedge delay is the default until enough latencies are recorded."""
+    tracker = LatencyTracker()
+    for _ in range(MIN_SAMPLES - 1):
+        tracker.record("model", TYPICAL_LATENCY)
+    assert hedge_delay(tracker, 0.9) == DEFAULT_DELAY
+
+    tracker.record("model", SLOW_LATENCY)
+    assert hedge_delay(tracker, 0.9) == TYPICAL_LATENCY
+    assert hedge_delay(tracker, 1.0) >= SLOW_LATENCY
+
+
+@pytest.mark.asyncio
+async def test_slow_primary_is_hedged_and_cancelled() -> None:
+    """Test that the secondary is used when it responds before a slow primary."""
+    cancelled = asyncio.Event()
+
+    async def primary() -> str:
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return "primary"
+
+    async def secondary() -> str:
+        return "secondary"
+
+    assert await hedge_request(primary, secondary, delay=0.01) == "secondary"
+    await asyncio.sleep(0)
+    assert cancelled.is_set()
+
+
+@pytest.mark.asyncio
+async def test_failed_primary_fails_over_to_secondary() -> None:
+    """Test that the secondary is sent immediately when the primary fails."""
+    secondary_calls = []
+
+    async def primary() -> str:
+        msg = "primary failed"
+        raise ValueError(msg)
+
+    async def secondary() -> str:
+        secondary_calls.append(1)
+        return "secondary"
+
+    assert await hedge_request(primary, secondary, delay=10) == "secondary"
+    assert secondary_calls == [1]
+
+    async def failing_secondary() -> str:
+        msg = "secondary failed"
+        raise RuntimeError(msg)
+
+    with pytest.raises(ValueError, match="primary failed"):
+        await hedge_request(primary, failing_secondary, delay=10)
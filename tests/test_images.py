@@ -0,0 +1,75 @@
+import io
+from pathlib import Path
+
+import httpx
+import pytest
+from PIL import ExifTags, Image
+
+from slashbot.llm import images
+from slashbot.llm.images import EncodedImage, ImageCache, downscale_image, ingest_images
+from slashbot.transport import TRANSPORTS
+
+
+@pytest.mark.asyncio
+async def test_cache_spills_to_disk_and_reloads(tmp_path: Path) -> None:
+    """Test that images evicted from memory are read back from disk."""
+    cache = ImageCache(tmp_path, max_memory_bytes=10, max_disk_bytes=1000)
+    first = EncodedImage("image/png", "A" * 8)
+    second = EncodedImage("image/png", "B" * 8)
+
+    await cache.put("first", first)
+    await cache.put("second", second)
+    assert (tmp_path / "first").exists()
+    assert await cache.get("first") == first
+
+    # A new cache finds the spilled images
+    assert "first" in ImageCache(tmp_path, max_memory_bytes=10, max_disk_bytes=1000)._disk  # noqa: SLF001
+
+
+def test_downscale_image_fits_within_max_dimension() -> None:
+    """Test that large images are downscaled and re-encoded."""
+    original = io.BytesIO()
+    Image.new("RGB", (2000, 1000)).save(original, format="PNG")
+
+    data, mime_type = downscale_image(original.getvalue(), "image/png", 500)
+
+    assert mime_type == "image/jpeg"
+    assert Image.open(io.BytesIO(data)).size == (500, 250)
+    assert downscale_image(data, mime_type, 500) == (data, mime_type)
+
+
+def test_downscale_image_applies_the_exif_orientation() -> None:
+    """Test that a photo taken sideways is the right way up once its EXIF data is dropped."""
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = 6  # rotated 90 degrees clockwise
+    original = io.BytesIO()
+    Image.new("RGB", (2000, 1000)).save(original, format="JPEG", exif=exif)
+
+    data, _ = downscale_image(original.getvalue(), "image/jpeg", 500)
+
+    assert Image.open(io.BytesIO(data)).size == (250, 500)
+
+
+@pytest.mark.asyncio
+async def test_ingest_images_downloads_once_and_skips_failures(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """Test that repeated images come from the cache, and bad URLs are skipped."""
+    downloads = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        downloads.append(request.url.path)
+        if request.url.path.endswith("missing.png"):
+            return httpx.Response(404)
+        return httpx.Response(200, content=b"not really a png", headers={"Content-Type": "image/png"})
+
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(TRANSPORTS, "get_http_client", lambda _service: http_client)
+    monkeypatch.setattr(images, "IMAGE_CACHE", ImageCache(tmp_path, max_memory_bytes=1000, max_disk_bytes=0))
+
+    url = "https://cdn.discordapp.com/attachments/1/2/image.png"
+    first = await ingest_images([f"{url}?ex=1", "https://example.com/missing.png"], max_dimension=100)
+    second = await ingest_images([f"{url}?ex=2"], max_dimension=100)
+
+    assert len(first) == 1
+    assert first[0].b64image == second[0].b64image
+    assert first[0].mime_type == "image/png"
+    assert downloads.count("/attachments/1/2/image.png") == 1
@@ -0,0 +1,152 @@
+import asyncio
+import json
+
+import httpx
+import openai
+import pytest
+
+from slashbot.llm.clients import local
+from slashbot.llm.clients.local import LocalClient, LocalServer, read_local_timings
+from slashbot.settings import BotSettings
+
+NUM_PARALLEL = 2
+PROMPT_MS = 500
+PREDICTED_MS = 2000
+PREDICTED_N = 50
+LOAD_NS = 3e9
+EVAL_NS = 1e9
+EVAL_COUNT = 10
+RETRY_AFTER = 0.05
+
+
+def completion(content: str, **extras: object) -> dict:
+    """Create the body of a chat completion from an OpenAI-compatible server."""
+    return {
+        "id": "chatcmpl-1",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "llama",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 5, "completion_tokens": 2, "total_tokens": 7},
+        **extras,
+    }
+
+
+@pytest.fixture
+def server(monkeypatch: pytest.MonkeyPatch) -> LocalServer:
+    """Fixture yielding fresh local server state which allows two parallel requests."""
+    monkeypatch.setattr(BotSettings.local_models, "num_parallel", NUM_PARALLEL)
+    monkeypatch.setattr(BotSettings.local_models, "keep_alive", "30m")
+    server = LocalServer()
+    monkeypatch.setattr(local, "LOCAL_SERVER", server)
+    return server
+
+
+def create_client(transport: httpx.AsyncBaseTransport) -> LocalClient:
+    """Create a client which sends its requests to a stub server."""
+    client = LocalClient("llama")
+    client._client = openai.AsyncClient(  # noqa: SLF001
+        api_key="local",
+        base_url="http://localhost/v1",
+        http_client=httpx.AsyncClient(transport=transport),
+        max_retries=0,
+    )
+    return client
+
+
+def test_timings_are_read_from_llama_cpp_and_ollama() -> None:
+    """Test that both styles of timings are understood."""
+    llama_cpp = openai.types.chat.ChatCompletion.model_validate(
+        completion("hi", timings={"prompt_ms": PROMPT_MS, "predicted_ms": PREDICTED_MS, "predicted_n": PREDICTED_N})
+    )
+    timings = read_local_timings(llama_cpp.model_extra or {})
+    assert timings is not None
+    assert timings.prompt_eval_seconds == PROMPT_MS / 1e3
+    assert timings.tokens_per_second == PREDICTED_N / (PREDICTED_MS / 1e3)
+
+    timings = read_local_timings({"load_duration": LOAD_NS, "eval_duration": EVAL_NS, "eval_count": EVAL_COUNT})
+    assert timings is not None
+    assert timings.load_seconds == LOAD_NS / 1e9
+    assert timings.tokens_per_second == EVAL_COUNT / (EVAL_NS / 1e9)
+
+    assert (
+        read_local_timings(openai.types.chat.ChatCompletion.model_validate(completion("hi")).model_extra or {}) is None
+    )
+
+
+@pytest.mark.asyncio
+async def test_requests_record_timings_and_respect_parallelism(server: LocalServer) -> None:
+    """Test that timings are recorded and requests queued to the server's parallelism."""
+    bodies = []
+    in_flight = 0
+    max_in_flight = 0
+
+    eval_tokens = 4
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal in_flight, max_in_flight
+        bodies.append(json.loads(request.content))
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, json=completion("hello", timings={"predicted_ms": 100, "predicted_n": eval_tokens}))
+
+    client = create_client(httpx.MockTransport(handler))
+    content = [{"role": "user", "content": "hi"}]
+    responses = await asyncio.gather(*(client.generate_response(content) for _ in range(5)))
+
+    assert [response.message for response in responses] == ["hello"] * 5
+    assert len(bodies) == len(responses)
+    assert max_in_flight == NUM_PARALLEL
+    assert server.timings["llama"].eval_tokens == eval_tokens
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("server")
+async def test_slot_is_released_while_waiting_to_retry(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a request waiting to be retried does not hold the server's only slot."""
+    monkeypatch.setattr(BotSettings.local_models, "num_parallel", 1)
+    monkeypatch.setattr(BotSettings.resilience, "max_retries", 1)
+    monkeypatch.setattr(local, "LOCAL_SERVER", LocalServer())
+    order = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        message = json.loads(request.content)["messages"][0]["content"]
+        order.append(message)
+        if order.count("first") == 1 and message == "first":
+            return httpx.Response(503, headers={"Retry-After": str(RETRY_AFTER)}, json={"error": "busy"})
+        return httpx.Response(200, json=completion(message))
+
+    client = create_client(httpx.MockTransport(handler))
+    first = asyncio.create_task(client.generate_response([{"role": "user", "content": "first"}]))
+    await asyncio.sleep(0)
+    second = await client.generate_response([{"role": "user", "content": "second"}])
+
+    assert second.message == "second"
+    assert (await first).message == "first"
+    assert order == ["first", "second", "first"]
+
+
+@pytest.mark.asyncio
+async def test_ollama_is_warmed_up_through_its_native_api(server: LocalServer, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that Ollama models are loaded with keep_alive, and their load timings recorded."""
+    monkeypatch.setattr(BotSettings.local_models, "base_url", "http://localhost:11434/v1")
+    requests = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(
+            200,
+            json={"response": "Hi", "done": True, "load_duration": LOAD_NS, "eval_duration": EVAL_NS, "eval_count": 1},
+        )
+
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(local.TRANSPORTS, "get_http_client", lambda _service: http_client)
+    await server.warm_up("llama")
+
+    assert str(requests[0].url) == "http://localhost:11434/api/generate"
+    body = json.loads(requests[0].content)
+    assert body["keep_alive"] == "30m"
+    assert body["options"] == {"num_predict": 1}
+    assert server.timings["llama"].load_seconds == LOAD_NS / 1e9
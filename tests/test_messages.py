@@ -0,0 +1,118 @@
+import itertools
+
+import pytest
+
+from slashbot.messages import MAX_MESSAGE_LENGTH, StreamedReply
+
+MESSAGE_IDS = itertools.count(1)
+
+
+class FakeMessage:
+    """A sent Discord message which records its content."""
+
+    def __init__(self, content: str) -> None:
+        """Initialise with the sent content and a new ID."""
+        self.id = next(MESSAGE_IDS)
+        self.content = content
+
+    async def edit(self, *, content: str) -> None:
+        """Replace the content."""
+        self.content = content
+
+
+class FakeChannel:
+    """A Discord channel which records sent messages."""
+
+    def __init__(self) -> None:
+        """Initialise with no sent messages."""
+        self.sent: list[FakeMessage] = []
+        self.last_message_id: int | None = None
+
+    async def send(self, content: str) -> FakeMessage:
+        """Record a new message."""
+        message = FakeMessage(content)
+        self.sent.append(message)
+        self.last_message_id = message.id
+        return message
+
+
+class FakeAuthor:
+    """A Discord user."""
+
+    mention = "<@1>"
+
+
+class FakeInteraction:
+    """An object to reply to, which is not in a text channel."""
+
+    def __init__(self) -> None:
+        """Initialise with a fake author and channel."""
+        self.author = FakeAuthor()
+        self.channel = FakeChannel()
+
+
+@pytest.mark.asyncio
+async def test_streamed_reply_waits_for_first_sentence_and_edits() -> None:
+    """Test that nothing is sent before a sentence, and edits keep the mention."""
+    obj = FakeInteraction()
+    reply = StreamedReply(obj, edit_interval=0)
+
+    await reply.add_text("Hello")
+    assert obj.channel.sent == []
+
+    await reply.add_text(" there. How")
+    await reply.add_text(" are you?")
+    sent = await reply.finish()
+
+    assert sent == obj.channel.sent
+    assert sent[0].content == "<@1> Hello there. How are you?"
+
+
+@pytest.mark.asyncio
+async def test_streamed_reply_rolls_over_long_text() -> None:
+    """Test that text longer than a Discord message is split over messages."""
+    obj = FakeInteraction()
+    reply = StreamedReply(obj, dont_tag_user=True, edit_interval=0)
+
+    words = ["word."] * MAX_MESSAGE_LENGTH
+    for word in words:
+        await reply.add_text(word + " ")
+    sent = await reply.finish()
+
+    assert len(sent) > 1
+    assert all(len(message.content) <= MAX_MESSAGE_LENGTH + 1 for message in sent)
+    assert " ".join(message.content.strip() for message in sent) == " ".join(words)
+
+
+@pytest.mark.asyncio
+async def test_streamed_reply_replaces_placeholder() -> None:
+    """Test that streamed text is edited into a placeholder as soon as it arrives."""
+    obj = FakeInteraction()
+    reply = StreamedReply(obj, edit_interval=0)
+
+    await reply.send_placeholder("A Markov sentence.")
+    assert reply.showing_placeholder
+
+    await reply.add_text("Hello")
+    sent = await reply.finish()
+
+    assert sent == obj.channel.sent
+    assert len(sent) == 1
+    assert sent[0].content == "<@1> Hello"
+    assert not reply.showing_placeholder
+
+
+@pytest.mark.asyncio
+async def test_streamed_reply_is_discarded_if_conversation_moved_on() -> None:
+    """Test that a placeholder is kept if another message was sent after it."""
+    obj = FakeInteraction()
+    reply = StreamedReply(obj, edit_interval=0)
+
+    await reply.send_placeholder("A Markov sentence.")
+    obj.channel.last_message_id = FakeMessage("Someone else's message.").id
+
+    await reply.add_text("Hello.")
+    sent = await reply.finish()
+
+    assert reply.discarded
+    assert [message.content for message in sent] == ["<@1> A Markov sentence."]
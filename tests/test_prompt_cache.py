@@ -0,0 +1,152 @@
+import itertools
+import json
+
+import httpx
+import pytest
+from anthropic import AsyncAnthropic
+
+from slashbot.llm import TextGenerationInput
+from slashbot.llm.clients.claude import ClaudeClient
+from slashbot.llm.clients.gemini import GeminiClient
+from slashbot.settings import BotSettings
+from slashbot.transport import TRANSPORTS
+
+CACHED_TOKENS = 100
+
+
+def stub_server(requests: list[httpx.Request]) -> httpx.MockTransport:
+    """Create a stub provider server which echoes what was asked to be cached.
+
+    The Anthropic stub reports cache reads when the request has cache_control
+    breakpoints. The Gemini stub creates cachedContents, each with a new name,
+    and reports cache reads when a request uses one.
+    """
+    cache_names = (f"cachedContents/{n}" for n in itertools.count())
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.method == "DELETE":
+            return httpx.Response(200, json={})
+        body = json.loads(request.content)
+        if request.url.path.endswith("/messages"):
+            cached = CACHED_TOKENS if "cache_control" in request.content.decode() else 0
+            return httpx.Response(
+                200,
+                json={
+                    "id": "msg",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": body["model"],
+                    "content": [{"type": "text", "text": "a reply"}],
+                    "stop_reason": "end_turn",
+                    "usage": {"input_tokens": 10, "output_tokens": 5, "cache_read_input_tokens": cached},
+                },
+            )
+        if request.url.path.endswith("/cachedContents"):
+            return httpx.Response(200, json={"name": next(cache_names), "usageMetadata": {"totalTokenCount": 50}})
+        cached = CACHED_TOKENS if "cachedContent" in body else 0
+        return httpx.Response(
+            200,
+            json={
+                "candidates": [{"content": {"role": "model", "parts": [{"text": "a reply"}]}}],
+                "usageMetadata": {
+                    "promptTokenCount": 10 + cached,
+                    "candidatesTokenCount": 5,
+                    "totalTokenCount": 15 + cached,
+                    "cachedContentTokenCount": cached,
+                },
+            },
+        )
+
+    return httpx.MockTransport(handler)
+
+
+@pytest.mark.asyncio
+async def test_claude_marks_cache_breakpoints_and_reports_hits() -> None:
+    """Test that the system prompt and last message are marked as cacheable."""
+    requests = []
+    client = ClaudeClient("claude-haiku-4-5")
+    client._client = AsyncAnthropic(  # noqa: SLF001
+        api_key="test", http_client=httpx.AsyncClient(transport=stub_server(requests))
+    )
+
+    await client.generate_response_with_context(TextGenerationInput("hello"))
+
+    body = json.loads(requests[0].content)
+    assert body["system"][0]["cache_control"] == ClaudeClient.CACHE_CONTROL
+    assert body["messages"][-1]["content"][-1]["cache_control"] == ClaudeClient.CACHE_CONTROL
+    assert "cache_control" not in json.dumps(client._get_context_request())  # noqa: SLF001
+    assert client.prompt_cache.is_warm
+    assert client.prompt_cache.stats.cache_read_tokens == CACHED_TOKENS
+    assert client.prompt_cache.stats.input_tokens == CACHED_TOKENS + 10
+
+
+@pytest.mark.asyncio
+async def test_gemini_reuses_cached_contents_until_prefix_changes(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a cachedContents is created in the background and reused for the prefix."""
+    requests = []
+    http_client = httpx.AsyncClient(transport=stub_server(requests))
+    monkeypatch.setattr(TRANSPORTS, "get_http_client", lambda _service: http_client)
+    monkeypatch.setattr(BotSettings.cogs.chatbot, "prompt_cache_min_tokens", 0)
+    client = GeminiClient("gemini-2.5-flash")
+
+    def num_caches_created() -> int:
+        return sum(request.url.path.endswith("/cachedContents") for request in requests)
+
+    # The first request is sent in full, whilst the cache is created
+    await client.generate_response_with_context(TextGenerationInput("hello"))
+    assert "cachedContent" not in json.loads(requests[0].content)
+    await client._cache_task  # noqa: SLF001
+    await client.generate_response_with_context(TextGenerationInput("hello again"))
+
+    assert num_caches_created() == 1
+    body = json.loads(requests[-1].content)
+    assert body["cachedContent"] == "cachedContents/0"
+    assert "system_instruction" not in body
+    assert len(body["contents"]) == len(client) - 1
+    assert client.prompt_cache.stats.hits == 1
+
+    # Once expired, the cache is re-made to include the conversation so far
+    # and the old cache is deleted
+    client.prompt_cache.expires_at = 0
+    await client.generate_response_with_context(TextGenerationInput("and again"))
+    await client._cache_task  # noqa: SLF001
+    assert num_caches_created() == 1 + 1
+    assert requests[-1].method == "DELETE"
+    assert requests[-1].url.path.endswith("/cachedContents/0")
+    await client.generate_response_with_context(TextGenerationInput("and once more"))
+    body = json.loads(requests[-1].content)
+    assert body["cachedContent"] == "cachedContents/1"
+    assert len(body["contents"]) == len(client) - 5
+
+    # Removing the start of the conversation changes the prefix, so the cache
+    # has to be re-made
+    client._remove_message_from_model_context(0)  # noqa: SLF001
+    await client.generate_response_with_context(TextGenerationInput("one more time"))
+    await client._cache_task  # noqa: SLF001
+    assert num_caches_created() == 1 + 1 + 1
+
+
+@pytest.mark.asyncio
+async def test_gemini_backs_off_when_a_cache_cannot_be_created(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a failed cachedContents request is not retried on the next turn."""
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.url.path.endswith("/cachedContents"):
+            return httpx.Response(400, json={"error": {"message": "Cached content is too small"}})
+        return stub_server([]).handler(request)
+
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(TRANSPORTS, "get_http_client", lambda _service: http_client)
+    monkeypatch.setattr(BotSettings.cogs.chatbot, "prompt_cache_min_tokens", 0)
+    client = GeminiClient("gemini-2.5-flash")
+
+    await client.generate_response_with_context(TextGenerationInput("hello"))
+    await client._cache_task  # noqa: SLF001
+    await client.generate_response_with_context(TextGenerationInput("hello again"))
+
+    assert sum(request.url.path.endswith("/cachedContents") for request in requests) == 1
+    assert not client.prompt_cache.can_write
+    assert client.prompt_cache.write_failures == 1
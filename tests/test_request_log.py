@@ -0,0 +1,137 @@
+import base64
+import datetime
+import gzip
+import json
+import time
+import zlib
+from pathlib import Path
+
+import pytest
+
+from slashbot.llm import request_log as request_log_module
+from slashbot.llm.blobs import BlobRef
+from slashbot.llm.request_log import RequestLog, redact
+from slashbot.settings import BotSettings
+
+CHANNEL_ID = 1234
+FLUSH_INTERVAL = 0.01
+
+
+@pytest.fixture
+def request_log(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> RequestLog:
+    """Fixture yielding a request log which writes to a temporary directory."""
+    monkeypatch.setattr(BotSettings.logging, "enable_request_log", True)
+    monkeypatch.setattr(BotSettings.logging, "request_log_directory", str(tmp_path))
+    monkeypatch.setattr(BotSettings.logging, "request_log_sample_rate", 1.0)
+    monkeypatch.setattr(BotSettings.logging, "request_log_channel_sample_rates", {})
+    return RequestLog()
+
+
+def read_records(directory: Path) -> list[dict]:
+    """Read every record in the request log."""
+    records = []
+    for path in sorted(directory.glob("requests-*.jsonl.gz")):
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            records.extend(json.loads(line) for line in file)
+    return records
+
+
+def test_media_is_replaced_by_hash_and_size() -> None:
+    """Test that base64 data and blob references are not written to the log."""
+    image = base64.b64encode(b"\x89PNG" * 1000).decode()
+    payload = [
+        {"role": "user", "content": [{"type": "text", "text": "look at this"}, {"type": "image", "data": image}]},
+        {"role": "user", "content": [{"type": "image_url", "url": f"data:image/png;base64,{image}"}]},
+        {"role": "user", "content": [{"type": "image", "data": BlobRef("abc123", 4000)}]},
+    ]
+
+    redacted = redact(payload, inline_limit=256)
+
+    assert redacted[0]["content"][0]["text"] == "look at this"
+    assert redacted[0]["content"][1]["data"]["bytes"] == len(image)
+    assert redacted[1]["content"][0]["url"]["bytes"] == len(image) + len("data:image/png;base64,")
+    assert redacted[2]["content"][0]["data"] == {"sha256": "abc123", "bytes": 4000}
+    assert image not in json.dumps(redacted)
+
+
+def test_requests_and_responses_are_written_in_background(request_log: RequestLog, tmp_path: Path) -> None:
+    """Test that a response is linked to its request in the compressed log."""
+    request_id = request_log.log_request("model", CHANNEL_ID, [{"role": "user", "content": "hello"}])
+    request_log.log_response(request_id, "model", CHANNEL_ID, {"text": "hi there"})
+    request_log.close()
+
+    request, response = read_records(tmp_path)
+    assert request["kind"] == "request"
+    assert request["channel"] == CHANNEL_ID
+    assert request["payload"] == [{"role": "user", "content": "hello"}]
+    assert response["kind"] == "response"
+    assert response["id"] == request["id"]
+    assert response["payload"] == {"text": "hi there"}
+
+
+def test_requests_are_copied_before_they_are_queued(request_log: RequestLog, tmp_path: Path) -> None:
+    """Test that a request is logged as it was sent, if the context changes before it is written."""
+    contents = [{"role": "user", "content": "hello"}]
+    request = {"contents": contents, "generationConfig": {"temperature": 1.0}}
+    request_log.log_request("model", CHANNEL_ID, request)
+    contents.append({"role": "model", "content": "a later reply"})
+    request_log.close()
+
+    (logged,) = read_records(tmp_path)
+    assert logged["payload"]["contents"] == [{"role": "user", "content": "hello"}]
+
+
+def test_incomplete_files_are_not_appended_to(request_log: RequestLog, tmp_path: Path) -> None:
+    """Test that records are written to a new file, if a previous run did not exit cleanly."""
+    today = datetime.datetime.now(tz=datetime.UTC).date().isoformat()
+    crashed = tmp_path / f"requests-{today}-0.jsonl.gz"
+    crashed_contents = gzip.compress(b'{"kind":"request"}\n')[:-8]
+    crashed.write_bytes(crashed_contents)
+
+    request_log.log_request("model", CHANNEL_ID, "after the crash")
+    request_log.close()
+
+    assert crashed.read_bytes() == crashed_contents
+    with gzip.open(tmp_path / f"requests-{today}-1.jsonl.gz", "rt", encoding="utf-8") as file:
+        assert json.loads(file.readline())["payload"] == "after the crash"
+
+
+def test_requests_are_sampled_per_channel(
+    request_log: RequestLog, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that a channel's sample rate overrides the global rate."""
+    monkeypatch.setattr(BotSettings.logging, "request_log_channel_sample_rates", {1: 0.0})
+
+    request_id = request_log.log_request("model", 1, "quiet channel")
+    request_log.log_response(request_id, "model", 1, "not logged")
+    assert request_id is None
+
+    request_log.log_request("model", 2, "busy channel")
+    request_log.close()
+
+    assert [record["payload"] for record in read_records(tmp_path)] == ["busy channel"]
+
+
+def test_idle_flush_keeps_one_gzip_member(
+    request_log: RequestLog, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test that records can be read after an idle flush, and later records go in the same gzip member."""
+    monkeypatch.setattr(request_log_module, "FLUSH_INTERVAL", FLUSH_INTERVAL)
+    request_log.log_request("model", CHANNEL_ID, "before the flush")
+
+    flushed = b""
+    deadline = time.monotonic() + 5
+    while b"before the flush" not in flushed and time.monotonic() < deadline:
+        time.sleep(FLUSH_INTERVAL)
+        (path,) = tmp_path.glob("requests-*.jsonl.gz")
+        flushed = zlib.decompressobj(wbits=31).decompress(path.read_bytes())
+    assert json.loads(flushed)["payload"] == "before the flush"
+
+    request_log.log_request("model", CHANNEL_ID, "after the flush")
+    request_log.close()
+
+    decompressor = zlib.decompressobj(wbits=31)
+    lines = decompressor.decompress(path.read_bytes()).splitlines()
+    assert decompressor.eof
+    assert not decompressor.unused_data
+    assert [json.loads(line)["payload"] for line in lines] == ["before the flush", "after the flush"]
@@ -0,0 +1,124 @@
+import types
+from collections.abc import AsyncIterator
+
+import httpx
+import pytest
+
+from slashbot.llm.clients import resilience as resilience_module
+from slashbot.llm.clients.resilience import CircuitOpenError, CircuitState, ProviderResilience, get_retry_after
+from slashbot.llm.hedging import LATENCY_BUCKETS
+from slashbot.settings import BotSettings
+
+RETRY_AFTER_SECONDS = 2
+RETRY_AFTER_MILLISECONDS = 250
+FIRST_CHUNK_SECONDS = 0.1
+STREAM_SECONDS = 60
+
+
+def status_error(status_code: int, headers: dict[str, str] | None = None) -> httpx.HTTPStatusError:
+    """Create the exception raised for an HTTP error response."""
+    request = httpx.Request("POST", "https://example.com")
+    response = httpx.Response(status_code, headers=headers, request=request)
+    return httpx.HTTPStatusError("error", request=request, response=response)
+
+
+def test_retry_after_is_read_from_seconds_and_milliseconds() -> None:
+    """Test that both forms of Retry-After header are understood."""
+    retry_after = {"retry-after": str(RETRY_AFTER_SECONDS)}
+    assert get_retry_after(status_error(429, retry_after)) == RETRY_AFTER_SECONDS
+    retry_after_ms = {"retry-after-ms": str(RETRY_AFTER_MILLISECONDS)}
+    assert get_retry_after(status_error(429, retry_after_ms)) == RETRY_AFTER_MILLISECONDS / 1000
+    assert get_retry_after(status_error(429)) is None
+    assert get_retry_after(ValueError()) is None
+
+
+@pytest.mark.asyncio
+async def test_transient_errors_are_retried(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that rate limited requests are retried, but bad requests are not."""
+    monkeypatch.setattr(BotSettings.resilience, "max_retries", 2)
+    resilience = ProviderResilience("test")
+    attempts = []
+
+    async def rate_limited_once() -> str:
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise status_error(429, {"retry-after": "0"})
+        return "response"
+
+    assert await resilience.call(rate_limited_once) == "response"
+    assert attempts == [1, 1]
+    assert resilience.consecutive_failures == 0
+
+    async def bad_request() -> str:
+        attempts.append(1)
+        raise status_error(400)
+
+    attempts.clear()
+    with pytest.raises(httpx.HTTPStatusError):
+        await resilience.call(bad_request)
+    assert len(attempts) == 1
+
+
+@pytest.mark.asyncio
+async def test_circuit_opens_and_fails_fast(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that requests fail immediately once a provider keeps failing."""
+    monkeypatch.setattr(BotSettings.resilience, "max_retries", 0)
+    monkeypatch.setattr(BotSettings.resilience, "breaker_failure_threshold", 2)
+    monkeypatch.setattr(BotSettings.resilience, "breaker_reset_timeout", 60)
+    resilience = ProviderResilience("test")
+
+    async def unavailable() -> str:
+        raise status_error(503)
+
+    for _ in range(2):
+        with pytest.raises(httpx.HTTPStatusError):
+            await resilience.call(unavailable)
+    assert resilience.state == CircuitState.OPEN
+
+    with pytest.raises(CircuitOpenError):
+        await resilience.call(unavailable)
+
+    monkeypatch.setattr(BotSettings.resilience, "breaker_reset_timeout", 0)
+
+    async def available() -> str:
+        return "response"
+
+    assert await resilience.call(available) == "response"
+    assert resilience.state == CircuitState.CLOSED
+
+
+@pytest.mark.asyncio
+async def test_stream_is_retried_before_first_chunk(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a stream which fails before yielding anything is sent again."""
+    monkeypatch.setattr(BotSettings.resilience, "retry_base_delay", 0)
+    resilience = ProviderResilience("test")
+    attempts = []
+
+    async def open_stream() -> AsyncIterator[str]:
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise status_error(502)
+        yield "a"
+        yield "b"
+
+    assert [text async for text in resilience.stream(open_stream)] == ["a", "b"]
+    assert attempts == [1, 1]
+
+
+@pytest.mark.asyncio
+async def test_stream_latency_is_time_to_first_chunk(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a long stream records the time to its first chunk, and not its full duration."""
+    now = 0.0
+    monkeypatch.setattr(resilience_module, "time", types.SimpleNamespace(monotonic=lambda: now))
+    resilience = ProviderResilience("test")
+
+    async def open_stream() -> AsyncIterator[str]:
+        nonlocal now
+        now += FIRST_CHUNK_SECONDS
+        yield "a"
+        now += STREAM_SECONDS
+        yield "b"
+
+    assert [text async for text in resilience.stream(open_stream)] == ["a", "b"]
+    assert resilience.latency.total == 1
+    assert resilience.latency.quantile(1.0) == LATENCY_BUCKETS[0]
@@ -0,0 +1,130 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from slashbot.cogs.chatbot.response_generator import ResponseGenerator
+from slashbot.llm import TextGenerationInput
+
+
+class FakeConversation:
+    """A conversation which records each request."""
+
+    needs_compaction = False
+
+    def __init__(self) -> None:
+        """Initialise with no requests."""
+        self.requests: list[list[TextGenerationInput]] = []
+
+    async def send_message(self, messages: list[TextGenerationInput], **_kwargs: str) -> str:
+        """Record the request and respond, slowly."""
+        self.requests.append(messages)
+        await asyncio.sleep(0.01)
+        return "a reply"
+
+    def get_last_turn(self) -> list:
+        """Get the newest turn, which is not kept."""
+        return []
+
+
+def fake_message(author: str, content: str) -> SimpleNamespace:
+    """Create a fake Discord message in a shared channel."""
+    return SimpleNamespace(
+        id=0,
+        channel=SimpleNamespace(id=1),
+        author=SimpleNamespace(mention=f"@{author}"),
+        content=content,
+        clean_content=content,
+    )
+
+
+@pytest.mark.asyncio
+async def test_mentions_during_a_request_are_coalesced(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that mentions arriving whilst a request is in flight share a turn."""
+    conversation = FakeConversation()
+    registry = SimpleNamespace(get_chat_object=lambda _: conversation, recall=lambda *_: "")
+    generator = ResponseGenerator(registry, bot=None)
+
+    async def create_input(message: SimpleNamespace) -> TextGenerationInput:
+        return TextGenerationInput(message.content)
+
+    monkeypatch.setattr(generator, "_create_input", create_input)
+
+    first_turn = generator._join_pending_turn(fake_message("alice", "one"))  # noqa: SLF001
+    first_request = asyncio.create_task(generator.generate_response(first_turn))
+    await asyncio.sleep(0)
+
+    second_turn = generator._join_pending_turn(fake_message("bob", "two"))  # noqa: SLF001
+    assert generator._join_pending_turn(fake_message("carol", "three")) is None  # noqa: SLF001
+    second_request = asyncio.create_task(generator.generate_response(second_turn))
+    await asyncio.gather(first_request, second_request)
+
+    assert [[message.text for message in request] for request in conversation.requests] == [
+        ["one"],
+        ["two", "three"],
+    ]
+    assert second_turn.reply_to.content == "three"
+    assert second_turn.other_author_mentions == "@bob"
+
+
+@pytest.mark.asyncio
+async def test_a_failed_input_does_not_lose_the_turn(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that a message whose input could not be prepared is answered using its text."""
+    conversation = FakeConversation()
+    registry = SimpleNamespace(get_chat_object=lambda _: conversation, recall=lambda *_: "")
+    generator = ResponseGenerator(registry, bot=None)
+
+    async def create_input(message: SimpleNamespace) -> TextGenerationInput:
+        if message.content == "forbidden":
+            msg = "Missing access to the referenced message"
+            raise RuntimeError(msg)
+        return TextGenerationInput(message.content)
+
+    monkeypatch.setattr(generator, "_create_input", create_input)
+    monkeypatch.setattr(generator, "_get_user_label", lambda _message: "")
+
+    turn = generator._join_pending_turn(fake_message("alice", "one"))  # noqa: SLF001
+    assert generator._join_pending_turn(fake_message("bob", "forbidden")) is None  # noqa: SLF001
+
+    assert await generator.generate_response(turn) == "a reply"
+    assert [message.text for message in conversation.requests[0]] == ["one", "forbidden"]
+
+
+class FakeSentMessage:
+    """A sent Discord message which records its content."""
+
+    def __init__(self, message_id: int, content: str) -> None:
+        """Initialise with an ID and the sent content."""
+        self.id = message_id
+        self.content = content
+
+    async def edit(self, *, content: str) -> None:
+        """Replace the content."""
+        self.content = content
+
+    async def delete(self) -> None:
+        """Remove the content."""
+        self.content = ""
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    ("last_message_id", "expected"), [(None, "the real reply"), (10, "the real reply"), (11, "a placeholder")]
+)
+async def test_late_response_is_edited_in_unless_conversation_moved_on(
+    last_message_id: int | None, expected: str
+) -> None:
+    """Test that a late response replaces its placeholder only if it is the latest message."""
+    generator = ResponseGenerator(SimpleNamespace(), bot=None)
+    placeholder = [FakeSentMessage(9, "a placeholder"), FakeSentMessage(10, "")]
+    reply_to = SimpleNamespace(channel=SimpleNamespace(id=1, last_message_id=last_message_id))
+
+    async def late_response() -> str:
+        await asyncio.sleep(0.01)
+        return "the real reply"
+
+    response = asyncio.create_task(late_response())
+    assert not await generator._wait_for_response(response, 0.001)  # noqa: SLF001
+    await generator._edit_in_late_response(response, placeholder, reply_to, dont_tag_user=True)  # noqa: SLF001
+
+    assert placeholder[0].content == expected
@@ -0,0 +1,78 @@
+import pytest
+
+from slashbot.cogs.chatbot.chat_registry import AIChat, AIChatSummary, SummaryMessage
+from slashbot.cogs.chatbot.retrieval import BM25Index
+from slashbot.llm import TextGenerationInput
+from slashbot.llm.clients.claude import ClaudeClient
+from slashbot.settings import BotSettings
+
+
+def test_index_ranks_relevant_documents_and_forgets_removed_ones() -> None:
+    """Test that search ranks by relevance, returns oldest first and skips recent documents."""
+    index = BM25Index()
+    for text in ("the weather is nice today", "my cat likes fish", "fish and chips for dinner", "cat cat cat"):
+        index.append(text, text)
+
+    assert index.search("cat fish", k=2) == ["my cat likes fish", "cat cat cat"]
+    assert index.search("cat", k=5, skip_newest=1) == ["my cat likes fish"]
+    assert index.search("football", k=5) == []
+
+    assert index.popleft() == "the weather is nice today"
+    assert index.search("weather", k=5) == []
+    assert index.search("dinner", k=5) == ["fish and chips for dinner"]
+
+
+def test_history_is_recalled_after_being_trimmed_and_restored() -> None:
+    """Test that the summary history index follows the history."""
+    summary = AIChatSummary(token_window_size=7)
+    for text in ("the wifi password is hunter2", "lunch at noon", "the wifi is down again"):
+        summary.add_message_to_history(SummaryMessage("alice", text, tokens=4))
+
+    # The first message is trimmed from the history when the third is added
+    assert [message.content for message in summary.recall("wifi password", k=5)] == ["the wifi is down again"]
+
+    restored = AIChatSummary(token_window_size=7)
+    restored.restore_history(summary.get_history())
+    assert [message.content for message in restored.recall("lunch", k=5)] == ["lunch at noon"]
+
+
+@pytest.mark.asyncio
+async def test_recalled_messages_are_sent_but_not_kept(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that recalled messages are added to the request only."""
+    client = ClaudeClient("claude-haiku-4-5")
+    requests = []
+
+    async def generate_response(content: list[dict], **_kwargs: int | None) -> object:
+        """Record the request."""
+        requests.append(content)
+        return type("Response", (), {"message": "a reply", "output_tokens": 0})()
+
+    monkeypatch.setattr(client, "generate_response", generate_response)
+    await client.generate_response_with_context(TextGenerationInput("what is it?"), recalled="alice: it is 42")
+
+    assert "alice: it is 42" in str(requests[0][-1])
+    assert "alice: it is 42" not in str(client._get_context_request())  # noqa: SLF001
+    assert [message.text for message in client.get_context()] == ["what is it?", "a reply"]
+
+
+@pytest.mark.parametrize("enable_retrieval", [True, False])
+def test_retrieval_uses_a_smaller_recent_window(monkeypatch: pytest.MonkeyPatch, *, enable_retrieval: bool) -> None:
+    """Test that only the recent window is kept in the context when older messages can be recalled."""
+    settings = BotSettings.cogs.chatbot
+    monkeypatch.setattr(settings, "enable_retrieval", enable_retrieval)
+
+    client = ClaudeClient("claude-haiku-4-5")
+
+    expected = settings.retrieval_window_size if enable_retrieval else settings.token_window_size
+    assert client._token_window_size == expected  # noqa: SLF001
+
+
+def test_a_full_retrieval_window_is_not_compacted(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that compaction is measured against the token window, not the smaller retrieval window."""
+    settings = BotSettings.cogs.chatbot
+    monkeypatch.setattr(settings, "enable_retrieval", True)
+    chat = AIChat(system_prompt="Be helpful.")
+    monkeypatch.setattr(type(chat), "size_tokens", property(lambda _: settings.retrieval_window_size))
+
+    assert settings.retrieval_window_size < settings.context_compaction_threshold * settings.token_window_size
+    assert not chat.needs_compaction
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from slashbot.cogs.chatbot.scheduler import Priority, RequestDroppedError, RequestScheduler
+
+
+@pytest.mark.asyncio
+async def test_waiting_requests_run_in_priority_order() -> None:
+    """Test that queued requests are given slots by priority, then arrival."""
+    scheduler = RequestScheduler(max_concurrency=1, max_queue_size=10)
+    order = []
+    release = asyncio.Event()
+
+    async def request(name: str, priority: Priority) -> None:
+        async with scheduler.slot(priority):
+            order.append(name)
+            await release.wait()
+
+    blocker = asyncio.create_task(request("blocker", Priority.PROMPTED))
+    await asyncio.sleep(0)
+    waiting = [
+        asyncio.create_task(request(name, priority))
+        for name, priority in [
+            ("summary", Priority.SUMMARY),
+            ("unprompted", Priority.UNPROMPTED),
+            ("mention", Priority.PROMPTED),
+        ]
+    ]
+    await asyncio.sleep(0)
+    assert scheduler.metrics.queue_depth == len(waiting)
+
+    release.set()
+    await asyncio.gather(blocker, *waiting)
+
+    assert order == ["blocker", "mention", "unprompted", "summary"]
+    assert scheduler.metrics.active == 0
+    assert scheduler.metrics.queue_depth == 0
+    assert scheduler.metrics.max_wait_time[Priority.SUMMARY] > 0
+
+
+@pytest.mark.asyncio
+async def test_low_priority_requests_are_dropped_when_saturated() -> None:
+    """Test that a saturated queue drops or evicts low priority requests."""
+    scheduler = RequestScheduler(max_concurrency=1, max_queue_size=1)
+    await scheduler.acquire(Priority.PROMPTED)
+
+    summary = asyncio.create_task(scheduler.acquire(Priority.SUMMARY))
+    await asyncio.sleep(0)
+
+    # A summary can't replace another summary, so is dropped
+    with pytest.raises(RequestDroppedError):
+        await scheduler.acquire(Priority.SUMMARY)
+
+    # A mention evicts the queued summary
+    mention = asyncio.create_task(scheduler.acquire(Priority.PROMPTED))
+    await asyncio.sleep(0)
+    with pytest.raises(RequestDroppedError):
+        await summary
+
+    # Mentions are never dropped
+    second_mention = asyncio.create_task(scheduler.acquire(Priority.PROMPTED))
+    await asyncio.sleep(0)
+    assert scheduler.metrics.queue_depth == 1 + 1
+
+    scheduler.release()
+    await mention
+    scheduler.release()
+    await second_mention
+    assert scheduler.metrics.dropped[Priority.SUMMARY] == 1 + 1
+    assert scheduler.metrics.dropped[Priority.PROMPTED] == 0
+
+
+@pytest.mark.asyncio
+async def test_optional_requests_do_not_wait_for_a_slot() -> None:
+    """Test that try_slot only runs a request if a slot is free."""
+    scheduler = RequestScheduler(max_concurrency=1, max_queue_size=10)
+
+    async with scheduler.try_slot(Priority.PROMPTED) as acquired:
+        assert acquired
+        assert scheduler.metrics.active == 1
+        async with scheduler.try_slot(Priority.PROMPTED) as acquired_again:
+            assert not acquired_again
+    assert scheduler.metrics.active == 0
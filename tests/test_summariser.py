@@ -0,0 +1,82 @@
+import asyncio
+from collections.abc import AsyncIterator
+
+import pytest
+
+from slashbot.cogs.chatbot.chat_registry import SummaryMessage
+from slashbot.cogs.chatbot.summariser import chunk_messages, map_reduce_summary, map_reduce_summary_stream
+
+
+def test_messages_are_chunked_by_tokens() -> None:
+    """Test that chunks are bounded by tokens, and large messages are kept whole."""
+    messages = [SummaryMessage("alice", str(i), tokens=tokens) for i, tokens in enumerate((3, 3, 3, 10, 1))]
+
+    chunks = chunk_messages(messages, 6)
+
+    assert [[message.content for message in chunk] for chunk in chunks] == [["0", "1"], ["2"], ["3"], ["4"]]
+
+
+@pytest.mark.asyncio
+async def test_long_history_is_summarised_concurrently_and_reduced() -> None:
+    """Test that chunks are summarised concurrently, and reduced to one summary."""
+    messages = [SummaryMessage("alice", f"message {i}", tokens=10) for i in range(40)]
+    prompts = []
+    running = 0
+    max_running = 0
+
+    async def request(prompt: str) -> str:
+        """Record the prompt, and the number of requests running at once."""
+        nonlocal running, max_running
+        prompts.append(prompt)
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return f"summary {len(prompts)}"
+
+    summary = await map_reduce_summary(messages, request, lambda _: 1, chunk_tokens=50, max_fan_in=4, max_concurrency=3)
+
+    # 8 chunks are mapped, then reduced in groups of 4 to 2 and then 1
+    num_map = 8
+    assert len(prompts) == num_map + 2 + 1
+    assert max_running == 1 + 2
+    assert summary == f"summary {len(prompts)}"
+    assert "message 0" in prompts[0]
+    assert "Part 4" in prompts[num_map]
+
+
+@pytest.mark.asyncio
+async def test_streamed_messages_are_summarised_as_they_are_read() -> None:
+    """Test that streamed messages are chunked and reduced, with bounded reads ahead."""
+    prompts = []
+
+    async def batches() -> AsyncIterator[list[SummaryMessage]]:
+        """Yield batches of messages."""
+        for i in range(4):
+            yield [SummaryMessage("alice", f"message {i} {j}", tokens=10) for j in range(5)]
+
+    async def request(prompt: str) -> str:
+        """Record the prompt."""
+        prompts.append(prompt)
+        await asyncio.sleep(0)
+        return f"summary {len(prompts)}"
+
+    summary = await map_reduce_summary_stream(
+        batches(), request, lambda _: 1, chunk_tokens=50, max_fan_in=4, max_concurrency=2
+    )
+
+    num_map = 4
+    assert len(prompts) == num_map + 1
+    assert summary == f"summary {len(prompts)}"
+    assert (
+        await map_reduce_summary_stream(
+            batches_of([]), request, lambda _: 1, chunk_tokens=50, max_fan_in=4, max_concurrency=2
+        )
+        == ""
+    )
+
+
+async def batches_of(messages: list[SummaryMessage]) -> AsyncIterator[list[SummaryMessage]]:
+    """Yield the messages as a single batch, if there are any."""
+    if messages:
+        yield messages
@@ -0,0 +1,78 @@
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from slashbot.llm.models import TextGenerationResponse
+from slashbot.llm.telemetry import QUEUE_WAIT, Histogram, TelemetryRegistry
+from slashbot.settings import BotSettings, ModelPrice
+
+BUCKETS = (1, 2, 4)
+QUEUE_WAIT_SECONDS = 1.5
+
+
+@pytest.fixture
+def telemetry(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> TelemetryRegistry:
+    """Fixture yielding a registry which writes to a temporary database."""
+    monkeypatch.setattr(BotSettings.files, "telemetry_database", tmp_path / "telemetry.sqlite.db")
+    monkeypatch.setattr(
+        BotSettings.telemetry,
+        "model_prices",
+        {"model": ModelPrice(input=1.0, output=10.0, cached_input=0.1)},
+    )
+    return TelemetryRegistry()
+
+
+def test_histogram_quantiles_use_bucket_bounds() -> None:
+    """Test that quantiles are estimated from the fixed buckets."""
+    histogram = Histogram(BUCKETS)
+    assert histogram.quantile(0.5) is None
+    for value in (0.5, 1.5, 3, 100):
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == BUCKETS[1]
+    assert histogram.quantile(0.75) == BUCKETS[2]
+    assert histogram.quantile(1.0) == BUCKETS[2]
+    assert histogram.counts == [1] * (len(BUCKETS) + 1)
+
+
+def test_requests_are_recorded_per_model_and_channel(telemetry: TelemetryRegistry) -> None:
+    """Test that tokens, cost and queue wait are recorded, and exported for Prometheus."""
+    token = QUEUE_WAIT.set(QUEUE_WAIT_SECONDS)
+    try:
+        trace = telemetry.start_request("claude", "model", 1234, None)
+    finally:
+        QUEUE_WAIT.reset(token)
+    trace.mark_first_token()
+    telemetry.record(
+        trace, TextGenerationResponse("hi", 0, input_tokens=1_000_000, output_tokens=100_000, cached_tokens=500_000)
+    )
+    telemetry.record_failure(telemetry.start_request("claude", "model", 1234, None))
+
+    metrics = telemetry._metrics[("claude", "model", 1234)]  # noqa: SLF001
+    assert metrics.totals.requests == 1
+    assert metrics.totals.failures == 1
+    assert metrics.totals.cost == pytest.approx(0.5 + 0.05 + 1.0)
+    assert metrics.queue_wait.sum == QUEUE_WAIT_SECONDS
+    assert metrics.time_to_first_token.count == 1
+
+    assert "<#1234>" in telemetry.describe("channel")
+    exported = telemetry.to_prometheus()
+    labels = 'provider="claude",model="model",channel="1234"'
+    assert f"slashbot_llm_requests_total{{{labels}}} 1" in exported
+    assert f'slashbot_llm_request_duration_seconds_bucket{{{labels},le="+Inf"}} 1' in exported
+
+
+@pytest.mark.asyncio
+async def test_usage_is_added_to_the_database(telemetry: TelemetryRegistry) -> None:
+    """Test that each flush adds the usage since the previous flush."""
+    for _ in range(2):
+        telemetry.record(
+            telemetry.start_request("gemini", "model", None, None),
+            TextGenerationResponse("hi", 0, input_tokens=10, output_tokens=5),
+        )
+        await telemetry.flush()
+    await telemetry.flush()
+
+    with sqlite3.connect(BotSettings.files.telemetry_database) as connection:
+        rows = connection.execute("SELECT provider, channel_id, requests, input_tokens FROM llm_usage").fetchall()
+    assert rows == [("gemini", 0, 2, 20)]
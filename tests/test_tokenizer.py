@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from slashbot.llm.tokenizer import (
+    PromptTokenCache,
+    ProviderTokenizer,
+    TokenReconciler,
+    count_text_tokens,
+    summarise_payload,
+)
+
+
+def test_summarise_payload_understands_each_provider() -> None:
+    """Test that text, messages and media are found in each payload format."""
+    claude = [
+        {"role": "user", "content": [{"type": "text", "text": "hello"}, {"type": "image", "source": {"data": "AAAA"}}]},
+        {"role": "assistant", "content": [{"type": "text", "text": "hi there"}]},
+    ]
+    summary = summarise_payload(claude)
+    assert summary.text == ["hello", "hi there"]
+    assert summary.num_messages == len(claude)
+    assert summary.num_images == 1
+
+    gemini = {
+        "system_instruction": {"parts": [{"text": "be nice"}]},
+        "contents": [
+            {"role": "user", "parts": [{"file_data": {"file_uri": "https://youtu.be/x"}}, {"text": "watch this"}]}
+        ],
+        "generationConfig": {"temperature": "0.8"},
+    }
+    summary = summarise_payload(gemini)
+    assert summary.text == ["watch this", "be nice"]
+    assert summary.num_messages == 1
+    assert summary.num_videos == 1
+
+    summary = summarise_payload([{"role": "system", "content": "a prompt"}])
+    assert summary.text == ["a prompt"]
+
+
+def test_count_includes_media_and_overheads() -> None:
+    """Test that the estimate adds fixed costs for messages and images."""
+    tokenizer = ProviderTokenizer("test", image_tokens=100, message_overhead=4)
+    text_only = {"role": "user", "content": [{"type": "text", "text": "hello world"}]}
+    with_image = {"role": "user", "content": [*text_only["content"], {"type": "image"}]}
+
+    assert tokenizer.count(text_only) == count_text_tokens("hello world") + 4
+    assert tokenizer.count(with_image) == tokenizer.count(text_only) + 100
+    assert tokenizer.count("") == 0
+
+
+def test_record_usage_calibrates_scale() -> None:
+    """Test that reported usage moves the scale towards the observed ratio."""
+    tokenizer = ProviderTokenizer("test", scale=1.0, smoothing=0.5)
+    tokenizer.record_usage(100, 200)
+    assert tokenizer.scale == pytest.approx(1.5)
+    assert tokenizer.drift.samples == 1
+    assert tokenizer.drift.last_relative_error == pytest.approx(-0.5)
+
+    # Small requests are too noisy to calibrate with
+    tokenizer.record_usage(4, 10)
+    assert tokenizer.drift.samples == 1
+
+
+@pytest.mark.asyncio
+async def test_reconciler_counts_in_background() -> None:
+    """Test that submitted payloads are counted exactly and calibrate."""
+    tokenizer = ProviderTokenizer("test", smoothing=1.0)
+    counted = []
+
+    async def exact_counter(messages: str) -> int:
+        counted.append(messages)
+        return 200
+
+    reconciler = TokenReconciler(tokenizer, exact_counter, interval=0)
+    reconciler.submit("first", 100)
+    reconciler.submit("second", 100)
+    await asyncio.sleep(0.01)
+
+    assert counted == ["first", "second"]
+    assert tokenizer.scale == pytest.approx(2.0)
+
+
+def test_prompt_token_cache_counts_each_prompt_once() -> None:
+    """Test that prompts, and their variants, are counted once per model."""
+    cache = PromptTokenCache()
+    cache.add_variant_suffix(" Be brief.")
+    cache.prewarm(["model-a"], ["You are a bot."])
+    num_variants = 2
+    assert cache.misses == num_variants
+
+    assert cache.count("model-a", "You are a bot. Be brief.") == count_text_tokens("You are a bot. Be brief.")
+    assert cache.count("model-a", "You are a bot.") == count_text_tokens("You are a bot.")
+    assert cache.hits == num_variants
+
+    # A changed prompt, or another model, is a new entry
+    cache.count("model-b", "You are a bot.")
+    cache.prewarm(["model-a"], ["You are a cat."])
+    assert cache.misses == num_variants + 1 + num_variants
@@ -0,0 +1,20 @@
+import pytest
+
+from slashbot.transport import TransportRegistry
+
+
+@pytest.mark.asyncio
+async def test_clients_are_shared_and_recreated_after_close() -> None:
+    """Test that each service gets one pooled client, until it is closed."""
+    registry = TransportRegistry()
+    client = registry.get_http_client("gemini")
+    assert registry.get_http_client("gemini") is client
+    assert registry.get_http_client("weather") is not client
+
+    sdk_client = registry.get_sdk_client("gemini", lambda http_client: {"http_client": http_client})
+    assert sdk_client["http_client"] is client
+    assert registry.get_sdk_client("gemini", lambda _: {}) is sdk_client
+
+    await registry.aclose()
+    assert client.is_closed
+    assert registry.get_http_client("gemini") is not client